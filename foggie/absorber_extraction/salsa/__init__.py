@@ -12,4 +12,6 @@ from foggie.absorber_extraction.salsa.absorber_plotter import AbsorberPlotter
 
 from foggie.absorber_extraction.salsa.generate_light_rays import generate_lrays, construct_rays, random_sightlines
 
+from foggie.absorber_extraction.salsa.ray_batch import generate_lray_store, construct_ray_store, RayStore
+
 from foggie.absorber_extraction.salsa.generate_catalog import generate_catalog, get_absorbers
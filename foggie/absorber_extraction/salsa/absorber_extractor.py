@@ -20,6 +20,7 @@ from yt.data_objects.static_output import \
 
 from foggie.absorber_extraction.salsa.utils.utility_functions import ion_p_num
 from foggie.utils.consistency import min_absorber_dict
+from foggie.clouds.cloud_utils import coldens_fraction_threshold, find_runs, merge_runs, interval_sums, interval_cells
 
 class AbsorberExtractor():
     """
@@ -77,13 +78,19 @@ class AbsorberExtractor():
         between 0 and 1.
         Default: 0.8
 
+    max_gap: int, optional
+        Runs of cells above the cutoff that are separated by this many cells
+        or fewer are merged into one absorber before they are combined in the
+        SPICE method. 0 keeps every run separate.
+        Default: 0
+
     """
 
     def __init__(self, ds_filename, ray_filename,
                 ion_name='H I', cut_region_filters=None,
                 wavelength_center=None, velocity_res = 10,
                 spectacle_defaults=None, spectacle_res=None,
-                absorber_min=None, frac=0.8):
+                absorber_min=None, frac=0.8, max_gap=0):
 
 
 
@@ -97,6 +104,7 @@ class AbsorberExtractor():
         self.ion_name = ion_name
         self.cut_region_filters = cut_region_filters
         self.frac = frac
+        self.max_gap = max_gap
 
         #add ion name to list of all ions to be plotted
         self.ion_list = [ion_name]
@@ -306,50 +314,43 @@ class AbsorberExtractor():
         stats_table['wave'] = self.wavelength_center
         stats_table['redshift'] = self.ds.current_redshift
 
-        # fill table with absorber features
-        for i in range(n_abs):
-            #load data for calculating properties
-            start, end = self.spice_intervals[i]
-            stats_table.loc[i, 'interval_start'] = start
-            stats_table.loc[i, 'interval_end'] = end
-            dl = self.data['dl'][start:end].in_units('cm')
-            density = self.data[('gas', 'density')][start:end].in_units('g/cm**3')
-            tot_density = np.sum(dl*density)
-
-            #calculate column density
-            ion_field = ion_p_num(self.ion_name)
-            ion_density=self.data[ion_field][start:end].in_units('cm**-3')
-            col_density = np.sum(dl*ion_density)
-
-            stats_table.loc[i, 'col_dens'] = np.log10(col_density)
-
-            #calculate delta_v of absorber. ion col dense weighted
-            vel_los_dat = self.data['velocity_los'][start:end].in_units('km/s')
-            central_vel = np.sum(dl*ion_density*vel_los_dat)/col_density
-            stats_table.loc[i, 'delta_v'] = central_vel
-
-            #calculate velocity dispersion
-
-            # set single cell absorber to zero velocity variance
-            if end-start == 1:
-                vel_variance=np.nan
+        # fill table with absorber features, for all absorbers at once
+        starts, ends = np.array(self.spice_intervals).T
+        stats_table['interval_start'] = starts
+        stats_table['interval_end'] = ends
+        dl = np.asarray(self.data['dl'].in_units('cm'))
+        density = np.asarray(self.data[('gas', 'density')].in_units('g/cm**3'))
+        tot_density = interval_sums(dl*density, starts, ends)
+
+        #calculate column density
+        ion_field = ion_p_num(self.ion_name)
+        ion_density = np.asarray(self.data[ion_field].in_units('cm**-3'))
+        col_density = interval_sums(dl*ion_density, starts, ends)
+        stats_table['col_dens'] = np.log10(col_density)
+
+        #calculate delta_v of absorber. ion col dense weighted
+        vel_los_dat = np.asarray(self.data['velocity_los'].in_units('km/s'))
+        central_vel = interval_sums(dl*ion_density*vel_los_dat, starts, ends)/col_density
+        stats_table['delta_v'] = central_vel
+
+        #calculate velocity dispersion (weighted sample variance)
+        cells, offsets = interval_cells(starts, ends)
+        central_vel_cells = np.repeat(central_vel, ends-starts)
+        sq_dev = np.add.reduceat(dl[cells]*ion_density[cells]*(vel_los_dat[cells] - central_vel_cells)**2, offsets)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            vel_variance = col_density*sq_dev \
+                 /(col_density**2 - interval_sums((dl*ion_density)**2, starts, ends))
+        # set single cell absorber to zero velocity variance
+        vel_variance[ends-starts == 1] = np.nan
+        stats_table['vel_dispersion'] = np.sqrt(vel_variance)
+
+        #calculate other field averages. gas col density weighted
+        for fld in fields:
+            if fld in units_dict.keys():
+                fld_data = np.asarray(self.data[fld].in_units( units_dict[fld] ))
             else:
-                #weighted sample variance
-                vel_variance=col_density \
-                     *np.sum(dl*ion_density * ( vel_los_dat - self.ds.quan(central_vel, 'km/s') )**2) \
-                     /(col_density**2 - np.sum( (dl*ion_density)**2 ))
-
-            stats_table.loc[i, 'vel_dispersion'] = np.sqrt(vel_variance)
-
-            #calculate other field averages. gas col density weighted
-            for fld in fields:
-                fld_data = self.data[fld][start:end]
-                avg_fld = np.sum(dl*density*fld_data)/tot_density
-
-                if fld in units_dict.keys():
-                    stats_table.loc[i, fld] = avg_fld.in_units( units_dict[fld] )
-                else:
-                    stats_table.loc[i, fld] = avg_fld
+                fld_data = np.asarray(self.data[fld])
+            stats_table[fld] = interval_sums(dl*density*fld_data, starts, ends)/tot_density
 
         self.spice_df = stats_table
         return self.spice_df
@@ -459,10 +460,11 @@ class AbsorberExtractor():
 
         #make sure intervals have high enough col density
         final_intervals=[]
-        for b, e in all_intervals:
-            lcd = np.log10(np.sum(dl_list[b:e]*num_density[b:e]))
-            if lcd > self.absorber_min:
-                final_intervals.append((b, e))
+        if len(all_intervals) > 0:
+            starts, ends = np.array(all_intervals).T
+            with np.errstate(divide='ignore'):
+                lcd = np.log10(interval_sums(np.asarray(dl_list*num_density), starts, ends))
+            final_intervals = [all_intervals[i] for i in np.flatnonzero(lcd > self.absorber_min)]
         return final_intervals
 
     def _create_spectra(self):
@@ -496,15 +498,7 @@ class AbsorberExtractor():
 
     def _cloud_method(self, num_density_arr, coldens_fraction):
         "run the cloud method"
-        cut = 0.999
-        total = np.sum(num_density_arr)
-        ratio = 0.001
-        while ratio < coldens_fraction:
-            part = np.sum(num_density_arr[num_density_arr > cut * np.max(num_density_arr)])
-            ratio = part / total
-            cut = cut - 0.001
-
-        threshold = cut * np.max(num_density_arr)
+        threshold, num_above = coldens_fraction_threshold(num_density_arr, coldens_fraction)
 
         return threshold
 
@@ -570,74 +564,47 @@ class AbsorberExtractor():
             return curr_intervals
 
         new_intervals=prev_intervals.copy()
-        del_v = self.ds.quan(self.velocity_res, 'km/s')
+        del_v = self.velocity_res
+        prev_b = np.array([b for b, e in prev_intervals])
+        prev_e = np.array([e for b, e in prev_intervals])
+        # weights and weighted velocities for finding each piece's average velocity
+        weight = np.asarray(density_array*dl_array)
+        weight_vel = weight*np.asarray(velocity_array)
 
         #loop through current intervals
         for curr_b, curr_e in curr_intervals:
-
-            overlap_intervals=[]
-            #loop through all previous intervals
-            for b,e in prev_intervals:
-                #check if previous interval is nested in curr interval
-                if curr_b <= b and curr_e >= b:
-                    #print(f"interval ({curr_b}, {curr_e}) overlap with ", b, e)
-                    if curr_b <= e and curr_e >= e:
-                        overlap_intervals.append((b, e))
-
-                    #check if just beginning point enclose
-                    else:
-                        err_file = open("error_file.txt", 'a')
-                        err_file.write(f"{self.ray_filename} had an intersection that wasn't complete :/")
-                        err_file.close()
-                #check if just endpoint enclosed
-                elif curr_b <= e and curr_e >= e:
-                    err_file = open("error_file.txt", 'a')
+            #check which previous intervals are nested in curr interval, and
+            #whether any only partly overlap it
+            begin_in = (curr_b <= prev_b) & (curr_e >= prev_b)
+            end_in = (curr_b <= prev_e) & (curr_e >= prev_e)
+            nested = begin_in & end_in
+            if np.any(begin_in != end_in):
+                err_file = open("error_file.txt", 'a')
+                for k in range(np.count_nonzero(begin_in != end_in)):
                     err_file.write(f"{self.ray_filename} had an intersection that wasn't complete :/")
-                    err_file.close()
-
-            #
-            #
-            #This is such a mess below but it works
-            #hopefully I'll think of a much cleaner way to do this
-            #but for now this is it
-            #
-            #
+                err_file.close()
 
-            if overlap_intervals == []:
+            if not np.any(nested):
                 new_intervals.append((curr_b, curr_e))
-            else:
-
-                #collect overlap points into list
-                points = [curr_b]
-                for b, e in overlap_intervals:
-                    #print(f"curr {curr_b, curr_e} ovelaps {b, e}")
-                    new_intervals.remove((b, e))
-                    points.append(b)
-                    points.append(e)
-                points.append(curr_e)
-
-                avg_v=[]
-                for i in range(len(points)-1):
-                    pnt1, pnt2 = points[i], points[i+1]
-                    #find weighted avg velocity
-                    curr_dense = density_array[pnt1:pnt2]
-                    curr_dl = dl_array[pnt1:pnt2]
-                    vel = np.sum(curr_dense*curr_dl*velocity_array[pnt1:pnt2]) \
-                          /np.sum(curr_dense*curr_dl)
-                    avg_v.append((vel, pnt1, pnt2))
-
-                start_b = curr_b
-                for i in range(len(avg_v)-1):
-                    #if velocity difference is greater than threshold
-                    if abs(avg_v[i][0] - avg_v[i+1][0]) > del_v:
-                        #create new interval
-                        new_intervals.append((start_b, avg_v[i][2]))
-                        #change start of next interval
-                        start_b = avg_v[i+1][1]
-                    #check if this is the last two intervals to check
-                    if i == len(avg_v) -2:
-                        new_intervals.append((start_b, curr_e))
+                continue
 
+            #split curr interval into pieces at the ends of the nested intervals
+            #and find the weighted average velocity of each piece
+            order = np.argsort(prev_b[nested])
+            overlap_b = prev_b[nested][order]
+            overlap_e = prev_e[nested][order]
+            for b, e in zip(overlap_b.tolist(), overlap_e.tolist()):
+                new_intervals.remove((b, e))
+            points = np.concatenate(([curr_b], np.column_stack((overlap_b, overlap_e)).ravel(), [curr_e]))
+            with np.errstate(invalid='ignore', divide='ignore'):
+                avg_v = interval_sums(weight_vel, points[:-1], points[1:]) / \
+                        interval_sums(weight, points[:-1], points[1:])
+
+            #start a new interval wherever the velocity jumps by more than del_v
+            split = np.flatnonzero(np.abs(np.diff(avg_v)) > del_v)
+            new_starts = np.concatenate(([curr_b], points[split+1]))
+            new_ends = np.concatenate((points[split+1], [curr_e]))
+            new_intervals += list(zip(new_starts.tolist(), new_ends.tolist()))
 
         return new_intervals
 
@@ -656,24 +623,24 @@ class AbsorberExtractor():
         intervals : list of tuples
             list of the intervals defining the absorbers in this ray.
         """
-        num_density = self.data[ion_p_num(self.ion_name)].in_units("cm**(-3)")
-        in_absorber = False
-        intervals = []
-
-        #Iterate over values in field
-        for i,value in enumerate(num_density):
-            #Check if started an absorber and if above cutoff
-            if in_absorber and value < cutoff:
-                in_absorber = False
-                #add interval to list
-                intervals.append((start,i))
-            # check if just entered an absorber
-            elif not in_absorber and value >= cutoff:
-                in_absorber = True
-                start = i
-            else:
-                continue
-        #check if was still in absorber when hitting end of ray
-        if in_absorber and start != i:
-            intervals.append((start, i))
+        num_density = np.asarray(self.data[ion_p_num(self.ion_name)].in_units("cm**(-3)"))
+
+        #find runs of cells above the cutoff. An absorber still open at the
+        #end of the ray ends at (and doesn't include) the last cell, and is
+        #dropped if it only started there
+        above = num_density >= cutoff
+        #a nan cell neither starts nor ends an absorber, so it takes the state of the cell before it
+        nan_cells = np.isnan(num_density)
+        if np.any(nan_cells):
+            last_valid = np.maximum.accumulate(np.where(nan_cells, 0, np.arange(num_density.size)))
+            above = above[last_valid]
+        starts, ends = find_runs(above)
+        if self.max_gap > 0:
+            starts, ends = merge_runs(starts, ends, self.max_gap)
+        if ends.size > 0 and ends[-1] == num_density.size:
+            ends[-1] = num_density.size - 1
+            if starts[-1] == ends[-1]:
+                starts, ends = starts[:-1], ends[:-1]
+
+        intervals = list(zip(starts.tolist(), ends.tolist()))
         return intervals
@@ -15,8 +15,13 @@ from foggie.absorber_extraction.salsa.absorber_extractor import AbsorberExtracto
 from foggie.absorber_extraction.salsa.utils.collect_files import collect_files, check_rays
 from foggie.absorber_extraction.salsa.utils.utility_functions import ion_p_num
 from foggie.absorber_extraction.salsa.generate_light_rays import generate_lrays
+from foggie.absorber_extraction.salsa.ray_batch import generate_lray_store, check_ray_store, RayStore
 from foggie.utils.consistency import units_dict
-from mpi4py import MPI
+try:
+    from mpi4py import MPI
+except ImportError:
+    # only needed to make or read rays across MPI ranks; ray stores (ray_batch.py) work without it
+    MPI = None
 
 from yt.data_objects.static_output import \
     Dataset
@@ -33,7 +38,9 @@ def generate_catalog(ds_file, n_rays,
                      ftype='gas',
                      cut_region_filters=[],
                      extractor_kwargs={},
-                     units_dict={}):
+                     units_dict={},
+                     ray_store=None,
+                     nproc=1):
 
     """
     Generates a catalog of absorber properties from a given number of lightrays
@@ -109,13 +116,36 @@ def generate_catalog(ds_file, n_rays,
 
         Default: {}
 
+    ray_store: str, optional
+        path to a single file holding all the rays (see ray_batch.py). If given,
+        rays are read from or made in this file instead of one file per ray in
+        ray_directory, which needs far fewer files for large numbers of rays
+        and doesn't need MPI. Only works with method='spice'.
+        Default: None
+
+    nproc: int, optional
+        number of processes used to trace rays into the ray_store.
+        Default: 1
+
     Returns
     -------
     full_catalog: pandas.DataFrame
         pandas dataframe containing all of the absorbers extracted from all
         the lightrays. If no absorbers are found, None is returned
     """
-    comm = MPI.COMM_WORLD
+    # spectacle fits spectra made with trident from full light rays, which a ray store doesn't hold
+    if ray_store is not None and method == 'spectacle':
+        raise ValueError("method='spectacle' needs ray files; ray_store only works with method='spice'")
+
+    # ray stores can be made and read on a single node without MPI
+    if MPI is None and ray_store is None:
+        raise ImportError("generate_catalog needs mpi4py unless the rays are kept in a ray_store")
+    if MPI is None:
+        comm = None
+        rank, size = 0, 1
+    else:
+        comm = MPI.COMM_WORLD
+        rank, size = comm.rank, comm.size
 
     # check ds_file is need to load
     if isinstance(ds_file, str):
@@ -129,13 +159,19 @@ def generate_catalog(ds_file, n_rays,
         check_fields.append(ion_p_num(i))
 
     #check if rays already made
-    check = check_rays(ray_directory, n_rays, check_fields)
-    my_ray_bool = np.array([check], dtype=int)
-    ray_bool = np.array([0], dtype=int)
+    if ray_store is None:
+        check = check_rays(ray_directory, n_rays, check_fields)
+    else:
+        check = check_ray_store(ray_store, n_rays, check_fields)
+    if comm is None:
+        ray_bool = np.array([check], dtype=int)
+    else:
+        my_ray_bool = np.array([check], dtype=int)
+        ray_bool = np.array([0], dtype=int)
 
-    # share if rays made already or not
-    comm.Barrier()
-    comm.Allreduce([my_ray_bool, MPI.INT],[ray_bool, MPI.INT], op=MPI.LAND)
+        # share if rays made already or not
+        comm.Barrier()
+        comm.Allreduce([my_ray_bool, MPI.INT],[ray_bool, MPI.INT], op=MPI.LAND)
 
     print('We will use the '+method+' method to generate absorbers.')
 
@@ -145,56 +181,84 @@ def generate_catalog(ds_file, n_rays,
         if center is None:
             center=ds.domain_center
 
-        #construct random rays in ray_directory
-        generate_lrays(ds, center,
-                    n_rays, impact_param_lims[1],
-                    min_impact_param=impact_param_lims[0],
-                    length=ray_length,
-                    fld_params=field_parameters,
-                    ion_list=ion_list,
-                    fields=fields,
-                    ftype=ftype,
-                    out_dir=ray_directory)
-
-    comm.Barrier()
+        if ray_store is None:
+            #construct random rays in ray_directory
+            generate_lrays(ds, center,
+                        n_rays, impact_param_lims[1],
+                        min_impact_param=impact_param_lims[0],
+                        length=ray_length,
+                        fld_params=field_parameters,
+                        ion_list=ion_list,
+                        fields=fields,
+                        ftype=ftype,
+                        out_dir=ray_directory)
+        elif rank == 0:
+            #construct all random rays in one ray store on the first rank
+            generate_lray_store(ds, center,
+                        n_rays, impact_param_lims[1],
+                        min_impact_param=impact_param_lims[0],
+                        length=ray_length,
+                        fld_params=field_parameters,
+                        ion_list=ion_list,
+                        fields=fields,
+                        ftype=ftype,
+                        store_file=ray_store,
+                        nproc=nproc)
+
+    if comm is not None:
+        comm.Barrier()
     #Extract Absorbers
 
-    #collect and split up ray files
-    ray_files = np.array(collect_files(ray_directory, key_words=['ray']), dtype=str)
-    ray_files_split = np.array_split(ray_files, comm.size)
-    my_rays = ray_files_split[ comm.rank ]
+    if ray_store is None:
+        #collect and split up ray files
+        ray_files = np.array(collect_files(ray_directory, key_words=['ray']), dtype=str)
+        ray_files_split = np.array_split(ray_files, size)
+        my_rays = ray_files_split[ rank ]
 
-    #add directory path to rays
-    my_ray_files=[ ray_directory+'/'+r for r in my_rays ]
-
-    #create catalog for each ion
-    df_list=[]
-    for ion in ion_list:
-        #check if extractor kwargs has ion specific information
-        if ion in extractor_kwargs.keys():
-            curr_kwargs = extractor_kwargs[ion]
-        else:
-            curr_kwargs=extractor_kwargs.copy()
-
-        # setup absorber extractor
-        abs_ext = AbsorberExtractor(ds, my_ray_files[0], ion_name=ion,
-                                     cut_region_filters=cut_region_filters,
-                                     **curr_kwargs)
-
-        # get catalogs
-        my_df = get_absorbers(abs_ext, my_ray_files, method, fields=fields, units_dict=units_dict)
-        if my_df is not None:
-            df_list.append(my_df)
+        #add directory path to rays
+        my_ray_files=[ ray_directory+'/'+r for r in my_rays ]
+    else:
+        #split up the rays in the store
+        store = RayStore(ray_store, ds)
+        my_rays = np.array_split(np.arange(len(store)), size)[ rank ]
+        my_ray_files = [ store.ray(i) for i in my_rays ]
+
+    try:
+        #create catalog for each ion
+        df_list=[]
+        for ion in ion_list:
+            #check if extractor kwargs has ion specific information
+            if ion in extractor_kwargs.keys():
+                curr_kwargs = extractor_kwargs[ion]
+            else:
+                curr_kwargs=extractor_kwargs.copy()
+
+            # setup absorber extractor
+            abs_ext = AbsorberExtractor(ds, my_ray_files[0], ion_name=ion,
+                                         cut_region_filters=cut_region_filters,
+                                         **curr_kwargs)
+
+            # get catalogs
+            my_df = get_absorbers(abs_ext, my_ray_files, method, fields=fields, units_dict=units_dict)
+            if my_df is not None:
+                df_list.append(my_df)
+    finally:
+        if ray_store is not None:
+            store.close()
 
     # Return Nonetype if no absorbers found
     if df_list == []:
         my_catalog = None
     else:
         my_catalog= pd.concat(df_list, ignore_index=True)
-    comm.Barrier()
 
-    #gather all catalogs and creae one large
-    all_dfs = comm.allgather(my_catalog)
+    if comm is None:
+        all_dfs = [my_catalog]
+    else:
+        comm.Barrier()
+
+        #gather all catalogs and creae one large
+        all_dfs = comm.allgather(my_catalog)
 
     # check if any absorbers were found
     if all(v is None for v in all_dfs):
@@ -271,8 +335,10 @@ def get_absorbers(abs_extractor, ray_list, method, fields=None, units_dict=None)
 def get_ray_num(file_path):
     """
     extract the ray's number from it's file name by removing 'ray' and '.h5' as
-    well as preceding path
+    well as preceding path. Rays from a ray store already know their number.
     """
+    if not isinstance(file_path, str):
+        return file_path.ray_num
     filename = file_path.split('/')[-1]
     num = filename[3:-3]
     return num
@@ -12,7 +12,10 @@ import numpy as np
 from yt.data_objects.static_output import \
     Dataset
 
-from mpi4py import MPI
+try:
+    from mpi4py import MPI
+except ImportError:
+    MPI = None
 
 from scipy.spatial.transform import Rotation
 import matplotlib.pyplot as plt
@@ -0,0 +1,639 @@
+#
+# Batched light ray construction for salsa: traces many sightlines through the
+# dataset's cells at once and saves them all in a single ray store file
+#
+#
+import os
+import yt
+import trident
+import numpy as np
+import multiprocessing as multi
+import h5py
+
+from yt.data_objects.static_output import \
+    Dataset
+
+from foggie.absorber_extraction.salsa.utils.utility_functions import ion_p_num
+from foggie.absorber_extraction.salsa.generate_light_rays import random_sightlines
+
+# cells and sightlines shared with the worker processes, which inherit them when they fork
+_shared = {}
+
+def load_cells(ds, left_edge, right_edge, fields, ftype='gas', data_source=None):
+    """
+    Loads the leaf cells of the dataset in a box once, along with the fields
+    needed for the rays, and indexes them by refinement level so points can be
+    matched to the cell that contains them.
+
+    Parameters
+    ----------
+    ds : YT dataset
+        the dataset to take cells from
+
+    left_edge : array like
+        left edge of the box to load in code_length
+
+    right_edge : array like
+        right edge of the box to load in code_length
+
+    fields : list
+        names of the fields to load for each cell
+
+    ftype : str, optional
+        the field type of the fields.
+        Default: 'gas'
+
+    data_source : YT data object, optional
+        region to take the cells from instead of the box, i.e. ds.refine_box.
+        Rays are only traced through the cells in this region.
+        Default: None
+
+    Returns
+    --------
+    cells : dict
+        'left' and 'width' of each cell in code_length, 'fields' a dict of
+        field name to (values, units), and 'levels' the cells of each
+        refinement level sorted by their index on that level, finest first.
+    """
+    if data_source is None:
+        data_source = ds.box(left_edge, right_edge)
+
+    center = np.column_stack([data_source[('index', ax)].in_units('code_length').v for ax in 'xyz'])
+    width = np.column_stack([data_source[('index', 'd'+ax)].in_units('code_length').v for ax in 'xyz'])
+
+    cells = {'left': center - width/2., 'width': width, 'fields': {}}
+    for fld in fields:
+        values = data_source[(ftype, fld)]
+        # code units can't be read back without the dataset
+        if 'code' in str(values.units):
+            values = values.in_cgs()
+        cells['fields'][fld] = (np.asarray(values.v, dtype=np.float64), str(values.units))
+
+    # index cells on each level by the integer position of their center on that level
+    domain_left = np.asarray(ds.domain_left_edge.in_units('code_length').v, dtype=np.float64)
+    domain_width = np.asarray(ds.domain_width.in_units('code_length').v, dtype=np.float64)
+    level = np.rint(np.log2(domain_width[0]/width[:, 0])).astype(np.int64)
+    cells['levels'] = []
+    for lev in np.unique(level)[::-1]:
+        ids = np.flatnonzero(level == lev)
+        level_width = width[ids[0]]
+        dims = np.rint(domain_width/level_width).astype(np.int64)
+        index = np.floor((center[ids] - domain_left)/level_width).astype(np.int64)
+        keys = np.ravel_multi_index(index.T, dims)
+        order = np.argsort(keys)
+        cells['levels'].append((level_width, dims, keys[order], ids[order]))
+    cells['domain_left'] = domain_left
+    cells['spacing'] = width[:, 0].min()
+
+    return cells
+
+def locate_cells(points, cells):
+    """
+    Finds the cell containing each point, checking the finest level first.
+
+    Parameters
+    ----------
+    points : numpy array
+        2d array of points in code_length
+
+    cells : dict
+        cells returned by load_cells
+
+    Returns
+    --------
+    cell : numpy array
+        index of the cell containing each point, -1 if it is outside the loaded cells
+    """
+    cell = np.full(points.shape[0], -1, dtype=np.int64)
+    for level_width, dims, keys, ids in cells['levels']:
+        todo = np.flatnonzero(cell < 0)
+        if todo.size == 0:
+            break
+        index = np.floor((points[todo] - cells['domain_left'])/level_width).astype(np.int64)
+        inside = np.all((index >= 0) & (index < dims), axis=1)
+        todo, index = todo[inside], index[inside]
+        key = np.ravel_multi_index(index.T, dims)
+        pos = np.minimum(np.searchsorted(keys, key), keys.size-1)
+        found = keys[pos] == key
+        cell[todo[found]] = ids[pos[found]]
+
+    return cell
+
+def cell_crossings(start, direction, left, width):
+    """
+    Finds where each ray enters and exits a cell, as a fraction of the ray's length.
+
+    Parameters
+    ----------
+    start : numpy array
+        2d array of ray start points
+
+    direction : numpy array
+        2d array of the vectors from each ray's start point to its end point
+
+    left : numpy array
+        2d array of the left edges of the cells
+
+    width : numpy array
+        2d array of the widths of the cells
+
+    Returns
+    --------
+    t_enter : numpy array
+        where each ray enters its cell, between 0 and 1
+
+    t_exit : numpy array
+        where each ray exits its cell, between 0 and 1. t_exit <= t_enter if
+        the ray misses the cell
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t0 = (left - start)/direction
+        t1 = (left + width - start)/direction
+
+    # rays parallel to an axis are either always or never inside the cell on that axis
+    parallel = direction == 0
+    inside = (start >= left) & (start < left + width)
+    t_min = np.where(parallel, np.where(inside, -np.inf, np.inf), np.fmin(t0, t1))
+    t_max = np.where(parallel, np.where(inside, np.inf, -np.inf), np.fmax(t0, t1))
+
+    t_enter = np.clip(t_min.max(axis=1), 0., 1.)
+    t_exit = np.clip(t_max.min(axis=1), 0., 1.)
+    return t_enter, t_exit
+
+def trace_rays(start_points, end_points, cells, max_iterations=100, tolerance=1e-10):
+    """
+    Traces a batch of rays through the loaded cells together. Each ray is
+    sampled at the spacing of the finest cells to find most of the cells it
+    crosses, then any gaps left between the cells found (corners clipped
+    between samples) are sampled until every part of the ray is covered.
+
+    Parameters
+    ----------
+    start_points : numpy array
+        2d array of starting points for each ray (code_length)
+
+    end_points : numpy array
+        2d array of end points for each ray (code_length)
+
+    cells : dict
+        cells returned by load_cells
+
+    max_iterations : int, optional
+        the most times to sample gaps between cells.
+        Default: 100
+
+    tolerance : float, optional
+        gaps shorter than this fraction of the ray's length are ignored.
+        Default: 1e-10
+
+    Returns
+    --------
+    ray : numpy array
+        the ray each segment belongs to
+
+    cell : numpy array
+        the cell of each segment
+
+    t_enter : numpy array
+        start of each segment as a fraction of its ray's length
+
+    t_exit : numpy array
+        end of each segment as a fraction of its ray's length
+
+    Segments are sorted by ray then by position along the ray.
+    """
+    start_points = np.asarray(start_points, dtype=np.float64)
+    direction = np.asarray(end_points, dtype=np.float64) - start_points
+    n_rays = start_points.shape[0]
+    n_cells = cells['left'].shape[0]
+
+    #sample every ray at the spacing of the finest cells
+    length = np.linalg.norm(direction, axis=1)
+    n_samples = np.maximum(np.ceil(length/cells['spacing']).astype(np.int64), 1)
+    ray = np.repeat(np.arange(n_rays), n_samples)
+    first = np.repeat(np.cumsum(n_samples) - n_samples, n_samples)
+    t = (np.arange(ray.size) - first + 0.5)/np.repeat(n_samples, n_samples)
+    cell = locate_cells(start_points[ray] + t[:, None]*direction[ray], cells)
+    pairs = np.unique(ray[cell >= 0]*n_cells + cell[cell >= 0])
+
+    for iteration in range(max_iterations):
+        ray, cell = pairs // n_cells, pairs % n_cells
+        t_enter, t_exit = cell_crossings(start_points[ray], direction[ray], cells['left'][cell], cells['width'][cell])
+        order = np.lexsort((t_enter, ray))
+        ray, cell, t_enter, t_exit = ray[order], cell[order], t_enter[order], t_exit[order]
+
+        #find the gaps before each segment, after each ray's last segment, and along empty rays
+        is_first = np.r_[True, ray[1:] != ray[:-1]]
+        is_last = np.r_[ray[1:] != ray[:-1], True]
+        empty = np.setdiff1d(np.arange(n_rays), ray)
+        gap_ray = np.concatenate((ray, ray[is_last], empty))
+        gap_lo = np.concatenate((np.where(is_first, 0., np.r_[0., t_exit[:-1]]), t_exit[is_last], np.zeros(empty.size)))
+        gap_hi = np.concatenate((t_enter, np.ones(is_last.sum()), np.ones(empty.size)))
+        gaps = gap_hi - gap_lo > tolerance
+        if not np.any(gaps):
+            break
+
+        #sample the middle of each gap and add any cells not already found
+        t = 0.5*(gap_lo[gaps] + gap_hi[gaps])
+        gap_ray = gap_ray[gaps]
+        gap_cell = locate_cells(start_points[gap_ray] + t[:, None]*direction[gap_ray], cells)
+        new_pairs = np.setdiff1d(gap_ray[gap_cell >= 0]*n_cells + gap_cell[gap_cell >= 0], pairs)
+        if new_pairs.size == 0:
+            break
+        pairs = np.union1d(pairs, new_pairs)
+
+    #drop cells the rays only touch
+    crossed = t_exit > t_enter
+    return ray[crossed], cell[crossed], t_enter[crossed], t_exit[crossed]
+
+def _trace_batch(ray_ids):
+    """
+    traces the rays 'ray_ids' through the shared cells. Run by each worker process.
+    """
+    cells = _shared['cells']
+    ray, cell, t_enter, t_exit = trace_rays(_shared['start'][ray_ids], _shared['end'][ray_ids], cells)
+    return ray_ids, ray, cell, t_enter, t_exit
+
+def construct_ray_store(ds_file,
+        start_points,
+        end_points,
+        fld_params=None,
+        line_list=None,
+        other_fields=None,
+        ftype='gas',
+        store_file='./rays.h5',
+        impact_param=None,
+        data_source=None,
+        nproc=1,
+        batch_size=1000):
+    """
+    Construct rays given a set of starting points and end points, like
+    construct_rays, but load the cells once, trace the rays in batches, and
+    save them all in one file instead of one file per ray. Does not need MPI;
+    batches are split among 'nproc' processes on this node.
+
+    Parameters
+    ----------
+    ds_file : str or YT dataset
+        path to dataset to be used to create rays
+
+    start_points : numpy array
+        2d array of starting points for each ray (code_length)
+
+    end_points : numpy array
+        2d array of end points for each ray (code_length)
+
+    fld_params: dict, optional
+        Dictionary of parameters for the rays. Only 'bulk_velocity' is used,
+        which is subtracted when finding the line of sight velocity.
+        Default: None
+
+    line_list : list
+        list of ions to add to light rays. None defaults to
+        H I, C IV, and O VI
+
+    other_fields : list
+        other yt fields to add to light rays. None defaults
+        to density, metallicity, and temperature
+
+    ftype : str
+        The field type of the ion fields and other fields, i.e.
+        ('gas', 'H_p0_number_density').
+
+    store_file : str/path
+        the file to save all of the lightrays in
+
+    impact_param : array, optional
+        impact parameter of each ray in kpc, saved with the rays.
+        Default: None
+
+    data_source : YT data object, optional
+        region to take the cells from instead of the box around all the rays,
+        i.e. ds.refine_box.
+        Default: None
+
+    nproc : int, optional
+        number of processes to trace the rays with.
+        Default: 1
+
+    batch_size : int, optional
+        number of rays to trace together in each batch.
+        Default: 1000
+    """
+    #set file names and ion name
+    if isinstance(ds_file, str):
+        ds = yt.load(ds_file)
+    elif isinstance(ds_file, Dataset):
+        ds = ds_file
+
+    #set defaults
+    if line_list is None:
+        line_list=['H I', 'C IV', 'O VI']
+    if other_fields is None:
+        other_fields=['density', 'metallicity', 'temperature']
+    if fld_params is None:
+        fld_params = {}
+
+    start_points = np.asarray(start_points, dtype=np.float64)
+    end_points = np.asarray(end_points, dtype=np.float64)
+    n_rays = start_points.shape[0]
+
+    #load every cell any ray passes through, once
+    ray_fields = [ f if isinstance(f, str) else f[1] for f in other_fields ]
+    ray_fields += [ ion_p_num(ion) for ion in line_list ]
+    ray_fields = list(dict.fromkeys(ray_fields))
+    vel_fields = ['velocity_x', 'velocity_y', 'velocity_z']
+    load_fields = list(dict.fromkeys(ray_fields + vel_fields))
+    left_edge = np.maximum(np.minimum(start_points, end_points).min(axis=0), ds.domain_left_edge.in_units('code_length').v)
+    right_edge = np.minimum(np.maximum(start_points, end_points).max(axis=0), ds.domain_right_edge.in_units('code_length').v)
+    cells = load_cells(ds, left_edge, right_edge, load_fields, ftype=ftype, data_source=data_source)
+    velocity = np.column_stack([ds.arr(*cells['fields'][f]).in_units('km/s').v for f in vel_fields])
+    if 'bulk_velocity' in fld_params and fld_params['bulk_velocity'] is not None:
+        velocity = velocity - ds.arr(fld_params['bulk_velocity']).in_units('km/s').v
+
+    #line of sight points from end back to start, as in trident rays
+    length = ds.arr(np.linalg.norm(end_points - start_points, axis=1), 'code_length').in_units('cm').v
+    line_of_sight = (start_points - end_points)/np.linalg.norm(start_points - end_points, axis=1)[:, None]
+
+    _shared['cells'] = cells
+    _shared['start'] = start_points
+    _shared['end'] = end_points
+    batches = np.array_split(np.arange(n_rays), max(1, int(np.ceil(n_rays/batch_size))))
+
+    # Write to a temporary file then rename, so a partly-written store is never read
+    tmp_file = store_file + '.tmp%d' % (os.getpid())
+    pool = None
+    try:
+        if nproc > 1:
+            pool = multi.get_context('fork').Pool(nproc)
+            traced = pool.imap(_trace_batch, batches)
+        else:
+            traced = map(_trace_batch, batches)
+
+        with h5py.File(tmp_file, 'w') as f:
+            f.create_dataset('start', data=start_points).attrs['units'] = 'code_length'
+            f.create_dataset('end', data=end_points).attrs['units'] = 'code_length'
+            if impact_param is not None:
+                f.create_dataset('impact_parameter', data=np.asarray(impact_param)).attrs['units'] = 'kpc'
+            offsets = np.zeros(n_rays+1, dtype=np.int64)
+            units = {'l': 'cm', 'dl': 'cm', 'velocity_los': 'km/s'}
+            units.update({ fld: cells['fields'][fld][1] for fld in ray_fields })
+            for fld in units:
+                out = f.create_dataset('fields/'+fld, shape=(0,), maxshape=(None,), chunks=(65536,), dtype=np.float64)
+                out.attrs['units'] = units[fld]
+
+            n_done = 0
+            for ray_ids, ray, cell, t_enter, t_exit in traced:
+                ray_global = ray_ids[ray]
+                offsets[ray_ids+1] = np.bincount(ray, minlength=ray_ids.size)
+                values = {'l': t_enter*length[ray_global],
+                          'dl': (t_exit - t_enter)*length[ray_global],
+                          'velocity_los': np.sum(velocity[cell]*line_of_sight[ray_global], axis=1)}
+                for fld in ray_fields:
+                    values[fld] = cells['fields'][fld][0][cell]
+                for fld in values:
+                    out = f['fields/'+fld]
+                    out.resize((n_done + ray.size,))
+                    out[n_done:] = values[fld]
+                n_done += ray.size
+                print('Traced %d of %d rays' % (ray_ids[-1]+1, n_rays))
+
+            f.create_dataset('ray_offsets', data=np.cumsum(offsets))
+        os.replace(tmp_file, store_file)
+    finally:
+        # every batch has been read by now unless tracing raised, so nothing is lost by terminating
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        _shared.clear()
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+def generate_lray_store(ds, center,
+                n_rays, max_impact_param,
+                min_impact_param=0.,
+                length=200,
+                fld_params={},
+                ion_list=['H I', 'C IV', 'O VI'],
+                fields=None,
+                ftype='gas',
+                store_file='./rays.h5',
+                data_source=None,
+                nproc=1,
+                batch_size=1000):
+    """
+    Generate a sample of lightrays that randomly, uniformly cover impact
+    parameter, like generate_lrays, but save them all in the single ray store
+    'store_file' using construct_ray_store. Does not need MPI.
+
+    Parameters
+    ----------
+    ds : YT Dataset
+        already loaded YT dataset
+
+    center : arr
+        coordinates of the center of the galaxy
+
+    n_rays : int
+        number of light rays to construct
+
+    max_impact_param : float
+        maximum impact param to sample from in kpc
+
+    min_impact_param : float
+        minimum impact param to sample from in kpc
+
+    length : float
+        length of the sightline in kpc
+
+    ion_list : list
+        ions to add to lightray
+
+    fields : list
+        fields to add to lightray
+
+    ftype : str
+        The field type that ion fields will be added to, i.e.
+        ('gas', 'H_p0_number_density').
+
+    store_file : string
+        path to the file the rays will be written to
+
+    data_source : YT data object, optional
+        region to take cells from, i.e. ds.refine_box
+        Default: None
+
+    nproc : int
+        number of processes to trace rays with
+
+    batch_size : int
+        number of rays to trace together in each batch
+    """
+    start_pnts, end_pnts, imp_param = random_sightlines(ds, center,
+                                             n_rays,
+                                             max_impact_param,
+                                             min_impact_param=min_impact_param,
+                                             length=length)
+    imp_param = ds.arr(imp_param, 'code_length').in_units('kpc')
+
+    #add density field. Needed in absorber calculations
+    if fields is None:
+        construct_fields=['density']
+    else:
+        construct_fields = fields.copy()
+        if 'density' not in construct_fields:
+            construct_fields.append('density')
+
+    #add ion fields to dataset if not already there
+    trident.add_ion_fields(ds, ions=ion_list, ftype=ftype)
+
+    construct_ray_store(ds, start_pnts, end_pnts,
+                   fld_params=fld_params,
+                   line_list=ion_list,
+                   other_fields=construct_fields,
+                   ftype=ftype,
+                   store_file=store_file,
+                   impact_param=imp_param.v,
+                   data_source=data_source,
+                   nproc=nproc,
+                   batch_size=batch_size)
+
+def check_ray_store(store_file, n_rays, fields):
+    """
+    Check if a ray store already exists with a given number of rays and
+    contains the necessary fields, like check_rays does for a directory of rays.
+
+    Parameters
+    ----------
+    store_file : str
+        The path to the ray store
+
+    n_rays : int
+        The number of rays that should be in the store
+
+    fields : list, str
+        List of the fields needed in each light ray
+
+    Returns
+    --------
+    store_bool : bool
+        `True` if the store has `n_rays` rays with all the fields. `False` if
+        there is no store.
+
+    Raises
+    ------
+    RuntimeError
+        This is raised if the store exists but doesn't match the number of
+        rays or doesn't contain all the fields.
+    """
+    if not os.path.exists(store_file):
+        return False
+
+    with h5py.File(store_file, 'r') as f:
+        store_rays = f['ray_offsets'].size - 1
+        stored_fields = list(f['fields'].keys())
+    if store_rays != n_rays:
+        raise RuntimeError(f"{store_file} has {store_rays} rays, not {n_rays}")
+    for fld in fields:
+        name = fld if isinstance(fld, str) else fld[1]
+        if name not in stored_fields:
+            raise RuntimeError(f"{store_file} does not contain {fld}")
+
+    return True
+
+class RayStore():
+    """
+    Reads the rays saved by construct_ray_store. Each ray can be passed to
+    AbsorberExtractor.load_ray in place of a ray file.
+
+    Parameters
+    ----------
+    store_file : str
+        path to the ray store
+
+    ds : YT dataset, optional
+        dataset the rays were made from, used to give fields code units.
+        Default: None
+    """
+    def __init__(self, store_file, ds=None):
+        self.filename = store_file
+        self.file = h5py.File(store_file, 'r')
+        self.offsets = self.file['ray_offsets'][:]
+        self.n_rays = self.offsets.size - 1
+        self.pad = int(np.floor(np.log10(max(self.n_rays, 1)))) + 1
+        if ds is None:
+            self.arr = yt.YTArray
+        else:
+            self.arr = ds.arr
+
+    def __len__(self):
+        return self.n_rays
+
+    def ray(self, i):
+        """
+        returns the ith ray in the store
+        """
+        return StoredRay(self, i)
+
+    def read(self, fld, i):
+        """
+        returns field 'fld' along the ith ray
+        """
+        name = fld if isinstance(fld, str) else fld[1]
+        if name not in self.file['fields']:
+            raise KeyError(f"{name} is not saved in {self.filename}")
+        data = self.file['fields/'+name]
+        return self.arr(data[self.offsets[i]:self.offsets[i+1]], data.attrs['units'])
+
+    def close(self):
+        self.file.close()
+
+class StoredRay():
+    """
+    One ray in a RayStore, with the parts of a loaded trident ray that
+    AbsorberExtractor uses.
+    """
+    def __init__(self, store, i):
+        self.store = store
+        self.ray_index = i
+        self.ray_num = f"{i:0{store.pad}d}"
+        self.filename_template = f"{store.filename}:ray{self.ray_num}"
+        self.light_ray_solution = [{'start': store.arr(store.file['start'][i], 'code_length'),
+                                    'end': store.arr(store.file['end'][i], 'code_length')}]
+
+    def __repr__(self):
+        return self.filename_template
+
+    def all_data(self):
+        return StoredRayData(self)
+
+    def close(self):
+        # the store is closed by its owner
+        pass
+
+class StoredRayData():
+    """
+    The fields along a StoredRay, optionally cut down by cut_region filters
+    written the same way as for YT cut regions, i.e. "obj[('gas', 'temperature')] > 1e5"
+    """
+    def __init__(self, ray, mask=None):
+        self.ray = ray
+        self.mask = mask
+        self._fields = {}
+
+    def __getitem__(self, fld):
+        name = fld if isinstance(fld, str) else fld[1]
+        if name not in self._fields:
+            values = self.ray.store.read(name, self.ray.ray_index)
+            if self.mask is not None:
+                values = values[self.mask]
+            self._fields[name] = values
+        return self._fields[name]
+
+    def cut_region(self, filter):
+        mask = np.asarray(eval(filter, {'obj': self, 'np': np}), dtype=bool)
+        if self.mask is not None:
+            full_mask = self.mask.copy()
+            full_mask[self.mask] = mask
+            mask = full_mask
+        return StoredRayData(self.ray, mask=mask)
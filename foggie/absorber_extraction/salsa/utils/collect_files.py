@@ -8,7 +8,10 @@
 from os import listdir
 import yt
 from astropy.table import QTable, vstack
-from mpi4py import MPI
+try:
+    from mpi4py import MPI
+except ImportError:
+    MPI = None
 import pandas as pd
 import numpy as np
 
@@ -49,6 +49,7 @@ from scipy.interpolate import interp1d
 from scipy.interpolate import RegularGridInterpolator as RGI
 from scipy.interpolate import LinearNDInterpolator as LND
 from scipy.special import erf
+from scipy.sparse import csr_matrix
 from scipy.optimize import curve_fit, fminbound
 
 from astropy.io import ascii, fits
@@ -19,7 +19,7 @@ import make_mappings_grid as mmg
 # -------------------------------------------------------------------------------------------------
 def get_erf(lambda_array, height, centre, width, delta_lambda):
     '''
-    Integral of a Gaussian function; used by gauss(), to 'stick' emission lines on top of stellar spectra
+    Integral of a Gaussian function; used by gauss() and add_HII_spectra(), to 'stick' emission lines on top of stellar spectra
     '''
     return np.sqrt(np.pi / 2) * height * width * (erf((centre + delta_lambda / 2 - lambda_array) / (np.sqrt(2) * width)) - \
             erf((centre - delta_lambda / 2 - lambda_array) / (np.sqrt(2) * width))) / delta_lambda  # https://www.wolframalpha.com/input/?i=integrate+a*exp(-(x-b)%5E2%2F(2*c%5E2))*dx+from+(w-d%2F2)+to+(w%2Bd%2F2)
@@ -150,6 +150,75 @@ def get_HII_list(args):
     paramlist = pd.read_table(emission_file, delim_whitespace=True, comment='#')  # reading in the list of HII region emission fluxes
     return paramlist
 
+# -----------------------------------------------------------------------
+def add_HII_spectra(ifu, paramlist, cont_interp_func_arr, args, chunk_size=100000, nsigma=5.):
+    '''
+    Function to add the spectra (stellar continuum + emission lines) of all HII regions in paramlist to the pixel each of them falls in, a block of chunk_size HII regions at a time
+    :param paramlist: For each block, the (already spectrally binned) continuum of every HII region is scaled from the one for its age, and the emission lines of
+    every HII region are computed as a broadcast array over only the wavelength cells within nsigma Gaussian widths of each line (as the rest of each line is ~0),
+    binned spectrally and scatter-added in to the cube with np.add.at. Since spectral binning (taking the mean in each bin) is linear, this gives the
+    same cube as binning the full spectrum of each HII region, but the memory needed only scales with chunk_size, not with the number of HII regions.
+    :return: ifu (with data in ergs/s/A and counts of HII regions in each pixel)
+    '''
+    ifu.counts = np.zeros((np.shape(ifu.data)[0], np.shape(ifu.data)[1])) # to keep a tab on how many HII regions contributed to a certain pixel
+
+    # -------spectral binning of each wavelength cell, i.e. which bin it goes in and the weight that makes the bin its mean---------
+    wave_arr = ifu.base_wave_arr
+    bin_counts = np.bincount(ifu.bin_index, minlength=ifu.ndisp + 2)[1 : ifu.ndisp + 1]
+    wave_bin = ifu.bin_index - 1
+    in_bin = (wave_bin >= 0) & (wave_bin < ifu.ndisp)
+    wave_weight = np.zeros(len(wave_arr))
+    wave_weight[in_bin] = 1. / bin_counts[wave_bin[in_bin]]
+    wave_bin[~in_bin] = 0
+    empty_bins = bin_counts == 0 # the mean of no wavelength cells
+
+    # -------discarding lines whose labels are not present in HIIRegion dataframe-------
+    ifu.linelist = ifu.linelist[ifu.linelist['label'].isin(paramlist.columns)].reset_index(drop=True)
+
+    # -------binned continuum for each age, to be scaled by HII region mass, as the ones produced by SB99 was for sb99_mass; ergs/s/A-------
+    ages_rounded = np.round(paramlist['age'].values).astype(int)
+    unique_ages, age_index = np.unique(ages_rounded, return_inverse=True)
+    binned_cont = np.array([np.bincount(wave_bin, weights=cont_interp_func_arr[age](wave_arr) * wave_weight, minlength=ifu.ndisp) for age in unique_ages])
+
+    ifu.data = np.ascontiguousarray(ifu.data)
+    flat_data = ifu.data.reshape(-1) # a view of ifu.data, so adding to flat_data adds to ifu.data
+    nregions = len(paramlist)
+    for start in range(0, nregions, chunk_size):
+        block = slice(start, np.min([start + chunk_size, nregions]))
+        myprint('Particles ' + str(start + 1) + ' to ' + str(block.stop) + ' of ' + str(nregions) + '..', args)
+        x_cell = paramlist['pos_' + projection_dict[args.projection][0] + '_grid'].values[block].astype(int)
+        y_cell = paramlist['pos_' + projection_dict[args.projection][1] + '_grid'].values[block].astype(int)
+        vel_z = paramlist['vel_' + projection_dict[args.projection][2] + '_inc'].values[block]
+        mass = paramlist['mass'].values[block]
+
+        np.add.at(ifu.data, (x_cell, y_cell), binned_cont[age_index[block]] * (mass / sb99_mass)[:, None])
+        np.add.at(ifu.counts, (x_cell, y_cell), 1)
+
+        for line_index, thisline in ifu.linelist.iterrows():
+            this_flux = paramlist[thisline['label']].values[block]
+            this_wave_cen = thisline['wave_vacuum'] * (1 + vel_z / c)  # shift central wavelength wrt w0 due to LoS velocity (vel_z) of HII region as compared to systemic velocity
+            sigma = this_wave_cen * args.vel_disp / c # converting velocity dispersion (km/s) to sigma (Angstrom)
+            amplitude = this_flux / np.sqrt(2 * np.pi * sigma ** 2)  # height of Gaussian, such that area = this_flux
+            cen_index = np.clip(np.searchsorted(wave_arr, this_wave_cen, side='left'), 1, len(wave_arr) - 1) # first wavelength cell >= this_wave_cen
+            delta_wave = wave_arr[cen_index] - wave_arr[cen_index - 1]
+
+            # only the wavelength cells within nsigma of each line
+            first = np.searchsorted(wave_arr, this_wave_cen - nsigma * sigma - delta_wave / 2, side='left')
+            last = np.searchsorted(wave_arr, this_wave_cen + nsigma * sigma + delta_wave / 2, side='right')
+            window = first[:, None] + np.arange(np.max(last - first))[None, :]
+            use = window < last[:, None]
+            window = np.where(use, window, 0)
+
+            gaussian = get_erf(wave_arr[window], amplitude[:, None], this_wave_cen[:, None], sigma[:, None], delta_wave[:, None]) # compute what the gaussian should look like if the area has to be equal to the given flux
+            voxel = (x_cell[:, None] * np.shape(ifu.data)[1] + y_cell[:, None]) * ifu.ndisp + wave_bin[window]
+            np.add.at(flat_data, voxel[use], (gaussian * wave_weight[window])[use])
+
+        if args.debug: myprint('Total bolometric flux so far = ' + '%.2E'%(np.sum(ifu.data)) + ' ers/s/A, in ' + '%d'%(np.sum(ifu.counts > 0)) + ' cells', args)
+
+    ifu.data[ifu.counts > 0, :] = np.where(empty_bins, np.nan, ifu.data[ifu.counts > 0, :]) # the mean of no wavelength cells is NaN, in every cell that has HII regions
+
+    return ifu
+
 # -----------------------------------------------------------------------
 def get_ideal_datacube(args, linelist):
     '''
@@ -174,29 +243,7 @@ def get_ideal_datacube(args, linelist):
     else:
         myprint('Ideal cube file does not exist. Creating now..', args)
         cont_interp_func_arr = get_SB99continuum()
-        ifu.counts = np.zeros((np.shape(ifu.data)[0], np.shape(ifu.data)[1])) # to keep a tab on how many HII regions contributed to a certain pixel
-
-        # -------iterating over each HII region now, to compute LoS spectra (stellar continuum + nebular emission) for each-------------
-        for index, HIIregion in paramlist.iterrows():
-            age_rounded = int(round(HIIregion['age']))
-            flux = np.multiply(cont_interp_func_arr[age_rounded](ifu.base_wave_arr), (HIIregion['mass'] / sb99_mass))  # to scale the continuum by HII region mass, as the ones produced by SB99 was for sb99_mass; ergs/s/A
-
-            for line_index, thisline in ifu.linelist.iterrows():
-                try:
-                    flux = gauss(ifu.base_wave_arr, flux, thisline['wave_vacuum'], HIIregion[thisline['label']], args.vel_disp, HIIregion['vel_' + projection_dict[args.projection][2] + '_inc'])  # adding every line flux on top of continuum; gaussians are in ergs/s/A
-                except KeyError:
-                    ifu.linelist = ifu.linelist.drop(line_index)  # discarding label from linelist if it is not present in HIIRegion dataframe
-                    pass
-            ifu.linelist = ifu.linelist.reset_index(drop=True)
-
-            flux = np.array([flux[ifu.bin_index == ii].mean() for ii in range(1, len(ifu.dispersion_arr) + 1)])  # spectral smearing i.e. rebinning of spectrum                                                                                                                             #mean() is used here to conserve flux; as f is in units of ergs/s/A, we want integral of f*dlambda to be preserved (same before and after resampling)
-            # this can be checked as np.sum(f[1:]*np.diff(wavelength_array))
-            x_cell = int(HIIregion['pos_' + projection_dict[args.projection][0] + '_grid'])
-            y_cell = int(HIIregion['pos_' + projection_dict[args.projection][1] + '_grid'])
-            ifu.data[x_cell][y_cell][:] += flux  # flux is ergs/s/A
-            ifu.counts[x_cell][y_cell] += 1
-            myprint('Particle ' + str(index + 1) + ' of ' + str(len(paramlist)) + '..', args)
-            if args.debug: myprint('with bolometric flux = ' + '%.2E'%(np.sum(flux)) + ' ers/s/A, ' + ' is assigned to cell ' + str(x_cell) + ',' + str(y_cell) + ' which now has total ' + '%d'%(ifu.counts[x_cell][y_cell]) + ' star particles and total flux ' + '%.2E'%(np.sum(ifu.data[x_cell, y_cell, :])) + ' ers/s/A', args)
+        ifu = add_HII_spectra(ifu, paramlist, cont_interp_func_arr, args) # computing LoS spectra (stellar continuum + nebular emission) for all HII regions
 
         ifu.data = ifu.data / (4 * np.pi * (ifu.distance * Mpc_to_cm)**2) # converting from ergs/s/A to ergs/s/cm^2/A
         write_fitsobj(args.idealcube_filename, ifu, instrument, args, for_qfits=True) # writing into FITS file
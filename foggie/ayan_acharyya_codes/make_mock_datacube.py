@@ -15,41 +15,64 @@ from util import *
 from make_ideal_datacube import get_ideal_datacube
 
 # ---------------------------------------------------------------------
-def spatial_convolve(ideal_ifu, mock_ifu, args):
+def spatial_convolve(ideal_ifu, mock_ifu, args, max_voxels=int(5e7)):
     '''
-    Function to spatially (rebin and) convolve ideal data cube, with a given PSF, wavelength slice by wavelength slice
+    Function to spatially (rebin and) convolve ideal data cube, with a given PSF, in chunks of wavelength slices
+    All slices are rebinned at once with the rebinning matrices along each spatial axis, and each chunk of slices is convolved with a single FFT,
+    using the 2D kernel as a 3D kernel one slice thick, so every slice is convolved exactly as if it were done on its own;
+    max_voxels is the number of voxels in each chunk, to bound the memory used by the FFT
     :return: mockcube object: mock_ifu
     '''
     start_time = time.time()
 
-    wlen = np.shape(ideal_ifu.data)[2] # length of dispersion axis
-    mock_ifu.data = np.zeros((mock_ifu.box_size_in_pix, mock_ifu.box_size_in_pix, wlen))  # initialise datacube with zeroes
+    (xlen, ylen, wlen) = np.shape(ideal_ifu.data) # wlen = length of dispersion axis
+    x_matrix = get_rebin_matrix(xlen, mock_ifu.box_size_in_pix)
+    y_matrix = get_rebin_matrix(ylen, mock_ifu.box_size_in_pix)
+    rebinned_data = np.einsum('Ii,ijk,Jj->IJk', x_matrix, ideal_ifu.data, y_matrix, optimize=True)  # rebinning before convolving
+    if np.sum(ideal_ifu.data) > 0: assert np.abs(np.sum(rebinned_data) / np.sum(ideal_ifu.data) - 1) < 0.1 # as in rebin(), to check that flux is conserved
 
-    for slice in range(wlen):
-        myprint('Rebinning & convolving slice ' + str(slice + 1) + ' of ' + str(wlen) + '..', args)
-        rebinned_slice = rebin(ideal_ifu.data[:, :, slice], (mock_ifu.box_size_in_pix, mock_ifu.box_size_in_pix))  # rebinning before convolving
-        mock_ifu.data[:, :, slice] = con.convolve_fft(rebinned_slice, mock_ifu.kernel, normalize_kernel=True)  # convolving with kernel
+    kernel = np.array(mock_ifu.kernel.array)[:, :, None]
+    mock_ifu.data = np.zeros((mock_ifu.box_size_in_pix, mock_ifu.box_size_in_pix, wlen))  # initialise datacube with zeroes
+    chunk = int(np.max([1, max_voxels // (mock_ifu.box_size_in_pix + mock_ifu.ker_size) ** 2]))
+    for start in range(0, wlen, chunk):
+        myprint('Convolving slices ' + str(start + 1) + ' to ' + str(np.min([start + chunk, wlen])) + ' of ' + str(wlen) + '..', args)
+        mock_ifu.data[:, :, start : start + chunk] = con.convolve_fft(rebinned_data[:, :, start : start + chunk], kernel, normalize_kernel=True)  # convolving with kernel
 
     myprint('Completed spatial convolution in %s minutes' % ((time.time() - start_time) / 60), args)
     return mock_ifu
 
+# ---------------------------------------------------------------------
+def get_spectral_rebin_matrix(bin_index, nbins):
+    '''
+    Function to compute the sparse matrix that spectrally rebins spectra (along the last axis) by taking the mean of all wavelength cells with the same bin_index,
+    where bin_index runs from 1 to nbins (cells with any other bin_index are left out, as they lie outside the binned wavelength array)
+    :return: sparse matrix of shape (len(bin_index), nbins), and boolean array of which bins have no cells
+    '''
+    counts = np.bincount(bin_index, minlength=nbins + 2)[1 : nbins + 1]
+    use = (bin_index >= 1) & (bin_index <= nbins)
+    rows = np.where(use)[0]
+    cols = bin_index[use] - 1
+    matrix = csr_matrix((1. / counts[cols], (rows, cols)), shape=(len(bin_index), nbins))
+
+    return matrix, counts == 0
+
 # ---------------------------------------------------------------------
 def spectral_bin(mock_ifu, args):
     '''
-    Function to spectrally rebin given data cube, with a given spectral resolution, pixel by pixel
+    Function to spectrally rebin given data cube, with a given spectral resolution, all pixels at once with a sparse rebinning matrix
     :return: mockcube object: mock_ifu
     '''
     start_time = time.time()
 
     smoothed_data = mock_ifu.data # smoothed_data is only spatially smoothed but as yet spectrally unbinned
-    xlen, ylen = np.shape(smoothed_data)[0], np.shape(smoothed_data)[1]
-    mock_ifu.data = np.zeros((mock_ifu.box_size_in_pix, mock_ifu.box_size_in_pix, mock_ifu.ndisp))  # initialise datacube with zeroes
+    xlen, ylen, wlen = np.shape(smoothed_data)
+    matrix, empty_bins = get_spectral_rebin_matrix(np.asarray(mock_ifu.bin_index), len(mock_ifu.dispersion_arr))
+    myprint('Spectral rebinning ' + str(xlen * ylen) + ' pixels from ' + str(wlen) + ' to ' + str(mock_ifu.ndisp) + ' wavelength cells..', args)
 
-    for index in range(xlen*ylen):
-        i, j = int(index / ylen), int(index % ylen) # cell position
-        myprint('Spectral rebinning pixel (' + str(i) + ',' + str(j) + '), i.e. ' + str(index + 1) + ' out of ' + str(xlen * ylen) + '..', args)
-        unbinned_spectra = smoothed_data[i, j, :]
-        mock_ifu.data[i, j, :] = np.array([unbinned_spectra[mock_ifu.bin_index == ii].mean() for ii in range(1, len(mock_ifu.dispersion_arr) + 1)])  # spectral smearing i.e. rebinning of spectrum                                                                                                                             #mean() is used here to conserve flux; as f is in units of ergs/s/A, we want integral of f*dlambda to be preserved (same before and after resampling)
+    binned_data = np.asarray(smoothed_data.reshape(xlen * ylen, wlen) @ matrix)  # spectral smearing i.e. rebinning of spectrum
+    #mean() is used here to conserve flux; as f is in units of ergs/s/A, we want integral of f*dlambda to be preserved (same before and after resampling)
+    binned_data[:, empty_bins] = np.nan # mean of no cells
+    mock_ifu.data = binned_data.reshape(xlen, ylen, mock_ifu.ndisp)
 
     myprint('Completed spectral binning in %s minutes' % ((time.time() - start_time) / 60), args)
     return mock_ifu
@@ -57,38 +80,26 @@ def spectral_bin(mock_ifu, args):
 # ---------------------------------------------------------------------
 def add_noise(mock_ifu, instrument, args):
     '''
-    Function to add noise to a data cube, with a given target SNR, voxel by voxel (i.e. the noise is spatially and spectrally variable)
+    Function to add noise to a data cube, with a given target SNR, for all voxels at once (i.e. the noise is spatially and spectrally variable)
     :return: mockcube object: mock_ifu
     '''
     start_time = time.time()
 
     clean_data = mock_ifu.data # clean_data has no noise, in flux density units
-    (xlen, ylen, zlen) = np.shape(clean_data)
-    mock_ifu.data = np.zeros(np.shape(clean_data))  # initialise datacube with zeroes
-    mock_ifu.error = np.zeros(np.shape(clean_data))  # initialise datacube with zeroes
-
-    for index in range(xlen * ylen * zlen):
-        i, j, k = int(index / (ylen * zlen)), int((index / zlen) % ylen), int(index % zlen) # cell position
-        myprint('Adding noise to voxel (' + str(i) + ',' + str(j) + ',' + str(k) + '), i.e. ' + str(index + 1) + ' out of ' + str(xlen * ylen * zlen) + '..', args)
-        flux = clean_data[i, j, k]
-        wavelength = mock_ifu.dispersion_arr[k]
-        delta_lambda = mock_ifu.delta_lambda[k]
-
-        if args.debug: myprint('Deb225: flux = ' + str(flux) + ' ergs/s/cm^2/A; wavelength = ' + str(wavelength) + ' A; delta lambda = ' + str(delta_lambda) + ' A', args)
-        # compute conversion factor from flux density units to photon count (will be used to add noise), based on telescope properties
-        flux_density_to_counts = np.pi * (instrument.radius * 1e2)**2 * mock_ifu.exptime * instrument.el_per_phot * delta_lambda / (planck * (c * 1e3) / (wavelength * 1e-10))  # to bring ergs/s/A/pixel to units of counts/pixel (ADUs)
-
-        flux = flux * flux_density_to_counts  # converting flux density units to counts (photons)
+    wavelength = np.asarray(mock_ifu.dispersion_arr)
+    delta_lambda = np.asarray(mock_ifu.delta_lambda)
+    myprint('Adding noise to ' + str(np.size(clean_data)) + ' voxels..', args)
 
-        if args.debug: myprint('Deb231: flux = ' + str(flux) + ' electrons/pix; using factor = ' + str(flux_density_to_counts) + ' A.s.cm^2/ergs', args)
+    # compute conversion factor from flux density units to photon count (will be used to add noise), based on telescope properties, for each wavelength slice
+    flux_density_to_counts = np.pi * (instrument.radius * 1e2)**2 * mock_ifu.exptime * instrument.el_per_phot * delta_lambda / (planck * (c * 1e3) / (wavelength * 1e-10))  # to bring ergs/s/A/pixel to units of counts/pixel (ADUs)
 
-        absolute_noise, random_noise = get_noise_in_voxel(flux, wavelength, mock_ifu.snr, args)
-        noisyflux = flux + random_noise # adding noise to the flux, in counts unit
+    flux = clean_data * flux_density_to_counts  # converting flux density units to counts (photons)
 
-        mock_ifu.data[i, j, k] = noisyflux / flux_density_to_counts # converting counts to flux density units
-        mock_ifu.error[i, j, k] = absolute_noise / flux_density_to_counts # converting counts to flux density units; such that noisy flux spaxel = pure signal + random draw off error spaxel value
+    absolute_noise, random_noise = get_noise_in_voxel(flux, wavelength, mock_ifu.snr, args)
+    noisyflux = flux + random_noise # adding noise to the flux, in counts unit
 
-        if args.debug: myprint('Deb236: noisy flux = ' + str(noisyflux) + ' electrons/pix = ' + str(mock_ifu.data[i, j, k]) + ' ergs/s/cm^2/A', args)
+    mock_ifu.data = noisyflux / flux_density_to_counts # converting counts to flux density units
+    mock_ifu.error = absolute_noise / flux_density_to_counts # converting counts to flux density units; such that noisy flux spaxel = pure signal + random draw off error spaxel value
 
     myprint('Completed adding noise in %s minutes' % ((time.time() - start_time) / 60), args)
     return mock_ifu
@@ -96,11 +107,12 @@ def add_noise(mock_ifu, instrument, args):
 # ---------------------------------------------------------------------
 def get_noise_in_voxel(data, wavelength, target_SNR, args):
     '''
-    Function to compute the noise to add to a single voxel, given the data (flux) in photon counts, wavelength and target SNR
+    Function to compute the noise to add to a voxel (or an array of voxels), given the data (flux) in photon counts, wavelength and target SNR
     :return: initial data + randomly generated noise
     '''
     absolute_noise = data / target_SNR
-    random_noise = np.random.poisson(lam=absolute_noise ** 2, size=np.shape(data)) - absolute_noise ** 2
+    variance = np.nan_to_num(absolute_noise ** 2) # voxels with no flux (NaN) stay NaN after adding noise
+    random_noise = np.random.poisson(lam=variance, size=np.shape(data)) - absolute_noise ** 2
 
     if args.debug: myprint('Deb250: data = ' + str(data) + ' electrons; absolute_noise = ' + str(absolute_noise) + '; random noise = ' + str(random_noise) + ' electrons', args)
 
@@ -497,6 +497,26 @@ def rebin(array, dimensions=None, scale=None):
     if array.sum() > 0: assert (array.sum() < result.sum() * (1 + allowError)) & (array.sum() > result.sum() * (1 - allowError))
     return result
 
+# -----------------------------------------------------------------
+def get_rebin_matrix(old_size, new_size):
+    '''
+    Function to compute the matrix that rebins one axis of length old_size to new_size, with the same weights as rebin()
+    The weights in rebin() are a product of one weight along each axis, so rebin(array, (ny, nx)) = Ry @ array @ Rx.T,
+    where Ry = get_rebin_matrix(array.shape[0], ny) and Rx = get_rebin_matrix(array.shape[1], nx); this can rebin every slice of a cube at once
+    :return: 2D array of shape (new_size, old_size)
+    '''
+    matrix = np.zeros((new_size, old_size))
+    for i in range(old_size):
+        I, di = divmod(i * new_size, old_size)
+        I1, di1 = divmod(i + 1, old_size / float(new_size))
+        if (I1 - I == 0) | ((I1 - I == 1) & (di1 == 0)): dx = 1
+        else: dx = 1 - di1
+        I_ = np.min([new_size - 1, I + 1]) # prevent it from allocating outside the array
+        matrix[I, i] += dx
+        matrix[I_, i] += 1 - dx
+
+    return matrix
+
 # --------------------------------------------------------------------------
 def get_KD02_metallicity(photgrid):
     '''
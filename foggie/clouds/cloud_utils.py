@@ -4,37 +4,115 @@ useful stuff for cloud analysis JT090618
 import copy
 import numpy as np
 
+def find_runs(mask):
+    """ this function returns the indices where each run of True values in
+        the boolean vector mask starts and ends (one past its last cell) """
+    padded = np.concatenate(([False], np.asarray(mask, dtype=bool), [False]))
+    edges = np.flatnonzero(padded[1:] != padded[:-1])
+
+    return edges[0::2], edges[1::2]
+
+
+def merge_runs(starts, ends, max_gap):
+    """ this function merges runs (from find_runs) that are separated by
+        max_gap or fewer cells into one run """
+    starts = np.asarray(starts)
+    ends = np.asarray(ends)
+    if np.size(starts) == 0:
+        return starts, ends
+    new_run = np.concatenate(([True], starts[1:] - ends[:-1] > max_gap))
+    last_of_run = np.concatenate((new_run[1:], [True]))
+
+    return starts[new_run], ends[last_of_run]
+
+
+def interval_sums(values, starts, ends):
+    """ this function returns the sum of values[starts[i]:ends[i]] for every
+        interval i, in one pass with np.add.reduceat. Empty intervals sum
+        to zero. """
+    starts = np.asarray(starts, dtype=int)
+    ends = np.asarray(ends, dtype=int)
+    if np.size(starts) == 0:
+        return np.zeros(0)
+    values = np.concatenate((np.asarray(values, dtype=float), [0.]))
+    sums = np.add.reduceat(values, np.column_stack((starts, ends)).ravel())[0::2]
+    sums[ends <= starts] = 0.
+
+    return sums
+
+
+def interval_cells(starts, ends):
+    """ this function returns the index of every cell in the intervals
+        starts[i]:ends[i], one interval after another, and the index of the
+        first of these cells for each interval, so that per-cell values
+        gathered with the cell indices can be summed per interval with
+        np.add.reduceat """
+    starts = np.asarray(starts, dtype=int)
+    lengths = np.asarray(ends, dtype=int) - starts
+    offsets = np.cumsum(lengths) - lengths
+    cells = np.arange(np.sum(lengths)) - np.repeat(offsets - starts, lengths)
+
+    return cells, offsets
+
+
 def reduce_ion_vector(vx, ion):
     """ this function takes in two vectors for velocity and ionization
         fraction and chunks the ionization fraction into a uniform velocity
         grid. JT 082018"""
     v = np.arange(3001) - 1500
-    ion_hist = v * 0.
-    index = np.clip(np.around(vx) + 1500, 0, 2999)
-    for i in np.arange(np.size(ion)):
-        ion_hist[int(index[i])] = ion_hist[int(
-            index[i])] + ion[int(i)]
+    index = np.clip(np.around(np.asarray(vx)) + 1500, 0, 2999).astype(int)
+    ion_hist = np.bincount(index, weights=np.asarray(ion, dtype=float), minlength=np.size(v))
 
     return v, ion_hist
 
 
-def get_fion_threshold(ion_to_use, coldens_fraction):
-    cut = 0.999
-    total = np.sum(ion_to_use)
-    ratio = 0.001
-    while ratio < coldens_fraction:
-        part = np.sum(
-            ion_to_use[ion_to_use > cut * np.max(ion_to_use)])
-        ratio = part / total
-        cut = cut - 0.001
-
-    threshold = cut * np.max(ion_to_use)
-    number_of_cells_above_threshold = np.size(
-        np.where(ion_to_use > threshold))
+def _make_cuts():
+    """ the sequence of cuts (as fractions of the maximum) that the stepwise
+        search tries, lowering the cut by 0.001 each step down to where every
+        cell is above it, built the same way the stepwise loop builds them"""
+    cuts = [0.999]
+    while cuts[-1] > -0.001:
+        cuts.append(cuts[-1] - 0.001)
+    return np.array(cuts)
+
+_cuts = _make_cuts()
+
+
+def coldens_fraction_threshold(ion_to_use, coldens_fraction):
+    """ this function finds the threshold in ion_to_use above which the cells
+        hold at least coldens_fraction of the total. It gives the same answer as
+        lowering a cut from 0.999 of the maximum in steps of 0.001 until the
+        cells above it hold coldens_fraction of the total, and returning the
+        next cut down, but sorts ion_to_use once instead of summing it at every
+        step. Returns the threshold and the number of cells above it. Masked
+        cells of a masked array are left out, as np.sum leaves them out."""
+    values = np.sort(np.asarray(ion_to_use)[~np.ma.getmaskarray(ion_to_use)])
+    if coldens_fraction <= 0.001:
+        threshold = _cuts[0] * values[-1]
+        return threshold, np.size(values) - np.searchsorted(values, threshold, side='right')
+
+    # sum of everything above each cut, summed from the top down so the sums
+    # of the few largest cells don't lose precision against the total
+    above_sums = np.concatenate((np.cumsum(values[::-1])[::-1], [0.]))
+    total = above_sums[0]
+    thresholds = _cuts * values[-1]
+    num_below = np.searchsorted(values, thresholds, side='right')
+    ratios = above_sums[num_below] / total
+    reached = np.flatnonzero(ratios >= coldens_fraction)
+    if np.size(reached) == 0:
+        step = len(_cuts) - 2
+    else:
+        step = reached[0]
+    threshold = _cuts[step+1] * values[-1]
+    number_of_cells_above_threshold = np.size(values) - np.searchsorted(values, threshold, side='right')
 
     return threshold, number_of_cells_above_threshold
 
 
+def get_fion_threshold(ion_to_use, coldens_fraction):
+    return coldens_fraction_threshold(ion_to_use, coldens_fraction)
+
+
 def get_sizes(ray_df, species, x, axis_to_use, ion_to_use, coldens_threshold):
 
     threshold, number_of_cells = get_fion_threshold(
@@ -49,57 +127,30 @@ def get_sizes(ray_df, species, x, axis_to_use, ion_to_use, coldens_threshold):
     # insert a cloud flag vector that IDs the cloud
     cloud_flag = np.zeros(np.size(dx), dtype=np.int8)
 
-    indexsizes = []
-    kpcsizes = []
-    column_densities = []
-    masses = []
-    centers = []
-    velocities = []
-    indices = []
-    xs = []
-    for m in np.arange(100):  # can find up to 100 peaks
-        i = np.squeeze(np.where(np.array(ion_to_use) > threshold))
-
-        if np.size(i) >= 1:
-            startindex = np.min(i)
-            f = ion_to_use[startindex]
-            index = startindex
-            ion_to_use[startindex] = 0.0
-            sum_mass = cell_mass[startindex]
-            sum_coldens = ion_density[startindex] * dx[index]
-            count = 0
-            velsum = 0.
-            while (f > threshold) and (index < np.size(x)-1):
-                count += 1
-                cloud_flag[index] = m+1 # place cloud number in flag vector
-                if (count > 10000):
-                    os.sys.exit('stuck in the size finding loop')
-                index += 1
-                if index == np.size(x):  # this means we're at the edge
-                    index = np.size(x)-1
-                    f = 0.0
-                else:
-                    f = ion_to_use[index]
-                    ion_to_use[index] = 0.0
-                    sum_mass = sum_mass + cell_mass[index]
-                    velsum = velsum + \
-                        cell_mass[index] * axis_velocity[index]
-                    sum_coldens = sum_coldens + \
-                        ion_density[index] * dx[index]
-
-            x_coord = x[startindex:index]
-            ion_d = ion_density[startindex:index]
-            ion_center = np.sum(x_coord * ion_d) / np.sum(ion_d)
-
-            indexsizes.append(index - startindex)
-            kpcsizes.append(x[startindex]-x[index])
-            column_densities.append(sum_coldens)
-            masses.append(sum_mass)
-            # should end up with mass-weighted velocity along LOS
-            velocities.append(velsum / sum_mass)
-            centers.append(ion_center)
-            indices.append(index)
-            xs.append(x[index])
+    # each cloud is a run of cells above the threshold (up to 100 of them),
+    # whose sums also take in the first cell after the run (or the last cell
+    # of the ray); the mass-weighted velocity leaves out the first cell
+    starts, run_ends = find_runs(np.array(ion_to_use) > threshold)
+    starts = starts[:100]
+    index = np.minimum(run_ends[:100], np.size(x)-1)
+    for m in range(np.size(starts)):
+        cloud_flag[starts[m]:index[m]] = m+1 # place cloud number in flag vector
+
+    masses = interval_sums(cell_mass, starts, index+1)
+    column_densities = interval_sums(ion_density * dx, starts, index+1)
+    velsums = interval_sums(cell_mass * axis_velocity, starts+1, index+1)
+    ion_centers = interval_sums(x * ion_density, starts, index) / \
+        interval_sums(ion_density, starts, index)
+
+    indexsizes = list(index - starts)
+    kpcsizes = list(x[starts] - x[index])
+    column_densities = list(column_densities)
+    # should end up with mass-weighted velocity along LOS
+    velocities = list(velsums / masses)
+    centers = list(ion_centers)
+    indices = list(index)
+    xs = list(x[index])
+    masses = list(masses)
 
     size_dict = {'coldens_threshold': coldens_threshold}
     size_dict[species+'_xs'] = xs
@@ -8,12 +8,14 @@ from foggie.utils.consistency import axes_label_dict, logfields, categorize_by_t
     categorize_by_metals, categorize_by_fraction
 from foggie.utils.yt_fields import *
 from foggie.utils.foggie_load import *
+from foggie.utils.grid_cache import cached_covering_grid
 import seaborn as sns
 
-def function_for_edges(ds, trackfile, refine_box, box_size = 400., sampling_level = 9): 
+def function_for_edges(ds, trackfile, refine_box, box_size = 400., sampling_level = 9, grid_cache = None): 
     
     # this function creates the basic dictionary containting stuff derived from the dataset 
     # and the dictionary we'll use but none of the region screening 
+    # if grid_cache is a directory, the covering grid fields are saved there and reused by later calls (see utils/grid_cache.py)
 
     pix_res = float(np.min(refine_box[('gas','dx')].in_units('kpc')))  # cell size at highest AMR level 
 
@@ -27,9 +29,9 @@ def function_for_edges(ds, trackfile, refine_box, box_size = 400., sampling_leve
 
     print("function_for_edges: creating covering grid of dimension ", refine_res, " on a side.")
 
-    box = ds.covering_grid(level=sampling_level, \
-                       left_edge=ds.halo_center_kpc-ds.arr([box_size/2.,box_size/2.,box_size/2.],'kpc'), 
-                       dims=[refine_res, refine_res,refine_res])
+    box = cached_covering_grid(ds, sampling_level, \
+                       ds.halo_center_kpc-ds.arr([box_size/2.,box_size/2.,box_size/2.],'kpc'), 
+                       [refine_res, refine_res,refine_res], cache_dir=grid_cache)
    
     print("function for edges: assembling output dictionary")
 
@@ -14,6 +14,10 @@ utils/get_run_loc_etc.py
 utils/yt_fields.py
 utils/foggie_load.py
 utils/analysis_utils.py
+utils/snapshot_scheduler.py
+utils/halo_catalog.py
+utils/grid_cache.py
+utils/tiled_grid.py
 """
 
 # Import everything as needed
@@ -47,6 +51,10 @@ from foggie.utils.get_run_loc_etc import get_run_loc_etc
 from foggie.utils.yt_fields import *
 from foggie.utils.foggie_load import *
 from foggie.utils.analysis_utils import *
+from foggie.utils.snapshot_scheduler import run_snapshots
+from foggie.utils.halo_catalog import lookup_masses, lookup_rvir
+from foggie.utils.grid_cache import cached_covering_grid
+from foggie.utils.tiled_grid import tiled_covering_grid, gaussian_smoothing_kernel, binning_kernel
 
 # These imports for datashader plots
 import datashader as dshader
@@ -144,6 +152,21 @@ def parse_args():
                         'Default is level 9 (forced refinement level).')
     parser.set_defaults(level=9)
 
+    parser.add_argument('--grid_cache', metavar='grid_cache', type=str, action='store', \
+                        help='If you want to save the fields taken from the covering grid to disk so later runs\n' + \
+                        'on the same snapshot (of this or other scripts) can read them back instead of making the\n' + \
+                        'grid again, give the directory to save them in here. Default is not to do this.')
+    parser.set_defaults(grid_cache='none')
+
+    parser.add_argument('--tile_size', metavar='tile_size', type=int, action='store', \
+                        help='If the grid at the requested --level is too big to fit in memory, give a number of\n' + \
+                        'cells here and the grid will be made in cubes of this many cells on a side and saved to\n' + \
+                        'the --grid_cache directory (or a grid_cache directory in the output directory if\n' + \
+                        '--grid_cache is not given), then read back from disk as it is used. Fluxes are then summed\n' + \
+                        'one cube at a time, unless the accretion_viz or accretion_direction plots are made.\n' + \
+                        'Default is 0, which makes the whole grid at once.')
+    parser.set_defaults(tile_size=0)
+
     parser.add_argument('--nproc', metavar='nproc', type=int, action='store', \
                         help='How many processes do you want? Default is 1 ' + \
                         '(no parallelization), if multiple outputs and multiple processors are' + \
@@ -170,11 +193,23 @@ def parse_args():
                         'accretion_vs_radius    - line plot of various properties of accreting gas vs radius\n' + \
                         'flux_vs_radius         - line plot of accreting mass and metal fluxes vs radius\n' + \
                         'phase_plot             - 2D phase plots of various properties of accreting gas and non-accreting gas in same shell\n' + \
-                        'sky_map                - column density maps of all gas and only accreting gas\n' + \
+                        'sky_map                - column density maps of all gas and only accreting gas (see --sky_map_ions and --sky_map_cuts)\n' + \
                         'streamlines            - projection plots with streamlines overplotted\n' + \
                         'Default is not to do any plotting. Specify multiple plots by listing separated with commas, no spaces.')
     parser.set_defaults(plot='none')
 
+    parser.add_argument('--sky_map_ions', metavar='sky_map_ions', type=str, action='store', \
+                        help='If plotting sky_map, which ions do you want column density maps of? Give ions in\n' + \
+                        'trident notation (e.g. H_p0 for H I, O_p5 for O VI) separated by commas, no spaces.\n' + \
+                        'Default is H_p0.')
+    parser.set_defaults(sky_map_ions='H_p0')
+
+    parser.add_argument('--sky_map_cuts', metavar='sky_map_cuts', type=str, action='store', \
+                        help='If plotting sky_map, which gas do you want maps of? Options are all (all gas),\n' + \
+                        'acc (only accreting gas, with radial velocity < 1.2 vff), and out (only non-accreting gas).\n' + \
+                        'Give multiple separated by commas, no spaces. Default is all,acc.')
+    parser.set_defaults(sky_map_cuts='all,acc')
+
     parser.add_argument('--dark_matter', dest='dark_matter', action='store_true', \
                         help='Do you want to calculate fluxes and/or make plots for dark matter too?\n' + \
                         'This is very slow, so the default is not to do this.')
@@ -230,6 +265,21 @@ def parse_args():
                              'of the starting output here. If no filename is passed, a new calculation will be started.')
     parser.set_defaults(streamline_file='none')
 
+    parser.add_argument('--retries', metavar='retries', type=int, action='store', \
+                        help='If running in parallel, how many times do you want to retry a snapshot that fails? Default is 2.')
+    parser.set_defaults(retries=2)
+
+    parser.add_argument('--mem_per_snap', metavar='mem_per_snap', type=float, action='store', \
+                        help='If running in parallel, how much memory (in GB) does one snapshot need? If given, fewer\n' + \
+                        'than nproc snapshots will be run at once if the node does not have enough memory available.\n' + \
+                        'Default is not to limit by memory.')
+    parser.set_defaults(mem_per_snap=0.)
+
+    parser.add_argument('--resume', dest='resume', action='store_true', \
+                        help='Do you want to skip snapshots that were already finished by a previous run that was\n' + \
+                        'interrupted? Default is no, start over with all snapshots.')
+    parser.set_defaults(resume=False)
+
 
     args = parser.parse_args()
     return args
@@ -597,9 +647,36 @@ def plot_accretion_direction(theta_acc, phi_acc, temperature, metallicity, radia
     plt.savefig(prefix + 'Plots/' + snap + '_accretion-direction_metal-mass-colored' + save_r + save_dv + save_suffix + '.png')
     plt.close()
 
+def healpix_sum(pixels, values, npix):
+    '''Returns the sum of 'values' in each of the 'npix' healpix pixels, where 'pixels' is the pixel
+    number of each value, and the number of values in each pixel.'''
+
+    return np.bincount(pixels, weights=values, minlength=npix), np.bincount(pixels, minlength=npix)
+
+def clip_and_smooth_map(m, neighbors):
+    '''Takes a healpix map of log column densities 'm' and the array of the neighbors of every pixel
+    'neighbors' (from healpy.get_all_neighbours, with -1 for a missing neighbor), sets any pixel that
+    is more than 3 sigma from the median of its neighbors to that median, and then replaces every
+    pixel with the mean of its neighbors. Returns the new map.
+
+    Each step uses the neighbor values from before that step for every pixel. Older versions of this
+    script updated the map in place one pixel at a time, so later pixels saw their already-clipped or
+    already-smoothed neighbors, and maps made with them differ slightly from maps made with this.'''
+
+    has_neighbor = (neighbors >= 0)
+    neighbor_vals = np.where(has_neighbor, 10**m[neighbors], np.nan)
+    std = np.nanstd(neighbor_vals, axis=0)
+    med = np.nanmedian(neighbor_vals, axis=0)
+    outlier = (10**m > med + 3.*std) | (10**m < med - 3.*std)
+    m = np.where(outlier, np.log10(med), m)
+
+    neighbor_vals = np.where(has_neighbor, 10**m[neighbors], np.nan)
+    return np.log10(np.nanmean(neighbor_vals, axis=0))
+
 def sky_map(ds, sp, snap, snap_props):
-    '''Makes a sky map of column densities as viewed from the center of the galaxy for all gas and
-    only accreting gas.'''
+    '''Makes sky maps of column densities of the ions in --sky_map_ions as viewed from the center of
+    the galaxy, for each of the gas selections in --sky_map_cuts (all gas, only accreting gas, or only
+    non-accreting gas).'''
 
     prefix = output_dir + 'projections_halo_00' + args.halo + '/' + args.run + '/'
     Menc_profile, Mvir, Rvir = snap_props
@@ -610,69 +687,142 @@ def sky_map(ds, sp, snap, snap_props):
     trident.add_ion_fields(ds, ions='all', ftype='gas')
 
     # Load grid properties
-    radius = sp['gas','radius_corrected'].in_units('cm').v
     theta = sp['gas','theta_pos_disk'].v*(180./np.pi)
     phi = sp['gas','phi_pos_disk'].v*(180./np.pi)
-    mass = sp['gas','cell_mass'].in_units('g').v
     rv = sp['gas','radial_velocity_corrected'].in_units('km/s').v
     vff = sp['gas','vff'].in_units('km/s').v
-    density = sp['gas','density'].in_units('g/cm**3').v
     dx = sp['gas','dx'].in_units('cm').v
-    NHI = sp['gas','H_p0_number_density'].in_units('cm**-3').v
 
-    for i in ['all','acc']:
-        if (i=='acc'):
-            accreting = (rv < 1.2*vff)
+    # Every map uses the same pixels and neighbors, so find them once
+    nside = 2**6
+    npix = healpy.nside2npix(nside)
+    pixels = healpy.ang2pix(nside, phi*(np.pi/180.), theta*(np.pi/180.)+np.pi)
+    neighbors = healpy.get_all_neighbours(nside, np.arange(npix))
+    cuts = {'all': np.ones(np.shape(theta), dtype=bool), 'acc': (rv < 1.2*vff), 'out': (rv >= 1.2*vff)}
+    numerals = ['I','II','III','IV','V','VI','VII','VIII','IX','X']
+
+    ions = args.sky_map_ions.split(',')
+    for ion in ions:
+        col_den = sp['gas', ion + '_number_density'].in_units('cm**-3').v*dx
+        element, state = ion.split('_p')
+        ion_label = element + ' ' + numerals[int(state)]
+        if (ion=='H_p0'):
+            ion_save = ''
         else:
-            accreting = np.ones(np.shape(theta), dtype=bool)
+            ion_save = ion + '_'
+        for i in args.sky_map_cuts.split(','):
+            pix_col_den, pix_count = healpix_sum(pixels[cuts[i]], col_den[cuts[i]], npix)
+            m = np.zeros(npix)              # make empty array of map pixels
+            m[pix_count>0] = np.log10(pix_col_den[pix_count>0])
+            m = clip_and_smooth_map(m, neighbors)
+
+            fig1 = plt.figure(num=1, figsize=(10,6), dpi=300)
+            #cmap = density_color_map
+            cmap = sns.blend_palette(("black","#4575b4", "#984ea3", "#d73027","darkorange", "#ffe34d"), as_cmap=True)
+            if (ion=='H_p0'):
+                cmin = 12
+                cmax = 22
+            else:
+                cmin = np.floor(np.nanpercentile(m[m>0], 1))
+                cmax = np.ceil(np.nanpercentile(m[m>0], 99))
+            if (i=='all'):
+                title = 'All gas'
+            elif (i=='acc'):
+                title = 'Only accreting gas'
+            else:
+                title = 'Only non-accreting gas'
+            healpy.mollview(m, fig=1, cmap=cmap, min=cmin, max=cmax, title=title, unit='log ' + ion_label + ' Column Density [cm$^{-2}$]')
+            healpy.graticule()
+            plt.savefig(prefix + snap + '_' + ion_save + 'col-den-map_' + i + save_suffix + '.png')
+            plt.close()
 
-        radius_plot = radius[accreting]
-        theta_plot = theta[accreting]
-        phi_plot = phi[accreting]
-        density_plot = density[accreting]
-        dx_plot = dx[accreting]
-        NHI_plot = NHI[accreting]
+def flux_bin_index(disp_vel, disp_vel_bins, phi=None, filter=None, regions=None):
+    '''Returns the combined bin number of every cell (or particle), made from its bin in displacement
+    velocity 'disp_vel' (bin edges 'disp_vel_bins'), its angle bin (major axis for 60 <= 'phi' <= 120,
+    minor axis otherwise), and its bin in the region filter 'filter' (bin edges 'regions'), and the
+    shape of the bins. The last bin of each axis holds anything that is in none of the other bins of
+    that axis, so summing over an axis gives the total regardless of that binning.'''
+
+    n_dv = len(disp_vel_bins)-1
+    dv_index = np.digitize(disp_vel, disp_vel_bins) - 1
+    dv_index[(dv_index < 0) | (dv_index >= n_dv)] = n_dv
+    angle_index = np.full(np.shape(disp_vel), 2)
+    if (phi is not None):
+        angle_index[(phi >= 60.) & (phi <= 120.)] = 0
+        angle_index[(phi < 60.) | (phi > 120.)] = 1
+    if (filter is not None):
+        n_reg = len(regions)-1
+        region_index = np.full(np.shape(disp_vel), n_reg)
+        for j in range(n_reg):
+            region_index[(filter > regions[j]) & (filter < regions[j+1])] = j
+    else:
+        n_reg = 0
+        region_index = np.zeros(np.shape(disp_vel), dtype=int)
+    bin_shape = (n_dv+1, 3, n_reg+1)
 
-        fig1 = plt.figure(num=1, figsize=(10,6), dpi=300)
-        nside = 2**6
-        npix = healpy.nside2npix(nside)
-        pix_area = healpy.nside2pixarea(nside)
-        pixels = healpy.ang2pix(nside, phi_plot*(np.pi/180.), theta_plot*(np.pi/180.)+np.pi)
-        uniq, dup_ind = np.unique(pixels, return_index=True)
-        #col_den = density_plot*dx_plot/mp
-        col_den = NHI_plot*dx_plot
-        m = np.zeros(healpy.nside2npix(nside))              # make empty array of map pixels
-        npix = np.zeros(healpy.nside2npix(nside))
-        for u in uniq:
-            pix_col_den = np.sum(col_den[(pixels==u)])
-            m[u] = np.log10(pix_col_den)
-            npix[u] = len(col_den[(pixels==u)])
-
-        # If a pixel is an outlier from its neighbors, set it to the median value of the neighbors
-        for pix in range(len(m)):
-            neighbors = healpy.get_all_neighbours(nside, pix)
-            std = np.std(10**m[neighbors])
-            med = np.median(10**m[neighbors])
-            if (10**m[pix]>(med+3.*std)) or (10**m[pix]<(med-3.*std)):
-                m[pix] = np.log10(med)
-
-        # Smooth over neighbors
-        for pix in range(len(m)):
-            neighbors = healpy.get_all_neighbours(nside, pix)
-            m[pix] = np.log10(np.mean(10**m[neighbors]))
-
-        #cmap = density_color_map
-        cmap = sns.blend_palette(("black","#4575b4", "#984ea3", "#d73027","darkorange", "#ffe34d"), as_cmap=True)
-        cmin = 12
-        cmax = 22
-        if (i=='all'):
-            title = 'All gas'
-        else:
-            title = 'Only accreting gas'
-        healpy.mollview(m, fig=1, cmap=cmap, min=cmin, max=cmax, title=title, unit='log H I Column Density [cm$^{-2}$]')
-        healpy.graticule()
-        plt.savefig(prefix + snap + '_col-den-map_' + i + save_suffix + '.png')
-        plt.close()
+    return np.ravel_multi_index((dv_index, angle_index, region_index), bin_shape), bin_shape
+
+def crossing_sums(bin_index, bin_shape, to_shape, from_shape, properties):
+    '''Returns a list with an array for each array in 'properties' of the sums of that property in
+    each bin of 'bin_index' (from flux_bin_index), over the cells entering the shape ('to_shape', first
+    index 0) and leaving the shape ('from_shape', first index 1).'''
+
+    n_bins = np.prod(bin_shape)
+    crossing = to_shape | from_shape
+    index = bin_index[crossing] + n_bins*from_shape[crossing]
+    sums = []
+    for prop in properties:
+        sums.append(np.bincount(index, weights=prop[crossing], minlength=2*n_bins).reshape((2,) + bin_shape))
+
+    return sums
+
+def displaced_cells(x, y, z, vx, vy, vz, vff, xbins, ybins, zbins):
+    '''Returns the indices on the grid with cell edges 'xbins', 'ybins', 'zbins' of where each cell at
+    'x', 'y', 'z' moves to with velocity 'vx', 'vy', 'vz' over a long elapsed time (necessary because
+    digitizing onto grid can "reset" positions of slow-moving gas), and its displacement velocity as a
+    fraction of the free-fall velocity 'vff'.'''
+
+    new_x = vx*(5.*dt) + x
+    new_y = vy*(5.*dt) + y
+    new_z = vz*(5.*dt) + z
+    displacement = np.sqrt((new_x-x)**2. + (new_y-y)**2. + (new_z-z)**2.)
+    displacement_vel = displacement*1000.*cmtopc/(5.*dt*stoyr)/1e5
+    displacement_vel = np.abs(displacement_vel/vff)
+    inds_x = np.digitize(new_x, xbins)-1      # indices of new x positions
+    inds_y = np.digitize(new_y, ybins)-1      # indices of new y positions
+    inds_z = np.digitize(new_z, zbins)-1      # indices of new z positions
+
+    return (inds_x, inds_y, inds_z), displacement_vel
+
+def flux_properties(get_field, Menc_profile):
+    '''Returns the list of the gas properties whose fluxes calculate_flux finds, in the order of its
+    table, where get_field(field, units) returns the field 'field' in the units 'units' from the grid
+    or from one tile of it.'''
+
+    properties = []
+    if ('mass' in flux_types):
+        properties.append(get_field('cell_mass', 'Msun'))
+        properties.append(get_field('metal_mass', 'Msun'))
+    if ('energy' in flux_types):
+        radius = get_field('radius_corrected', 'kpc')
+        cell_mass = get_field('cell_mass', 'g')
+        kinetic_energy = get_field('kinetic_energy_corrected', 'erg')
+        thermal_energy = cell_mass*get_field('thermal_energy', 'erg/g')
+        potential_energy = -G * Menc_profile(radius)*gtoMsun / (radius*1000.*cmtopc)*cell_mass
+        bernoulli_energy = kinetic_energy + 5./3.*thermal_energy + potential_energy
+        cooling_energy = thermal_energy/get_field('cooling_time', 'yr')
+        properties += [thermal_energy, kinetic_energy, potential_energy, bernoulli_energy, cooling_energy]
+
+    return properties
+
+def tile_field(data, field, units):
+    '''Returns the field 'field' from the dictionary 'data' of the arrays of a tile made by make_grid
+    (which are in the units in grid_units) in the units 'units'.'''
+
+    values = data['gas', field]
+    if (units==grid_units[field]):
+        return values
+    return values*yt.YTQuantity(1., grid_units[field]).in_units(units).v
 
 def calculate_flux(ds, grid, shape, snap, snap_props):
     '''Calculates the flux into and out of the specified shape at the snapshot 'snap' and saves to file.'''
@@ -711,36 +861,50 @@ def calculate_flux(ds, grid, shape, snap, snap_props):
             density_cut_factor = 1. - 0.9*(current_time-8656.88)/2130.24
         else:
             density_cut_factor = 0.1
-        cgm_bool = (grid['gas','density'].in_units('g/cm**3').v < density_cut_factor * cgm_density_max)
+        cgm_bool = (grid_field(grid, 'density', 'g/cm**3') < density_cut_factor * cgm_density_max)
     else:
-        cgm_bool = (grid['gas','density'].in_units('g/cm**3').v > 0.)
+        cgm_bool = (grid_field(grid, 'density', 'g/cm**3') > 0.)
     shape = shape & cgm_bool
 
+    # Unless the plots need the properties of every cell, a grid made in tiles is read back one tile at
+    # a time and only the binned fluxes are summed, so the whole grid is never in memory
+    tiled = (args.tile_size > 0) and ('accretion_viz' not in plots) and ('accretion_direction' not in plots)
+
     # Load grid properties
-    x = grid['gas', 'x'].in_units('kpc').v - ds.halo_center_kpc[0].v
-    y = grid['gas', 'y'].in_units('kpc').v - ds.halo_center_kpc[1].v
-    z = grid['gas', 'z'].in_units('kpc').v - ds.halo_center_kpc[2].v
-    xbins = x[:,0,0][:-1] - 0.5*np.diff(x[:,0,0])
-    ybins = y[0,:,0][:-1] - 0.5*np.diff(y[0,:,0])
-    zbins = z[0,0,:][:-1] - 0.5*np.diff(z[0,0,:])
-    vx = grid['gas','vx_corrected'].in_units('kpc/yr').v
-    vy = grid['gas','vy_corrected'].in_units('kpc/yr').v
-    vz = grid['gas','vz_corrected'].in_units('kpc/yr').v
-    radius = grid['gas','radius_corrected'].in_units('kpc').v
-    rv = grid['gas','radial_velocity_corrected'].in_units('km/s').v
-    vff = grid['gas','vff'].in_units('km/s').v
-    if (args.direction) or ('disk' in surface[0]) or ('accretion_direction' in plots):
-        theta = grid['gas','theta_pos_disk'].v*(180./np.pi)
-        phi = grid['gas','phi_pos_disk'].v*(180./np.pi)
-    if ('accretion_viz' in plots) or ('accretion_direction' in plots):
-        temperature = grid['gas','temperature'].in_units('K').v
-        density = grid['gas','density'].in_units('g/cm**3').v
-        tcool = grid['gas','cooling_time'].in_units('Myr').v
-        metallicity = grid['gas', 'metallicity'].in_units('Zsun').v
+    x_cells = grid_field(grid, 'x', 'kpc')[:,0,0] - ds.halo_center_kpc[0].v
+    y_cells = grid_field(grid, 'y', 'kpc')[0,:,0] - ds.halo_center_kpc[1].v
+    z_cells = grid_field(grid, 'z', 'kpc')[0,0,:] - ds.halo_center_kpc[2].v
+    xbins = x_cells[:-1] - 0.5*np.diff(x_cells)
+    ybins = y_cells[:-1] - 0.5*np.diff(y_cells)
+    zbins = z_cells[:-1] - 0.5*np.diff(z_cells)
+    radius = grid_field(grid, 'radius_corrected', 'kpc')
+    if not (tiled):
+        x = grid_field(grid, 'x', 'kpc') - ds.halo_center_kpc[0].v
+        y = grid_field(grid, 'y', 'kpc') - ds.halo_center_kpc[1].v
+        z = grid_field(grid, 'z', 'kpc') - ds.halo_center_kpc[2].v
+        vx = grid_field(grid, 'vx_corrected', 'kpc/yr')
+        vy = grid_field(grid, 'vy_corrected', 'kpc/yr')
+        vz = grid_field(grid, 'vz_corrected', 'kpc/yr')
+        rv = grid_field(grid, 'radial_velocity_corrected', 'km/s')
+        vff = grid_field(grid, 'vff', 'km/s')
+        if (args.direction) or ('disk' in surface[0]) or ('accretion_direction' in plots):
+            theta = grid_field(grid, 'theta_pos_disk')*(180./np.pi)
+            phi = grid_field(grid, 'phi_pos_disk')*(180./np.pi)
+        if ('accretion_viz' in plots) or ('accretion_direction' in plots):
+            temperature = grid_field(grid, 'temperature', 'K')
+            density = grid_field(grid, 'density', 'g/cm**3')
+            tcool = grid_field(grid, 'cooling_time', 'Myr')
+            metallicity = grid_field(grid, 'metallicity', 'Zsun')
+        if ('accretion_direction' in plots):
+            mass = grid_field(grid, 'cell_mass', 'Msun')
+            metals = grid_field(grid, 'metal_mass', 'Msun')
     # Load dark matter velocities and positions and digitize onto grid
     if (args.dark_matter):
-        left_edge = grid.LeftEdge.in_units('kpc')
-        right_edge = grid.RightEdge.in_units('kpc')
+        # Edges of the grid from its cell centers, so the grid itself doesn't have to be made
+        left_edge = ds.arr([x_cells[0] - 0.5*(x_cells[1]-x_cells[0]), y_cells[0] - 0.5*(y_cells[1]-y_cells[0]), \
+          z_cells[0] - 0.5*(z_cells[1]-z_cells[0])], 'kpc') + ds.halo_center_kpc
+        right_edge = ds.arr([x_cells[-1] + 0.5*(x_cells[-1]-x_cells[-2]), y_cells[-1] + 0.5*(y_cells[-1]-y_cells[-2]), \
+          z_cells[-1] + 0.5*(z_cells[-1]-z_cells[-2])], 'kpc') + ds.halo_center_kpc
         box_dm = ds.box(left_edge, right_edge)
         x_dm = box_dm['dm','particle_position_x'].in_units('kpc').v - ds.halo_center_kpc[0].v
         y_dm = box_dm['dm','particle_position_y'].in_units('kpc').v - ds.halo_center_kpc[1].v
@@ -754,51 +918,16 @@ def calculate_flux(ds, grid, shape, snap, snap_props):
         inds_z = np.digitize(z_dm, zbins)-1      # indices of z positions
         inds_dm = np.array([inds_x, inds_y, inds_z])
         in_shape_dm = shape[tuple(inds_dm)]
-    properties = []
-    if ('mass' in flux_types):
-        mass = grid['gas', 'cell_mass'].in_units('Msun').v
-        metals = grid['gas', 'metal_mass'].in_units('Msun').v
-        properties.append(mass)
-        properties.append(metals)
-        if (args.dark_matter):
+        dm_props = []
+        if ('mass' in flux_types):
             mass_dm = box_dm[('dm','particle_mass')].in_units('Msun').v
-            properties.append(mass_dm)
-    if ('energy' in flux_types):
-        kinetic_energy = grid['gas','kinetic_energy_corrected'].in_units('erg').v
-        thermal_energy = (grid['gas','cell_mass']*grid['gas','thermal_energy']).in_units('erg').v
-        potential_energy = -G * Menc_profile(radius)*gtoMsun / (radius*1000.*cmtopc)*grid['gas','cell_mass'].in_units('g').v
-        bernoulli_energy = kinetic_energy + 5./3.*thermal_energy + potential_energy
-        cooling_energy = thermal_energy/grid['gas','cooling_time'].in_units('yr').v
-        properties.append(thermal_energy)
-        properties.append(kinetic_energy)
-        properties.append(potential_energy)
-        properties.append(bernoulli_energy)
-        properties.append(cooling_energy)
-
-    # Calculate new positions of gas cells for a long elapsed time (necessary because digitizing onto grid can "reset" positions of slow-moving gas)
-    new_x = vx*(5.*dt) + x
-    new_y = vy*(5.*dt) + y
-    new_z = vz*(5.*dt) + z
-    displacement = np.sqrt((new_x-x)**2. + (new_y-y)**2. + (new_z-z)**2.)
-    displacement_vel = displacement*1000.*cmtopc/(5.*dt*stoyr)/1e5
-    displacement_vel = np.abs(displacement_vel/vff)
-    inds_x = np.digitize(new_x, xbins)-1      # indices of new x positions
-    inds_y = np.digitize(new_y, ybins)-1      # indices of new y positions
-    inds_z = np.digitize(new_z, zbins)-1      # indices of new z positions
-    new_inds = np.array([inds_x, inds_y, inds_z])
+            dm_props.append(mass_dm)
 
-
-    # Calculate new positions of dark matter
+    # Calculate new positions of gas cells and dark matter for a long elapsed time
+    if not (tiled):
+        new_inds, displacement_vel = displaced_cells(x, y, z, vx, vy, vz, vff, xbins, ybins, zbins)
     if (args.dark_matter):
-        new_x_dm = vx_dm*(5.*dt) + x_dm
-        new_y_dm = vy_dm*(5.*dt) + y_dm
-        new_z_dm = vz_dm*(5.*dt) + z_dm
-        displacement_vel_dm = np.sqrt((new_x_dm-x_dm)**2. + (new_y_dm-y_dm)**2. + (new_z_dm-z_dm)**2.)/(5.*dt)*(cmtopc*1000./stoyr/1e5)
-        displacement_vel_dm = np.abs(displacement_vel_dm/vff_dm)
-        inds_x = np.digitize(new_x_dm, xbins)-1      # indices of new x positions
-        inds_y = np.digitize(new_y_dm, ybins)-1      # indices of new y positions
-        inds_z = np.digitize(new_z_dm, zbins)-1      # indices of new z positions
-        new_inds_dm = np.array([inds_x, inds_y, inds_z])
+        new_inds_dm, displacement_vel_dm = displaced_cells(x_dm, y_dm, z_dm, vx_dm, vy_dm, vz_dm, vff_dm, xbins, ybins, zbins)
 
     # If calculating direction of accretion, set up theta and phi and bins
     if (args.direction):
@@ -823,14 +952,16 @@ def calculate_flux(ds, grid, shape, snap, snap_props):
     if (args.region_filter!='none'):
         if (args.region_filter=='temperature'):
             regions = [0., 10**4., 10**5., 10**6., np.inf]
-            filter = grid['gas','temperature'].in_units('K').v
+            filter_field, filter_units = 'temperature', 'K'
         elif (args.region_filter=='metallicity'):
             regions = [0., 0.1, 0.5, 1., np.inf]
-            filter = grid['gas','metallicity'].in_units('Zsun').v
+            filter_field, filter_units = 'metallicity', 'Zsun'
         elif (args.region_filter=='velocity'):
             #regions = [-np.inf, -100., 0., 100., np.inf]
             regions = [0., -20., -50., -100., -200.]
-            filter = grid['gas','radial_velocity_corrected'].in_units('km/s').v
+            filter_field, filter_units = 'radial_velocity_corrected', 'km/s'
+    else:
+        regions = None
     #disp_vel_bins = [0., 50., 100., 150., 200., 300., np.inf]
     #disp_vel_saves = ['_0-50','_50-100','_100-150','_150-200','_200-300','_300-inf']
     #disp_vel_bins = [0., 0.2, 0.4, 0.6, 0.8, 1.0, np.inf]
@@ -838,37 +969,117 @@ def calculate_flux(ds, grid, shape, snap, snap_props):
     disp_vel_bins = [0., 0.25, 0.5, 0.75, np.inf]
     disp_vel_saves = ['_0-0p25', '_0p25-0p5', '_0p5-0p75', '_0p75-inf']
 
+    # Find which bin of displacement velocity, angle, and region filter each cell (and particle) is in once,
+    # since these don't depend on the shape
+    n_dv = len(disp_vel_bins)-1
+    if (args.region_filter!='none'):
+        n_reg = len(regions)-1
+    else:
+        n_reg = 0
+    gas_fluxes = [flux for flux in fluxes if ('dm' not in flux)]
+    if not (tiled):
+        if (args.direction):
+            bin_phi = phi.flatten()
+        else:
+            bin_phi = None
+        if (args.region_filter!='none'):
+            filter = grid_field(grid, filter_field, filter_units)
+            bin_index, bin_shape = flux_bin_index(displacement_vel.flatten(), disp_vel_bins, phi=bin_phi, filter=filter.flatten(), regions=regions)
+        else:
+            bin_index, bin_shape = flux_bin_index(displacement_vel.flatten(), disp_vel_bins, phi=bin_phi)
+        dv_index = np.reshape(bin_index // (bin_shape[1]*bin_shape[2]), np.shape(displacement_vel))
+        gas_props = [prop.flatten() for prop in flux_properties(lambda field, units: grid_field(grid, field, units), Menc_profile)]
+    else:
+        # Sum the fluxes of every shape (one for each radius if stepping through radii) in every bin one
+        # tile at a time, with the bins numbered as (radius, in/out, displacement velocity, angle, region)
+        bin_shape = (n_dv+1, 3, n_reg+1)
+        n_bins = np.prod(bin_shape)
+        def crossing_bins(data):
+            x = tile_field(data, 'x', 'kpc') - ds.halo_center_kpc[0].v
+            y = tile_field(data, 'y', 'kpc') - ds.halo_center_kpc[1].v
+            z = tile_field(data, 'z', 'kpc') - ds.halo_center_kpc[2].v
+            new_inds, displacement_vel = displaced_cells(x, y, z, tile_field(data, 'vx_corrected', 'kpc/yr'), \
+              tile_field(data, 'vy_corrected', 'kpc/yr'), tile_field(data, 'vz_corrected', 'kpc/yr'), \
+              tile_field(data, 'vff', 'km/s'), xbins, ybins, zbins)
+            if (args.direction):
+                bin_phi = tile_field(data, 'phi_pos_disk', '')*(180./np.pi)
+            else:
+                bin_phi = None
+            if (args.region_filter!='none'):
+                bin_index, bin_shape = flux_bin_index(displacement_vel, disp_vel_bins, phi=bin_phi, \
+                  filter=tile_field(data, filter_field, filter_units), regions=regions)
+            else:
+                bin_index, bin_shape = flux_bin_index(displacement_vel, disp_vel_bins, phi=bin_phi)
+            if (surface[0]=='sphere') and (args.radial_stepping>0):
+                cell_radius = tile_field(data, 'radius_corrected', 'kpc')
+                new_radius = radius[new_inds]
+            else:
+                # Where the tile is in the grid, from its cell centers
+                cells = np.ix_(np.searchsorted(x_cells, x[:,0,0]), np.searchsorted(y_cells, y[0,:,0]), np.searchsorted(z_cells, z[0,0,:]))
+                in_shape = shape[cells]
+                new_in_shape = shape[new_inds]
+            index = np.full((len(radii),) + np.shape(x), -1)
+            for r in range(len(radii)):
+                if (surface[0]=='sphere') and (args.radial_stepping>0):
+                    in_shape = (cell_radius < radii[r])
+                    new_in_shape = (new_radius < radii[r])
+                from_shape = in_shape & ~new_in_shape
+                to_shape = ~in_shape & new_in_shape
+                crossing = to_shape | from_shape
+                index[r][crossing] = (2*r + from_shape[crossing])*n_bins + bin_index[crossing]
+            return index
+        def crossing_weights(data):
+            properties = flux_properties(lambda field, units: tile_field(data, field, units), Menc_profile)
+            return {gas_fluxes[i]: properties[i] for i in range(len(gas_fluxes))}
+        tile_fields = ['x', 'y', 'z', 'vx_corrected', 'vy_corrected', 'vz_corrected', 'vff', 'radius_corrected', \
+                       'cell_mass', 'metal_mass']
+        if ('energy' in flux_types):
+            tile_fields += ['kinetic_energy_corrected', 'thermal_energy', 'cooling_time']
+        if (args.direction):
+            tile_fields.append('phi_pos_disk')
+        if (args.region_filter!='none') and (filter_field not in tile_fields):
+            tile_fields.append(filter_field)
+        kernel = binning_kernel('flux', crossing_bins, len(radii)*2*n_bins, crossing_weights)
+        out_dir = os.path.join(args.grid_cache, 'tiled_' + os.path.basename(ds.parameter_filename) + '_fluxes')
+        outputs = tiled_covering_grid(ds, args.level, None, grid.ActiveDimensions, \
+          {('gas',field):grid_units[field] for field in tile_fields}, kernels=[kernel], tile_size=args.tile_size, \
+          out_dir=out_dir, num_ghost_zones=1, grid=grid)
+        tiled_sums = [outputs['flux_' + flux].reshape((len(radii), 2) + bin_shape) for flux in gas_fluxes]
+    if (args.dark_matter):
+        if (args.direction):
+            bin_index_dm, bin_shape_dm = flux_bin_index(displacement_vel_dm, disp_vel_bins, phi=phi_dm)
+        else:
+            bin_index_dm, bin_shape_dm = flux_bin_index(displacement_vel_dm, disp_vel_bins)
+
     # Step through radii (if chosen) and calculate fluxes and plot things for each radius
     for r in range(len(radii)):
         # If stepping through radii, define the shape for this radius value
         if (surface[0]=='sphere') and (args.radial_stepping>0):
-            shape = (radius < radii[r])
+            if not (tiled): shape = (radius < radii[r])
             save_r = '_r%d' % (r)
         else:
             save_r = ''
-        # Define which cells are entering and leaving shape
-        new_in_shape = shape[tuple(new_inds)]
-        from_shape = shape & ~new_in_shape
-        to_shape = ~shape & new_in_shape
-        from_shape_fast = from_shape & (rv > 200.)
+        if (tiled):
+            sums = [flux_sums[r] for flux_sums in tiled_sums]
+        else:
+            # Define which cells are entering and leaving shape
+            new_in_shape = shape[tuple(new_inds)]
+            from_shape = shape & ~new_in_shape
+            to_shape = ~shape & new_in_shape
+            from_shape_fast = from_shape & (rv > 200.)
 
-        # Bin cells by displacement velocity
-        to_shape_dv = []
-        for dv in range(len(disp_vel_bins)-1):
-            low_dv = disp_vel_bins[dv]
-            upp_dv = disp_vel_bins[dv+1]
-            to_shape_dv.append(to_shape & (displacement_vel >= low_dv) & (displacement_vel < upp_dv))
+            # Sum every flux in every bin at once
+            sums = crossing_sums(bin_index, bin_shape, to_shape.flatten(), from_shape.flatten(), gas_props)
 
         # Define which cells are entering and leaving shape for dark matter
         if (args.dark_matter):
-            new_in_shape_dm = shape[tuple(new_inds_dm)]
+            if (surface[0]=='sphere') and (args.radial_stepping>0):
+                new_in_shape_dm = (radius[tuple(new_inds_dm)] < radii[r])
+            else:
+                new_in_shape_dm = shape[tuple(new_inds_dm)]
             from_shape_dm = in_shape_dm & ~new_in_shape_dm
             to_shape_dm = ~in_shape_dm & new_in_shape_dm
-            to_shape_dv_dm = []
-            for dv in range(len(disp_vel_bins)-1):
-                low_dv = disp_vel_bins[dv]
-                upp_dv = disp_vel_bins[dv+1]
-                to_shape_dv_dm.append(to_shape_dm & (displacement_vel_dm >= low_dv) & (displacement_vel_dm < upp_dv))
+            sums_dm = crossing_sums(bin_index_dm, bin_shape_dm, to_shape_dm, from_shape_dm, dm_props)
 
         if ('accretion_viz' in plots):
             # Set all values outside of the shapes of interest to zero
@@ -903,25 +1114,17 @@ def calculate_flux(ds, grid, shape, snap, snap_props):
               inset_box_args={"boxstyle":"round,pad=0.3","facecolor":"white","linewidth":2,"edgecolor":"black"})
             proj.save(prefix + 'Plots/' + snap + '_temperature-accreting_x' + save_suffix + '.png')
 
-        if (args.direction):
+        if (args.direction) and not (tiled):
             theta_to_dv = []
             phi_to_dv = []
-            if (args.dark_matter):
-                theta_to_dv_dm = []
-                phi_to_dv_dm = []
-            for dv in range(len(disp_vel_bins)-1):
-                theta_to_dv.append(theta[to_shape_dv[dv]])
-                phi_to_dv.append(phi[to_shape_dv[dv]])
-                if (args.dark_matter):
-                    theta_to_dv_dm.append(theta_dm[to_shape_dv_dm[dv]])
-                    phi_to_dv_dm.append(phi_dm[to_shape_dv_dm[dv]])
+            for dv in range(n_dv):
+                theta_to_dv.append(theta[to_shape & (dv_index==dv)])
+                phi_to_dv.append(phi[to_shape & (dv_index==dv)])
             if (args.dark_matter):
                 theta_to_dm = theta_dm[to_shape_dm]
                 phi_to_dm = phi_dm[to_shape_dm]
-                phi_from_dm = phi_dm[from_shape_dm]
             theta_to = theta[to_shape]
             phi_to = phi[to_shape]
-            phi_from = phi[from_shape]
             theta_out = theta[from_shape_fast]
             phi_out = phi[from_shape_fast]
 
@@ -931,86 +1134,32 @@ def calculate_flux(ds, grid, shape, snap, snap_props):
             else: results = []
             if (args.direction):
                 results.append(phi_bins[p])
-            if (phi_bins[p]=='all'):
-                angle_bin_from = np.ones(np.count_nonzero(from_shape), dtype=bool)
-                if (args.dark_matter):
-                    angle_bin_from_dm = np.ones(np.count_nonzero(from_shape_dm), dtype=bool)
-            elif (phi_bins[p]=='major'):
-                angle_bin_from = (phi_from >= 60.) & (phi_from <= 120.)
-                if (args.dark_matter):
-                    angle_bin_from_dm = (phi_from_dm >= 60.) & (phi_from_dm <= 120.)
-            elif (phi_bins[p]=='minor'):
-                angle_bin_from = (phi_from < 60.) | (phi_from > 120.)
-                if (args.dark_matter):
-                    angle_bin_from_dm = (phi_from_dm < 60.) | (phi_from_dm > 120.)
-            angle_bin_to_dv = []
-            angle_bin_to_dv_dm = []
-            if (phi_bins[p]=='all'):
-                angle_bin_to = np.ones(len(phi_to), dtype=bool)
-                if (args.dark_matter):
-                    angle_bin_to_dm = np.ones(len(phi_to_dm), dtype=bool)
-                for dv in range(len(disp_vel_bins)-1):
-                    angle_bin_to_dv.append(np.ones(np.count_nonzero(to_shape_dv[dv]), dtype=bool))
-                    if (args.dark_matter):
-                        angle_bin_to_dv_dm.append(np.ones(np.count_nonzero(to_shape_dv_dm[dv]), dtype=bool))
-            elif (phi_bins[p]=='major'):
-                angle_bin_to = (phi_to >= 60.) & (phi_to <= 120.)
-                if (args.dark_matter):
-                    angle_bin_to_dm = (phi_to_dm >=60.) & (phi_to_dm <= 120.)
-                for dv in range(len(disp_vel_bins)-1):
-                    angle_bin_to_dv.append((phi_to_dv[dv] >= 60.) & (phi_to_dv[dv] <= 120.))
-                    if (args.dark_matter):
-                        angle_bin_to_dm.append((phi_to_dm[dv] >= 60.) & (phi_to_dm[dv] <= 120.))
-            elif (phi_bins[p]=='minor'):
-                angle_bin_to = (phi_to < 60.) | (phi_to > 120.)
-                if (args.dark_matter):
-                    angle_bin_to_dm = (phi_to_dm < 60.) | (phi_to_dm > 120.)
-                for dv in range(len(disp_vel_bins)-1):
-                    angle_bin_to_dv.append((phi_to_dv[dv] < 60.) | (phi_to_dv[dv] > 120.))
-                    if (args.dark_matter):
-                        angle_bin_to_dm.append((phi_to_dm[dv] < 60.) | (phi_to_dm[dv] > 120.))
-
+            gas_i = 0
+            dm_i = 0
             for i in range(len(fluxes)):
                 if ('dm' in fluxes[i]):
-                    prop_to_dm = properties[i][to_shape_dm[dv]][angle_bin_to_dm]
-                    flux_in = np.sum(prop_to_dm)/(5.*dt)
-                    results.append(flux_in)
-                    for dv in range(len(disp_vel_bins)-1):
-                        prop_to_dm_dv = properties[i][to_shape_dv_dm[dv]][angle_bin_to_dv_dm[dv]]
-                        flux_in = np.sum(prop_to_dm_dv)/(5.*dt)
-                        results.append(flux_in)
-                    prop_from_dm = properties[i][from_shape_dm][angle_bin_from_dm]
-                    flux_out = np.sum(prop_from_dm)/(5.*dt)
-                    results.append(flux_out)
+                    flux_sums = sums_dm[dm_i]
+                    dm_i += 1
+                    regions_i = 0
                 else:
-                    prop_to = properties[i][to_shape][angle_bin_to]
-                    flux_in = np.sum(prop_to)/(5.*dt)
-                    results.append(flux_in)
-                    if (args.region_filter!='none'):
-                        region_to = filter[to_shape][angle_bin_to]
-                        for j in range(len(regions)-1):
-                            prop_to_region = prop_to[(region_to > regions[j]) & (region_to < regions[j+1])]
-                            flux_in = np.sum(prop_to_region)/(5.*dt)
-                            results.append(flux_in)
-                    for dv in range(len(disp_vel_bins)-1):
-                        prop_to_dv = properties[i][to_shape_dv[dv]][angle_bin_to_dv[dv]]
-                        flux_in = np.sum(prop_to_dv)/(5.*dt)
-                        results.append(flux_in)
-                        if (args.region_filter!='none'):
-                            region_to = filter[to_shape_dv[dv]][angle_bin_to_dv[dv]]
-                            for j in range(len(regions)-1):
-                                prop_to_region = prop_to_dv[(region_to > regions[j]) & (region_to < regions[j+1])]
-                                flux_in = np.sum(prop_to_region)/(5.*dt)
-                                results.append(flux_in)
-                    prop_from = properties[i][from_shape][angle_bin_from]
-                    flux_out = np.sum(prop_from)/(5.*dt)
-                    results.append(flux_out)
-                    if (args.region_filter!='none'):
-                        region_from = filter[from_shape][angle_bin_from]
-                        for j in range(len(regions)-1):
-                            prop_from_region = prop_from[(region_from > regions[j]) & (region_from < regions[j+1])]
-                            flux_out = np.sum(prop_from_region)/(5.*dt)
-                            results.append(flux_out)
+                    flux_sums = sums[gas_i]
+                    gas_i += 1
+                    regions_i = n_reg
+                # Pick out the angle bin, leaving arrays of (in/out, displacement velocity, region)
+                if (phi_bins[p]=='all'):
+                    flux_sums = np.sum(flux_sums, axis=2)
+                elif (phi_bins[p]=='major'):
+                    flux_sums = flux_sums[:,:,0,:]
+                elif (phi_bins[p]=='minor'):
+                    flux_sums = flux_sums[:,:,1,:]
+                flux_sums = flux_sums/(5.*dt)
+                results.append(np.sum(flux_sums[0]))
+                results += list(np.sum(flux_sums[0,:,:regions_i], axis=0))
+                for dv in range(n_dv):
+                    results.append(np.sum(flux_sums[0,dv]))
+                    results += list(flux_sums[0,dv,:regions_i])
+                results.append(np.sum(flux_sums[1]))
+                results += list(np.sum(flux_sums[1,:,:regions_i], axis=0))
             table.add_row(results)
 
         if ('accretion_direction' in plots):
@@ -1023,7 +1172,8 @@ def calculate_flux(ds, grid, shape, snap, snap_props):
                 plot_accretion_direction(theta_to*(np.pi/180.)+np.pi, phi_to*(np.pi/180.), temperature[to_shape], metallicity[to_shape], rv[to_shape], tcool[to_shape], mass[to_shape], metals[to_shape], theta_out*(np.pi/180.)+np.pi, phi_out*(np.pi/180.), tsnap, zsnap, prefix, snap, radii[r], save_r, '')
                 for dv in range(len(disp_vel_bins)-1):
                     save_dv = disp_vel_saves[dv]
-                    plot_accretion_direction(theta_to_dv[dv]*(np.pi/180.)+np.pi, phi_to_dv[dv]*(np.pi/180.), temperature[to_shape_dv[dv]], metallicity[to_shape_dv[dv]], rv[to_shape_dv[dv]], tcool[to_shape_dv[dv]], mass[to_shape_dv[dv]], metals[to_shape_dv[dv]], theta_out*(np.pi/180.)+np.pi, phi_out*(np.pi/180.), tsnap, zsnap, prefix, snap, radii[r], save_r, save_dv)
+                    to_shape_dv = to_shape & (dv_index==dv)
+                    plot_accretion_direction(theta_to_dv[dv]*(np.pi/180.)+np.pi, phi_to_dv[dv]*(np.pi/180.), temperature[to_shape_dv], metallicity[to_shape_dv], rv[to_shape_dv], tcool[to_shape_dv], mass[to_shape_dv], metals[to_shape_dv], theta_out*(np.pi/180.)+np.pi, phi_out*(np.pi/180.), tsnap, zsnap, prefix, snap, radii[r], save_r, save_dv)
 
     table = set_flux_table_units(table)
     table.write(tablename + flux_filename + save_suffix + '.hdf5', path='all_data', serialize_meta=True, overwrite=True)
@@ -1058,36 +1208,37 @@ def compare_accreting_cells(ds, grid, shape, snap, snap_props):
     props.append('sound_speed')
     table = make_props_table(props)
 
-    dx = float(np.min(grid[('gas','dx')].in_units('kpc')))
+    dx = float(np.min(grid_field(grid, 'dx')))
     smooth_scale = (25./dx)/6.
 
     # Load grid properties
-    x = grid['gas', 'x'].in_units('kpc').v - ds.halo_center_kpc[0].v
-    y = grid['gas', 'y'].in_units('kpc').v - ds.halo_center_kpc[1].v
-    z = grid['gas', 'z'].in_units('kpc').v - ds.halo_center_kpc[2].v
+    x = grid_field(grid, 'x', 'kpc') - ds.halo_center_kpc[0].v
+    y = grid_field(grid, 'y', 'kpc') - ds.halo_center_kpc[1].v
+    z = grid_field(grid, 'z', 'kpc') - ds.halo_center_kpc[2].v
     xbins = x[:,0,0][:-1] - 0.5*np.diff(x[:,0,0])
     ybins = y[0,:,0][:-1] - 0.5*np.diff(y[0,:,0])
     zbins = z[0,0,:][:-1] - 0.5*np.diff(z[0,0,:])
-    vx = grid['gas','vx_corrected'].in_units('kpc/yr').v
-    vy = grid['gas','vy_corrected'].in_units('kpc/yr').v
-    vz = grid['gas','vz_corrected'].in_units('kpc/yr').v
-    radius = grid['gas','radius_corrected'].in_units('kpc').v
-    theta = grid['gas','theta_pos_disk'].v*(180./np.pi)
-    phi = grid['gas','phi_pos_disk'].v*(180./np.pi)
-    rv = grid['radial_velocity_corrected'].in_units('km/s').v
-    vff = grid['gas','vff'].in_units('km/s').v
-    temperature = grid['gas','temperature'].in_units('K').v
-    metallicity = grid['gas','metallicity'].in_units('Zsun').v
-    tcool = grid['gas','cooling_time'].in_units('Myr').v
-    entropy = grid['gas','entropy'].in_units('cm**2*keV').v
-    pressure = grid['gas','pressure'].in_units('erg/cm**3').v
-    mass = grid['gas', 'cell_mass'].in_units('Msun').v
-    metals = grid['gas', 'metal_mass'].in_units('Msun').v
-    sound_speed = grid['gas','sound_speed'].in_units('km/s').v
-    thermal = grid['gas','thermal_energy'].in_units('erg/g').v*grid['gas','cell_mass'].in_units('g').v
+    vx = grid_field(grid, 'vx_corrected', 'kpc/yr')
+    vy = grid_field(grid, 'vy_corrected', 'kpc/yr')
+    vz = grid_field(grid, 'vz_corrected', 'kpc/yr')
+    radius = grid_field(grid, 'radius_corrected', 'kpc')
+    theta = grid_field(grid, 'theta_pos_disk')*(180./np.pi)
+    phi = grid_field(grid, 'phi_pos_disk')*(180./np.pi)
+    rv = grid_field(grid, 'radial_velocity_corrected')
+    vff = grid_field(grid, 'vff', 'km/s')
+    temperature = grid_field(grid, 'temperature', 'K')
+    metallicity = grid_field(grid, 'metallicity', 'Zsun')
+    tcool = grid_field(grid, 'cooling_time', 'Myr')
+    entropy = grid_field(grid, 'entropy', 'cm**2*keV')
+    pressure = grid_field(grid, 'pressure', 'erg/cm**3')
+    mass = grid_field(grid, 'cell_mass', 'Msun')
+    metals = grid_field(grid, 'metal_mass', 'Msun')
+    sound_speed = grid_field(grid, 'sound_speed', 'km/s')
+    mass_g = grid_field(grid, 'cell_mass', 'g')
+    thermal = grid_field(grid, 'thermal_energy')*mass_g
     cooling_energy = thermal/(tcool*1e6)*(5.*dt)
     if (args.weight=='mass'): weights = np.copy(mass)
-    if (args.weight=='volume'): weights = grid['gas','cell_volume'].in_units('kpc**3').v
+    if (args.weight=='volume'): weights = grid_field(grid, 'cell_volume', 'kpc**3')
     smooth_vx = gaussian_filter(vx, smooth_scale)
     smooth_vy = gaussian_filter(vy, smooth_scale)
     smooth_vz = gaussian_filter(vz, smooth_scale)
@@ -1095,9 +1246,9 @@ def compare_accreting_cells(ds, grid, shape, snap, snap_props):
     sig_x = (vx - smooth_vx)**2.*(cmtopc*1000/stoyr)**2.
     sig_y = (vy - smooth_vy)**2.*(cmtopc*1000/stoyr)**2.
     sig_z = (vz - smooth_vz)**2.*(cmtopc*1000/stoyr)**2.
-    turbulent_kinetic = 1./2.*(sig_x + sig_y + sig_z)*grid['gas','cell_mass'].in_units('g').v
-    radial_kinetic = 1./2.*smooth_vr**2.*grid['gas','cell_mass'].in_units('g').v
-    rotational_kinetic = 1./2.*(smooth_vx**2. + smooth_vy**2. + smooth_vz**2.)*(cmtopc*1000/stoyr)**2.*grid['gas','cell_mass'].in_units('g').v
+    turbulent_kinetic = 1./2.*(sig_x + sig_y + sig_z)*mass_g
+    radial_kinetic = 1./2.*smooth_vr**2.*mass_g
+    rotational_kinetic = 1./2.*(smooth_vx**2. + smooth_vy**2. + smooth_vz**2.)*(cmtopc*1000/stoyr)**2.*mass_g
     # Load dark matter velocities and positions and digitize onto grid
     properties = [mass, metals, thermal, radial_kinetic, turbulent_kinetic, rotational_kinetic, cooling_energy, temperature, metallicity, tcool, entropy, pressure, rv, sound_speed]
 
@@ -1455,6 +1606,71 @@ def phase_plots(temp_acc, vel_acc, tcool_acc, met_acc, entropy_acc, pressure_acc
             plt.savefig(prefix + 'Plots/' + snap + '_phase_' + props_save[i] + '-vs-' + props_save[j] + save_r + save_dv + save_suffix + '.png')
             plt.close()
 
+# Units each field read from the covering grid is used in. Fields made in tiles are saved in these
+# units, so they can be memory-mapped from disk and used without converting (and copying) them.
+grid_units = {'density':'g/cm**3', 'x':'kpc', 'y':'kpc', 'z':'kpc', 'dx':'kpc', 'cell_volume':'kpc**3', \
+              'vx_corrected':'kpc/yr', 'vy_corrected':'kpc/yr', 'vz_corrected':'kpc/yr', \
+              'radius_corrected':'kpc', 'radial_velocity_corrected':'km/s', 'vff':'km/s', \
+              'cell_mass':'Msun', 'metal_mass':'Msun', 'x_disk':'kpc', 'y_disk':'kpc', 'z_disk':'kpc', \
+              'theta_pos_disk':'', 'phi_pos_disk':'', 'temperature':'K', 'metallicity':'Zsun', \
+              'cooling_time':'Myr', 'entropy':'cm**2*keV', 'pressure':'erg/cm**3', 'sound_speed':'km/s', \
+              'thermal_energy':'erg/g', 'kinetic_energy_corrected':'erg'}
+
+def grid_fields(surface):
+    '''Returns the list of the fields that find_shape, calculate_flux, and compare_accreting_cells read
+    from the covering grid for the surface 'surface' and the options this script was run with.'''
+
+    fields = ['density', 'x', 'y', 'z', 'vx_corrected', 'vy_corrected', 'vz_corrected', 'radius_corrected', \
+              'radial_velocity_corrected', 'vff', 'cell_mass', 'metal_mass']
+    if ((surface[0]=='cylinder') and (surface[3]=='minor')) or (args.direction) or ('disk' in surface[0]):
+        fields += ['x_disk', 'y_disk', 'z_disk', 'theta_pos_disk', 'phi_pos_disk']
+    if ('fluxes' in args.calculate):
+        if ('energy' in flux_types):
+            fields += ['kinetic_energy_corrected', 'thermal_energy', 'cooling_time']
+        if ('accretion_viz' in plots) or ('accretion_direction' in plots):
+            fields += ['temperature', 'cooling_time', 'metallicity', 'theta_pos_disk', 'phi_pos_disk']
+        if (args.region_filter=='temperature') or (args.region_filter=='metallicity'):
+            fields.append(args.region_filter)
+    if ('accretion_compare' in args.calculate):
+        fields += ['dx', 'cell_volume', 'theta_pos_disk', 'phi_pos_disk', 'temperature', 'metallicity', \
+                   'cooling_time', 'entropy', 'pressure', 'sound_speed', 'thermal_energy']
+
+    return [field for i, field in enumerate(fields) if field not in fields[:i]]
+
+def grid_field(grid, field, units=None):
+    '''Returns the field ('gas', 'field') of the covering grid 'grid' as a numpy array in the units
+    'units' (default its units in grid_units). If it is already in those units, as fields made in tiles
+    are, it is not copied, so a field memory-mapped from disk is only read as it is used.'''
+
+    if (units is None): units = grid_units[field]
+    values = grid['gas', field]
+    if (values.units==units):
+        return values.v
+    return values.in_units(units).v
+
+def make_grid(ds, surface, left_edge, box_width, dx):
+    '''Returns the covering grid with left edge 'left_edge' and 'box_width' cells on a side at the
+    requested level, and the density smoothed over 5 kpc if the surface is the disk and the grid was
+    made in tiles, or None otherwise. If --tile_size was given, every field in grid_fields(surface) is
+    first made tile by tile (in the units in grid_units) and saved to the grid cache, and the returned
+    grid only reads fields from there, so asking it for any other field is an error rather than making
+    the whole grid.'''
+
+    smooth_density = None
+    if (args.tile_size > 0):
+        fields = {('gas',field):grid_units[field] for field in grid_fields(surface)}
+        kernels = []
+        if (surface[0]=='disk'):
+            kernels.append(gaussian_smoothing_kernel('smooth_density', ('gas','density'), (5./dx)/6.))
+        out_dir = os.path.join(args.grid_cache, 'tiled_' + os.path.basename(ds.parameter_filename))
+        outputs = tiled_covering_grid(ds, args.level, left_edge, box_width, fields, kernels=kernels, \
+          tile_size=args.tile_size, cache_dir=args.grid_cache, out_dir=out_dir, num_ghost_zones=1)
+        if ('smooth_density' in outputs): smooth_density = outputs['smooth_density']
+    box = cached_covering_grid(ds, args.level, left_edge, box_width, cache_dir=args.grid_cache, num_ghost_zones=1, \
+                               cached_only=(args.tile_size > 0))
+
+    return box, smooth_density
+
 def find_shape(ds, surface, snap_props):
     '''Defines the grid within the data set, identifies the specified shape,
     and returns both the full grid and the boolean array for the shape.'''
@@ -1494,7 +1710,7 @@ def find_shape(ds, surface, snap_props):
     if (args.constant_box!=0.):
         left_edge = ds.halo_center_kpc - ds.arr([max_extent, max_extent, max_extent], 'kpc')
         box_width = ds.arr([int(2.*max_extent/dx), int(2.*max_extent/dx), int(2.*max_extent/dx)])
-        box = ds.covering_grid(level=args.level, left_edge=left_edge, dims=box_width, num_ghost_zones=1)
+        box, smooth_density = make_grid(ds, surface, left_edge, box_width, dx)
     else:
         if (surface[0]=='disk'):
             # Define the density cut between disk and CGM to vary smoothly between 1 and 0.1 between z = 0.5 and z = 0.25,
@@ -1516,7 +1732,7 @@ def find_shape(ds, surface, snap_props):
             z_extent = max([np.max(z)+2.*edge_kpc,np.abs(np.min(z)-2.*edge_kpc)])
             left_edge = ds.halo_center_kpc - ds.arr([x_extent, y_extent, z_extent], 'kpc')
             box_width = np.array([int(2.*x_extent/dx), int(2.*y_extent/dx), int(2.*z_extent/dx)])
-            box = ds.covering_grid(level=args.level, left_edge=left_edge, dims=box_width, num_ghost_zones=1)
+            box, smooth_density = make_grid(ds, surface, left_edge, box_width, dx)
         elif (surface[0]=='stellar_disk'):
             x_stars = data['young_stars8','x_disk'].v
             y_stars = data['young_stars8','y_disk'].v
@@ -1530,15 +1746,15 @@ def find_shape(ds, surface, snap_props):
             z_extent = max([np.max(z_stars)+2.*edge_kpc,np.abs(np.min(z_stars)-2.*edge_kpc)])
             left_edge = ds.halo_center_kpc - ds.arr([x_extent, y_extent, z_extent], 'kpc')
             box_width = np.array([int(2.*x_extent/dx), int(2.*y_extent/dx), int(2.*z_extent/dx)])
-            box = ds.covering_grid(level=args.level, left_edge=left_edge, dims=box_width, num_ghost_zones=1)
+            box, smooth_density = make_grid(ds, surface, left_edge, box_width, dx)
         elif (surface[0]=='sphere'):
             left_edge = ds.halo_center_kpc - ds.arr([max_extent, max_extent, max_extent], 'kpc')
             box_width = ds.arr([int(max_extent*2./dx), int(max_extent*2./dx), int(max_extent*2./dx)], 'kpc')
-            box = ds.covering_grid(level=args.level, left_edge=left_edge, dims=box_width, num_ghost_zones=1)
+            box, smooth_density = make_grid(ds, surface, left_edge, box_width, dx)
         elif (surface[0]=='cylinder'):
             left_edge = ds.halo_center_kpc - ds.arr([max_extent, max_extent, max_extent], 'kpc')
             box_width = ds.arr([int(max_extent*2./dx), int(max_extent*2./dx), int(max_extent*2./dx)])
-            box = ds.covering_grid(level=args.level, left_edge=left_edge, dims=box_width, num_ghost_zones=1)
+            box, smooth_density = make_grid(ds, surface, left_edge, box_width, dx)
 
     if (surface[0]=='disk'):
         # Define the density cut between disk and CGM to vary smoothly between 1 and 0.1 between z = 0.5 and z = 0.25,
@@ -1550,8 +1766,9 @@ def find_shape(ds, surface, snap_props):
             density_cut_factor = 1. - 0.9*(current_time-8656.88)/2130.24
         else:
             density_cut_factor = 0.1
-        density = box['gas','density'].in_units('g/cm**3').v
-        smooth_density = gaussian_filter(density, (5./dx)/6.)
+        if (smooth_density is None):
+            density = grid_field(box, 'density', 'g/cm**3')
+            smooth_density = gaussian_filter(density, (5./dx)/6.)
         shape = (smooth_density > density_cut_factor * cgm_density_max)
     elif (surface[0]=='stellar_disk'):
         x_stars = data['young_stars8','x_disk'].v
@@ -1563,16 +1780,16 @@ def find_shape(ds, surface, snap_props):
         z_stars = z_stars[r_stars < 20.]
         stars_radius = np.max(np.sqrt(x_stars**2. + y_stars**2.))
         stars_height = np.max(np.abs(z_stars))
-        x = box['gas','x_disk'].in_units('kpc').v
-        y = box['gas','y_disk'].in_units('kpc').v
-        z = box['gas','z_disk'].in_units('kpc').v
+        x = grid_field(box, 'x_disk', 'kpc')
+        y = grid_field(box, 'y_disk', 'kpc')
+        z = grid_field(box, 'z_disk', 'kpc')
         shape = (z >= -stars_height) & (z <= stars_height) & (np.sqrt(x**2.+y**2.) <= stars_radius)
     elif (surface[0]=='sphere'):
         if (args.Rvir):
             R = surface[1] * Rvir
         else:
             R = surface[1]
-        radius = box['gas','radius_corrected'].in_units('kpc').v
+        radius = grid_field(box, 'radius_corrected', 'kpc')
         shape = (radius < R)
     elif (surface[0]=='cylinder'):
         if (args.Rvir):
@@ -1582,13 +1799,13 @@ def find_shape(ds, surface, snap_props):
             radius = surface[1]
             height = surface[2]
         if (surface[3]=='minor'):
-            x = box['gas','x_disk'].in_units('kpc').v
-            y = box['gas','y_disk'].in_units('kpc').v
-            z = box['gas','z_disk'].in_units('kpc').v
+            x = grid_field(box, 'x_disk', 'kpc')
+            y = grid_field(box, 'y_disk', 'kpc')
+            z = grid_field(box, 'z_disk', 'kpc')
         else:
-            x = box['gas','x'].in_units('kpc').v - ds.halo_center_kpc[0].v
-            y = box['gas','y'].in_units('kpc').v - ds.halo_center_kpc[1].v
-            z = box['gas','z'].in_units('kpc').v - ds.halo_center_kpc[2].v
+            x = grid_field(box, 'x', 'kpc') - ds.halo_center_kpc[0].v
+            y = grid_field(box, 'y', 'kpc') - ds.halo_center_kpc[1].v
+            z = grid_field(box, 'z', 'kpc') - ds.halo_center_kpc[2].v
         if (surface[3]=='z') or (surface[3]=='minor'):
             norm_coord = z
             rad_coord = np.sqrt(x**2. + y**2.)
@@ -1655,15 +1872,9 @@ def load_and_calculate(snap, surface):
     zsnap = ds.get_parameter('CosmologyCurrentRedshift')
 
     # Load the mass enclosed profile
-    if (zsnap > 2.):
-        masses = Table.read(catalog_dir + 'masses_z-gtr-2.hdf5', path='all_data')
-    else:
-        masses = Table.read(catalog_dir + 'masses_z-less-2.hdf5', path='all_data')
-    rvir_masses = Table.read(catalog_dir + 'rvir_masses.hdf5', path='all_data')
-    masses_ind = np.where(masses['snapshot']==snap)[0]
-    Menc_profile = IUS(np.concatenate(([0],masses['radius'][masses_ind])), np.concatenate(([0],masses['total_mass'][masses_ind])))
-    Mvir = rvir_masses['total_mass'][rvir_masses['snapshot']==snap][0]
-    Rvir = rvir_masses['radius'][rvir_masses['snapshot']==snap][0]
+    radius, total_mass = lookup_masses(catalog_dir, snap, zsnap)
+    Menc_profile = IUS(np.concatenate(([0],radius)), np.concatenate(([0],total_mass)))
+    Rvir, Mvir = lookup_rvir(catalog_dir, snap)
     snap_props = [Menc_profile, Mvir, Rvir]
 
     if (args.plot=='sky_map'):
@@ -2541,6 +2752,9 @@ if __name__ == "__main__":
     # Set directory for output location, making it if necessary
     prefix = output_dir + 'fluxes_halo_00' + args.halo + '/' + args.run + '/'
     if not (os.path.exists(prefix)): os.system('mkdir -p ' + prefix)
+    # Tiled grids are read back from disk through the grid cache, so they need somewhere to go
+    if (args.tile_size > 0) and (args.grid_cache=='none'):
+        args.grid_cache = prefix + 'grid_cache/'
 
     print('foggie_dir: ', foggie_dir)
     catalog_dir = code_path + 'halo_infos/00' + args.halo + '/' + args.run + '/'
@@ -2584,72 +2798,23 @@ if __name__ == "__main__":
             target_dir = save_suffix
         else:
             target_dir = 'fluxes'
-        if (args.nproc==1):
-            if (args.streamlines):
-                streamlines_over_time(outs)
-            elif (args.plot=='streamlines'):
-                for snap in outs:
-                    plot_streamlines(snap)
+        # Delete leftover outputs from failed processes from tmp directory if on pleiades
+        if (args.system=='pleiades_cassi'):
+            if (args.copy_to_tmp):
+                tmp_dir = '/tmp/' + args.halo + '/' + args.run + '/' + target_dir + '/'
             else:
-                for snap in outs:
-                    load_and_calculate(snap, surface)
+                tmp_dir = '/nobackup/clochhaa/tmp/' + args.halo + '/' + args.run + '/' + target_dir + '/'
         else:
-            skipped_outs = outs
-            while (len(skipped_outs)>0):
-                skipped_outs = []
-                # Split into a number of groupings equal to the number of processors
-                # and run one process per processor
-                for i in range(len(outs)//args.nproc):
-                    threads = []
-                    snaps = []
-                    for j in range(args.nproc):
-                        snap = outs[args.nproc*i+j]
-                        snaps.append(snap)
-                        if (args.plot=='streamlines'):
-                            threads.append(multi.Process(target=plot_streamlines, args=[snap]))
-                        else:
-                            threads.append(multi.Process(target=load_and_calculate, args=[snap, surface]))
-                    for t in threads:
-                        t.start()
-                    for t in threads:
-                        t.join()
-                    # Delete leftover outputs from failed processes from tmp directory if on pleiades
-                    if (args.system=='pleiades_cassi'):
-                        if (args.copy_to_tmp):
-                            snap_dir = '/tmp/' + args.halo + '/' + args.run + '/' + target_dir + '/'
-                        else:
-                            snap_dir = '/nobackup/clochhaa/tmp/' + args.halo + '/' + args.run + '/' + target_dir + '/'
-                        for s in range(len(snaps)):
-                            if (os.path.exists(snap_dir + snaps[s])):
-                                print('Deleting failed %s from /tmp' % (snaps[s]))
-                                skipped_outs.append(snaps[s])
-                                shutil.rmtree(snap_dir + snaps[s])
-                # For any leftover snapshots, run one per processor
-                threads = []
-                snaps = []
-                for j in range(len(outs)%args.nproc):
-                    snap = outs[-(j+1)]
-                    snaps.append(snap)
-                    if (args.plot=='streamlines'):
-                        threads.append(multi.Process(target=plot_streamlines, args=[snap]))
-                    else:
-                        threads.append(multi.Process(target=load_and_calculate, args=[snap, surface]))
-                for t in threads:
-                    t.start()
-                for t in threads:
-                    t.join()
-                # Delete leftover outputs from failed processes from tmp directory if on pleiades
-                if (args.system=='pleiades_cassi'):
-                    if (args.copy_to_tmp):
-                        snap_dir = '/tmp/' + args.halo + '/' + args.run + '/' + target_dir + '/'
-                    else:
-                        snap_dir = '/nobackup/clochhaa/tmp/' + args.halo + '/' + args.run + '/' + target_dir + '/'
-                    for s in range(len(snaps)):
-                        if (os.path.exists(snap_dir + snaps[s])):
-                            print('Deleting failed %s from /tmp' % (snaps[s]))
-                            skipped_outs.append(snaps[s])
-                            shutil.rmtree(snap_dir + snaps[s])
-                outs = skipped_outs
+            tmp_dir = None
+        if (args.nproc==1) and (args.streamlines):
+            streamlines_over_time(outs)
+        elif (args.plot=='streamlines'):
+            run_snapshots(plot_streamlines, outs, nproc=args.nproc, retries=args.retries, mem_per_snap=args.mem_per_snap, \
+              manifest=prefix + 'finished_streamlines' + save_suffix + '.txt', resume=args.resume, tmp_dir=tmp_dir)
+        else:
+            run_snapshots(load_and_calculate, outs, make_args=lambda snap: (snap, surface), nproc=args.nproc, \
+              retries=args.retries, mem_per_snap=args.mem_per_snap, manifest=prefix + 'finished_' + target_dir + '.txt', \
+              resume=args.resume, tmp_dir=tmp_dir)
 
     print(str(datetime.datetime.now()))
     print("All snapshots finished!")
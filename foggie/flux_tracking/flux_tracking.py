@@ -14,6 +14,8 @@ utils/get_run_loc_etc.py
 utils/yt_fields.py
 utils/foggie_load.py
 utils/analysis_utils.py
+utils/snapshot_scheduler.py
+utils/halo_catalog.py
 """
 
 # Import everything as needed
@@ -45,6 +47,8 @@ from foggie.utils.get_run_loc_etc import get_run_loc_etc
 from foggie.utils.yt_fields import *
 from foggie.utils.foggie_load import *
 from foggie.utils.analysis_utils import *
+from foggie.utils.snapshot_scheduler import run_snapshots
+from foggie.utils.halo_catalog import lookup_halo_c_v, lookup_masses, lookup_rvir
 
 def parse_args():
     '''Parse command line arguments. Returns args object.
@@ -204,6 +208,21 @@ def parse_args():
                         "Default is not to do this.")
     parser.set_defaults(copy_to_tmp=False)
 
+    parser.add_argument('--retries', metavar='retries', type=int, action='store', \
+                        help='If running in parallel, how many times do you want to retry a snapshot that fails? Default is 2.')
+    parser.set_defaults(retries=2)
+
+    parser.add_argument('--mem_per_snap', metavar='mem_per_snap', type=float, action='store', \
+                        help='If running in parallel, how much memory (in GB) does one snapshot need? If given, fewer\n' + \
+                        'than nproc snapshots will be run at once if the node does not have enough memory available.\n' + \
+                        'Default is not to limit by memory.')
+    parser.set_defaults(mem_per_snap=0.)
+
+    parser.add_argument('--resume', dest='resume', action='store_true', \
+                        help='Do you want to skip snapshots that were already finished by a previous run that was\n' + \
+                        'interrupted? Default is no, start over with all snapshots.')
+    parser.set_defaults(resume=False)
+
 
     args = parser.parse_args()
     return args
@@ -612,38 +631,28 @@ def calc_fluxes_simple(ds, snap, zsnap, dt, refine_width_kpc, tablename, save_su
     if (args.temp_cut): temps = [0.,4.,5.,6.,12.]
     else: temps = [0.]
 
+    # Sum every field within every temperature bin in one pass, rather than masking the arrays
+    # separately for every field and temperature bin
+    num_temps = len(temps)
+    temp_index_shapes = bin_index(temperature_shapes, temps)
+    temp_index_in = bin_index(temperature_in_shapes, temps)
+    temp_index_out = bin_index(temperature_out_shapes, temps)
+    index_shapes = np.zeros(len(temperature_shapes), dtype=int)
+    index_in = np.zeros(len(temperature_in_shapes), dtype=int)
+    index_out = np.zeros(len(temperature_out_shapes), dtype=int)
+
     for i in range(len(fields)):
         if (fluxes[i]=='cooling_energy_flux'):
-            iter = [0]
-            field = fields[i][bool_inshapes_entire]
+            sums = binned_sums(index_shapes, fields[i][bool_inshapes_entire], 1, temp_index_shapes, num_temps)
+            for k in range(num_temps):
+                row.append(-sums[k][0])
         else:
-            iter = [0,1,2]
-            field_in = fields_in_shapes[i]
-            field_out = fields_out_shapes[i]
-
-        for k in range(len(temps)):
-            if (k==0):
-                if (fluxes[i]=='cooling_energy_flux'):
-                    field_t = field
-                else:
-                    field_in_t = field_in
-                    field_out_t = field_out
-            else:
-                if (fluxes[i]=='cooling_energy_flux'):
-                    field_t = field[(temperature_shapes > temps[k-1]) & (temperature_shapes < temps[k])]
-                else:
-                    field_in_t = field_in[(temperature_in_shapes > temps[k-1]) & (temperature_in_shapes < temps[k])]
-                    field_out_t = field_out[(temperature_out_shapes > temps[k-1]) & (temperature_out_shapes < temps[k])]
-            for j in iter:
-                if (j==0):
-                    if (fluxes[i]=='cooling_energy_flux'):
-                        row.append(-np.sum(field_t))
-                    else:
-                        row.append(np.sum(field_out_t)/dt - np.sum(field_in_t)/dt)
-                if (j==1):
-                    row.append(-np.sum(field_in_t)/dt)
-                if (j==2):
-                    row.append(np.sum(field_out_t)/dt)
+            sums_in = binned_sums(index_in, fields_in_shapes[i], 1, temp_index_in, num_temps)
+            sums_out = binned_sums(index_out, fields_out_shapes[i], 1, temp_index_out, num_temps)
+            for k in range(num_temps):
+                row.append(sums_out[k][0]/dt - sums_in[k][0]/dt)
+                row.append(-sums_in[k][0]/dt)
+                row.append(sums_out[k][0]/dt)
 
     table.add_row(row)
     table = set_table_units(table)
@@ -1070,90 +1079,89 @@ def calc_fluxes(ds, snap, zsnap, dt, refine_width_kpc, tablename, save_suffix, s
     if (args.temp_cut): temps = [0.,5.,12.]
     else: temps = [0.]
 
-    # Loop over chunks and compute fluxes to add to tables
-    for r in range(len(chunks)-1):
-        if (r%10==0): print("Computing chunk " + str(r) + "/" + str(len(chunks)) + \
-                            " for snapshot " + snap)
+    # Sort cells into chunks once: find which chunk boundaries each cell crosses between this snapshot
+    # and the next and which chunk each cell is in, then sum every field within every chunk and
+    # temperature bin in one pass, rather than masking the arrays separately for every chunk
+    print('Binning cells into chunks for snapshot ' + snap)
+    chunk_edges = np.asarray(chunks)
+    num_chunks = len(chunks)-1
+    num_temps = len(temps)
+    temp_index_shapes = bin_index(temperature_shapes, temps)
+    up_cells, up_chunks = crossing_index(radius_shapes, new_radius_shapes, chunk_edges)
+    down_cells, down_chunks = crossing_index(new_radius_shapes, radius_shapes, chunk_edges)
+    r_chunks = bin_index(radius_shapes, chunk_edges)
+    if (edges):
+        in_chunks = bin_index(new_radius_in_shapes, chunk_edges)
+        out_chunks = bin_index(radius_out_shapes, chunk_edges)
+        temp_index_in = bin_index(temperature_in_shapes, temps)
+        temp_index_out = bin_index(temperature_out_shapes, temps)
+    if (sat):
+        in_sat_chunks = bin_index(new_radius_in_sat, chunk_edges)
+        out_sat_chunks = bin_index(radius_out_sat, chunk_edges)
+        temp_index_in_sat = bin_index(temperature_in_sat, temps)
+        temp_index_out_sat = bin_index(temperature_out_sat, temps)
+
+    # Each of these lists holds one array of shape (num_temps, num_chunks) for each field
+    sums_r, sums_up, sums_down = [], [], []
+    sums_in, sums_out, sums_in_sat, sums_out_sat = [], [], [], []
+    for i in range(len(fields)):
+        if (fluxes[i]=='cooling_energy_flux'):
+            sums_r.append(binned_sums(r_chunks, fields_shapes[i], num_chunks, temp_index_shapes, num_temps))
+            sums_up.append(None)
+            sums_down.append(None)
+            sums_in.append(None)
+            sums_out.append(None)
+            sums_in_sat.append(None)
+            sums_out_sat.append(None)
+        else:
+            sums_r.append(None)
+            sums_up.append(binned_sums(up_chunks, fields_shapes[i][up_cells], num_chunks, \
+              temp_index_shapes[up_cells], num_temps))
+            sums_down.append(binned_sums(down_chunks, fields_shapes[i][down_cells], num_chunks, \
+              temp_index_shapes[down_cells], num_temps))
+            if (edges):
+                sums_in.append(binned_sums(in_chunks, fields_in_shapes[i], num_chunks, temp_index_in, num_temps))
+                sums_out.append(binned_sums(out_chunks, fields_out_shapes[i], num_chunks, temp_index_out, num_temps))
+            else:
+                sums_in.append(None)
+                sums_out.append(None)
+            if (sat):
+                sums_in_sat.append(binned_sums(in_sat_chunks, fields_in_sat[i], num_chunks, temp_index_in_sat, num_temps))
+                sums_out_sat.append(binned_sums(out_sat_chunks, fields_out_sat[i], num_chunks, temp_index_out_sat, num_temps))
+            else:
+                sums_in_sat.append(None)
+                sums_out_sat.append(None)
 
+    # Loop over chunks and add the fluxes to the tables
+    for r in range(num_chunks):
         inner = chunks[r]
         outer = chunks[r+1]
         row = [zsnap, inner]
         if (edges): row_edge = [zsnap, inner, outer]
         if (sat): row_sat = [zsnap, inner, outer]
 
-        temp_up = temperature_shapes[(radius_shapes < inner) & (new_radius_shapes > inner)]
-        temp_down = temperature_shapes[(radius_shapes > inner) & (new_radius_shapes < inner)]
-        temp_r = temperature_shapes[(radius_shapes > inner) & (radius_shapes < outer)]
-        if (edges):
-            temp_in = temperature_in_shapes[(new_radius_in_shapes > inner) & (new_radius_in_shapes < outer)]
-            temp_out = temperature_out_shapes[(radius_out_shapes > inner) & (radius_out_shapes < outer)]
-        if (sat):
-            temp_in_sat = temperature_in_sat[(new_radius_in_sat > inner) & (new_radius_in_sat < outer)]
-            temp_out_sat = temperature_out_sat[(radius_out_sat > inner) & (radius_out_sat < outer)]
-
         for i in range(len(fields)):
-            if (fluxes[i]=='cooling_energy_flux'):
-                iter = [0]
-                field_r = fields_shapes[i][(radius_shapes > inner) & (radius_shapes < outer)]
-            else:
-                iter = [0,1,2]
-                field_up = fields_shapes[i][(radius_shapes < inner) & (new_radius_shapes > inner)]
-                field_down = fields_shapes[i][(radius_shapes > inner) & (new_radius_shapes < inner)]
-                if (edges):
-                    field_in = fields_in_shapes[i][(new_radius_in_shapes > inner) & (new_radius_in_shapes < outer)]
-                    field_out = fields_out_shapes[i][(radius_out_shapes > inner) & (radius_out_shapes < outer)]
-                if (sat):
-                    field_in_sat = fields_in_sat[i][(new_radius_in_sat > inner) & (new_radius_in_sat < outer)]
-                    field_out_sat = fields_out_sat[i][(radius_out_sat > inner) & (radius_out_sat < outer)]
-
-            for k in range(len(temps)):
-                if (k==0):
-                    if (fluxes[i]=='cooling_energy_flux'):
-                        field_r_t = field_r
-                    else:
-                        field_up_t = field_up
-                        field_down_t = field_down
-                        if (edges):
-                            field_in_t = field_in
-                            field_out_t = field_out
-                        if (sat):
-                            field_in_sat_t = field_in_sat
-                            field_out_sat_t = field_out_sat
+            for k in range(num_temps):
+                if (fluxes[i]=='cooling_energy_flux'):
+                    row.append(-sums_r[i][k][r])
                 else:
-                    if (fluxes[i]=='cooling_energy_flux'):
-                        field_r_t = field_r[(temp_r > temps[k-1]) & (temp_r < temps[k])]
-                    else:
-                        field_up_t = field_up[(temp_up > temps[k-1]) & (temp_up < temps[k])]
-                        field_down_t = field_down[(temp_down > temps[k-1]) & (temp_down < temps[k])]
-                        if (edges):
-                            field_in_t = field_in[(temp_in > temps[k-1]) & (temp_in < temps[k])]
-                            field_out_t = field_out[(temp_out > temps[k-1]) & (temp_out < temps[k])]
-                        if (sat):
-                            field_in_sat_t = field_in_sat[(temp_in_sat > temps[k-1]) & (temp_in_sat < temps[k])]
-                            field_out_sat_t = field_out_sat[(temp_out_sat > temps[k-1]) & (temp_out_sat < temps[k])]
-                for j in iter:
-                    if (j==0):
-                        if (fluxes[i]=='cooling_energy_flux'):
-                            row.append(-np.sum(field_r_t))
-                        else:
-                            row.append(np.sum(field_up_t)/dt - np.sum(field_down_t)/dt)
-                            if (edges):
-                                row_edge.append(np.sum(field_in_t)/dt - np.sum(field_out_t)/dt)
-                            if (sat):
-                                row_sat.append(np.sum(field_in_sat_t)/dt - np.sum(field_out_sat_t)/dt)
-                    if (j==1):
-                        row.append(-np.sum(field_down_t)/dt)
-                        if (edges):
-                            row_edge.append(np.sum(field_in_t)/dt)
-                        if (sat):
-                            row_sat.append(np.sum(field_in_sat_t)/dt)
-                    if (j==2):
-                        row.append(np.sum(field_up_t)/dt)
-                        if (edges):
-                            row_edge.append(-np.sum(field_out_t)/dt)
-                        if (sat):
-                            row_sat.append(-np.sum(field_out_sat_t)/dt)
-
+                    up = sums_up[i][k][r]
+                    down = sums_down[i][k][r]
+                    row.append(up/dt - down/dt)
+                    row.append(-down/dt)
+                    row.append(up/dt)
+                    if (edges):
+                        field_in = sums_in[i][k][r]
+                        field_out = sums_out[i][k][r]
+                        row_edge.append(field_in/dt - field_out/dt)
+                        row_edge.append(field_in/dt)
+                        row_edge.append(-field_out/dt)
+                    if (sat):
+                        field_in_sat = sums_in_sat[i][k][r]
+                        field_out_sat = sums_out_sat[i][k][r]
+                        row_sat.append(field_in_sat/dt - field_out_sat/dt)
+                        row_sat.append(field_in_sat/dt)
+                        row_sat.append(-field_out_sat/dt)
 
         table.add_row(row)
         if (edges): table_edge.add_row(row_edge)
@@ -1219,31 +1227,18 @@ def load_and_calculate(system, foggie_dir, run_dir, track, halo_c_v_name, snap,
             elif (snap2 < 100): snap2 = snap_type + '00' + str(snap2)
             elif (snap2 < 1000): snap2 = snap_type + '0' + str(snap2)
             else: snap2 = snap_type + str(snap2)
-            halo_c_v = Table.read(halo_c_v_name, format='ascii')
-            halo_ind = np.where(halo_c_v['col3']==snap2)[0][0]
-            halo_center_kpc2 = ds.arr([float(halo_c_v['col4'][halo_ind]), \
-                                      float(halo_c_v['col5'][halo_ind]), \
-                                      float(halo_c_v['col6'][halo_ind])], 'kpc')
+            halo_center_kpc2 = ds.arr(lookup_halo_c_v(halo_c_v_name, snap2)[0], 'kpc')
         else:
             print("Removing satellites for an RD output is not as accurate as for DD outputs, but I'll do it anyway")
-            halo_c_v = Table.read(halo_c_v_name, format='ascii')
-            halo_ind = np.where(halo_c_v['col3']==snap[-6:])[0][0]
-            halo_center_kpc2 = ds.arr([float(halo_c_v['col4'][halo_ind]), \
-                                      float(halo_c_v['col5'][halo_ind]), \
-                                      float(halo_c_v['col6'][halo_ind])], 'kpc')
+            halo_center_kpc2 = ds.arr(lookup_halo_c_v(halo_c_v_name, snap)[0], 'kpc')
     else:
         sat = False
         halo_center_kpc2 = [0,0,0]
 
     # Load the mass enclosed profile
-    if (zsnap > 2.):
-        masses = Table.read(masses_dir + 'masses_z-gtr-2.hdf5', path='all_data')
-    else:
-        masses = Table.read(masses_dir + 'masses_z-less-2.hdf5', path='all_data')
-    rvir_masses = Table.read(masses_dir + 'rvir_masses.hdf5', path='all_data')
-    snap_ind = masses['snapshot']==snap
-    Menc_profile = IUS(masses['radius'][snap_ind], masses['total_mass'][snap_ind])
-    Rvir = rvir_masses['radius'][rvir_masses['snapshot']==snap]
+    radius, total_mass = lookup_masses(masses_dir, snap, zsnap)
+    Menc_profile = IUS(radius, total_mass)
+    Rvir = np.array([lookup_rvir(masses_dir, snap)[0]])
 
     # Do the actual calculation
     if (args.simple):
@@ -1314,72 +1309,20 @@ if __name__ == "__main__":
             print('The flux type   %s   has not been implemented. Ask Cassi to add it.' % (flux_types[i]))
             sys.exit()
 
-    # Loop over outputs, for either single-processor or parallel processor computing
-    if (args.nproc==1):
-        for i in range(len(outs)):
-            snap = outs[i]
-            # Make the output table name for this snapshot
-            tablename = prefix + snap + '_fluxes'
-            # Do the actual calculation
-            load_and_calculate(args.system, foggie_dir, run_dir, trackname, halo_c_v_name, snap, \
-              tablename, save_suffix, surfaces, flux_types, sat_dir, sat_radius, masses_dir)
+    # Delete leftover outputs from failed processes from tmp directory if on pleiades
+    if (args.system=='pleiades_cassi'):
+        if (args.copy_to_tmp):
+            tmp_dir = '/tmp/' + args.halo + '/' + args.run + '/fluxes/'
+        else:
+            tmp_dir = '/nobackup/clochhaa/tmp/' + args.halo + '/' + args.run + '/fluxes/'
     else:
-        skipped_outs = outs
-        while (len(skipped_outs)>0):
-            skipped_outs = []
-            # Split into a number of groupings equal to the number of processors
-            # and run one process per processor
-            for i in range(len(outs)//args.nproc):
-                threads = []
-                snaps = []
-                for j in range(args.nproc):
-                    snap = outs[args.nproc*i+j]
-                    snaps.append(snap)
-                    tablename = prefix + snap + '_fluxes'
-                    threads.append(multi.Process(target=load_and_calculate, \
-    			       args=(args.system, foggie_dir, run_dir, trackname, halo_c_v_name, snap, \
-                         tablename, save_suffix, surfaces, flux_types, sat_dir, sat_radius, masses_dir)))
-                for t in threads:
-                    t.start()
-                for t in threads:
-                    t.join()
-                # Delete leftover outputs from failed processes from tmp directory if on pleiades
-                if (args.system=='pleiades_cassi'):
-                    if (args.copy_to_tmp):
-                        snap_dir = '/tmp/' + args.halo + '/' + args.run + '/fluxes/'
-                    else:
-                        snap_dir = '/nobackup/clochhaa/tmp/' + args.halo + '/' + args.run + '/fluxes/'
-                    for s in range(len(snaps)):
-                        if (os.path.exists(snap_dir + snaps[s])):
-                            print('Deleting failed %s from /tmp' % (snaps[s]))
-                            skipped_outs.append(snaps[s])
-                            shutil.rmtree(snap_dir + snaps[s])
-            # For any leftover snapshots, run one per processor
-            threads = []
-            snaps = []
-            for j in range(len(outs)%args.nproc):
-                snap = outs[-(j+1)]
-                snaps.append(snap)
-                tablename = prefix + snap + '_fluxes'
-                threads.append(multi.Process(target=load_and_calculate, \
-    			   args=(args.system, foggie_dir, run_dir, trackname, halo_c_v_name, snap, \
-                     tablename, save_suffix, surfaces, flux_types, sat_dir, sat_radius, masses_dir)))
-            for t in threads:
-                t.start()
-            for t in threads:
-                t.join()
-            # Delete leftover outputs from failed processes from tmp directory if on pleiades
-            if (args.system=='pleiades_cassi'):
-                if (args.copy_to_tmp):
-                    snap_dir = '/tmp/' + args.halo + '/' + args.run + '/fluxes/'
-                else:
-                    snap_dir = '/nobackup/clochhaa/tmp/' + args.halo + '/' + args.run + '/fluxes/'
-                for s in range(len(snaps)):
-                    if (os.path.exists(snap_dir + snaps[s])):
-                        print('Deleting failed %s from /tmp' % (snaps[s]))
-                        skipped_outs.append(snaps[s])
-                        shutil.rmtree(snap_dir + snaps[s])
-            outs = skipped_outs
+        tmp_dir = None
+
+    # Loop over outputs, for either single-processor or parallel processor computing
+    run_snapshots(load_and_calculate, outs, make_args=lambda snap: (args.system, foggie_dir, run_dir, trackname, \
+      halo_c_v_name, snap, prefix + snap + '_fluxes', save_suffix, surfaces, flux_types, sat_dir, sat_radius, masses_dir), \
+      nproc=args.nproc, retries=args.retries, mem_per_snap=args.mem_per_snap, \
+      manifest=prefix + 'finished_fluxes' + save_suffix + '.txt', resume=args.resume, tmp_dir=tmp_dir)
 
     print(str(datetime.datetime.now()))
     print("All snapshots finished!")
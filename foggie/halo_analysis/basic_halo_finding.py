@@ -19,6 +19,9 @@ import datashader.transfer_functions as tf
 import multiprocessing as mp
 from astropy.cosmology import WMAP9
 from astropy.table import Table
+from scipy.spatial import cKDTree
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 
 @yt.particle_filter(requires=["particle_type"], filtered_type='all')
 def stars(pfilter, data):
@@ -89,83 +92,6 @@ def aggregate_particles(df, axis1, axis2, bincount):
 
 
 
-def assign_densities(particle_df):
-    """ Assign 2D projected densities to each particle in the dataframe
-        Sum those densities and put them all into the dataframe."""
-
-    #<---- aggregate the particles and populate the projected 2D density
-    #<---- fields of the dataframe Z projection, so axis1 = x, axis2=y,
-    #<---- flip for subscripts
-    agg_z = aggregate_particles(particle_df, 'position_x', 'position_y', 2500)
-    densities = agg_z.values
-    xsubs = np.floor(particle_df['position_x']/10.).astype(int)
-    ysubs = np.floor(particle_df['position_y']/10.).astype(int)
-    zsubs = np.floor(particle_df['position_z']/10.).astype(int)
-    particle_df['z_proj_density'] = densities[ysubs, xsubs]
-
-    #<---- Y projection, so axis1 = x, axis2=z, flip for subscripts
-    agg_y = aggregate_particles(particle_df, 'position_x', 'position_z', 2500)
-    densities = agg_y.values
-    particle_df['y_proj_density'] = densities[zsubs, xsubs]
-
-    #<---- X projection, so axis1 = y, axis2=z, flip for subscripts
-    agg_x = aggregate_particles(particle_df, 'position_y', 'position_z', 2500)
-    densities = agg_x.values
-    particle_df['x_proj_density'] = densities[zsubs, ysubs]
-
-    particle_df['sum_proj_density'] = particle_df['x_proj_density'] + \
-                                      particle_df['y_proj_density'] + \
-                                      particle_df['z_proj_density']
-
-    particle_df.sort_values('sum_proj_density', ascending=False, inplace=True)
-
-    print("Done assigning densities.")
-
-    return {'agg_x':agg_x, 'agg_y':agg_y, 'agg_z':agg_z}, particle_df
-
-
-
-def halo_r200_guess(sigma):
-    return 10.**(0.4 * np.log10(sigma) - 2.) / 1000.
-    #<---- provides a guess, in proper Mpc, for R200 based on the tabulated sum_proj_density
-
-
-
-def obtain_rvir(dataset, first_particle_position, total_box_density, central_sigma):
-
-    print("central sigma ", central_sigma)
-    print("R200 guess ", halo_r200_guess(central_sigma) )
-
-    radius = halo_r200_guess(central_sigma)
-    sph = dataset.sphere(first_particle_position, (radius, 'Mpc') )
-    halo_mass = sph['particle_mass'].sum().in_units('Msun')
-    halo_vol = 4. / 3. * 3.14159 * YTArray(radius, 'Mpc')**3
-    overdensity = halo_mass / halo_vol / total_box_density
-    print("initial overdensity at guess radius R = ", radius, " overdensity: ", overdensity)
-
-    if (overdensity > 200): #<---- if overdensity > 200, work *out* in radius
-        while overdensity > 200.:
-            increment = 1.1
-            if np.abs(overdensity - 200.) < 20: increment = 1.05
-            radius = radius * increment #<---- step out by 10 %
-            sph = dataset.sphere(first_particle_position, (radius, 'Mpc') )
-            halo_mass = sph['particle_mass'].sum().in_units('Msun')
-            halo_vol = 4. / 3. * 3.14159 * YTArray(radius, 'Mpc')**3
-            overdensity = halo_mass / halo_vol / total_box_density
-            print("stepping out from guess, radius R = ", radius, " overdensity: ", overdensity)
-    elif (overdensity < 200):  #<---- if overdensity < 200, work *in* in radius
-        while overdensity < 200.:
-            increment = 0.9
-            if np.abs(overdensity - 200.) < 20: increment = 0.95
-            radius = radius * increment #<---- step in by 5 kpc
-            sph = dataset.sphere(first_particle_position, (radius, 'Mpc') )
-            halo_mass = sph['particle_mass'].sum().in_units('Msun')
-            halo_vol = 4. / 3. * 3.14159 * YTArray(radius, 'Mpc')**3
-            overdensity = halo_mass / halo_vol / total_box_density
-            print("stepping in from guess, radius R = ", radius, " overdensity: ", overdensity)
-
-    return halo_mass, radius
-
 def get_stellar_mass(sph):
     tot_star_mass = sph['stars', 'particle_mass'].sum().in_units('Msun')
     print(tot_star_mass)
@@ -193,71 +119,238 @@ def get_stellar_mass(sph):
     return stellar_mass, half_mass_radius
 
 
-def find_a_halo(dataset, particle_df, used_particles, halo_catalog, total_box_density):
-
-    #<---- first we reassign densities based on the current particle dataframe
-    agg_dict, particle_df = assign_densities(particle_df)
+def get_particle_arrays(box):
+    """ extracts the particle positions (proper kpc and code units), masses (Msun),
+        indices, and types from a yt region as a dictionary of arrays"""
+
+    particles = {}
+    particles['position'] = np.transpose([box['particle_position_x'].in_units('kpc').ndarray_view(),
+                                          box['particle_position_y'].in_units('kpc').ndarray_view(),
+                                          box['particle_position_z'].in_units('kpc').ndarray_view()])
+    particles['code_position'] = np.transpose([box['particle_position_x'].ndarray_view(),
+                                               box['particle_position_y'].ndarray_view(),
+                                               box['particle_position_z'].ndarray_view()])
+    particles['mass'] = box['particle_mass'].in_units('Msun').ndarray_view()
+    particles['index'] = box['particle_index'].ndarray_view()
+    particles['type'] = box['particle_type'].ndarray_view()
+    print("Done with particle arrays")
+
+    return particles
+
+
+def knn_densities(tree, masses, k_neighbors=32, workers=1, chunk_size=1000000):
+    """ kernel density estimate at every particle in the cKDTree 'tree': the mass
+        of its k nearest neighbors (including itself) over the volume of the sphere
+        reaching the k-th one. Returns Msun per cubic unit of the tree positions."""
+
+    k_neighbors = min(k_neighbors, tree.n)
+    densities = np.zeros(tree.n)
+    for start in range(0, tree.n, chunk_size):
+        dist, ind = tree.query(tree.data[start:start+chunk_size], k=k_neighbors, workers=workers)
+        dist = dist.reshape(len(dist), -1)
+        ind = ind.reshape(len(ind), -1)
+        densities[start:start+chunk_size] = masses[ind].sum(axis=1) / \
+            (4. / 3. * np.pi * np.maximum(dist[:,-1], 1e-10)**3)
+
+    return densities
+
+
+def friends_of_friends(tree, linking_length, chunk_size=100000):
+    """ friends-of-friends groups of the particles in the cKDTree 'tree': any two
+        particles closer than 'linking_length' are in the same group. The pairs are
+        found for 'chunk_size' particles at a time and merged into the groups found so
+        far (union-find), so only one chunk's pairs are ever in memory. Returns the
+        group label of each particle."""
+
+    #<---- every particle points straight at the root (lowest index) of its group
+    roots = np.arange(tree.n)
+    for start in range(0, tree.n, chunk_size):
+        chunk = cKDTree(tree.data[start:start+chunk_size])
+        pairs = chunk.sparse_distance_matrix(tree, linking_length, output_type='ndarray')
+        i, j = pairs['i'] + start, pairs['j']
+        a, b = roots[i[i < j]], roots[j[i < j]]
+        a, b = a[a != b], b[a != b]
+        if (len(a) == 0): continue
+        #<---- merge the groups these pairs join, each into its lowest root
+        linked, inverse = np.unique(np.concatenate((a, b)), return_inverse=True)
+        graph = coo_matrix((np.ones(len(a)), (inverse[:len(a)], inverse[len(a):])), shape=(len(linked), len(linked)))
+        n_merged, merged = connected_components(graph, directed=False)
+        new_root = np.full(n_merged, tree.n)
+        np.minimum.at(new_root, merged, linked)
+        remap = np.arange(tree.n)
+        remap[linked] = new_root[merged]
+        roots = remap[roots]
+
+    group_roots, labels = np.unique(roots, return_inverse=True)
+    print("Found ", len(group_roots), " friends-of-friends groups")
+
+    return labels
+
+
+def find_candidates(labels, densities, masses, min_particles, min_density):
+    """ the densest particle of each friends-of-friends group with at least
+        'min_particles' particles whose density is above 'min_density'. Returns the
+        indices of those particles, sorted by decreasing density, and the masses of
+        their groups."""
+
+    group_n = np.bincount(labels)
+    group_mass = np.bincount(labels, weights=masses)
+    #<---- sort by group then by decreasing density, so the first of each group is its densest
+    order = np.lexsort((-densities, labels))
+    first = np.flatnonzero(np.r_[True, labels[order][1:] != labels[order][:-1]])
+    centers = order[first]
+    keep = (group_n[labels[centers]] >= min_particles) & (densities[centers] > min_density)
+    centers = centers[keep]
+    centers = centers[np.argsort(-densities[centers])]
+
+    return centers, group_mass[labels[centers]]
+
+
+def obtain_rvir_all(tree, masses, centers, mean_density, mass_guess, overdensity=200., workers=1,
+                    max_doublings=10):
+    """ virial radius and mass of every candidate at once: the particles around each
+        center are sorted by distance, and the radius is where the enclosed mass over
+        the enclosed volume first drops below 'overdensity' times 'mean_density' (Msun
+        per cubic unit of the tree positions). 'mass_guess' sets the first search
+        radius; candidates that are still above the overdensity at the edge of the
+        search are searched again with twice the radius, up to 'max_doublings' times.
+        Returns radius, mass, and for each candidate the indices of the particles
+        within its radius. Candidates whose radius isn't found (e.g. ones whose search
+        already covers every particle) are failed, with NaN radius and mass and no
+        particles."""
+
+    radius = np.zeros(len(centers))
+    mass = np.zeros(len(centers))
+    members = [None] * len(centers)
+    search_radius = 2. * (3. * mass_guess / (4. * np.pi * overdensity * mean_density))**(1./3.)
+    todo = np.arange(len(centers))
+    n_doublings = 0
+    while (len(todo) > 0) and (n_doublings <= max_doublings):
+        balls = tree.query_ball_point(tree.data[centers[todo]], search_radius[todo], workers=workers)
+        n_ball = np.array([len(ball) for ball in balls])
+        ind = np.concatenate(balls).astype(int)
+        owner = np.repeat(np.arange(len(todo)), n_ball)
+        dist = np.sqrt(np.sum((tree.data[ind] - tree.data[centers[todo]][owner])**2, axis=1))
+        order = np.lexsort((dist, owner))
+        ind, owner, dist = ind[order], owner[order], dist[order]
+        offsets = np.r_[0, np.cumsum(n_ball)]
+        cum_mass = np.cumsum(masses[ind])
+        cum_mass -= np.r_[0., cum_mass[offsets[1:-1]-1]][owner]
+        with np.errstate(divide='ignore'):
+            enclosed = cum_mass / (4. / 3. * np.pi * dist**3)
+        #<---- first particle (going out) where the enclosed overdensity is below the threshold
+        below = np.where(enclosed < overdensity * mean_density, np.arange(len(ind)), len(ind))
+        first_below = np.minimum.reduceat(below, offsets[:-1])
+        found = first_below < offsets[1:]
+        for t in np.flatnonzero(found):
+            n_in = first_below[t] - offsets[t]
+            radius[todo[t]] = dist[first_below[t]-1] if n_in > 0 else dist[first_below[t]]
+            mass[todo[t]] = cum_mass[first_below[t]-1] if n_in > 0 else 0.
+            members[todo[t]] = ind[offsets[t]:first_below[t]]
+        todo = todo[~found]
+        search_radius[todo] *= 2.
+        n_doublings += 1
+
+    if (len(todo) > 0): print("Could not find the virial radius of ", len(todo), " candidate halos")
+    radius[todo] = np.nan
+    mass[todo] = np.nan
+    for t in todo: members[t] = np.array([], dtype=int)
+
+    return radius, mass, members
+
+
+def get_stellar_masses(positions, masses, is_star, centers, members):
+    """ stellar mass within twice the stellar half-mass radius of each halo, and that
+        half-mass radius, from the star particles among its members (0, -1 if none)"""
+
+    stellar_mass = np.zeros(len(centers))
+    half_mass_radius = -np.ones(len(centers))
+    for h, center in enumerate(centers):
+        stars = members[h][is_star[members[h]]]
+        if (len(stars) == 0): continue
+        star_distance = np.sqrt(np.sum((positions[stars] - positions[center])**2, axis=1))
+        order = np.argsort(star_distance)
+        star_distance = star_distance[order]
+        cumulative_star_mass = np.cumsum(masses[stars][order])
+        half_mass_radius[h] = star_distance[np.argmin(np.abs(cumulative_star_mass - 0.5 * cumulative_star_mass[-1]))]
+        stellar_mass[h] = cumulative_star_mass[np.searchsorted(star_distance, 2. * half_mass_radius[h], side='right') - 1]
 
-    #<---- assume for now that the first particle is the new halo center
-    first_particle_index = particle_df.index.values[0]
-    first_particle_position = [particle_df['code_x'][first_particle_index],
-                               particle_df['code_y'][first_particle_index],
-                               particle_df['code_z'][first_particle_index]]
-    central_sigma = particle_df['sum_proj_density'][first_particle_index]
-
-    halo_mass, radius = obtain_rvir(dataset, first_particle_position, total_box_density, central_sigma)
-
-    print("FAH, with Mass :", halo_mass.value/1e12, 'e12 Msun and radius :', radius, 'Mpc')
-
-    sph = dataset.sphere(first_particle_position, (radius, 'Mpc') )
-    #<---- want to get more information about what is in this halo
-    stellar_mass, half_mass_radius = get_stellar_mass(sph)
-
-    sph.save_as_dataset(filename = 'halo_'+str(int(first_particle_index))+'.h5',
-        fields = ["particle_position_x", "particle_position_y", "particle_position_z",
-                  "particle_index", "particle_mass", "particle_type"])
-        #<---- these filenames should always be unique since no two halos should
-        # have the same key particle
-
-    pindex = sph['particle_index']
-
-    ss = particle_df['sum_proj_density'][first_particle_index]
-
-    print("FAH adding ", pindex.size, " to used_particles from the dataframe")
-    used_particles = used_particles.append(particle_df.loc[pindex])
-
-    print("FAH dropping ", pindex.size, " particles from the dataframe")
-    particle_df.drop(pindex, inplace=True, errors='ignore') #<---- ignore means particles that don't exist will be ignored.
+    return stellar_mass, half_mass_radius
 
-    hh = pd.DataFrame([[first_particle_position[0],
-                     first_particle_position[1],
-                     first_particle_position[2],
-                     halo_mass.value, radius, ss,
-                     stellar_mass, half_mass_radius, first_particle_index, pindex.size]],
-                     columns=['x0','y0','z0','Mhalo','r200', 'sum_dens', 'Mstar', 'rhalf', 'key_particle', 'n_particles'])
 
+def find_halos_in_particles(particles, mean_density, min_overdensity=1000., linking_length=0.2,
+                            min_particles=100, k_neighbors=32, n_processes=1):
+    """ the 3D halo-finding core. Builds one cKDTree over the particle positions,
+        estimates the density at each particle from its nearest neighbors, groups
+        the particles with friends-of-friends (linking length in units of the mean
+        separation of the high-resolution (least massive) dark matter particles at
+        the mean density), and takes
+        the densest particle of each group denser than 'min_overdensity' times the
+        mean as a candidate center. The virial radii of all candidates are found at
+        once (dropping any where it isn't found), then candidates are accepted in
+        order of decreasing central density, dropping any whose center is inside an
+        already accepted halo (just as
+        find_a_halo used to remove a halo's particles before picking the next).
+        'mean_density' is in Msun / kpc**3 (proper). The tree queries run on
+        'n_processes' threads, split over particles and candidates.
+
+        returns: halo_catalog"""
+
+    positions = particles['position']
+    masses = particles['mass']
+    tree = cKDTree(positions)
+    print("Built particle tree")
+    densities = knn_densities(tree, masses, k_neighbors=k_neighbors, workers=n_processes)
+    print("Done assigning densities.")
+    is_star = (particles['type'] == 2)
+    if np.any(~is_star): dm_mass = np.min(masses[~is_star])
+    else: dm_mass = np.min(masses)
+    labels = friends_of_friends(tree, linking_length * (dm_mass / mean_density)**(1./3.))
+    centers, group_mass = find_candidates(labels, densities, masses, min_particles, min_overdensity * mean_density)
+    print("Found ", len(centers), " candidate halos")
+    radius, mass, members = obtain_rvir_all(tree, masses, centers, mean_density, group_mass, workers=n_processes)
+
+    #<---- accept candidates from the densest down, skipping any inside an accepted halo
+    accepted = []
+    for c in range(len(centers)):
+        if not np.isfinite(radius[c]): continue
+        if (len(accepted) > 0):
+            d = np.sqrt(np.sum((positions[centers[accepted]] - positions[centers[c]])**2, axis=1))
+            if np.any(d < radius[accepted]): continue
+        accepted.append(c)
+    accepted = np.array(accepted, dtype=int)
+    centers, radius, mass = centers[accepted], radius[accepted], mass[accepted]
+    members = [members[c] for c in accepted]
+
+    stellar_mass, half_mass_radius = get_stellar_masses(positions, masses, is_star, centers, members)
+
+    halo_catalog = pd.DataFrame({'x0': particles['code_position'][centers,0],
+                                 'y0': particles['code_position'][centers,1],
+                                 'z0': particles['code_position'][centers,2],
+                                 'Mhalo': mass, 'r200': radius / 1000.,
+                                 'sum_dens': densities[centers], 'Mstar': stellar_mass,
+                                 'rhalf': half_mass_radius,
+                                 'key_particle': particles['index'][centers],
+                                 'n_particles': [len(m) for m in members]},
+                                columns=['x0','y0','z0','Mhalo','r200', 'sum_dens', 'Mstar', 'rhalf', 'key_particle', 'n_particles'])
 
-    return particle_df, used_particles, hh, pindex
+    return halo_catalog
 
 
+def get_mean_density(dataset):
+    """ mean matter density at the redshift of a yt dataset in Msun / proper kpc**3"""
+    return get_box_density(dataset).in_units('Msun/kpc**3').value * (1. + dataset.current_redshift)**3
 
 
-def find_halos_in_region(dsname, minsigma, qnumber, x0, y0, z0, x1, y1, z1):
+def find_halos_in_region(dsname, min_overdensity, qnumber, x0, y0, z0, x1, y1, z1, n_processes=1):
 
     print("Analyzing Octant : ", qnumber)
     dataset = yt.load(dsname)
-    dataset.add_particle_filter('stars')
     box = dataset.r[x0:x1, y0:y1, z0:z1]
-    particle_df, used_particles, halo_catalog = create_particle_df(box)
-    agg_dict, particle_df = assign_densities(particle_df)
-    while (np.max(particle_df['sum_proj_density']) > minsigma):
-        particle_df, used_particles, hh, pindex = find_a_halo(dataset, particle_df, used_particles, halo_catalog, get_box_density(dataset))
-        halo_catalog = halo_catalog.append(hh, ignore_index=True)
-        print("Halo in octant: ", qnumber, hh)
-
-    halo_catalog = halo_catalog[2:]
-    #halo_catalog.to_pickle('halo_octant_'+str(qnumber)+'.pkl' )
-#    used_particles.to_pickle('used_particles_'+str(qnumber)+'.pkl' )
+    particles = get_particle_arrays(box)
+    halo_catalog = find_halos_in_particles(particles, get_mean_density(dataset),
+                                           min_overdensity=min_overdensity, n_processes=n_processes)
+    print("Halos in octant: ", qnumber, halo_catalog)
 
     return halo_catalog
 
@@ -295,23 +388,25 @@ def color_code_dm(dsname):
 
 
 
-def find_halos_in_particle_dataframe(dsname, particle_df, used_particles, halo_catalog, minsigma):
+def find_halos_in_particle_dataframe(dsname, particle_df, min_overdensity, n_processes=1):
     """ this is for finding halos in a previously constructed df, however derived
     it could for instance use a df that has already been screened on particle location,
-    mass, type (stars) or whatever.
+    mass, type (stars) or whatever. the df needs code_x/y/z and mass columns, and
+    particle_type to find stellar masses.
 
-    inputs: dataset name, particle_df, used_particles, and minimum projected density.
+    inputs: dataset name, particle_df, and minimum overdensity of halo centers.
     outputs: halo_catalog
     """
 
     dataset = yt.load(dsname)
-    agg_dict, particle_df = assign_densities(particle_df)
-    while (np.max(particle_df['sum_proj_density']) > minsigma):
-        particle_df, used_particles, hh, pindex = find_a_halo(dataset, particle_df, used_particles, halo_catalog, get_box_density(dataset))
-        halo_catalog = halo_catalog.append(hh, ignore_index=True)
-        print("New halo dataframe : ", hh)
-
-    halo_catalog = halo_catalog[2:]
+    code_position = np.transpose([particle_df['code_x'], particle_df['code_y'], particle_df['code_z']])
+    particles = {'code_position': code_position,
+                 'position': code_position * dataset.domain_width.in_units('kpc').value,
+                 'mass': np.asarray(particle_df['mass']),
+                 'index': np.asarray(particle_df.index),
+                 'type': np.asarray(particle_df['particle_type']) if 'particle_type' in particle_df else np.zeros(len(particle_df))}
+    halo_catalog = find_halos_in_particles(particles, get_mean_density(dataset),
+                                           min_overdensity=min_overdensity, n_processes=n_processes)
 
     return halo_catalog
 
@@ -337,26 +432,20 @@ def get_subregions(dsname, minsigma, interval):
 
 
 
-def wrap_halo_finding(dsname, minsigma, interval, n_processes):
+def wrap_halo_finding(dsname, min_overdensity, n_processes, linking_length=0.2,
+                      min_particles=100, k_neighbors=32):
     """ This is the main function call to drive halo finding.
-    Parameters are the dataset name, the minimum projected density
-    to count as halos, and the dx/dy/dz interval for the subregions
-    that will be multithreaded."""
-
-    subregion_list = get_subregions(dsname, minsigma, interval)
-    pool = mp.Pool(processes=n_processes)
-    list_of_halos = pool.starmap(find_halos_in_region, subregion_list)
+    Parameters are the dataset name, the minimum overdensity (relative to the mean
+    matter density) of a halo's central particle, and the number of processes, which
+    the particle tree queries are split over (by particle for the densities and by
+    candidate for the virial radii). The whole box is handled by one particle tree,
+    so halos are never split between subregions."""
 
-    halo_catalog = pd.concat(list_of_halos)
-
-    used_particle_files = glob.glob('used_particles*pkl')
-    used_particles = [pd.read_pickle(used_particle_files[0])] #<---- a list
-
-    for file in used_particle_files[1:]:
-        uu = pd.read_pickle(file)
-        used_particles.append(uu)
-
-    used_particles_df = pd.concat(used_particles)
-    #used_particles_df.to_pickle('used_particles_all.pkl')
+    dataset = yt.load(dsname)
+    particles = get_particle_arrays(dataset.all_data())
+    halo_catalog = find_halos_in_particles(particles, get_mean_density(dataset),
+                                           min_overdensity=min_overdensity, linking_length=linking_length,
+                                           min_particles=min_particles, k_neighbors=k_neighbors,
+                                           n_processes=n_processes)
 
-    return halo_catalog, used_particles_df
+    return halo_catalog
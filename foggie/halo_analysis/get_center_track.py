@@ -10,7 +10,8 @@ import argparse
 import sys
 
 from foggie.utils.consistency  import  *
-from foggie.utils.get_halo_center import get_halo_center
+from foggie.utils.get_halo_center import get_halo_center, get_particle_center, read_center_particles
+from foggie.utils.track_builder import build_track
 import numpy as np
 
 
@@ -25,11 +26,86 @@ def parse_args():
                         help='which halo? default is 5016 (Squall)')
     parser.set_defaults(halo="5016")
 
+    parser.add_argument('--make_plots', dest='make_plots', action='store_true',
+                        help='make x, y, and z density projections of each snapshot once the track is done? default is no')
+    parser.set_defaults(make_plots=False)
+
+    parser.add_argument('--center_method', metavar='center_method', type=str, action='store',
+                        help='how to find the halo centers? options are dm_density (the peak of the dark matter density) ' +
+                        'and particles (a shrinking sphere on the dark matter and star particles, which is faster). default is dm_density')
+    parser.set_defaults(center_method='dm_density')
+
     args = parser.parse_args()
     return args
 
 
-def get_center_track(first_center, latesnap, earlysnap, interval):
+def load_snapshot(name, center_guess, center_method='dm_density'):
+    """ opens the snapshot 'name' and, if center_method is 'particles', reads
+        its particles within twice the search radius of 'center_guess', which
+        is the center two snapshots back when this runs ahead in the background"""
+
+    ds = yt.load(name+'/'+name)
+    particles = None
+    if (center_method == 'particles'):
+        search_radius = 10. / (1+ds.get_parameter('CosmologyCurrentRedshift'))  ## PHYSICAL kpc
+        particles = read_center_particles(ds.sphere(center_guess, (2.*search_radius, 'kpc')))
+
+    return ds, particles
+
+
+def find_center(name, data, center_guess, center_method='dm_density'):
+    """ centers the halo in the snapshot 'name' with get_halo_center's
+        center_method ('dm_density' or 'particles', which uses the particles
+        read by load_snapshot), and returns the row for the track log"""
+
+    ds, particles = data
+    print(name)
+    comoving_box_size = ds.get_parameter('CosmologyComovingBoxSize')
+    print('Comoving Box Size:', comoving_box_size)
+
+    # decreased these from 500 to 100 because outputs so short spaced now
+    this_search_radius = 10. / (1+ds.get_parameter('CosmologyCurrentRedshift'))  ## search radius is in PHYSICAL kpc
+    if (center_method == 'particles'):
+        new_center, vel_center, diagnostics = get_particle_center(ds, center_guess, radius=this_search_radius, \
+                                                                  vel_radius=this_search_radius, particles=particles)
+        if not (diagnostics['converged']): print('center of', name, 'moved by', diagnostics['shift'], 'kpc in the last step')
+    else:
+        new_center, vel_center = get_halo_center(ds, center_guess, radius=this_search_radius, vel_radius=this_search_radius, \
+                                                 method=center_method)
+    print(new_center)
+
+    ### just in case memory becomes a problem
+    ds.index.clear_all_data()
+
+    return [ds.get_parameter('CosmologyCurrentRedshift'), new_center[0], new_center[1], new_center[2]]
+
+
+def make_track_plots(t):
+    """ makes the x, y, and z density projections around the center of each
+        snapshot in the track table 't' """
+
+    for row in t:
+        ds = yt.load(row['name']+'/'+row['name'])
+        new_center = [row['x0'], row['y0'], row['z0']]
+        for axis in ['x', 'y', 'z']:
+            p = yt.ProjectionPlot(ds, axis, 'density', center=new_center, width=(200., 'kpc'))
+            p.set_unit(('gas','density'),'Msun/pc**2')
+            p.set_zlim('density', density_proj_min, density_proj_max)
+            p.set_cmap(field='density', cmap=density_color_map)
+            p.annotate_timestamp(corner='upper_left', redshift=True, draw_inset_box=True)
+            p.save()
+        ds.index.clear_all_data()
+
+
+def get_center_track(first_center, latesnap, earlysnap, interval, log_file='track_log.dat', make_plots=False,
+                     center_method='dm_density'):
+    """ finds the center in each snapshot from earlysnap to latesnap, starting
+        from first_center. each snapshot's center is appended to 'log_file' as
+        soon as it is found, and snapshots already there are skipped, so a run
+        that stops can just be started again. the next snapshot is read while
+        the current one is centered. the projection plots of each snapshot
+        are only made (after the whole track is done) if make_plots is True.
+        center_method ('dm_density' or 'particles') is passed to find_center."""
 
     ### do this way at high-redshift
     ### snaplist = np.flipud(np.arange(earlysnap,latesnap+1))
@@ -38,70 +114,28 @@ def get_center_track(first_center, latesnap, earlysnap, interval):
     snaplist = np.arange(earlysnap,latesnap+1)
     print(snaplist)
 
-    t = Table([[0.0,0.0],[0.0,0.0],[0.0,0.0],[0.0,0.0], ['       ', '       ']],
-        names=('redshift', 'x0', 'y0', 'z0', 'name'))
-
-    center_guess = first_center
-    search_radius = 10. ### COMOVING KPC
-
+    names = []
     for isnap in snaplist:
         if (isnap > 999): name = 'DD'+str(isnap)
         if (isnap <= 999): name = 'DD0'+str(isnap)
         if (isnap <= 99): name = 'DD00'+str(isnap)
         if (isnap <= 9): name = 'DD000'+str(isnap)
+        names.append(name)
 
-        print
-        print
-        print(name)
-        ds = yt.load(name+'/'+name)
-        comoving_box_size = ds.get_parameter('CosmologyComovingBoxSize')
-        print('Comoving Box Size:', comoving_box_size)
-
-        # decreased these from 500 to 100 because outputs so short spaced now
-        this_search_radius = search_radius / (1+ds.get_parameter('CosmologyCurrentRedshift'))  ## search radius is in PHYSICAL kpc
-        new_center, vel_center = get_halo_center(ds, center_guess, radius=this_search_radius, vel_radius=this_search_radius)
-        print(new_center)
-
-        t.add_row( [ds.get_parameter('CosmologyCurrentRedshift'),
-            new_center[0], new_center[1],new_center[2], name])
-
-        center_guess = new_center
-
-        p = yt.ProjectionPlot(ds, 'x', 'density', center=new_center, width=(200., 'kpc'))
-        p.set_unit(('gas','density'),'Msun/pc**2')
-        p.set_zlim('density', density_proj_min, density_proj_max)
-        p.set_cmap(field='density', cmap=density_color_map)
-        p.annotate_timestamp(corner='upper_left', redshift=True, draw_inset_box=True)
-        p.save()
-        p = yt.ProjectionPlot(ds, 'y', 'density', center=new_center, width=(200., 'kpc'))
-        p.set_unit(('gas','density'),'Msun/pc**2')
-        p.set_zlim('density', density_proj_min, density_proj_max)
-        p.set_cmap(field='density', cmap=density_color_map)
-        p.annotate_timestamp(corner='upper_left', redshift=True, draw_inset_box=True)
-        p.save()
-        p = yt.ProjectionPlot(ds, 'z', 'density', center=new_center, width=(200., 'kpc'))
-        p.set_unit(('gas','density'),'Msun/pc**2')
-        p.set_zlim('density', density_proj_min, density_proj_max)
-        p.set_cmap(field='density', cmap=density_color_map)
-        p.annotate_timestamp(corner='upper_left', redshift=True, draw_inset_box=True)
-        p.save()
-        print(t)
-        ascii.write(t, 'track_temp.dat', format='fixed_width_two_line', overwrite=True)
-        print
-        print
-
-        ### just in case memory becomes a problem
-        ds.index.clear_all_data()
-        del ds.index.grid_dimensions
-        del ds.index.grid_left_edge
-        del ds.index.grid_right_edge
-        del ds.index.grid_levels
-        del ds.index.grid_particle_count
-        del ds.index.grids
+    rows = build_track(names, lambda name, center_guess: load_snapshot(name, center_guess, center_method),
+                       lambda name, data, center_guess: find_center(name, data, center_guess, center_method),
+                       first_center, log_file,
+                       ['redshift', 'x0', 'y0', 'z0'], ['x0', 'y0', 'z0'])
 
+    t = Table([[0.0,0.0],[0.0,0.0],[0.0,0.0],[0.0,0.0], ['       ', '       ']],
+        names=('redshift', 'x0', 'y0', 'z0', 'name'))
+    for name in names:
+        t.add_row(rows[name] + [name])
+    ascii.write(t, 'track_temp.dat', format='fixed_width_two_line', overwrite=True)
 
     t = t[2:]
     print(t)
+    if (make_plots): make_track_plots(t)
 
     # now interpolate the track to the interval given as a parameter
     n_points = int((np.max(t['redshift']) - np.min(t['redshift']))  / interval)
@@ -236,4 +270,5 @@ if __name__ == "__main__":
         sys.exit("halo not found!")
 
 
-    get_center_track(first_center, end_snap, start_snap, 0.002)
+    get_center_track(first_center, end_snap, start_snap, 0.002, make_plots=args.make_plots,
+                     center_method=args.center_method)
@@ -1,3 +1,7 @@
+# 10/17/2026.
+# Now projects all the ions at once with core_funcs.allsky_column_density
+# instead of the special yt healpix_projection, one pass per observer.
+#
 # 10/13/2019, Yong Zheng, UCB.
 # Changed the code to plot gc and offcenter allsky projections for diff ions.
 # added trident to post process the simulation for different ions.
@@ -35,7 +39,6 @@ os.sys.path.insert(0, sys_dir)
 
 import yt
 # import foggie
-from yt.visualization.volume_rendering.healpix_projection import healpix_projection
 from mocky_way_modules import save_allsky_healpix_img, plt_allsky_healpix_img
 import foggie.consistency as consistency # for plotting
 
@@ -204,18 +207,17 @@ else:
     sys.exit()
 
 #### then, plot allsky projection from offcenter
+# all ions are projected together in one pass over the cells of obj,
+# the center of the image (l=0) points from the observer along -obs_vec
+from foggie.mocky_way.core_funcs import allsky_column_density
+ds_paras = {'sun_vec': sun_vec, 'phi_vec': phi_vec, 'L_vec': L_vec}
 for obs_xyz, obs_tag in zip([halo_center, offcenter_location],
                             ['halo_center', 'offcenter_location']):
-    for ion in ion_list:
-        field_to_proj = consistency.species_dict[ion]
-        item_to_proj = ('gas', field_to_proj)
-        img = healpix_projection(obj, obs_xyz, pathlength,
-                                 nside, item_to_proj,
-                                 normal_vector=-obs_vec,
-                                 north_vector=L_vec)
-                                 # normal vector points to the
-                                 # center of the image
-
+    allsky_N = allsky_column_density(ds, ds_paras, obj, nside,
+                                     ion_list=ion_list,
+                                     observer_location=obs_xyz,
+                                     pathlength_kpc=pathlength.in_units('kpc').value)
+    for ion, img in zip(ion_list, allsky_N):
         # save the healpix projection result
         filename = '%s_%s_%s_%s_%s'%(sim_name, dd_name, obj_tag, obs_tag, ion)
         save_to_fits = '%s/%s_r160.fits'%(fig_dir, filename)
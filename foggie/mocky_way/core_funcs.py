@@ -927,6 +927,139 @@ def calc_ray_ion_column_density(ds, ion, los_ray_start, los_ray_end,
 
     return ray_Nion, output_ray_info
 
+def healpix_cell_sums(los_xyz_cm, dx_cm, cell_values, gal_vecs, nside,
+                      max_r_cm=None, min_r_cm=None, pix_per_cell=2.,
+                      max_subdiv=32, chunk_size=4000000):
+    """
+    Spread the cells over the healpix pixels they cover as seen by an
+    observer, and add up each cell's value * volume / r^2 in every pixel.
+    Dividing by the pixel solid angle gives the column density toward each
+    pixel, since N = int n dr and the integral of N over a solid angle is
+    int n dV / r^2. Cells that cover more than about one pixel are split
+    into k^3 sub-cells, with k chosen so each sub-cell covers less than
+    1/pix_per_cell of a pixel, up to max_subdiv.
+
+    Input:
+    los_xyz_cm: (N, 3) position of each cell relative to the observer, in cm
+    dx_cm: (N, ) cell size in cm
+    cell_values: (n_field, N) value of each field in each cell, i.e.
+                 ion number densities in cm-3
+    gal_vecs: the three unit vectors (toward l=0, toward l=90, toward b=90)
+              of the Galactic coordinates, so pixel (l, b) is the direction
+              used by calc_ray_end
+    nside: healpix nside of the maps
+    max_r_cm: if given, only count gas closer than this to the observer
+    min_r_cm: if given, only count gas farther than this from the observer
+
+    Return:
+    pix_sums: (n_field, npix) sum of value*volume/r^2 in each pixel, RING order
+
+    History:
+    Written to replace one trident ray per healpix pixel for all sky maps.
+    """
+    import numpy as np
+    import healpy as hp
+
+    npix = hp.nside2npix(nside)
+    pix_width = np.sqrt(4*np.pi/npix)
+    rot = np.array([np.asarray(vec, dtype=np.float64) for vec in gal_vecs])
+    cell_values = np.atleast_2d(cell_values)
+    pix_sums = np.zeros((cell_values.shape[0], npix))
+
+    # number of sub-cells along each side, from the angular size of each cell
+    los_r_cm = np.sqrt(np.sum(los_xyz_cm**2, axis=1))
+    with np.errstate(divide='ignore'):
+        nsub = np.ceil(pix_per_cell*dx_cm/(los_r_cm*pix_width))
+    nsub = np.clip(np.nan_to_num(nsub, nan=max_subdiv, posinf=max_subdiv), 1, max_subdiv).astype(int)
+
+    for k in np.unique(nsub):
+        # centers of the k^3 sub-cells, in units of the cell size
+        sub_1d = (np.arange(k)+0.5)/k - 0.5
+        sub_off = np.array(np.meshgrid(sub_1d, sub_1d, sub_1d, indexing='ij')).reshape(3, -1).T
+        k_cells = np.flatnonzero(nsub == k)
+        step = max(1, chunk_size//(k**3))
+        for i in range(0, k_cells.size, step):
+            cells = k_cells[i:i+step]
+            sub_xyz = los_xyz_cm[cells, None, :] + sub_off[None, :, :]*dx_cm[cells, None, None]
+            sub_xyz = sub_xyz.reshape(-1, 3)
+            sub_r2 = np.sum(sub_xyz**2, axis=1)
+            # keep the sub-cell containing the observer finite
+            sub_dx = np.repeat(dx_cm[cells]/k, k**3)
+            sub_r2 = np.maximum(sub_r2, (0.5*sub_dx)**2)
+            weight = sub_dx**3/sub_r2
+            if max_r_cm is not None:
+                weight[sub_r2 > max_r_cm**2] = 0.
+            if min_r_cm is not None:
+                weight[sub_r2 < min_r_cm**2] = 0.
+            gal_xyz = sub_xyz.dot(rot.T)
+            pix = hp.vec2pix(nside, gal_xyz[:, 0], gal_xyz[:, 1], gal_xyz[:, 2])
+            for j in range(cell_values.shape[0]):
+                pix_sums[j] += np.bincount(pix, minlength=npix,
+                                           weights=weight*np.repeat(cell_values[j, cells], k**3))
+
+    return pix_sums
+
+def allsky_column_density(ds, ds_paras, obj, nside, ion_list=None,
+                          observer_location=None, pathlength_kpc=None,
+                          pix_per_cell=2., max_subdiv=32):
+    """
+    Calculate all sky column density maps of several ions at once, as seen
+    by the mock observer, by going through the leaf cells of obj once instead
+    of making one trident ray per direction (see healpix_cell_sums).
+
+    Input:
+    ds, ds_paras: from prepdata
+    obj: data object to project, i.e. from obj_source_all_disk_cgm
+    nside: healpix nside of the maps
+    ion_list: ions in consistency.species_dict, default to HI and all the
+              ions that prepdata adds with trident
+    observer_location: default to ds_paras['offcenter_location']
+    pathlength_kpc: if given, only count gas within this distance of observer
+
+    Return:
+    allsky_N: (len(ion_list), npix) column density in cm-2 of each ion in
+              healpix RING order, so allsky_N[i] can go to
+              save_allsky_healpix_img/hp.mollview like a healpix_projection
+              image. Pixel (l, b) from hp.pix2ang(nside, ipix, lonlat=True)
+              is the same direction as calc_ray_end(ds, ds_paras, l, b, ...).
+
+    History:
+    Written to replace one trident ray per healpix pixel for all sky maps.
+    """
+    import numpy as np
+    import healpy as hp
+    from foggie.utils import consistency
+
+    if ion_list is None:
+        ion_list = ['HI', 'SiII', 'SiIII', 'SiIV', 'CII', 'CIV', 'OVI', 'NV',
+                    'OVII', 'OVIII', 'NeVII', 'NeVIII']
+    if observer_location is None:
+        observer_location = ds_paras['offcenter_location']
+    observer_cm = ds.arr(observer_location, 'code_length').in_units('cm').value
+
+    los_xyz_cm = np.column_stack([obj['gas', ax].in_units('cm').value.flatten()
+                                  for ax in ['x', 'y', 'z']]) - observer_cm
+    dx_cm = obj['gas', 'dx'].in_units('cm').value.flatten()
+    cell_values = np.array([obj['gas', consistency.species_dict[ion]].in_units('cm**-3').value.flatten()
+                            for ion in ion_list])
+
+    # l=0 points from the observer toward the galactic center (-sun_vec),
+    # l=90 along phi_vec, and b=90 along L_vec, as in calc_ray_end
+    gal_vecs = [-np.asarray(ds_paras['sun_vec']), np.asarray(ds_paras['phi_vec']),
+                np.asarray(ds_paras['L_vec'])]
+
+    if pathlength_kpc is None:
+        max_r_cm = None
+    else:
+        max_r_cm = ds.quan(pathlength_kpc, 'kpc').in_units('cm').value
+
+    pix_sums = healpix_cell_sums(los_xyz_cm, dx_cm, cell_values, gal_vecs, nside,
+                                 max_r_cm=max_r_cm, pix_per_cell=pix_per_cell,
+                                 max_subdiv=max_subdiv)
+    allsky_N = pix_sums/hp.nside2pixarea(nside)
+
+    return allsky_N
+
 def los_r(ds, data, observer_location):
     """
     Calculate the distance between each cell in data and the observer
@@ -48,6 +48,12 @@ MakeProjections = True
 # do you want debug information while the calculation goes on?  True/False
 Debug = True
 
+# do you want to make one trident ray per pixel?  True/False
+# If False, every pixel is found at once from the cells around ray_start on
+# the first MPI task (see core_funcs.healpix_cell_sums), which is much faster.
+# WriteRays and fraction_ray_plots only apply to rays.
+UseRays = False
+
 # do you want to write out ray files?  True/False
 WriteRays = True
 
@@ -67,7 +73,7 @@ proj_scales = [40., 400.]
 
 proj_dims = ['x','y','z']
 
-if comm.rank == 0 and WriteRays:
+if comm.rank == 0 and UseRays and WriteRays:
     if os.path.exists('ray_files'):
         shutil.rmtree('ray_files')
         os.mkdir('ray_files')
@@ -141,138 +147,168 @@ if Debug:
 
 raygen_start =  time.time()
 
-for i in range(start_index,end_index):
-    theta = x[i]
-    phi = y[i]
-
-    dx = R*np.cos(theta)*np.sin(phi)
-    dy = R*np.sin(theta)*np.sin(phi)
-    dz = R*np.cos(phi)
-
-    dv = YTArray([dx, dy, dz], 'kpc')
-
-    ray_end = ray_start + dv
-
-    padded_num = '{:05d}'.format(i)
-
-    if WriteRays:
-        rayfile = 'ray_files/ray'+str(ds)+'_'+padded_num+'.h5'
-    else:
-        rayfile = None
-
-    ray = trident.make_simple_ray(ds,
-                                  start_position=ray_start,
-                                  end_position=ray_end,
-                                  data_filename=rayfile,
-                                  fields=field_list,
-                                  ftype='gas')
-
-    ray_data = ray.all_data()
-
-    path_length = ray_data['dl'].convert_to_units('kpc').d
+if UseRays:
+    for i in range(start_index,end_index):
+        theta = x[i]
+        phi = y[i]
 
+        dx = R*np.cos(theta)*np.sin(phi)
+        dy = R*np.sin(theta)*np.sin(phi)
+        dz = R*np.cos(phi)
 
+        dv = YTArray([dx, dy, dz], 'kpc')
 
-    # Remove the first N kpc from the ray data
-    path = np.zeros(len(path_length))
+        ray_end = ray_start + dv
 
-    for h in range(len(path_length)-1):
-        dl = path_length[h]
-        p = path[h]
-        path[h+1] = dl + p
+        padded_num = '{:05d}'.format(i)
 
-    for g in range(len(path)):
-        if path[g] < remove_first_N_kpc:
-            continue
+        if WriteRays:
+            rayfile = 'ray_files/ray'+str(ds)+'_'+padded_num+'.h5'
         else:
-            start = g
-        break
-
-    path_mod = path[start:]
-
-
-    # Convert from number density to column density
-    H_I_number_density_mod = ray_data['H_p0_number_density'][start:]
-    H_I_density = ray_data['dl']*ray_data['H_p0_number_density']
-    H_I_density = H_I_density.in_units('cm**-2')
-    H_I_density_mod = H_I_density[start:]
-    H_I_column_density = sum(H_I_density_mod.d)
-    H_I_column = np.append(H_I_column, H_I_column_density)
-
-    O_VI_number_density_mod = ray_data['O_p5_number_density'][start:]
-    O_VI_density = ray_data['dl']*ray_data['O_p5_number_density']
-    O_VI_density = O_VI_density.in_units('cm**-2')
-    O_VI_density_mod = O_VI_density[start:]
-    O_VI_column_density = sum(O_VI_density_mod.d)
-    O_VI_column = np.append(O_VI_column, O_VI_column_density)
-
-    los_mod = ray_data['velocity_los'][start:]
-    los_mod = los_mod.in_units('km/s')
-
-    los_mod = H_I_density_mod*los_mod
-    mean_los = sum(los_mod.d)/sum(H_I_density_mod.d)
-
-
-    # Save column densities to arrays
-    H_I[i] += H_I_column_density
-    O_VI[i] += O_VI_column_density
-    vel_los[i] += mean_los
-
-    r = npr.uniform()
-
-    if r <= fraction_ray_plots:
-        plt.subplot(321)
-        plt.semilogy(path_mod, H_I_number_density_mod, color='purple')
-        #plt.ylim(10**-12.5, 10**-9.5)
-        plt.xlabel("Distance (kpc)")
-        plt.ylabel('H I Density')
-        plt.title("H I density")
-        plt.grid()
-
-        plt.subplot(322)
-        plt.semilogy(path_mod, O_VI_number_density_mod, color='blue')
-        #plt.ylim(10**-16, 10**-8)
-        plt.xlabel("Distance (kpc)")
-        plt.ylabel('O VI Density')
-        plt.title("O VI density")
-        plt.grid()
-
-        plt.subplot(323)
-        plt.semilogy(path, ray_data['temperature'], 'r-')
-        #plt.ylim(10**5, 10**8.5)
-        plt.title('Temperature')
-        plt.xlabel('Distance (kpc)')
-        plt.ylabel('Temperature (K)')
-        plt.grid()
-
-        plt.subplot(324)
-        plt.semilogy(path, ray_data['density'], 'g-')
-        #plt.ylim(10**-28.8, 10**-26)
-        plt.xlabel("Distance (kpc)")
-        plt.ylabel('Density (g/cm^2)')
-        plt.title("Density")
-        plt.grid()
-
-        plt.subplot(325)
-        plt.semilogy(path, ray_data['metallicity'], linestyle='-',color='orange')
-        plt.xlabel('Distance (kpc)')
-        plt.ylabel('Metallicity')
-        plt.title('Metallicity')
-        plt.grid()
-
-        v_los = ray_data['velocity_los'].in_units('km/s')
-
-        plt.subplot(326)
-        plt.plot(path, v_los, color='black')
-        plt.xlabel('Distance (kpc)')
-        plt.ylabel('Velocity (km/s)')
-        plt.title('Line of Sight Velocity')
-        plt.grid()
-
-        plt.tight_layout()
-        plt.savefig('ray_data_'+str(ds)+'_'+str(i)+'.png')
-
-        plt.clf()
+            rayfile = None
+
+        ray = trident.make_simple_ray(ds,
+                                      start_position=ray_start,
+                                      end_position=ray_end,
+                                      data_filename=rayfile,
+                                      fields=field_list,
+                                      ftype='gas')
+
+        ray_data = ray.all_data()
+
+        path_length = ray_data['dl'].convert_to_units('kpc').d
+
+
+
+        # Remove the first N kpc from the ray data
+        path = np.zeros(len(path_length))
+
+        for h in range(len(path_length)-1):
+            dl = path_length[h]
+            p = path[h]
+            path[h+1] = dl + p
+
+        for g in range(len(path)):
+            if path[g] < remove_first_N_kpc:
+                continue
+            else:
+                start = g
+            break
+
+        path_mod = path[start:]
+
+
+        # Convert from number density to column density
+        H_I_number_density_mod = ray_data['H_p0_number_density'][start:]
+        H_I_density = ray_data['dl']*ray_data['H_p0_number_density']
+        H_I_density = H_I_density.in_units('cm**-2')
+        H_I_density_mod = H_I_density[start:]
+        H_I_column_density = sum(H_I_density_mod.d)
+        H_I_column = np.append(H_I_column, H_I_column_density)
+
+        O_VI_number_density_mod = ray_data['O_p5_number_density'][start:]
+        O_VI_density = ray_data['dl']*ray_data['O_p5_number_density']
+        O_VI_density = O_VI_density.in_units('cm**-2')
+        O_VI_density_mod = O_VI_density[start:]
+        O_VI_column_density = sum(O_VI_density_mod.d)
+        O_VI_column = np.append(O_VI_column, O_VI_column_density)
+
+        los_mod = ray_data['velocity_los'][start:]
+        los_mod = los_mod.in_units('km/s')
+
+        los_mod = H_I_density_mod*los_mod
+        mean_los = sum(los_mod.d)/sum(H_I_density_mod.d)
+
+
+        # Save column densities to arrays
+        H_I[i] += H_I_column_density
+        O_VI[i] += O_VI_column_density
+        vel_los[i] += mean_los
+
+        r = npr.uniform()
+
+        if r <= fraction_ray_plots:
+            plt.subplot(321)
+            plt.semilogy(path_mod, H_I_number_density_mod, color='purple')
+            #plt.ylim(10**-12.5, 10**-9.5)
+            plt.xlabel("Distance (kpc)")
+            plt.ylabel('H I Density')
+            plt.title("H I density")
+            plt.grid()
+
+            plt.subplot(322)
+            plt.semilogy(path_mod, O_VI_number_density_mod, color='blue')
+            #plt.ylim(10**-16, 10**-8)
+            plt.xlabel("Distance (kpc)")
+            plt.ylabel('O VI Density')
+            plt.title("O VI density")
+            plt.grid()
+
+            plt.subplot(323)
+            plt.semilogy(path, ray_data['temperature'], 'r-')
+            #plt.ylim(10**5, 10**8.5)
+            plt.title('Temperature')
+            plt.xlabel('Distance (kpc)')
+            plt.ylabel('Temperature (K)')
+            plt.grid()
+
+            plt.subplot(324)
+            plt.semilogy(path, ray_data['density'], 'g-')
+            #plt.ylim(10**-28.8, 10**-26)
+            plt.xlabel("Distance (kpc)")
+            plt.ylabel('Density (g/cm^2)')
+            plt.title("Density")
+            plt.grid()
+
+            plt.subplot(325)
+            plt.semilogy(path, ray_data['metallicity'], linestyle='-',color='orange')
+            plt.xlabel('Distance (kpc)')
+            plt.ylabel('Metallicity')
+            plt.title('Metallicity')
+            plt.grid()
+
+            v_los = ray_data['velocity_los'].in_units('km/s')
+
+            plt.subplot(326)
+            plt.plot(path, v_los, color='black')
+            plt.xlabel('Distance (kpc)')
+            plt.ylabel('Velocity (km/s)')
+            plt.title('Line of Sight Velocity')
+            plt.grid()
+
+            plt.tight_layout()
+            plt.savefig('ray_data_'+str(ds)+'_'+str(i)+'.png')
+
+            plt.clf()
+
+elif comm.rank == 0:
+    # column densities and the H I weighted line of sight velocity toward every
+    # pixel from sums of n*V/r^2 over the cells within R of ray_start, looked up
+    # in the direction of each pixel's ray
+    import healpy as hp
+    from foggie.mocky_way.core_funcs import healpix_cell_sums
+
+    nside = 64
+    sp = ds.sphere(ray_start, (R, 'kpc'))
+    los_xyz_cm = np.column_stack([sp['gas', ax].in_units('cm').d for ax in ['x', 'y', 'z']]) \
+                 - ray_start.in_units('cm').d
+    los_r_cm = np.sqrt(np.sum(los_xyz_cm**2, axis=1))
+    vel_kms = np.column_stack([sp['gas', 'velocity_'+ax].in_units('km/s').d for ax in ['x', 'y', 'z']])
+    # as trident's velocity_los, positive for gas moving back toward ray_start
+    cell_vlos = -np.sum(vel_kms*los_xyz_cm, axis=1)/np.maximum(los_r_cm, 1e-30)
+    cell_HI = sp['gas', 'H_p0_number_density'].in_units('cm**-3').d
+    cell_OVI = sp['gas', 'O_p5_number_density'].in_units('cm**-3').d
+
+    pix_sums = healpix_cell_sums(los_xyz_cm, sp['gas', 'dx'].in_units('cm').d,
+                                 np.array([cell_HI, cell_OVI, cell_HI*cell_vlos]),
+                                 np.identity(3), nside,
+                                 max_r_cm=ds.quan(R, 'kpc').in_units('cm').d,
+                                 min_r_cm=ds.quan(remove_first_N_kpc, 'kpc').in_units('cm').d)
+    pix = hp.vec2pix(nside, np.cos(x)*np.sin(y), np.sin(x)*np.sin(y), np.cos(y))
+    H_I[:] = pix_sums[0][pix]/hp.nside2pixarea(nside)
+    O_VI[:] = pix_sums[1][pix]/hp.nside2pixarea(nside)
+    has_HI = (pix_sums[0][pix] > 0)
+    vel_los[has_HI] = pix_sums[2][pix][has_HI]/pix_sums[0][pix][has_HI]
 
 raygen_end =  time.time()
 
@@ -15,6 +15,10 @@ utils/get_run_loc_etc.py
 utils/yt_fields.py
 utils/foggie_load.py
 utils/analysis_utils.py
+utils/halo_catalog.py
+utils/grid_cache.py
+utils/power_spectrum.py
+utils/tiled_grid.py
 """
 
 # Import everything as needed
@@ -63,6 +67,11 @@ from foggie.utils.get_run_loc_etc import get_run_loc_etc
 from foggie.utils.yt_fields import *
 from foggie.utils.foggie_load import *
 from foggie.utils.analysis_utils import *
+from foggie.utils.shell_stats import *
+from foggie.utils.halo_catalog import lookup_rvir
+from foggie.utils.grid_cache import cached_covering_grid
+from foggie.utils.power_spectrum import radial_power_spectrum
+from foggie.utils.tiled_grid import covering_grid_tile
 
 # These imports for datashader plots
 import datashader as dshader
@@ -268,6 +277,25 @@ def parse_args():
                         'run time and reduce weight on IO file system. Default is no.')
     parser.set_defaults(copy_to_tmp=False)
 
+    parser.add_argument('--grid_cache', metavar='grid_cache', type=str, action='store', \
+                        help='If you want to save the fields taken from the covering grid to disk so later runs\n' + \
+                        'on the same snapshot (of this or other scripts) can read them back instead of making the\n' + \
+                        'grid again, give the directory to save them in here. Only used by the pressure_vs_radius\n' + \
+                        'and force_vs_radius plots. Default is not to do this.')
+    parser.set_defaults(grid_cache='none')
+
+    parser.add_argument('--pk_tile_size', metavar='pk_tile_size', type=int, action='store', \
+                        help='If plotting turbulent_spectrum, do you want to find the power spectrum by averaging\n' + \
+                        'the spectra of overlapping windowed tiles of this many cells on a side, instead of one FFT\n' + \
+                        'of the whole (non-periodic) box? Each tile is made as its own covering grid, so this uses\n' + \
+                        'much less memory. Default is 0 (whole box).')
+    parser.set_defaults(pk_tile_size=0)
+
+    parser.add_argument('--pk_window', metavar='pk_window', type=str, action='store', \
+                        help='If using --pk_tile_size, what window do you want to multiply each tile by? Options are\n' + \
+                        '"hann" or "tukey". Default is hann.')
+    parser.set_defaults(pk_window='hann')
+
     args = parser.parse_args()
     return args
 
@@ -353,6 +381,30 @@ def weighted_avg_and_std(values, weights):
     variance = np.average((values-average)**2, weights=weights)
     return average, np.sqrt(variance)
 
+def force_pdfs_in_shells(index, force, weights, num_shells):
+    '''Returns the weighted PDFs of 'force' within each of the 'num_shells' shells given by 'index', using
+    100 logarithmic bins for forces below -1e-9, 100 linear bins between -1e-9 and 1e-9, and 100
+    logarithmic bins for forces above 1e-9, as well as the edges of the 300 bins.'''
+
+    bool_pos = (force>=1e-9)
+    bool_mid = (force>=-1e-9) & (force<=1e-9)
+    bool_neg = (force<=-1e-9)
+    log_force_pos = np.zeros(len(force))
+    log_force_pos[bool_pos] = np.log10(force[bool_pos])
+    log_force_neg = np.zeros(len(force))
+    log_force_neg[bool_neg] = np.log10(-force[bool_neg])
+    hist_pos, bin_edges_pos = shell_pdfs(np.where(bool_pos, index, -1), log_force_pos, weights, num_shells, 100, [-9, -5], density=False)
+    hist_mid, bin_edges_mid = shell_pdfs(np.where(bool_mid, index, -1), force, weights, num_shells, 100, [-1e-9, 1e-9], density=False)
+    hist_neg, bin_edges_neg = shell_pdfs(np.where(bool_neg, index, -1), log_force_neg, weights, num_shells, 100, [-9, -5], density=False)
+    norm = np.sum(hist_neg, axis=1) + np.sum(hist_mid, axis=1) + np.sum(hist_pos, axis=1)
+    bin_edges_neg = np.flip(bin_edges_neg)
+    hist_neg = np.flip(hist_neg, axis=1)
+    bin_edges = np.hstack([10**bin_edges_neg[:-1], bin_edges_mid, 10**bin_edges_pos[1:]])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        hist = np.hstack([hist_neg, hist_mid, hist_pos])/norm[:,np.newaxis]
+
+    return hist, bin_edges
+
 def set_table_units(table):
     '''Sets the units for the table. Note this needs to be updated whenever something is added to
     the table. Returns the table.'''
@@ -668,7 +720,7 @@ def pressures_vs_radius(snap):
         dx_cm = dx*1000*cmtopc
         smooth_scale = int(25./dx)/6.
         refine_res = int(3.*Rvir/dx)
-        box = ds.covering_grid(level=level, left_edge=ds.halo_center_kpc-ds.arr([1.5*Rvir,1.5*Rvir,1.5*Rvir],'kpc'), dims=[refine_res, refine_res, refine_res])
+        box = cached_covering_grid(ds, level, ds.halo_center_kpc-ds.arr([1.5*Rvir,1.5*Rvir,1.5*Rvir],'kpc'), [refine_res, refine_res, refine_res], cache_dir=args.grid_cache)
         density = box['density'].in_units('g/cm**3').v
         temperature = box['temperature'].v
         radius = box['radius_corrected'].in_units('kpc').v
@@ -828,35 +880,46 @@ def pressures_vs_radius(snap):
         else:
             regions = []
 
-        for i in range(len(radius_list)-1):
+        # Compute the statistics of every pressure in every shell at once, rather than masking
+        # and sorting the arrays separately for every shell
+        num_shells = len(radius_list)-1
+        log_pressures = []
+        for j in range(len(pressures)):
+            log_pressures.append(np.log10(pressures[j]))
+        pdf_ranges = [[-20, -12]]*len(pressures)
+        shells = shell_index(radius, radius_list, include_inner=True)
+        pressure_stats = shell_statistics(shells, num_shells, weights, log_pressures, pdf_ranges=pdf_ranges)
+        pressure_stats_regions = []
+        for k in range(len(regions)):
+            log_pressures_region = []
+            for j in range(len(pressures)):
+                log_pressures_region.append(np.log10(pressure_regions[j][k]))
+            shells_region = shell_index(radius_regions[k], radius_list, include_inner=True)
+            pressure_stats_regions.append(shell_statistics(shells_region, num_shells, weights_regions[k], \
+              log_pressures_region, pdf_ranges=pdf_ranges))
+
+        for i in range(num_shells):
             row = [zsnap, radius_list[i], radius_list[i+1]]
             pdf_array = []
             for j in range(len(pressures)):
-                pressure_shell = np.log10(pressures[j][(radius >= radius_list[i]) & (radius < radius_list[i+1])])
-                weights_shell = weights[(radius >= radius_list[i]) & (radius < radius_list[i+1])]
-                if (len(pressure_shell)!=0.):
-                    quantiles = weighted_quantile(pressure_shell, weights_shell, np.array([0.25,0.5,0.75]))
+                if (pressure_stats['count'][i]!=0):
+                    quantiles = pressure_stats['quantiles'][j][i]
                     row.append(quantiles[1])
                     row.append(quantiles[2]-quantiles[0])
-                    avg, std = weighted_avg_and_std(pressure_shell, weights_shell)
-                    row.append(avg)
-                    row.append(std)
-                    hist, bin_edges = np.histogram(pressure_shell, weights=weights_shell, bins=(200), range=[-20, -12], density=True)
+                    row.append(pressure_stats['avg'][j][i])
+                    row.append(pressure_stats['std'][j][i])
+                    bin_edges = pressure_stats['pdf_edges'][j]
                     pdf_array.append(bin_edges[:-1])
                     pdf_array.append(bin_edges[1:])
-                    pdf_array.append(hist)
+                    pdf_array.append(pressure_stats['pdf'][j][i])
                     for k in range(len(regions)):
-                        pressure_shell = np.log10(pressure_regions[j][k][(radius_regions[k] >= radius_list[i]) & (radius_regions[k] < radius_list[i+1])])
-                        weights_shell = weights_regions[k][(radius_regions[k] >= radius_list[i]) & (radius_regions[k] < radius_list[i+1])]
-                        if (len(pressure_shell)!=0.):
-                            quantiles = weighted_quantile(pressure_shell, weights_shell, np.array([0.25,0.5,0.75]))
+                        if (pressure_stats_regions[k]['count'][i]!=0):
+                            quantiles = pressure_stats_regions[k]['quantiles'][j][i]
                             row.append(quantiles[1])
                             row.append(quantiles[2]-quantiles[0])
-                            avg, std = weighted_avg_and_std(pressure_shell, weights_shell)
-                            row.append(avg)
-                            row.append(std)
-                            hist, bin_edges = np.histogram(pressure_shell, weights=weights_shell, bins=(200), range=[-20, -12], density=True)
-                            pdf_array.append(hist)
+                            row.append(pressure_stats_regions[k]['avg'][j][i])
+                            row.append(pressure_stats_regions[k]['std'][j][i])
+                            pdf_array.append(pressure_stats_regions[k]['pdf'][j][i])
                         else:
                             row.append(0.)
                             row.append(0.)
@@ -1204,7 +1267,7 @@ def forces_vs_radius(snap):
         smooth_scale = (25./dx)/6.
         dx_cm = dx*1000*cmtopc
         refine_res = int(3.*Rvir/dx)
-        box = ds.covering_grid(level=level, left_edge=ds.halo_center_kpc-ds.arr([1.5*Rvir,1.5*Rvir,1.5*Rvir],'kpc'), dims=[refine_res, refine_res, refine_res])
+        box = cached_covering_grid(ds, level, ds.halo_center_kpc-ds.arr([1.5*Rvir,1.5*Rvir,1.5*Rvir],'kpc'), [refine_res, refine_res, refine_res], cache_dir=args.grid_cache)
         #refine_res = int(ds.refine_width/dx)
         #box = ds.covering_grid(level=level, left_edge = ds.halo_center_kpc-ds.arr([0.5*ds.refine_width,0.5*ds.refine_width,0.5*ds.refine_width], 'kpc'), dims=[refine_res,refine_res,refine_res])
         density = box['density'].in_units('g/cm**3').v
@@ -1429,57 +1492,52 @@ def forces_vs_radius(snap):
         else:
             regions = []
 
-        for i in range(len(radius_list)-1):
+        # Compute the statistics of every force in every shell at once, rather than masking
+        # and sorting the arrays separately for every shell
+        num_shells = len(radius_list)-1
+        shells = shell_index(radius, radius_list, include_inner=True)
+        force_stats = shell_statistics(shells, num_shells, weights, forces)
+        force_pdfs = []
+        for j in range(len(forces)):
+            force_pdfs.append(force_pdfs_in_shells(shells, forces[j], weights, num_shells))
+        force_stats_regions = []
+        force_pdfs_regions = []
+        for k in range(len(regions)):
+            forces_region = []
+            for j in range(len(forces)):
+                forces_region.append(force_regions[j][k])
+            shells_region = shell_index(radius_regions[k], radius_list, include_inner=True)
+            force_stats_regions.append(shell_statistics(shells_region, num_shells, weights_regions[k], forces_region))
+            force_pdfs_regions.append([])
+            for j in range(len(forces)):
+                force_pdfs_regions[k].append(force_pdfs_in_shells(shells_region, forces_region[j], weights_regions[k], num_shells))
+
+        for i in range(num_shells):
             row = [zsnap, radius_list[i], radius_list[i+1]]
             pdf_array = []
             for j in range(len(forces)):
-                force_shell = forces[j][(radius >= radius_list[i]) & (radius < radius_list[i+1])]
-                weights_shell = weights[(radius >= radius_list[i]) & (radius < radius_list[i+1])]
-                if (len(force_shell)!=0.):
-                    quantiles = weighted_quantile(force_shell, weights_shell, np.array([0.25,0.5,0.75]))
+                if (force_stats['count'][i]!=0):
+                    quantiles = force_stats['quantiles'][j][i]
                     row.append(quantiles[1])
                     row.append(quantiles[2]-quantiles[0])
-                    avg, std = weighted_avg_and_std(force_shell, weights_shell)
-                    row.append(avg)
-                    row.append(std)
-                    row.append(np.sum(force_shell*weights_shell))
-                    row.append(np.sum(weights_shell))
-                    hist_pos, bin_edges_pos = np.histogram(np.log10(force_shell[force_shell>=1e-9]), \
-                      weights=weights_shell[force_shell>=1e-9], bins=(100), range=[-9, -5])
-                    hist_mid, bin_edges_mid = np.histogram(force_shell[(force_shell>=-1e-9) & (force_shell<=1e-9)], \
-                      weights=weights_shell[(force_shell>=-1e-9) & (force_shell<=1e-9)], bins=(100), range=[-1e-9, 1e-9])
-                    hist_neg, bin_edges_neg = np.histogram(np.log10(-force_shell[force_shell<=-1e-9]), \
-                      weights=weights_shell[force_shell<=-1e-9], bins=(100), range=[-9, -5])
-                    norm = np.sum([hist_neg, hist_mid, hist_pos])
-                    bin_edges_neg = np.flip(bin_edges_neg)
-                    hist_neg = np.flip(hist_neg)
-                    bin_edges = np.hstack([10**bin_edges_neg[:-1], bin_edges_mid, 10**bin_edges_pos[1:]])
-                    hist = np.hstack([hist_neg, hist_mid, hist_pos])/norm
+                    row.append(force_stats['avg'][j][i])
+                    row.append(force_stats['std'][j][i])
+                    row.append(force_stats['sum'][j][i])
+                    row.append(force_stats['weight'][i])
+                    hist, bin_edges = force_pdfs[j]
                     pdf_array.append(bin_edges[:-1])
                     pdf_array.append(bin_edges[1:])
-                    pdf_array.append(hist)
+                    pdf_array.append(hist[i])
                     for k in range(len(regions)):
-                        force_shell = force_regions[j][k][(radius_regions[k] >= radius_list[i]) & (radius_regions[k] < radius_list[i+1])]
-                        weights_shell = weights_regions[k][(radius_regions[k] >= radius_list[i]) & (radius_regions[k] < radius_list[i+1])]
-                        if (len(force_shell)!=0.):
-                            quantiles = weighted_quantile(force_shell, weights_shell, np.array([0.25,0.5,0.75]))
+                        if (force_stats_regions[k]['count'][i]!=0):
+                            quantiles = force_stats_regions[k]['quantiles'][j][i]
                             row.append(quantiles[1])
                             row.append(quantiles[2]-quantiles[0])
-                            avg, std = weighted_avg_and_std(force_shell, weights_shell)
-                            row.append(avg)
-                            row.append(std)
-                            row.append(np.sum(force_shell*weights_shell))
-                            row.append(np.sum(weights_shell))
-                            hist_pos, bin_edges_pos = np.histogram(np.log10(force_shell[force_shell>=1e-9]), \
-                              weights=weights_shell[force_shell>=1e-9], bins=(100), range=[-9, -5])
-                            hist_mid, bin_edges_mid = np.histogram(force_shell[(force_shell>=-1e-9) & (force_shell<=1e-9)], \
-                              weights=weights_shell[(force_shell>=-1e-9) & (force_shell<=1e-9)], bins=(100), range=[-1e-9, 1e-9])
-                            hist_neg, bin_edges_neg = np.histogram(np.log10(-force_shell[force_shell<=-1e-9]), \
-                              weights=weights_shell[force_shell<=-1e-9], bins=(100), range=[-9, -5])
-                            norm = np.sum([hist_neg, hist_mid, hist_pos])
-                            hist_neg = np.flip(hist_neg)
-                            hist = np.hstack([hist_neg, hist_mid, hist_pos])/norm
-                            pdf_array.append(hist)
+                            row.append(force_stats_regions[k]['avg'][j][i])
+                            row.append(force_stats_regions[k]['std'][j][i])
+                            row.append(force_stats_regions[k]['sum'][j][i])
+                            row.append(force_stats_regions[k]['weight'][i])
+                            pdf_array.append(force_pdfs_regions[k][j][0][i])
                         else:
                             row.append(0.)
                             row.append(0.)
@@ -3768,7 +3826,6 @@ def support_vs_time(snaplist):
     time_table = Table.read(output_dir + 'times_halo_00' + args.halo + '/' + args.run + '/time_table.hdf5', path='all_data')
     if (args.run != 'feedback_return'):
         masses_dir = code_path + 'halo_infos/00' + args.halo + '/' + args.run + '/'
-        rvir_masses = Table.read(masses_dir + 'rvir_masses.hdf5', path='all_data')
 
     fig = plt.figure(figsize=(8,6), dpi=200)
     ax = fig.add_subplot(1,1,1)
@@ -3807,18 +3864,15 @@ def support_vs_time(snaplist):
             if (int(snap[2:])<1737):
                 tablename_prefix = output_dir + 'stats_halo_00' + args.halo + '/nref11c_nref9f/Tables/'
                 masses_dir = code_path + 'halo_infos/00' + args.halo + '/nref11c_nref9f/'
-                rvir_masses = Table.read(masses_dir + 'rvir_masses.hdf5', path='all_data')
             elif (int(snap[2:])<1747):
                 tablename_prefix = output_dir + 'stats_halo_00' + args.halo + '/high_feedback_restart/Tables/'
                 masses_dir = code_path + 'halo_infos/00' + args.halo + '/high_feedback_restart/'
-                rvir_masses = Table.read(masses_dir + 'rvir_masses.hdf5', path='all_data')
             else:
                 tablename_prefix = output_dir + 'stats_halo_00' + args.halo + '/feedback_return/Tables/'
                 masses_dir = code_path + 'halo_infos/00' + args.halo + '/feedback_return/'
-                rvir_masses = Table.read(masses_dir + 'rvir_masses.hdf5', path='all_data')
         stats = Table.read(tablename_prefix + snap + '_stats_force-types' + args.filename + '.hdf5', path='all_data')
         radius_list = 0.5*(stats['inner_radius'] + stats['outer_radius'])
-        Rvir = rvir_masses['radius'][rvir_masses['snapshot']==snap][0]
+        Rvir = lookup_rvir(masses_dir, snap)[0]
         if (args.radius_range!='none'):
             radius_in = radius_range[0]*Rvir
             radius_out = radius_range[1]*Rvir
@@ -4071,7 +4125,6 @@ def support_vs_time_radius(snaplist):
         filename = '_' + args.filename
     if (args.run != 'feedback_return'):
         masses_dir = code_path + 'halo_infos/00' + args.halo + '/' + args.run + '/'
-        rvir_masses = Table.read(masses_dir + 'rvir_masses.hdf5', path='all_data')
 
     thermal_support = []
     turbulent_support = []
@@ -4088,25 +4141,22 @@ def support_vs_time_radius(snaplist):
             if (int(snap[2:])<1737):
                 tablename_prefix = output_dir + 'stats_halo_00' + args.halo + '/nref11c_nref9f/Tables/'
                 masses_dir = code_path + 'halo_infos/00' + args.halo + '/nref11c_nref9f/'
-                rvir_masses = Table.read(masses_dir + 'rvir_masses.hdf5', path='all_data')
                 fluxes = Table.read(output_dir + 'fluxes_halo_00' + args.halo + '/nref11c_nref9f/Tables/' + \
                                     snap + '_fluxes_mass_energy_cgm-only.hdf5', path='all_data')
             elif (int(snap[2:])<1747):
                 tablename_prefix = output_dir + 'stats_halo_00' + args.halo + '/high_feedback_restart/Tables/'
                 masses_dir = code_path + 'halo_infos/00' + args.halo + '/high_feedback_restart/'
-                rvir_masses = Table.read(masses_dir + 'rvir_masses.hdf5', path='all_data')
                 fluxes = Table.read(output_dir + 'fluxes_halo_00' + args.halo + '/high_feedback_restart/Tables/' + \
                                     snap + '_fluxes_mass_energy_cgm-only.hdf5', path='all_data')
             else:
                 tablename_prefix = output_dir + 'stats_halo_00' + args.halo + '/feedback_return/Tables/'
                 masses_dir = code_path + 'halo_infos/00' + args.halo + '/feedback_return/'
-                rvir_masses = Table.read(masses_dir + 'rvir_masses.hdf5', path='all_data')
                 fluxes = Table.read(output_dir + 'fluxes_halo_00' + args.halo + '/feedback_return/Tables/' + \
                                     snap + '_fluxes_mass_energy_cgm-only.hdf5', path='all_data')
         else:
             fluxes = Table.read(output_dir + 'fluxes_halo_00' + args.halo + '/' + args.run + '/Tables/' + \
                                 snap + '_fluxes_mass_energy_cgm-only.hdf5', path='all_data')
-        Rvir = rvir_masses['radius'][rvir_masses['snapshot']==snap][0]
+        Rvir = lookup_rvir(masses_dir, snap)[0]
         forces = Table.read(tablename_prefix + snap + '_stats_force-types' + filename + '.hdf5', path='all_data')
         radius_list = 0.5*(forces['inner_radius'] + forces['outer_radius'])/Rvir
         thermal_support.append(forces['thermal_force_sum']/-forces['gravity_force_sum'])
@@ -6362,52 +6412,36 @@ def Pk_turbulence(snap):
     dims = np.array([refine_res, refine_res, refine_res])
     box = ds.covering_grid(level=level, left_edge=left_edge, dims=dims)
 
-    nx, ny, nz = dims
+    # Turbulent kinetic energy in each radial k bin, from real FFTs of rho^(1/3) * v, binned with
+    # one bincount. With --pk_tile_size, the grid is split into windowed tiles that are transformed
+    # one at a time, so the whole box doesn't have to be periodic or fit in one FFT
     nindex_rho = 1./3.
-    Kk = np.zeros((nx//2+1, ny//2+1, nz//2+1))
-
-    for vel in ["vx_corrected", "vy_corrected", "vz_corrected"]:
-        rho = box['density'].v
-        u = box[vel].in_units('cm/s').v
-
-        # do the FFTs -- note that since our data is real, there will be
-        # too much information here.  fftn puts the positive freq terms in
-        # the first half of the axes -- that's what we keep.  Our
-        # normalization has an '8' to account for this clipping to one
-        # octant.
-        ru = np.fft.fftn(rho**nindex_rho * u)[0:nx//2+1, 0:ny//2+1, 0:nz//2+1]
-        ru = 8.0*ru/(nx * ny * nz)
-        k_fft = np.abs(ru)**2
-        Kk += 0.5 * k_fft
-
-    # wavenumbers
-    L = (right_edge - left_edge).v
-    kx = np.fft.rfftfreq(nx) * nx/L[0]
-    ky = np.fft.rfftfreq(ny) * ny/L[1]
-    kz = np.fft.rfftfreq(nz) * nz/L[2]
+    def get_fields(slices):
+        # Each tile is made as its own covering grid, so the whole box is never made in tiled mode
+        if (args.pk_tile_size > 0):
+            grid = covering_grid_tile(ds, level, left_edge, dims, slices)
+            slices = Ellipsis
+        else:
+            grid = box
+        rho = np.asarray(grid['density'][slices].v)
+        return [rho**nindex_rho * np.asarray(grid[vel][slices].in_units('cm/s').v) \
+                for vel in ["vx_corrected", "vy_corrected", "vz_corrected"]]
 
     # physical limits to the wavenumbers
+    L = (right_edge - left_edge).v
     kmin = np.min(1./L)
     kmax = np.min(0.5*dims/L)
-
     kbins = np.arange(kmin, kmax, kmin)
-    N = len(kbins)
-
-    # bin the Fourier KE into radial kbins
-    kx3d, ky3d, kz3d = np.meshgrid(kx, ky, kz, indexing="ij")
-    k = np.sqrt(kx3d**2 + ky3d**2 + kz3d**2)
-    whichbin = np.digitize(k.flat, kbins)
-    ncount = np.bincount(whichbin)
-    E_spectrum = np.zeros(len(ncount) - 1)
-
-    for n in range(1, len(ncount)):
-        E_spectrum[n - 1] = np.sum(Kk.flat[whichbin == n])
 
-    k = 0.5 * (kbins[0:N-1] + kbins[1:N])
+    if (args.nproc==1): workers = -1
+    else: workers = 1
+    E_spectrum, n_modes = radial_power_spectrum(get_fields, dims, L, kbins, tile_size=args.pk_tile_size, \
+                                                window=args.pk_window, workers=workers)
+    E_spectrum = 0.5*E_spectrum
+    k = 0.5 * (kbins[:-1] + kbins[1:])
     l = 1./k
-    E_spectrum = E_spectrum[1:N]
 
-    index = np.argmax(E_spectrum)
+    index = np.nanargmax(E_spectrum)
     kmax = k[index]
     Emax = E_spectrum[index]
 
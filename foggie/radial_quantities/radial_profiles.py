@@ -37,6 +37,7 @@ from foggie.utils.get_run_loc_etc import get_run_loc_etc
 from foggie.utils.yt_fields import *
 from foggie.utils.foggie_load import *
 from foggie.utils.analysis_utils import *
+from foggie.utils.snapshot_scheduler import run_snapshots
 
 # These imports for datashader plots
 import datashader as dshader
@@ -121,6 +122,21 @@ def parse_args():
                         ' specified, code will run one output per processor')
     parser.set_defaults(nproc=1)
 
+    parser.add_argument('--retries', metavar='retries', type=int, action='store', \
+                        help='If running in parallel, how many times do you want to retry a snapshot that fails? Default is 2.')
+    parser.set_defaults(retries=2)
+
+    parser.add_argument('--mem_per_snap', metavar='mem_per_snap', type=float, action='store', \
+                        help='If running in parallel, how much memory (in GB) does one snapshot need? If given, fewer\n' + \
+                        'than nproc snapshots will be run at once if the node does not have enough memory available.\n' + \
+                        'Default is not to limit by memory.')
+    parser.set_defaults(mem_per_snap=0.)
+
+    parser.add_argument('--resume', dest='resume', action='store_true', \
+                        help='Do you want to skip snapshots that were already finished by a previous run that was\n' + \
+                        'interrupted? Default is no, start over with all snapshots.')
+    parser.set_defaults(resume=False)
+
     args = parser.parse_args()
     return args
 
@@ -619,50 +635,6 @@ if __name__ == "__main__":
 
     # Loop over outputs, for either single-processor or parallel processor computing
     if ('time' not in args.plot_type):
-        if (args.nproc==1):
-            for i in range(len(outs)):
-                snap = outs[i]
-                target(snap)
-        else:
-            skipped_outs = outs
-            while (len(skipped_outs)>0):
-                skipped_outs = []
-                # Split into a number of groupings equal to the number of processors
-                # and run one process per processor
-                for i in range(len(outs)//args.nproc):
-                    threads = []
-                    snaps = []
-                    for j in range(args.nproc):
-                        snap = outs[args.nproc*i+j]
-                        snaps.append(snap)
-                        threads.append(multi.Process(target=target, args=[snap]))
-                    for t in threads:
-                        t.start()
-                    for t in threads:
-                        t.join()
-                    # Delete leftover outputs from failed processes from tmp directory if on pleiades
-                    if (args.system=='pleiades_cassi'):
-                        for s in range(len(snaps)):
-                            if (os.path.exists('/nobackup/clochhaa/tmp/' + args.halo + '/' + args.run + '/profiles/' + snaps[s])):
-                                print('Deleting failed %s from /tmp' % (snaps[s]))
-                                skipped_outs.append(snaps[s])
-                                shutil.rmtree('/nobackup/clochhaa/tmp/' + args.halo + '/' + args.run + '/profiles/' + snaps[s])
-                # For any leftover snapshots, run one per processor
-                threads = []
-                snaps = []
-                for j in range(len(outs)%args.nproc):
-                    snap = outs[-(j+1)]
-                    snaps.append(snap)
-                    threads.append(multi.Process(target=target, args=[snap]))
-                for t in threads:
-                    t.start()
-                for t in threads:
-                    t.join()
-                # Delete leftover outputs from failed processes from tmp directory if on pleiades
-                if (args.system=='pleiades_cassi'):
-                    for s in range(len(snaps)):
-                        if (os.path.exists('/nobackup/clochhaa/tmp/' + args.halo + '/' + args.run + '/profiles/' + snaps[s])):
-                            print('Deleting failed %s from /tmp' % (snaps[s]))
-                            skipped_outs.append(snaps[s])
-                            shutil.rmtree('/nobackup/clochhaa/tmp/' + args.halo + '/' + args.run + '/profiles/' + snaps[s])
-                outs = skipped_outs
+        run_snapshots(target, outs, nproc=args.nproc, retries=args.retries, mem_per_snap=args.mem_per_snap, \
+          manifest=save_dir + 'finished_' + args.plot_type + save_suffix + '.txt', resume=args.resume, \
+          tmp_dir='/nobackup/clochhaa/tmp/' + args.halo + '/' + args.run + '/profiles/' if (args.system=='pleiades_cassi') else None)
@@ -13,6 +13,8 @@ utils/get_halo_center.py
 utils/get_proper_box_size.py
 utils/get_run_loc_etc.py
 utils/yt_fields.py
+utils/snapshot_scheduler.py
+utils/halo_catalog.py
 """
 
 # Import everything as needed
@@ -47,6 +49,9 @@ from foggie.utils.get_run_loc_etc import get_run_loc_etc
 from foggie.utils.yt_fields import *
 from foggie.utils.foggie_load import *
 from foggie.utils.analysis_utils import *
+from foggie.utils.snapshot_scheduler import run_snapshots
+from foggie.utils.halo_catalog import lookup_masses, lookup_rvir
+from foggie.utils.shell_stats import *
 
 def parse_args():
     '''Parse command line arguments. Returns args object.
@@ -222,6 +227,21 @@ def parse_args():
                         'want to filter on velocity.')
     parser.set_defaults(region_filter="none")
 
+    parser.add_argument('--retries', metavar='retries', type=int, action='store', \
+                        help='If running in parallel, how many times do you want to retry a snapshot that fails? Default is 2.')
+    parser.set_defaults(retries=2)
+
+    parser.add_argument('--mem_per_snap', metavar='mem_per_snap', type=float, action='store', \
+                        help='If running in parallel, how much memory (in GB) does one snapshot need? If given, fewer\n' + \
+                        'than nproc snapshots will be run at once if the node does not have enough memory available.\n' + \
+                        'Default is not to limit by memory.')
+    parser.set_defaults(mem_per_snap=0.)
+
+    parser.add_argument('--resume', dest='resume', action='store_true', \
+                        help='Do you want to skip snapshots that were already finished by a previous run that was\n' + \
+                        'interrupted? Default is no, start over with all snapshots.')
+    parser.set_defaults(resume=False)
+
 
     args = parser.parse_args()
     return args
@@ -770,47 +790,57 @@ def calc_stats(ds, snap, zsnap, refine_width_kpc, tablename, save_suffix, shape_
             if (args.pdf):
                 table_pdf = make_pdf_table(stats, ['sphere', 0])
 
-        # Loop over chunks and compute stats to add to table
+        # Assign every cell to its chunk once and sort every field once by (chunk, value), then find the
+        # statistics of every field in every chunk for each velocity direction and temperature bin with
+        # segmented sums, rather than masking and sorting the arrays separately for every chunk
+        print('Computing statistics in chunks for snapshot ' + snap)
+        num_chunks = len(chunks)-1
+        chunk_index = shell_index(radius, chunks)
+        bool_vels = [np.ones(len(radius), dtype=bool), (rad_vel < 0.), (rad_vel > 0.)]
+        bool_temps = [(temperature > 0.)]
+        for k in range(1, len(temps)):
+            bool_temps.append((temperature > temps[k-1]) & (temperature < temps[k]))
+        field_stats = []
+        for i in range(len(fields)):
+            order = sort_by_shell(chunk_index, fields[i])
+            field_stats.append([])
+            for j in range(3):
+                field_stats[i].append([])
+                for k in range(len(temps)):
+                    bool_group = bool_vels[j] & bool_temps[k]
+                    index_group = np.where(bool_group, chunk_index, -1)
+                    counts = np.bincount(index_group[index_group >= 0], minlength=num_chunks)
+                    quantiles = shell_quantiles(index_group, fields[i], weights, num_chunks, np.array([0.25,0.5,0.75]), \
+                      order=order[bool_group[order]])
+                    avgs, stds = shell_avg_and_std(index_group, fields[i], weights, num_chunks)
+                    if (args.pdf) or (args.vel_fit):
+                        hists, bin_edges = shell_pdfs(index_group, fields[i], weights, num_chunks, 200, x_ranges[i])
+                    else:
+                        hists, bin_edges = None, None
+                    field_stats[i][j].append([counts, quantiles, avgs, stds, hists, bin_edges])
+
+        # Loop over chunks and add stats to table
         # Index r is for radial/height chunk, index i is for the property we're computing stats for,
         # index j is for net, in, or out, and index k is for temperature, net, cold, cool, warm, hot
-        for r in range(len(chunks)-1):
-            if (r%10==0): print("Computing chunk " + str(r) + "/" + str(len(chunks)) + \
-                                " for snapshot " + snap)
+        for r in range(num_chunks):
             inner = chunks[r]
             outer = chunks[r+1]
             row = [zsnap, inner, outer]
             if (args.pdf):
                 pdf_array = []
-            bool_r = (radius > inner) & (radius < outer)
-            rad_vel_r = rad_vel[bool_r]
-            temp_r = temperature[bool_r]
-            weights_r = weights[bool_r]
             for i in range(len(fields)):
-                field = fields[i]
-                field_r = field[bool_r]
                 for j in range(3):
-                    if (j==0): bool_vel = np.ones(len(field_r), dtype=bool)
-                    if (j==1): bool_vel = (rad_vel_r < 0.)
-                    if (j==2): bool_vel = (rad_vel_r > 0.)
-                    field_v = field_r[bool_vel]
-                    temp_v = temp_r[bool_vel]
-                    weights_v = weights_r[bool_vel]
                     if (args.vel_fit) and (stats[i]=='tangential_velocity') and (j==0):
                         sig_tan = []
                     for k in range(len(temps)):
-                        if (k==0):
-                            bool_temp = (temp_v > 0.)
-                        else:
-                            bool_temp = (temp_v > temps[k-1]) & (temp_v < temps[k])
-                        field_t = field_v[bool_temp]
-                        weights_t = weights_v[bool_temp]
+                        counts, quantiles, avgs, stds, hists, bin_edges = field_stats[i][j][k]
+                        if (hists is not None): hist = hists[r]
                         if (args.pdf) and (j==0) and (k==0):
-                            if (len(field_t)>0):
-                                hist, bin_edges = np.histogram(field_t, weights=weights_t, bins=(200), range=x_ranges[i], density=True)
+                            if (counts[r]>0):
                                 pdf_array.append(bin_edges[:-1])
                                 pdf_array.append(bin_edges[1:])
                                 pdf_array.append(hist)
-                        if (len(field_t)==0):
+                        if (counts[r]==0):
                             row.append(0.)
                             row.append(0.)
                             row.append(0.)
@@ -833,17 +863,17 @@ def calc_stats(ds, snap, zsnap, refine_width_kpc, tablename, save_suffix, shape_
                                     pdf_array.append(np.zeros(200))
                                     pdf_array.append(np.zeros(200))
                         else:
-                            quantiles = weighted_quantile(field_t, weights_t, np.array([0.25,0.5,0.75]))
-                            row.append(quantiles[1])
-                            row.append(quantiles[2]-quantiles[0])
-                            avg, std = weighted_avg_and_std(field_t, weights_t)
+                            row.append(quantiles[r][1])
+                            row.append(quantiles[r][2]-quantiles[r][0])
+                            avg = avgs[r]
+                            std = stds[r]
                             row.append(avg)
                             row.append(std)
                             if (args.pdf) and (j+k>0):
-                                hist, bins = np.histogram(field_t, weights=weights_t, bins=(200), range=x_ranges[i], density=True)
                                 pdf_array.append(hist)
                             if (args.vel_fit) and ('velocity' in stats[i]) and (j==0):
-                                hist_vel, bins_vel = np.histogram(field_t, weights=weights_t, bins=(200), range=x_ranges[i], density=True)
+                                hist_vel = hist
+                                bins_vel = bin_edges
                                 bin_centers = np.diff(bins_vel) + bins_vel[:-1]
                                 if (stats[i]=='radial_velocity') and (args.region_filter!='velocity'):
                                     guesses = [0., sig_tan[k], hist_vel[np.where(bin_centers>=0.)[0][0]]]
@@ -973,14 +1003,9 @@ def load_and_calculate(system, foggie_dir, run_dir, track, halo_c_v_name, snap,
         sat = False
 
     # Load the mass enclosed profile
-    if (zsnap > 2.):
-        masses = Table.read(masses_dir + 'masses_z-gtr-2.hdf5', path='all_data')
-    else:
-        masses = Table.read(masses_dir + 'masses_z-less-2.hdf5', path='all_data')
-    rvir_masses = Table.read(masses_dir + 'rvir_masses.hdf5', path='all_data')
-    snap_ind = masses['snapshot']==snap
-    Menc_profile = IUS(np.concatenate(([0],masses['radius'][snap_ind])), np.concatenate(([0],masses['total_mass'][snap_ind])))
-    Rvir = rvir_masses['radius'][rvir_masses['snapshot']==snap]
+    radius, total_mass = lookup_masses(masses_dir, snap, zsnap)
+    Menc_profile = IUS(np.concatenate(([0],radius)), np.concatenate(([0],total_mass)))
+    Rvir = np.array([lookup_rvir(masses_dir, snap)[0]])
 
     # Do the actual calculation
     message = calc_stats(ds, snap, zsnap, refine_width_kpc, tablename, save_suffix, shape_args, \
@@ -1046,40 +1071,10 @@ if __name__ == "__main__":
             sys.exit()
 
     # Loop over outputs, for either single-processor or parallel processor computing
-    if (args.nproc==1):
-        for i in range(len(outs)):
-            snap = outs[i]
-            # Make the output table name for this snapshot
-            tablename = prefix + snap + '_stats'
-            # Do the actual calculation
-            load_and_calculate(args.system, foggie_dir, run_dir, trackname, halo_c_v_name, snap, \
-              tablename, save_suffix, shapes, stat_types, sat_dir, sat_radius, masses_dir)
-    else:
-        # Split into a number of groupings equal to the number of processors
-        # and run one process per processor
-        for i in range(len(outs)//args.nproc):
-            threads = []
-            for j in range(args.nproc):
-                snap = outs[args.nproc*i+j]
-                tablename = prefix + snap + '_stats'
-                threads.append(multi.Process(target=load_and_calculate, \
-			       args=(args.system, foggie_dir, run_dir, trackname, halo_c_v_name, snap, \
-                     tablename, save_suffix, shapes, stat_types, sat_dir, sat_radius, masses_dir)))
-            for t in threads:
-                t.start()
-            for t in threads:
-                t.join()
-        # For any leftover snapshots, run one per processor
-        threads = []
-        for j in range(len(outs)%args.nproc):
-            snap = outs[-(j+1)]
-            tablename = prefix + snap + '_stats'
-            threads.append(multi.Process(target=load_and_calculate, \
-			   args=(args.system, foggie_dir, run_dir, trackname, halo_c_v_name, snap, \
-                 tablename, save_suffix, shapes, stat_types, sat_dir, sat_radius, masses_dir)))
-        for t in threads:
-            t.start()
-        for t in threads:
-            t.join()
+    run_snapshots(load_and_calculate, outs, make_args=lambda snap: (args.system, foggie_dir, run_dir, trackname, \
+      halo_c_v_name, snap, prefix + snap + '_stats', save_suffix, shapes, stat_types, sat_dir, sat_radius, masses_dir), \
+      nproc=args.nproc, retries=args.retries, mem_per_snap=args.mem_per_snap, \
+      manifest=prefix + 'finished_stats' + save_suffix + '.txt', resume=args.resume, \
+      tmp_dir='/tmp/' if (args.system=='pleiades_cassi') else None)
 
     print("All snapshots finished!")
@@ -14,6 +14,8 @@ utils/get_run_loc_etc.py
 utils/yt_fields.py
 utils/foggie_load.py
 utils/analysis_utils.py
+utils/snapshot_scheduler.py
+utils/halo_catalog.py
 """
 
 # Import everything as needed
@@ -47,6 +49,9 @@ from foggie.utils.get_run_loc_etc import get_run_loc_etc
 from foggie.utils.yt_fields import *
 from foggie.utils.foggie_load import *
 from foggie.utils.analysis_utils import *
+from foggie.utils.snapshot_scheduler import run_snapshots
+from foggie.utils.halo_catalog import lookup_masses, lookup_rvir
+from foggie.utils.shell_stats import *
 
 def parse_args():
     '''Parse command line arguments. Returns args object.
@@ -195,6 +200,21 @@ def parse_args():
                         'in, partially out of the refine box. Default is not to do this.')
     parser.set_defaults(refined_only=False)
 
+    parser.add_argument('--retries', metavar='retries', type=int, action='store', \
+                        help='If running in parallel, how many times do you want to retry a snapshot that fails? Default is 2.')
+    parser.set_defaults(retries=2)
+
+    parser.add_argument('--mem_per_snap', metavar='mem_per_snap', type=float, action='store', \
+                        help='If running in parallel, how much memory (in GB) does one snapshot need? If given, fewer\n' + \
+                        'than nproc snapshots will be run at once if the node does not have enough memory available.\n' + \
+                        'Default is not to limit by memory.')
+    parser.set_defaults(mem_per_snap=0.)
+
+    parser.add_argument('--resume', dest='resume', action='store_true', \
+                        help='Do you want to skip snapshots that were already finished by a previous run that was\n' + \
+                        'interrupted? Default is no, start over with all snapshots.')
+    parser.set_defaults(resume=False)
+
 
     args = parser.parse_args()
     return args
@@ -443,52 +463,50 @@ def calc_totals(ds, snap, zsnap, refine_width_kpc, tablename, save_suffix, shape
     for i in range(len(fields)):
         fields[i] = fields[i][bool_nosat]
 
-    # Loop over chunks and compute totals to add to table
     if (args.temp_cut): temps = [0.,4.,5.,6.,12.]
     if (args.temp_cut_Tvir):
         temps = np.concatenate(([0],np.log10(10**(np.arange(-1.,1.25,0.25))*Tvir),[12]))
     else: temps = [0.]
+
+    # Assign every cell to its chunk once, then sum every field in every chunk for each velocity direction
+    # and temperature bin with one pass each, rather than masking the arrays separately for every chunk
+    print('Computing totals in chunks for snapshot ' + snap)
+    num_chunks = len(chunks)-1
+    chunk_index = shell_index(radius, chunks)
+    if (args.vel_cut):
+        chunk_edges = np.asarray(chunks)
+        center = 0.5*(chunk_edges[:-1] + chunk_edges[1:])
+        rho = Menc_profile(center)*gtoMsun/((center*1000*cmtopc)**3.) * 3./(4.*np.pi)
+        vff = -(center*1000*cmtopc)/np.sqrt(3.*np.pi/(32.*G*rho))/1e5
+        bool_cut = np.zeros(len(radius), dtype=bool)
+        in_chunk = (chunk_index >= 0)
+        bool_cut[in_chunk] = (rad_vel[in_chunk] > 0.5*vff[chunk_index[in_chunk]])
+    else:
+        bool_cut = np.ones(len(radius), dtype=bool)
+    bool_vels = [bool_cut, bool_cut & (rad_vel < 0.), bool_cut & (rad_vel > 0.)]
+    bool_temps = [(temperature > 0.)]
+    for k in range(1, len(temps)):
+        bool_temps.append((temperature > temps[k-1]) & (temperature < temps[k]))
+    totals = []
+    for i in range(len(fields)):
+        totals.append([])
+        for j in range(3):
+            totals[i].append([])
+            for k in range(len(temps)):
+                index_group = np.where(bool_vels[j] & bool_temps[k], chunk_index, -1)
+                totals[i][j].append(shell_sums(index_group, fields[i], num_chunks))
+
+    # Loop over chunks and add totals to table
     # Index r is for radial/height chunk, index i is for the property we're computing stats for,
     # index j is for net, in, or out, and index k is for temperature, net, cold, cool, warm, hot
-    for r in range(len(chunks)-1):
-        if (r%10==0): print("Computing chunk " + str(r) + "/" + str(len(chunks)) + \
-                            " for snapshot " + snap)
+    for r in range(num_chunks):
         inner = chunks[r]
         outer = chunks[r+1]
         row = [zsnap, inner, outer]
-        bool_r = (radius > inner) & (radius < outer)
-        rad_vel_r = rad_vel[bool_r]
-        temp_r = temperature[bool_r]
-        if (args.vel_cut):
-            center = 0.5*(inner + outer)
-            rho = Menc_profile(center)*gtoMsun/((center*1000*cmtopc)**3.) * 3./(4.*np.pi)
-            vff = -(center*1000*cmtopc)/np.sqrt(3.*np.pi/(32.*G*rho))/1e5
-            vesc = np.sqrt(2.*G*Menc_profile(center)*gtoMsun/(center*1000.*cmtopc))/1e5
-            temp_r = temp_r[(rad_vel_r > 0.5*vff)]
-            rad_vel_cut_r = rad_vel_r[(rad_vel_r > 0.5*vff)]
-        else:
-            rad_vel_cut_r = rad_vel_r
         for i in range(len(fields)):
-            field = fields[i]
-            field_r = field[bool_r]
-            if (args.vel_cut):
-                field_r = field_r[(rad_vel_r > 0.5*vff)]
             for j in range(3):
-                if (j==0): bool_vel = np.ones(len(field_r), dtype=bool)
-                if (j==1): bool_vel = (rad_vel_cut_r < 0.)
-                if (j==2): bool_vel = (rad_vel_cut_r > 0.)
-                field_v = field_r[bool_vel]
-                temp_v = temp_r[bool_vel]
                 for k in range(len(temps)):
-                    if (k==0):
-                        bool_temp = (temp_v > 0.)
-                    else:
-                        bool_temp = (temp_v > temps[k-1]) & (temp_v < temps[k])
-                    field_t = field_v[bool_temp]
-                    if (len(field_t)==0):
-                        row.append(0.)
-                    else:
-                        row.append(np.sum(field_t))
+                    row.append(totals[i][j][k][r])
         table.add_row(row)
 
     table = set_table_units(table)
@@ -537,15 +555,11 @@ def load_and_calculate(system, foggie_dir, run_dir, track, halo_c_v_name, snap,
         sat = False
 
     # Load the mass enclosed profile
-    if (zsnap > 2.):
-        masses = Table.read(masses_dir + 'masses_z-gtr-2.hdf5', path='all_data')
-    else:
-        masses = Table.read(masses_dir + 'masses_z-less-2.hdf5', path='all_data')
-    rvir_masses = Table.read(masses_dir + 'rvir_masses.hdf5', path='all_data')
-    snap_ind = masses['snapshot']==snap
-    Menc_profile = IUS(np.concatenate(([0],masses['radius'][snap_ind])), np.concatenate(([0],masses['total_mass'][snap_ind])))
-    Rvir = rvir_masses['radius'][rvir_masses['snapshot']==snap]
-    Mvir = rvir_masses['total_mass'][rvir_masses['snapshot']==snap]
+    radius, total_mass = lookup_masses(masses_dir, snap, zsnap)
+    Menc_profile = IUS(np.concatenate(([0],radius)), np.concatenate(([0],total_mass)))
+    Rvir, Mvir = lookup_rvir(masses_dir, snap)
+    Rvir = np.array([Rvir])
+    Mvir = np.array([Mvir])
     Tvir = (mu*mp/kB)*(1./2.*G*Mvir*gtoMsun)/(Rvir*1000*cmtopc)
 
     # Do the actual calculation
@@ -609,40 +623,10 @@ if __name__ == "__main__":
             sys.exit()
 
     # Loop over outputs, for either single-processor or parallel processor computing
-    if (args.nproc==1):
-        for i in range(len(outs)):
-            snap = outs[i]
-            # Make the output table name for this snapshot
-            tablename = prefix + snap + '_totals'
-            # Do the actual calculation
-            load_and_calculate(args.system, foggie_dir, run_dir, trackname, halo_c_v_name, snap, \
-              tablename, save_suffix, shapes, total_types, sat_dir, sat_radius, masses_dir)
-    else:
-        # Split into a number of groupings equal to the number of processors
-        # and run one process per processor
-        for i in range(len(outs)//args.nproc):
-            threads = []
-            for j in range(args.nproc):
-                snap = outs[args.nproc*i+j]
-                tablename = prefix + snap + '_totals'
-                threads.append(multi.Process(target=load_and_calculate, \
-			       args=(args.system, foggie_dir, run_dir, trackname, halo_c_v_name, snap, \
-                     tablename, save_suffix, shapes, total_types, sat_dir, sat_radius, masses_dir)))
-            for t in threads:
-                t.start()
-            for t in threads:
-                t.join()
-        # For any leftover snapshots, run one per processor
-        threads = []
-        for j in range(len(outs)%args.nproc):
-            snap = outs[-(j+1)]
-            tablename = prefix + snap + '_totals'
-            threads.append(multi.Process(target=load_and_calculate, \
-			   args=(args.system, foggie_dir, run_dir, trackname, halo_c_v_name, snap, \
-                 tablename, save_suffix, shapes, total_types, sat_dir, sat_radius, masses_dir)))
-        for t in threads:
-            t.start()
-        for t in threads:
-            t.join()
+    run_snapshots(load_and_calculate, outs, make_args=lambda snap: (args.system, foggie_dir, run_dir, trackname, \
+      halo_c_v_name, snap, prefix + snap + '_totals', save_suffix, shapes, total_types, sat_dir, sat_radius, masses_dir), \
+      nproc=args.nproc, retries=args.retries, mem_per_snap=args.mem_per_snap, \
+      manifest=prefix + 'finished_totals' + save_suffix + '.txt', resume=args.resume, \
+      tmp_dir='/tmp/' if (args.system=='pleiades_cassi') else None)
 
     print("All snapshots finished!")
@@ -3,6 +3,7 @@ from yt.units import kpc, Mpc
 import joblib
 from joblib import Parallel, delayed
 import os
+import time
 from astropy.io import ascii
 import matplotlib.pyplot as plt
 import numpy as np
@@ -13,6 +14,7 @@ import scipy
 from scipy import stats
 from scipy import interpolate
 from scipy.interpolate import interp1d
+from scipy.spatial import cKDTree
 import astropy.units as u
 from astropy.convolution import convolve_fft, Gaussian1DKernel
 plt.ioff()
@@ -21,7 +23,42 @@ np.random.seed(1)
 
 
 
-def create_plunging_tunnels(haloname, DDname, simname = 'nref11c_nref9f',  ray_l = 110., ray_s = 10, nrays = 100, smooth = 1., center_dic = None):
+def load_tunnel_cells(ds, center, bulk_velocity, radius):
+    # reads the position, volume, density, radial velocity, and radius of every cell within radius of center
+    # once, so every tunnel sample point can be answered from these arrays instead of a new yt selection
+    sp = ds.sphere(center, radius)
+    sp.set_field_parameter('center', center)
+    sp.set_field_parameter('bulk_velocity', bulk_velocity)
+    cells = {}
+    cells['pos'] = np.transpose([sp['index', 'x'].to('kpc').value, sp['index', 'y'].to('kpc').value, sp['index', 'z'].to('kpc').value])
+    cells['cell_volume'] = sp['index', 'cell_volume'].to('kpc**3').value
+    cells['density'] = sp['gas', 'density'].to('g/cm**3').value
+    cells['vel_r'] = sp['gas', 'radial_velocity'].to('km/s').value
+    cells['dist_r'] = sp['index', 'radius'].to('kpc').value
+    return cells
+
+def sample_tunnel_points(tree, cells, points, smooth, fields = ['density', 'vel_r', 'dist_r'], chunk_size = 1000):
+    # volume-weighted averages of fields over the cells within smooth (kpc) of each of points, using a
+    # cKDTree of the cell positions; like a yt sphere, a point with no cell center that close gets the cell it is in
+    averages = {field: np.zeros(len(points)) for field in fields}
+    for start in arange(0, len(points), chunk_size):
+        pts = points[start:start+chunk_size]
+        balls = tree.query_ball_point(pts, smooth, return_sorted = False)
+        lengths = array([len(ball) for ball in balls])
+        if (lengths == 0).any():
+            nearest = tree.query(pts[lengths == 0])[1]
+            for n, b in enumerate(where(lengths == 0)[0]): balls[b] = [nearest[n]]
+            lengths[lengths == 0] = 1
+        ind = np.concatenate(balls).astype('int64')
+        owner = np.repeat(arange(len(pts)), lengths)
+        weights = cells['cell_volume'][ind]
+        wsum = np.bincount(owner, weights = weights, minlength = len(pts))
+        for field in fields:
+            averages[field][start:start+chunk_size] = np.bincount(owner, weights = weights * cells[field][ind], minlength = len(pts))/wsum
+    return averages
+
+def create_plunging_tunnels(haloname, DDname, simname = 'nref11c_nref9f',  ray_l = 110., ray_s = 10, nrays = 100, smooth = 1., center_dic = None, \
+                            sample_spacing = None):
 
     to_save = {}
 
@@ -80,58 +117,27 @@ def create_plunging_tunnels(haloname, DDname, simname = 'nref11c_nref9f',  ray_l
 
 
 
-    for i, (theta, phi) in enumerate(zip(ts_random, ps_random)):
-        #randomly sample rays starting along a sphere of ray_l and ending at ray_s
+    # read the cells around the center once and answer every sample point of every ray with one tree
+    if sample_spacing is None: sample_spacing = np.max([smooth, 0.5])
+    cells = load_tunnel_cells(ds, center, cen_bulkv, (ray_l + smooth, 'kpc'))
+    tree = cKDTree(cells['pos'])
+
+    #randomly sample rays starting along a sphere of ray_l and ending at ray_s
+    directions = np.transpose([np.cos(ts_random)*np.sin(ps_random), np.sin(ts_random)*np.sin(ps_random), np.cos(ps_random)])
+    ray_ds = arange(ray_s, ray_l + sample_spacing/2., sample_spacing)
+    points = center.to('kpc').value[None, None, :] + directions[:, None, :] * ray_ds[None, :, None]
+    c = time.time()
+    averages = sample_tunnel_points(tree, cells, points.reshape(-1, 3), smooth)
+    print (smooth, 'sampled %i points on %i rays in %.1f s'%(points.shape[0]*points.shape[1], nrays, time.time()-c))
+
+    for i in arange(nrays):
         to_save_sim_ray = {}
-        end = [(center[0].value + ray_l * np.cos(theta)*np.sin(phi), "kpc"),\
-               (center[1].value + ray_l * np.sin(theta)*np.sin(phi), "kpc"),\
-               (center[2].value + ray_l * np.cos(phi),               "kpc")]
-
-        start = [(center[0].value + ray_s * np.cos(theta)*np.sin(phi), "kpc"),\
-                 (center[1].value + ray_s * np.sin(theta)*np.sin(phi), "kpc"),\
-                 (center[2].value + ray_s * np.cos(phi),               "kpc")]
-
-
-        ray = ds.r[start:end]
-
-        xs = ray['index', 'x'].to('kpc')
-        ys = ray['index', 'y'].to('kpc')
-        zs = ray['index', 'z'].to('kpc')
-
-
-        ray.set_field_parameter('center', center)
-        ray.set_field_parameter('bulk_velocity', cen_bulkv)
-        dist_r = ray['index', 'radius'].to('kpc')
-        vel_r  = ray['gas', 'radial_velocity'].to('km/s')
-
-        dens = []
-        vel = []
-        dist_r = []
-        import time
-        c = time.time()
-        print (len(xs))
-        for count, (xi, yi, zi) in enumerate(zip(xs, ys, zs)):
-            if count%(int(smooth/0.5)) !=0: continue
-            cen = ds.arr([xi,yi,zi], 'kpc')
-            sphere = ds.sphere(cen, (smooth, 'kpc'))
-            sphere.set_field_parameter('center', center)
-            sphere.set_field_parameter('bulk_velocity', cen_bulkv)
-            #save gas densities
-
-            # distances in a coordinate system centered at central galaxy
-            # velocities in the rest-frame of the central galaxy
-            dens.append(sphere.quantities.weighted_average_quantity(('gas', 'density'), ('index', 'cell_volume')).to('g/cm**3'))
-            vel.append(sphere.quantities.weighted_average_quantity(('gas', 'radial_velocity'), ('index', 'cell_volume')).to('km/s'))
-            dist_r.append(sphere.quantities.weighted_average_quantity(('index', 'radius'), ('index', 'cell_volume')).to('kpc'))
-        d = time.time()
-        print (smooth, i, d-c)
-        #to_save_sim_ray['density'] = ray['gas', 'density'].to('g/cm**3')
-        #to_save_sim_ray['vel_r'] = ray['gas', 'radial_velocity'].to('km/s')
-        #to_save_sim_ray['dist_r'] = ray['index', 'radius'].to('kpc')
-
-        to_save_sim_ray['density'] = dens
-        to_save_sim_ray['vel_r'] = vel
-        to_save_sim_ray['dist_r'] = dist_r
+        # distances in a coordinate system centered at central galaxy
+        # velocities in the rest-frame of the central galaxy
+        ray_ind = slice(i*len(ray_ds), (i+1)*len(ray_ds))
+        to_save_sim_ray['density'] = ds.arr(averages['density'][ray_ind], 'g/cm**3')
+        to_save_sim_ray['vel_r'] = ds.arr(averages['vel_r'][ray_ind], 'km/s')
+        to_save_sim_ray['dist_r'] = ds.arr(averages['dist_r'][ray_ind], 'kpc')
 
         to_save_sim['ray_%s'%i] = to_save_sim_ray
 
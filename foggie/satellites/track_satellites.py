@@ -7,6 +7,8 @@ from numpy import *
 import math
 from joblib import Parallel, delayed
 import os, sys, argparse
+import shutil
+import h5py
 import yt
 from numpy import rec
 from astropy.io import ascii
@@ -65,75 +67,187 @@ def parse_args():
                         help='which output? default is RD0020')
     parser.set_defaults(output="DD0487")
 
+    parser.add_argument('--do_track', dest='do_track', action='store_true',
+                        help='track the satellites by their anchor stars?, default is no')
+    parser.set_defaults(do_track=False)
+
+    parser.add_argument('--track_outputs', metavar='track_outputs', type=str, action='store',
+                        help='if tracking, a comma-separated list of the outputs to track through, in order. outputs already\n' + \
+                        'in the tracks file are skipped. default is just --output')
+    parser.set_defaults(track_outputs="none")
+
+    parser.add_argument('--track_half_width', metavar='track_half_width', type=float, action='store',
+                        help='if tracking, how far (in kpc) around the expected location of a satellite to look for its anchor stars\' peak?\n' + \
+                        'default is 5')
+    parser.set_defaults(track_half_width=5.)
+
 
     args = parser.parse_args()
     return args
 
 
-def run_tracker(args, anchor_ids, sat, temp_outdir, id_all, x_all, y_all, z_all):
+def build_id_index(id_all):
+    # sort the particle IDs once per snapshot so any set of IDs can be found with a binary search
+    id_all = np.asarray(id_all)
+    order = np.argsort(id_all, kind = 'stable')
+    return id_all[order], order
+
+
+def match_ids(id_index, ids):
+    # returns the index into the particle arrays of each ID in ids, or -1 if it isn't in the snapshot
+    sorted_ids, order = id_index
+    ids = np.asarray(ids)
+    pos = np.searchsorted(sorted_ids, ids)
+    pos[pos == len(sorted_ids)] = 0
+    found = (len(sorted_ids) > 0) & (sorted_ids[pos] == ids)
+    return np.where(found, order[pos], -1)
+
+
+def find_density_peak(x, y, z, center, half_width = 30., bin_width = 0.3):
+    # returns the center of the densest cell of a histogram of the particles within half_width (kpc)
+    # of center along each axis, with cells bin_width (kpc) on a side (about the 200 cells over 60 kpc
+    # the tracker has always used), or nans if there are no particles there. the number of cells
+    # goes as (half_width/bin_width)**3, so a small window around a good guess is much faster
+    gd = where((abs(x - center[0]) < half_width) & \
+               (abs(y - center[1]) < half_width) & \
+               (abs(z - center[2]) < half_width))[0]
+    if len(gd) == 0: return np.array([np.nan, np.nan, np.nan])
+
+    nbins = max(1, int(round(2.*half_width/bin_width)))
+    bins = [center[i] + np.linspace(-half_width, half_width, nbins+1) for i in range(3)]
+    H, edges = histogramdd((x[gd], y[gd], z[gd]), bins = bins)
+    argmax_H  = np.unravel_index(np.argmax(H, axis = None), H.shape)
+    return np.array([np.mean([edges[i][argmax_H[i]], edges[i][argmax_H[i]+1]]) for i in range(3)])
+
+
+def run_tracker(args, anchor_ids, sat, temp_outdir, id_all, x_all, y_all, z_all, id_index = None, anchor_indices = None, \
+                guess = None, half_width = 30., bin_width = 0.3):
+    # anchor_indices (from match_ids) or id_index (from build_id_index) skip the search through id_all;
+    # guess is where the satellite is expected to be (e.g., from the previous outputs), around which
+    # the density peak of the anchor stars is searched for
     print ('tracking %s %s'%(args.halo, sat))
-    gd_indices = []
     print ('\t', args.halo, sat, 'finding anchor stars..')
-    for a, anchor_id in enumerate(anchor_ids):
-      match = where(id_all == anchor_id)[0]
-      if len(match) > 0: gd_indices.append(int(match))
-
-    x_anchors =  x_all[gd_indices]
-    y_anchors =  y_all[gd_indices]
-    z_anchors =  z_all[gd_indices]
-
+    if anchor_indices is None:
+      if id_index is None: id_index = build_id_index(id_all)
+      anchor_indices = match_ids(id_index, anchor_ids)
+    gd_indices = anchor_indices[anchor_indices >= 0]
 
+    x_anchors =  np.asarray(x_all[gd_indices])
+    y_anchors =  np.asarray(y_all[gd_indices])
+    z_anchors =  np.asarray(z_all[gd_indices])
 
     print (len(x_anchors))
 
-   
-    med_x = nanmedian(x_anchors).value
-    med_y = nanmedian(y_anchors).value
-    med_z = nanmedian(z_anchors).value
-
-
-
-
-
-
-
-    if (not np.isnan(med_x)) & (len(gd_indices) > 500): 
-
-
-          xbins = np.arange(med_x - 30, med_x+30, 0.05)
-          ybins = np.arange(med_y - 30, med_y+30, 0.05)
-          zbins = np.arange(med_z - 30, med_z+30, 0.05)
-
-          gd = where((abs(x_anchors.value - med_x) < 30) & \
-                     (abs(y_anchors.value - med_y) < 30) & \
-                     (abs(z_anchors.value - med_z) < 30))
-
-
-          x_anchors_use = x_anchors[gd].value
-          y_anchors_use = y_anchors[gd].value
-          z_anchors_use = z_anchors[gd].value
-
-          stack_bins = (200, 200, 200)
-          stack_positions = (x_anchors_use, y_anchors_use, z_anchors_use)
-
-          H, edges = histogramdd(stack_positions, bins = stack_bins)
-          argmax_H  = np.unravel_index(np.argmax(H, axis = None), H.shape)
-          xedges = edges[0]
-          yedges = edges[1]
-          zedges = edges[2]
-          x_sat = np.mean([xedges[argmax_H[0]],xedges[argmax_H[0]+1]]) 
-          y_sat = np.mean([yedges[argmax_H[1]],yedges[argmax_H[1]+1]]) 
-          z_sat = np.mean([zedges[argmax_H[2]],zedges[argmax_H[2]+1]]) 
+    med = np.array([nanmedian(x_anchors), nanmedian(y_anchors), nanmedian(z_anchors)])
 
+    if (not np.isnan(med[0])) & (len(gd_indices) > 500):
+          sat_loc = np.array([np.nan, np.nan, np.nan])
+          if (guess is not None) and (np.all(np.isfinite(guess))):
+              sat_loc = find_density_peak(x_anchors, y_anchors, z_anchors, guess, half_width = half_width, bin_width = bin_width)
+          if np.isnan(sat_loc[0]):
+              sat_loc = find_density_peak(x_anchors, y_anchors, z_anchors, med, half_width = 30., bin_width = bin_width)
+          x_sat, y_sat, z_sat = sat_loc
     else:
           x_sat = np.nan
           y_sat = np.nan
           z_sat = np.nan
     print ('\t found location for %s %s: (%.3f, %.3f, %.3f)'%(args.halo, sat, x_sat, y_sat, z_sat))
 
-    np.save(temp_outdir + '/' + args.halo + '_' + args.output + '_' + sat + '.npy', np.array([x_sat, y_sat, z_sat, len(gd_indices)]))
-
-    return 
+    if temp_outdir is not None:
+      np.save(temp_outdir + '/' + args.halo + '_' + args.output + '_' + sat + '.npy', np.array([x_sat, y_sat, z_sat, len(gd_indices)]))
+
+    return np.array([x_sat, y_sat, z_sat, len(gd_indices)])
+
+
+def read_tracks(track_file):
+    # returns the satellite tracks saved so far in track_file, as a dictionary of satellite to
+    # a dictionary of arrays of output name, time (Gyr), position (kpc) and number of anchors found
+    tracks = {}
+    if not os.path.isfile(track_file): return tracks
+    with h5py.File(track_file, 'r') as f:
+      for sat in f.keys():
+        tracks[sat] = {key: f[sat][key][()] for key in f[sat].keys()}
+        tracks[sat]['output'] = np.array([o.decode() if type(o) == bytes else o for o in tracks[sat]['output']])
+    return tracks
+
+
+def save_track_rows(track_file, output, time, locations):
+    # appends one output's satellite locations (a dictionary of satellite to [x, y, z, n_anchors])
+    # to track_file, replacing any rows already saved for that output, writing to a copy that replaces
+    # the file so a killed run never leaves it half-written
+    tmp_file = track_file + '.tmp' + str(os.getpid())
+    if os.path.isfile(track_file): shutil.copyfile(track_file, tmp_file)
+    with h5py.File(tmp_file, 'a') as f:
+      for sat in locations.keys():
+        row = {'output': np.array([output], dtype = 'S'), 'time': [time], 'x': [locations[sat][0]], 'y': [locations[sat][1]],\
+               'z': [locations[sat][2]], 'n_anchors': [locations[sat][3]]}
+        if sat not in f:
+          grp = f.create_group(sat)
+          for key in row.keys():
+            grp.create_dataset(key, data = row[key], maxshape = (None,), chunks = True)
+        else:
+          grp = f[sat]
+          keep = np.array([(o.decode() if type(o) == bytes else o) != output for o in grp['output'][()]], dtype = bool)
+          n_keep = np.count_nonzero(keep)
+          for key in row.keys():
+            values = grp[key][()][keep]
+            grp[key].resize((n_keep + 1,))
+            grp[key][:n_keep] = values
+            grp[key][-1] = row[key][0]
+    os.replace(tmp_file, track_file)
+
+
+def predict_location(track, time):
+    # returns where a satellite should be at time (Gyr), extrapolating from its two latest locations
+    # before then in track, or its latest location if there is only one, or None if there are none
+    if track is None: return None
+    pos = np.transpose([track['x'], track['y'], track['z']])
+    before = where((track['time'] < time) & np.all(np.isfinite(pos), axis = 1))[0]
+    if len(before) == 0: return None
+    before = before[np.argsort(track['time'][before])]
+    p1, t1 = pos[before[-1]], track['time'][before[-1]]
+    if len(before) == 1: return p1
+    p0, t0 = pos[before[-2]], track['time'][before[-2]]
+    return p1 + (p1 - p0) * (time - t1)/(t1 - t0)
+
+
+def track_outputs(args, anchors, outputs, run_dir, track_file, half_width = 5., bin_width = 0.3):
+    # tracks every satellite in anchors through outputs (in order), saving each output's locations to
+    # track_file as soon as it is done; outputs already in track_file are skipped, so a track can be
+    # extended by new outputs, or a killed run restarted, without redoing the ones before. an output
+    # saved for only some of the satellites is redone, and its old rows are replaced
+    tracks = read_tracks(track_file)
+    sats = list(anchors.keys())
+    n_anchors = [len(anchors[sat]['ids']) for sat in sats]
+    all_anchor_ids = np.concatenate([np.asarray(anchors[sat]['ids']) for sat in sats])
+    for output in outputs:
+      if all([(sat in tracks) and (output in tracks[sat]['output']) for sat in sats]):
+        print ('%s already tracked, skipping'%output)
+        continue
+      args.output = output
+      ds = yt.load(run_dir + output + '/' + output)
+      time = ds.current_time.in_units('Gyr').value
+      all_data = ds.all_data()
+      filter_particles(all_data, load_particles = True, load_particle_types = ['stars'], \
+                       load_particle_fields = ['particle_index', 'particle_position_x', 'particle_position_y', 'particle_position_z'])
+      id_all = all_data['stars', 'particle_index']
+      x_all  = all_data['stars', 'particle_position_x'].to('kpc').value
+      y_all  = all_data['stars', 'particle_position_y'].to('kpc').value
+      z_all  = all_data['stars', 'particle_position_z'].to('kpc').value
+
+      # resolve the anchors of all satellites with one sort of the IDs
+      all_indices = match_ids(build_id_index(id_all), all_anchor_ids)
+      locations = {}
+      for s, sat in enumerate(sats):
+        anchor_indices = all_indices[sum(n_anchors[:s]):sum(n_anchors[:s+1])]
+        guess = predict_location(tracks.get(sat), time)
+        locations[sat] = run_tracker(args, anchors[sat]['ids'], sat, None, id_all, x_all, y_all, z_all, \
+                                     anchor_indices = anchor_indices, guess = guess, half_width = half_width, bin_width = bin_width)
+
+      save_track_rows(track_file, output, time, locations)
+      tracks = read_tracks(track_file)
+
+    return tracks
 
 if __name__ == '__main__':
     args = parse_args()
@@ -180,23 +294,17 @@ if __name__ == '__main__':
 
       cond = not os.path.isfile('%s/%s/%s_%s.npy'%(temp_outdir.replace('/temp', ''), args.halo, args.halo, args.output))
       #cond = not os.path.isfile(temp_outdir + '/' + args.halo + '_' + args.output + '_0.npy')
-      if False:
-        load_particle_fields = ['particle_index',\
-                                'particle_position_x', 'particle_position_y', 'particle_position_z']      
-
-        filter_particles(all_data, load_particles = True, load_particle_types = ['stars'], load_particle_fields = load_particle_fields)
-
-        print ('particles loaded')
-        # Need to pass in these arrays, can't pass in refine box
-        id_all = all_data['stars', 'particle_index']
-        x_all  = all_data['stars', 'particle_position_x'].to('kpc')
-        y_all  = all_data['stars', 'particle_position_y'].to('kpc')
-        z_all  = all_data['stars', 'particle_position_z'].to('kpc')
-    
-        Parallel(n_jobs = -1)(delayed(run_tracker)(args, anchors[sat]['ids'], sat, temp_outdir, id_all, x_all, y_all, z_all) for sat in anchors.keys())
-
-      else: 
-        filter_particles(refine_box)
+      if args.do_track:
+        # track through the outputs with one particle ID sort per output, checkpointing each output to
+        # the tracks file so later runs only do new outputs
+        if args.track_outputs != 'none': outputs = args.track_outputs.split(',')
+        else: outputs = [args.output]
+        this_output = args.output
+        track_outputs(args, anchors, outputs, run_dir, '%s/sat_track_locations/%s_sat_tracks.hdf5'%(cat_dir, args.halo), \
+                      half_width = args.track_half_width)
+        args.output = this_output
+
+      filter_particles(refine_box)
 
 
 
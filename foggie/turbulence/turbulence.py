@@ -14,6 +14,10 @@ utils/get_run_loc_etc.py
 utils/yt_fields.py
 utils/foggie_load.py
 utils/analysis_utils.py
+utils/grid_cache.py
+utils/power_spectrum.py
+utils/tiled_grid.py
+utils/structure_function.py
 """
 
 # Import everything as needed
@@ -56,6 +60,10 @@ from foggie.utils.get_run_loc_etc import get_run_loc_etc
 from foggie.utils.yt_fields import *
 from foggie.utils.foggie_load import *
 from foggie.utils.analysis_utils import *
+from foggie.utils.grid_cache import cached_covering_grid
+from foggie.utils.power_spectrum import radial_power_spectrum
+from foggie.utils.tiled_grid import covering_grid_tile
+from foggie.utils.structure_function import grid_structure_function, cell_structure_function
 
 # These imports for datashader plots
 import datashader as dshader
@@ -162,6 +170,30 @@ def parse_args():
                         'run time and reduce weight on IO file system. Default is no.')
     parser.set_defaults(copy_to_tmp=False)
 
+    parser.add_argument('--grid_cache', metavar='grid_cache', type=str, action='store', \
+                        help='If you want to save the fields taken from the covering grid to disk so later runs\n' + \
+                        'on the same snapshot (of this or other scripts) can read them back instead of making the\n' + \
+                        'grid again, give the directory to save them in here. Default is not to do this.')
+    parser.set_defaults(grid_cache='none')
+
+    parser.add_argument('--pk_tile_size', metavar='pk_tile_size', type=int, action='store', \
+                        help='If plotting turbulent_spectrum, do you want to find the power spectrum by averaging\n' + \
+                        'the spectra of overlapping windowed tiles of this many cells on a side, instead of one FFT\n' + \
+                        'of the whole (non-periodic) box? Each tile is made as its own covering grid, so this uses\n' + \
+                        'much less memory. Default is 0 (whole box).')
+    parser.set_defaults(pk_tile_size=0)
+
+    parser.add_argument('--pk_window', metavar='pk_window', type=str, action='store', \
+                        help='If using --pk_tile_size, what window do you want to multiply each tile by? Options are\n' + \
+                        '"hann" or "tukey". Default is hann.')
+    parser.set_defaults(pk_window='hann')
+
+    parser.add_argument('--vsf_max_pairs', metavar='vsf_max_pairs', type=int, action='store', \
+                        help='If plotting vel_struc_func, what is the most pairs of cells you want to use for\n' + \
+                        'each octave of separation? All pairs are used at separations where there are fewer than\n' + \
+                        'this, and a random subset of cells otherwise. Default is 10000000.')
+    parser.set_defaults(vsf_max_pairs=10000000)
+
     args = parser.parse_args()
     return args
 
@@ -433,54 +465,38 @@ def Pk_turbulence(snap):
     left_edge = ds.halo_center_kpc - ds.arr([1.5*Rvir,1.5*Rvir,1.5*Rvir],'kpc')
     right_edge = ds.halo_center_kpc + ds.arr([1.5*Rvir,1.5*Rvir,1.5*Rvir],'kpc')
     dims = np.array([refine_res, refine_res, refine_res])
-    box = ds.covering_grid(level=level, left_edge=left_edge, dims=dims)
+    box = cached_covering_grid(ds, level, left_edge, dims, cache_dir=args.grid_cache)
 
-    nx, ny, nz = dims
+    # Turbulent kinetic energy in each radial k bin, from real FFTs of rho^(1/3) * v, binned with
+    # one bincount. With --pk_tile_size, the grid is split into windowed tiles that are transformed
+    # one at a time, so the whole box doesn't have to be periodic or fit in one FFT
     nindex_rho = 1./3.
-    Kk = np.zeros((nx//2+1, ny//2+1, nz//2+1))
-
-    for vel in ["vx_corrected", "vy_corrected", "vz_corrected"]:
-        rho = box['density'].v
-        u = box[vel].in_units('cm/s').v
-
-        # do the FFTs -- note that since our data is real, there will be
-        # too much information here.  fftn puts the positive freq terms in
-        # the first half of the axes -- that's what we keep.  Our
-        # normalization has an '8' to account for this clipping to one
-        # octant.
-        ru = np.fft.fftn(rho**nindex_rho * u)[0:nx//2+1, 0:ny//2+1, 0:nz//2+1]
-        ru = 8.0*ru/(nx * ny * nz)
-        k_fft = np.abs(ru)**2
-        Kk += 0.5 * k_fft
-
-    # wavenumbers
-    L = (right_edge - left_edge).v
-    kx = np.fft.rfftfreq(nx) * nx/L[0]
-    ky = np.fft.rfftfreq(ny) * ny/L[1]
-    kz = np.fft.rfftfreq(nz) * nz/L[2]
+    def get_fields(slices):
+        # Each tile is made as its own covering grid, so the whole box is never made in tiled mode
+        if (args.pk_tile_size > 0):
+            grid = covering_grid_tile(ds, level, left_edge, dims, slices)
+            slices = Ellipsis
+        else:
+            grid = box
+        rho = np.asarray(grid['density'][slices].v)
+        return [rho**nindex_rho * np.asarray(grid[vel][slices].in_units('cm/s').v) \
+                for vel in ["vx_corrected", "vy_corrected", "vz_corrected"]]
 
     # physical limits to the wavenumbers
+    L = (right_edge - left_edge).v
     kmin = np.min(1./L)
     kmax = np.min(0.5*dims/L)
-
     kbins = np.arange(kmin, kmax, kmin)
-    N = len(kbins)
-
-    # bin the Fourier KE into radial kbins
-    kx3d, ky3d, kz3d = np.meshgrid(kx, ky, kz, indexing="ij")
-    k = np.sqrt(kx3d**2 + ky3d**2 + kz3d**2)
-    whichbin = np.digitize(k.flat, kbins)
-    ncount = np.bincount(whichbin)
-    E_spectrum = np.zeros(len(ncount) - 1)
-
-    for n in range(1, len(ncount)):
-        E_spectrum[n - 1] = np.sum(Kk.flat[whichbin == n])
 
-    k = 0.5 * (kbins[0:N-1] + kbins[1:N])
+    if (args.nproc==1): workers = -1
+    else: workers = 1
+    E_spectrum, n_modes = radial_power_spectrum(get_fields, dims, L, kbins, tile_size=args.pk_tile_size, \
+                                                window=args.pk_window, workers=workers)
+    E_spectrum = 0.5*E_spectrum
+    k = 0.5 * (kbins[:-1] + kbins[1:])
     l = 1./k
-    E_spectrum = E_spectrum[1:N]
 
-    index = np.argmax(E_spectrum)
+    index = np.nanargmax(E_spectrum)
     kmax = k[index]
     Emax = E_spectrum[index]
 
@@ -494,10 +510,10 @@ def Pk_turbulence(snap):
     plt.savefig(save_dir + snap + '_turbulent_energy_spectrum' + save_suffix + '.pdf')
 
 def vsf_cubeshift(snap):
-    '''I DON'T THINK THIS WORKED PROPERLY. DO NOT USE.
-
-    Calculates and plots the velocity structure function for the snapshot 'snap' by shifting the
-    whole dataset by set amounts and calculating the velocity difference between shifted and un-shifted data.'''
+    '''Calculates and plots the velocity structure function for the snapshot 'snap' on a uniform
+    covering grid, from every pair of CGM cells at every lag vector at once (the FFT autocorrelations
+    in utils/structure_function.py), rather than shifting the grid by each separation. The VSF saved and
+    plotted is the root-mean-square velocity difference, sqrt(<|dv|^2>), in each bin of separation.'''
 
     Rvir = rvir_masses['radius'][rvir_masses['snapshot']==snap][0]
 
@@ -521,7 +537,7 @@ def vsf_cubeshift(snap):
         level = 9
         refine_res = int(3.*Rvir/(lvl1_res/(2.**level)))
         dx = lvl1_res/(2.**level)
-        box = ds.covering_grid(level=level, left_edge=ds.halo_center_kpc-ds.arr([1.5*Rvir,1.5*Rvir,1.5*Rvir],'kpc'), dims=[refine_res, refine_res, refine_res])
+        box = cached_covering_grid(ds, level, ds.halo_center_kpc-ds.arr([1.5*Rvir,1.5*Rvir,1.5*Rvir],'kpc'), [refine_res, refine_res, refine_res], cache_dir=args.grid_cache)
         vx = box['vx_corrected'].in_units('km/s').v
         vy = box['vy_corrected'].in_units('km/s').v
         vz = box['vz_corrected'].in_units('km/s').v
@@ -532,34 +548,50 @@ def vsf_cubeshift(snap):
         vz[(density > cgm_density_max) & (temperature < cgm_temperature_min)] = np.nan
         print('Fields loaded')
 
-        seps = np.linspace(1, 101, 51)
-        vsf = []
+        # Bins of separation centered on every other cell out to 101 cells
+        seps = np.linspace(1, 101, 51)*dx
+        sep_bins = np.linspace(0, 102, 52)*dx
+        masks = {'all':np.isfinite(vx)}
+        if (args.region_filter!='none'):
+            if (args.region_filter=='temperature'):
+                filter = temperature
+                low = 10**4.8
+                high = 10**6.3
+            if (args.region_filter=='metallicity'):
+                filter = box['metallicity'].in_units('Zsun').v
+                low = 0.01
+                high = 1.
+            if (args.region_filter=='velocity'):
+                filter = box['radial_velocity_corrected'].in_units('km/s').v
+                low = -75.
+                high = 75.
+            masks['low'] = (filter < low)
+            masks['mid'] = (filter > low) & (filter < high)
+            masks['high'] = (filter > high)
+        vsfs = grid_structure_function([vx, vy, vz], dx, sep_bins, masks=masks)
+        vsf = np.sqrt(vsfs['all'][0])
         f = open(save_dir + snap + '_VSF' + save_suffix + '.dat', 'w')
-        f.write('# Separation [kpc]   VSF [km/s]\n')
+        f.write('# Separation [kpc]   VSF [km/s]')
+        if (args.region_filter!='none'):
+            label = args.region_filter[0].upper() if (args.region_filter!='velocity') else 'v'
+            f.write('   low-%s VSF [km/s]   mid-%s VSF [km/s]   high-%s VSF [km/s]\n' % (label, label, label))
+        else: f.write('\n')
         for s in range(len(seps)):
-            print('Calculating separation %d/%d' % (s, len(seps)))
-            sep = seps[s]
-            shift_axes = [[sep, 0, 0], [-sep, 0, 0], [0, sep, 0], [0, -sep, 0], [0, 0, sep], [0, 0, -sep]]
-            dv_arrays = []
-            for sh in range(len(shift_axes)):
-                vx_shift = shift(vx, shift_axes[sh], order=1, cval=np.nan)
-                vy_shift = shift(vy, shift_axes[sh], order=1, cval=np.nan)
-                vz_shift = shift(vz, shift_axes[sh], order=1, cval=np.nan)
-                dv = np.sqrt((vx-vx_shift)**2. + (vy-vy_shift)**2. + (vz-vz_shift)**2.)
-                dv_arrays.append(dv)
-            dv_arrays = np.array(dv_arrays)
-            vsf.append(np.nanmean(dv_arrays))
-            f.write('%.5f             %.5f\n' % (sep*dx, vsf[-1]))
-            f.flush()
+            f.write('%.5f             %.5f' % (seps[s], vsf[s]))
+            if (args.region_filter!='none'):
+                f.write('          %.5f          %.5f          %.5f\n' % (np.sqrt(vsfs['low'][0][s]), \
+                  np.sqrt(vsfs['mid'][0][s]), np.sqrt(vsfs['high'][0][s])))
+            else: f.write('\n')
         f.close()
-        seps = seps*dx
 
     else:
         seps, vsf = np.loadtxt(save_dir + snap + '_VSF' + args.load_vsf + '.dat', usecols=[0,1], unpack=True)
 
+    # The VSF here is <|dv|^2>^(1/2), which goes as separation^(1/3) for Kolmogorov turbulence
+    # (<|dv|^2> goes as separation^(2/3)), the same slope vsf_randompoints uses
     Kolmogorov_slope = []
     for i in range(len(seps)):
-        Kolmogorov_slope.append(vsf[0]*(seps[i]/seps[0])**(2./3.))
+        Kolmogorov_slope.append(vsf[0]*(seps[i]/seps[0])**(1./3.))
 
     fig = plt.figure(figsize=(8,6),dpi=500)
     ax = fig.add_subplot(1,1,1)
@@ -568,7 +600,7 @@ def vsf_cubeshift(snap):
     ax.plot(seps, Kolmogorov_slope, 'k--', lw=2)
 
     ax.set_xlabel('Separation [kpc]', fontsize=14)
-    ax.set_ylabel('$\\langle | \\delta v | \\rangle$ [km/s]', fontsize=14)
+    ax.set_ylabel('$\\langle | \\delta v |^2 \\rangle^{1/2}$ [km/s]', fontsize=14)
     ax.set_xscale('log')
     ax.set_yscale('log')
     ax.axis([0.5,120,1,300])
@@ -583,8 +615,10 @@ def vsf_cubeshift(snap):
         shutil.rmtree(snap_dir)
 
 def vsf_randompoints(snap):
-    '''Calculates and plots the velocity structure function for the snapshot 'snap' by drawing a large
-    random number of pixel pairs and calculating velocity difference between them.'''
+    '''Calculates and plots the velocity structure function for the snapshot 'snap' from the velocity
+    differences between pairs of cells, found with a KD-tree in each octave of separation (see
+    utils/structure_function.py). Pairs at small separations are all used, and pairs at large
+    separations are between a random subset of cells, with at most --vsf_max_pairs pairs per octave.'''
 
     Rvir = rvir_masses['radius'][rvir_masses['snapshot']==snap][0]
 
@@ -640,57 +674,33 @@ def vsf_randompoints(snap):
 
         # Loop through bins of radius
         radius_bins = np.linspace(0., 200., 3)
-        npairs_bins_list = []
+        sep_bins = np.arange(0.,2.*Rvir+1,1)
         vsf_list = []
         if (args.region_filter!='none'):
-            vsf_low_list = []
-            vsf_mid_list = []
-            vsf_high_list = []
-            npairs_bins_low = []
-            npairs_bins_mid = []
-            npairs_bins_high = []
+            vsf_low = []
+            vsf_mid = []
+            vsf_high = []
         for r in range(len(radius_bins)-1):
             r_inner = radius_bins[r]
             r_outer = radius_bins[r+1]
+            in_bin = (radius >= r_inner) & (radius < r_outer)
 
-            x_bin = x[(radius >= r_inner) & (radius < r_outer)]
-            y_bin = y[(radius >= r_inner) & (radius < r_outer)]
-            z_bin = z[(radius >= r_inner) & (radius < r_outer)]
-            vx_bin = vx[(radius >= r_inner) & (radius < r_outer)]
-            vy_bin = vy[(radius >= r_inner) & (radius < r_outer)]
-            vz_bin = vz[(radius >= r_inner) & (radius < r_outer)]
-
-            # Select random pairs of pixels
-            npairs = int(len(x_bin)/2)
-            ind_A = random.sample(range(len(x_bin)), npairs)
-            ind_B = random.sample(range(len(x_bin)), npairs)
-
-            # Calculate separations and velocity differences
-            sep = np.sqrt((x_bin[ind_A] - x_bin[ind_B])**2. + (y_bin[ind_A] - y_bin[ind_B])**2. + (z_bin[ind_A] - z_bin[ind_B])**2.)
-            vdiff = np.sqrt((vx_bin[ind_A] - vx_bin[ind_B])**2. + (vy_bin[ind_A] - vy_bin[ind_B])**2. + (vz_bin[ind_A] - vz_bin[ind_B])**2.)
-
+            # Find average vdiff in bins of pixel separation for all pairs of cells in this radius bin, or
+            # a random subset of them at large separations, for all gas and each region at once
+            masks = {'all':in_bin}
+            if (args.region_filter!='none'):
+                masks['low'] = in_bin & (filter < low)
+                masks['mid'] = in_bin & (filter > low) & (filter < high)
+                masks['high'] = in_bin & (filter > high)
+            vsfs = cell_structure_function(np.transpose([x, y, z]), np.transpose([vx, vy, vz]), sep_bins, \
+              masks=masks, max_pairs=args.vsf_max_pairs)
+            vsf_list.append(vsfs['all'][0])
             if (args.region_filter!='none'):
-                seps_fil = []
-                vdiffs_fil = []
-                for i in range(3):
-                    if (i==0): bool = (filter < low)
-                    if (i==1): bool = (filter > low) & (filter < high)
-                    if (i==2): bool = (filter > high)
-                    x_fil = x_bin[bool]
-                    y_fil = y_bin[bool]
-                    z_fil = z_bin[bool]
-                    vx_fil = vx_bin[bool]
-                    vy_fil = vy_bin[bool]
-                    vz_fil = vz_bin[bool]
-                    npairs_fil = int(len(x_fil)/2)
-                    ind_A_fil = random.sample(range(len(x_fil)), npairs_fil)
-                    ind_B_fil = random.sample(range(len(x_fil)), npairs_fil)
-                    sep_fil = np.sqrt((x_fil[ind_A_fil] - x_fil[ind_B_fil])**2. + (y_fil[ind_A_fil] - y_fil[ind_B_fil])**2. + (z_fil[ind_A_fil] - z_fil[ind_B_fil])**2.)
-                    vdiff_fil = np.sqrt((vx_fil[ind_A_fil] - vx_fil[ind_B_fil])**2. + (vy_fil[ind_A_fil] - vy_fil[ind_B_fil])**2. + (vz_fil[ind_A_fil] - vz_fil[ind_B_fil])**2.)
-                    seps_fil.append(sep_fil)
-                    vdiffs_fil.append(vdiff_fil)
-
-            # Find average vdiff in bins of pixel separation and save to file
+                vsf_low.append(vsfs['low'][0])
+                vsf_mid.append(vsfs['mid'][0])
+                vsf_high.append(vsfs['high'][0])
+
+            # Save to file
             f = open(save_dir + snap + '_VSF_rbin' + str(r) + save_suffix + '.dat', 'w')
             f.write('# Inner radius [kpc] Outer radius [kpc] Separation [kpc]   VSF [km/s]')
             if (args.region_filter=='temperature'):
@@ -700,27 +710,9 @@ def vsf_randompoints(snap):
             elif (args.region_filter=='velocity'):
                 f.write('   low-v VSF [km/s]   mid-v VSF[km/s]   high-v VSF [km/s]\n')
             else: f.write('\n')
-            sep_bins = np.arange(0.,2.*Rvir+1,1)
-            vsf_list.append(np.zeros(len(sep_bins)-1))
-            if (args.region_filter!='none'):
-                vsf_low = np.zeros(len(sep_bins)-1)
-                vsf_mid = np.zeros(len(sep_bins)-1)
-                vsf_high = np.zeros(len(sep_bins)-1)
-                npairs_bins_low = np.zeros(len(sep_bins))
-                npairs_bins_mid = np.zeros(len(sep_bins))
-                npairs_bins_high = np.zeros(len(sep_bins))
-            npairs_bins_list.append(np.zeros(len(sep_bins)))
             for i in range(len(sep_bins)-1):
-                npairs_bins_list[r][i] += len(sep[(sep > sep_bins[i]) & (sep < sep_bins[i+1])])
-                vsf_list[r][i] += np.mean(vdiff[(sep > sep_bins[i]) & (sep < sep_bins[i+1])])
                 f.write('  %.2f              %.2f              %.5f              %.5f' % (r_inner, r_outer, sep_bins[i], vsf_list[r][i]))
                 if (args.region_filter!='none'):
-                    npairs_bins_low[r][i] += len(seps_fil[0][(seps_fil[0] > sep_bins[i]) & (seps_fil[0] < sep_bins[i+1])])
-                    vsf_low[r][i] += np.mean(vdiffs_fil[0][(seps_fil[0] > sep_bins[i]) & (seps_fil[0] < sep_bins[i+1])])
-                    npairs_bins_mid[r][i] += len(seps_fil[1][(seps_fil[1] > sep_bins[i]) & (seps_fil[1] < sep_bins[i+1])])
-                    vsf_mid[r][i] += np.mean(vdiffs_fil[1][(seps_fil[1] > sep_bins[i]) & (seps_fil[1] < sep_bins[i+1])])
-                    npairs_bins_high[r][i] += len(seps_fil[2][(seps_fil[2] > sep_bins[i]) & (seps_fil[2] < sep_bins[i+1])])
-                    vsf_high[r][i] += np.mean(vdiffs_fil[2][(seps_fil[2] > sep_bins[i]) & (seps_fil[2] < sep_bins[i+1])])
                     f.write('     %.5f           %.5f          %.5f\n' % (vsf_low[r][i], vsf_mid[r][i], vsf_high[r][i]))
                 else:
                     f.write('\n')
@@ -825,7 +817,7 @@ def vdisp_vs_radius(snap):
         dx = lvl1_res/(2.**level)
         smooth_scale = int(25./dx)/6.
         refine_res = int(3.*Rvir/dx)
-        box = ds.covering_grid(level=level, left_edge=ds.halo_center_kpc-ds.arr([1.5*Rvir,1.5*Rvir,1.5*Rvir],'kpc'), dims=[refine_res, refine_res, refine_res])
+        box = cached_covering_grid(ds, level, ds.halo_center_kpc-ds.arr([1.5*Rvir,1.5*Rvir,1.5*Rvir],'kpc'), [refine_res, refine_res, refine_res], cache_dir=args.grid_cache)
         density = box['density'].in_units('g/cm**3').v
         temperature = box['temperature'].v
         radius = box['radius_corrected'].in_units('kpc').v
@@ -199,168 +199,288 @@ def ellipse(center_x, center_y, a, b, rot_angle, x, y):
 
     return A*x**2. + B*x*y + C*y**2. + D*x + E*y + F < 0.
 
-def segment_region(x, y, z, theta, phi, radius, shapes, refine_width_kpc, x_disk=False, y_disk=False, z_disk=False, Rvir=100., units_kpc=False, units_rvir=False):
-    '''This function reads in arrays of x, y, z, theta_pos, phi_pos, and radius values and returns a
-    boolean list of the same size that is True if a cell is contained within a shape in the list of
-    shapes given by 'shapes' and is False otherwise. If disk-relative coordinates are needed for some
-    shapes, they can be passed in with the optional x_disk, y_disk, z_disk.'''
+def rotation_to_axis(axis):
+    '''Returns the rotation matrix that converts coordinates into a basis whose z axis points along
+    'axis'. The other two axes are chosen the same way (from a random vector with seed 99) every time.'''
+
+    axis = np.array(axis)
+    norm_axis = axis / np.sqrt((axis**2.).sum())
+    # Define other unit vectors orthagonal to the angular momentum vector
+    np.random.seed(99)
+    x_axis = np.random.randn(3)            # take a random vector
+    x_axis -= x_axis.dot(norm_axis) * norm_axis       # make it orthogonal to L
+    x_axis /= np.linalg.norm(x_axis)            # normalize it
+    y_axis = np.cross(norm_axis, x_axis)           # cross product with L
+    x_vec = np.array(x_axis)
+    y_vec = np.array(y_axis)
+    z_vec = np.array(norm_axis)
+    # Calculate the rotation matrix for converting from original coordinate system
+    # into this new basis
+    xhat = np.array([1,0,0])
+    yhat = np.array([0,1,0])
+    zhat = np.array([0,0,1])
+    transArr0 = np.array([[xhat.dot(x_vec), xhat.dot(y_vec), xhat.dot(z_vec)],
+                         [yhat.dot(x_vec), yhat.dot(y_vec), yhat.dot(z_vec)],
+                         [zhat.dot(x_vec), zhat.dot(y_vec), zhat.dot(z_vec)]])
+
+    return np.linalg.inv(transArr0)
+
+def ellipse_coefficients(center_x, center_y, a, b, rot_angle):
+    '''Returns the coefficients A, B, C, D, E, F of the ellipse used by ellipse(). Arguments can be
+    arrays, to get the coefficients of many ellipses at once.'''
 
-    bool_inshape = np.zeros(len(x), dtype=bool)
+    A = a**2. * np.sin(rot_angle)**2. + b**2. * np.cos(rot_angle)**2.
+    B = 2. * (b**2. - a**2.) * np.sin(rot_angle) * np.cos(rot_angle)
+    C = a**2. * np.cos(rot_angle)**2. + b**2. * np.sin(rot_angle)**2.
+    D = -2.*A*center_x - B*center_y
+    E = -B*center_x - 2.*C*center_y
+    F = A*center_x**2. + B*center_x*center_y + C*center_y**2. - a**2.*b**2.
+
+    return A, B, C, D, E, F
+
+# Shapes already compiled by this process, keyed by everything that goes into compiling them
+_compiled_shapes = {}
+
+def compile_shapes(shapes, refine_width_kpc, Rvir=100., units_kpc=False, units_rvir=False):
+    '''Parses the list of shapes 'shapes' (in the format taken by segment_region) once, working out
+    their sizes, rotation matrices, ellipse coefficients, and the range of radius each can contain,
+    and returns a function in_shapes(x, y, z, theta, phi, radius, x_disk=False, y_disk=False,
+    z_disk=False) that works the same as segment_region with these shapes. in_shapes only evaluates
+    the exact geometry of each shape for cells within its range of radius. Compiled shapes are
+    remembered, so compiling the same shapes again (e.g. for every chunk of a snapshot) is free.'''
 
+    key = repr((shapes, refine_width_kpc, Rvir, units_kpc, units_rvir))
+    ellipse_files = [shape[4] for shape in shapes if (shape[0]=='ellipse')]
+    key += repr([os.path.getmtime(filename) for filename in ellipse_files])
+    if (key in _compiled_shapes):
+        return _compiled_shapes[key]
+
+    if (units_kpc):
+        scale = 1.
+    elif (units_rvir):
+        scale = Rvir
+    else:
+        scale = refine_width_kpc
+
+    compiled = []
     for i in range(len(shapes)):
+        shape = {'type': shapes[i][0]}
         if (shapes[i][0]=='sphere'):
-            if (units_kpc):
-                inner_radius = shapes[i][1]
-                outer_radius = shapes[i][2]
-            elif (units_rvir):
-                inner_radius = shapes[i][1]*Rvir
-                outer_radius = shapes[i][2]*Rvir
-            else:
-                inner_radius = shapes[i][1]*refine_width_kpc
-                outer_radius = shapes[i][2]*refine_width_kpc
-            bool_insphere = (radius > inner_radius) & (radius < outer_radius)
-            bool_inshape = bool_inshape | bool_insphere
+            shape['inner_radius'] = shapes[i][1]*scale
+            shape['outer_radius'] = shapes[i][2]*scale
+            shape['r_range'] = [shape['inner_radius'], shape['outer_radius']]
         elif (shapes[i][0]=='frustum'):
-            if (units_kpc):
-                inner_radius = shapes[i][1]
-                outer_radius = shapes[i][2]
-            elif (units_rvir):
-                inner_radius = shapes[i][1]*Rvir
-                outer_radius = shapes[i][2]*Rvir
-            else:
-                inner_radius = shapes[i][1]*refine_width_kpc
-                outer_radius = shapes[i][2]*refine_width_kpc
+            shape['inner_radius'] = shapes[i][1]*scale
+            shape['outer_radius'] = shapes[i][2]*scale
             op_angle = shapes[i][6]
-            axis = shapes[i][4]
-            flip = shapes[i][5]
-            if (flip):
-                min_theta = np.pi-op_angle*np.pi/180.
-                max_theta = np.pi
+            shape['axis'] = shapes[i][4]
+            if (shapes[i][5]):
+                shape['min_theta'] = np.pi-op_angle*np.pi/180.
+                shape['max_theta'] = np.pi
             else:
-                min_theta = 0.
-                max_theta = op_angle*np.pi/180.
-            if (axis=='x'):
-                theta_frus = np.arccos(np.sin(theta)*np.cos(phi))
-                phi_frus = np.arctan2(np.cos(theta), np.sin(theta)*np.sin(phi))
-            if (axis=='y'):
-                theta_frus = np.arccos(np.sin(theta)*np.sin(phi))
-                phi_frus = np.arctan2(np.sin(theta)*np.cos(phi), np.cos(theta))
-            if (axis=='disk minor axis'):
-                theta_frus = np.arccos(z_disk/radius)
-                phi_frus = np.arctan2(y_disk, x_disk)
-            if (type(axis)==tuple) or (type(axis)==list):
-                axis = np.array(axis)
-                norm_axis = axis / np.sqrt((axis**2.).sum())
-                # Define other unit vectors orthagonal to the angular momentum vector
-                np.random.seed(99)
-                x_axis = np.random.randn(3)            # take a random vector
-                x_axis -= x_axis.dot(norm_axis) * norm_axis       # make it orthogonal to L
-                x_axis /= np.linalg.norm(x_axis)            # normalize it
-                y_axis = np.cross(norm_axis, x_axis)           # cross product with L
-                x_vec = np.array(x_axis)
-                y_vec = np.array(y_axis)
-                z_vec = np.array(norm_axis)
-                # Calculate the rotation matrix for converting from original coordinate system
-                # into this new basis
-                xhat = np.array([1,0,0])
-                yhat = np.array([0,1,0])
-                zhat = np.array([0,0,1])
-                transArr0 = np.array([[xhat.dot(x_vec), xhat.dot(y_vec), xhat.dot(z_vec)],
-                                     [yhat.dot(x_vec), yhat.dot(y_vec), yhat.dot(z_vec)],
-                                     [zhat.dot(x_vec), zhat.dot(y_vec), zhat.dot(z_vec)]])
-                rotationArr = np.linalg.inv(transArr0)
-                x_rot = rotationArr[0][0]*np.sin(theta)*np.cos(phi) + rotationArr[0][1]*np.sin(theta)*np.sin(phi) + rotationArr[0][2]*np.cos(theta)
-                y_rot = rotationArr[1][0]*np.sin(theta)*np.cos(phi) + rotationArr[1][1]*np.sin(theta)*np.sin(phi) + rotationArr[1][2]*np.cos(theta)
-                z_rot = rotationArr[2][0]*np.sin(theta)*np.cos(phi) + rotationArr[2][1]*np.sin(theta)*np.sin(phi) + rotationArr[2][2]*np.cos(theta)
-                theta_frus = np.arccos(z_rot)
-                phi_frus = np.arctan2(y_rot, x_rot)
-            bool_infrus = (theta_frus >= min_theta) & (theta_frus <= max_theta) & (radius >= inner_radius) & (radius <= outer_radius)
-            bool_inshape = bool_inshape | bool_infrus
+                shape['min_theta'] = 0.
+                shape['max_theta'] = op_angle*np.pi/180.
+            if (type(shape['axis'])==tuple) or (type(shape['axis'])==list):
+                shape['rotation'] = rotation_to_axis(shape['axis'])
+            shape['r_range'] = [shape['inner_radius'], shape['outer_radius']]
         elif (shapes[i][0]=='cylinder'):
-            if (units_kpc):
-                bottom_edge = shapes[i][1]
-                top_edge = shapes[i][2]
-                cyl_radius = shapes[i][6]
-            elif (units_rvir):
-                bottom_edge = shapes[i][1]*Rvir
-                top_edge = shapes[i][2]*Rvir
-                cyl_radius = shapes[i][6]*Rvir
-            else:
-                bottom_edge = shapes[i][1]*refine_width_kpc
-                top_edge = shapes[i][2]*refine_width_kpc
-                cyl_radius = shapes[i][6]*refine_width_kpc
-            axis = shapes[i][4]
-            flip = shapes[i][5]
-            if (flip): mult = -1.
-            else: mult = 1.
-            if (axis=='z'):
-                norm_coord = mult*z
-                rad_coord = np.sqrt(x**2. + y**2.)
-            if (axis=='x'):
-                norm_coord = mult*x
-                rad_coord = np.sqrt(y**2. + z**2.)
-            if (axis=='y'):
-                norm_coord = mult*y
-                rad_coord = np.sqrt(x**2. + z**2.)
-            if (axis=='disk minor axis'):
-                norm_coord = mult*z_disk
-                rad_coord = np.sqrt(x_disk**2. + y_disk**2.)
-            if (type(axis)==tuple) or (type(axis)==list):
-                axis = np.array(axis)
-                norm_axis = axis / np.sqrt((axis**2.).sum())
-                # Define other unit vectors orthagonal to the angular momentum vector
-                np.random.seed(99)
-                x_axis = np.random.randn(3)            # take a random vector
-                x_axis -= x_axis.dot(norm_axis) * norm_axis       # make it orthogonal to L
-                x_axis /= np.linalg.norm(x_axis)            # normalize it
-                y_axis = np.cross(norm_axis, x_axis)           # cross product with L
-                x_vec = np.array(x_axis)
-                y_vec = np.array(y_axis)
-                z_vec = np.array(norm_axis)
-                # Calculate the rotation matrix for converting from original coordinate system
-                # into this new basis
-                xhat = np.array([1,0,0])
-                yhat = np.array([0,1,0])
-                zhat = np.array([0,0,1])
-                transArr0 = np.array([[xhat.dot(x_vec), xhat.dot(y_vec), xhat.dot(z_vec)],
-                                     [yhat.dot(x_vec), yhat.dot(y_vec), yhat.dot(z_vec)],
-                                     [zhat.dot(x_vec), zhat.dot(y_vec), zhat.dot(z_vec)]])
-                rotationArr = np.linalg.inv(transArr0)
-                x_rot = rotationArr[0][0]*x + rotationArr[0][1]*y + rotationArr[0][2]*z
-                y_rot = rotationArr[1][0]*x + rotationArr[1][1]*y + rotationArr[1][2]*z
-                z_rot = rotationArr[2][0]*x + rotationArr[2][1]*y + rotationArr[2][2]*z
-                norm_coord = mult*z_rot
-                rad_coord = np.sqrt(x_rot**2. + y_rot**2.)
-            bool_incyl = (norm_coord >= bottom_edge) & (norm_coord <= top_edge) & (rad_coord <= cyl_radius)
-            bool_inshape = bool_inshape | bool_incyl
+            shape['bottom_edge'] = shapes[i][1]*scale
+            shape['top_edge'] = shapes[i][2]*scale
+            shape['cyl_radius'] = shapes[i][6]*scale
+            shape['axis'] = shapes[i][4]
+            if (shapes[i][5]): shape['mult'] = -1.
+            else: shape['mult'] = 1.
+            if (type(shape['axis'])==tuple) or (type(shape['axis'])==list):
+                shape['rotation'] = rotation_to_axis(shape['axis'])
+            # Nothing farther than the corner of the cylinder can be in it (with a little room for rounding)
+            max_height = max(abs(shape['bottom_edge']), abs(shape['top_edge']))
+            shape['r_range'] = [0., np.sqrt(max_height**2. + shape['cyl_radius']**2.)*(1.+1e-6)]
         elif (shapes[i][0]=='ellipse'):
-            filename = shapes[i][4]
-            if (units_kpc):
-                inner_radius = shapes[i][1]
-                outer_radius = shapes[i][2]
-            elif (units_rvir):
-                inner_radius = shapes[i][1]*Rvir
-                outer_radius = shapes[i][2]*Rvir
+            inner_radius = shapes[i][1]*scale
+            outer_radius = shapes[i][2]*scale
+            r_inner, r_outer = np.loadtxt(shapes[i][4], unpack=True, usecols=[0,1], ndmin=2)
+            ellipse_params = np.loadtxt(shapes[i][4], usecols=[2,3,4,5,6], ndmin=2)
+            # Rows of all zeros have no ellipse
+            has_ellipse = np.any(ellipse_params!=0., axis=1)
+            shape['r_inner'] = r_inner[has_ellipse]
+            shape['r_outer'] = r_outer[has_ellipse]
+            shape['coefficients'] = np.array(ellipse_coefficients(*ellipse_params[has_ellipse].T))
+            shape['inner_radius'] = inner_radius
+            shape['outer_radius'] = outer_radius
+            # If the radial bins of the ellipses don't overlap, each cell only needs to be checked
+            # against the one ellipse for its radius
+            order = np.argsort(shape['r_inner'])
+            shape['r_inner'] = shape['r_inner'][order]
+            shape['r_outer'] = shape['r_outer'][order]
+            shape['coefficients'] = shape['coefficients'][:,order]
+            shape['disjoint'] = np.all(shape['r_outer'][:-1] <= shape['r_inner'][1:])
+            if (len(shape['r_inner'])>0):
+                shape['r_range'] = [max(inner_radius, np.min(shape['r_inner'])), min(outer_radius, np.max(shape['r_outer']))]
             else:
-                inner_radius = shapes[i][1]*refine_width_kpc
-                outer_radius = shapes[i][2]*refine_width_kpc
-            r_inner, r_outer = np.loadtxt(filename, unpack=True, usecols=[0,1])
-            ellipse_params = np.loadtxt(filename, usecols=[2,3,4,5,6])
-            betw_radii = (radius > inner_radius) & (radius < outer_radius)
-            for r in range(len(r_inner)):
-                if False in (ellipse_params[r]==[0,0,0,0,0]):
-                    in_ellipse = ellipse(ellipse_params[r][0], ellipse_params[r][1], ellipse_params[r][2], \
-                      ellipse_params[r][3], ellipse_params[r][4], theta, phi)
-                    radbins = (radius > r_inner[r]) & (radius < r_outer[r])
-                    in_ellipse = in_ellipse & radbins & betw_radii
-                    bool_inshape = bool_inshape | in_ellipse
-
-    if (shapes[0][0]=='cylinder') and (shapes[0][7]=='radius'):
-        return bool_inshape, rad_coord
-    elif (shapes[0][0]=='cylinder') and (shapes[0][7]=='height'):
-        return bool_inshape, norm_coord
+                shape['r_range'] = [np.inf, -np.inf]
+        compiled.append(shape)
+
+    # Index of the last cylinder, whose coordinates are returned if the first shape is a cylinder
+    cylinders = [i for i in range(len(shapes)) if (shapes[i][0]=='cylinder')]
+    if (shapes[0][0]=='cylinder') and (shapes[0][7] in ['radius', 'height']):
+        return_coord = shapes[0][7]
     else:
-        return bool_inshape
+        return_coord = None
+
+    def cylinder_coords(shape, x, y, z, x_disk, y_disk, z_disk):
+        axis = shape['axis']
+        if (axis=='z'):
+            norm_coord = shape['mult']*z
+            rad_coord = np.sqrt(x**2. + y**2.)
+        elif (axis=='x'):
+            norm_coord = shape['mult']*x
+            rad_coord = np.sqrt(y**2. + z**2.)
+        elif (axis=='y'):
+            norm_coord = shape['mult']*y
+            rad_coord = np.sqrt(x**2. + z**2.)
+        elif (axis=='disk minor axis'):
+            norm_coord = shape['mult']*z_disk
+            rad_coord = np.sqrt(x_disk**2. + y_disk**2.)
+        else:
+            rot = shape['rotation']
+            x_rot = rot[0][0]*x + rot[0][1]*y + rot[0][2]*z
+            y_rot = rot[1][0]*x + rot[1][1]*y + rot[1][2]*z
+            z_rot = rot[2][0]*x + rot[2][1]*y + rot[2][2]*z
+            norm_coord = shape['mult']*z_rot
+            rad_coord = np.sqrt(x_rot**2. + y_rot**2.)
+        return norm_coord, rad_coord
+
+    def in_shapes(x, y, z, theta, phi, radius, x_disk=False, y_disk=False, z_disk=False):
+        bool_inshape = np.zeros(len(x), dtype=bool)
+        for i in range(len(compiled)):
+            shape = compiled[i]
+            if (shape['type']=='cylinder') and (return_coord is not None) and (i==cylinders[-1]):
+                # The full coordinates of this cylinder are returned, so they're needed for every cell anyway
+                norm_coord, rad_coord = cylinder_coords(shape, x, y, z, x_disk, y_disk, z_disk)
+                bool_inshape = bool_inshape | ((norm_coord >= shape['bottom_edge']) & \
+                  (norm_coord <= shape['top_edge']) & (rad_coord <= shape['cyl_radius']))
+                continue
+            # Only check cells that are within the shape's range of radius and not already in a shape
+            cand = np.flatnonzero((radius >= shape['r_range'][0]) & (radius <= shape['r_range'][1]) & ~bool_inshape)
+            if (len(cand)==0): continue
+            r = radius[cand]
+            if (shape['type']=='sphere'):
+                inside = (r > shape['inner_radius']) & (r < shape['outer_radius'])
+            elif (shape['type']=='frustum'):
+                axis = shape['axis']
+                th = theta[cand]
+                ph = phi[cand]
+                if (axis=='x'):
+                    theta_frus = np.arccos(np.sin(th)*np.cos(ph))
+                elif (axis=='y'):
+                    theta_frus = np.arccos(np.sin(th)*np.sin(ph))
+                elif (axis=='disk minor axis'):
+                    theta_frus = np.arccos(z_disk[cand]/r)
+                else:
+                    z_rot = shape['rotation'][2][0]*np.sin(th)*np.cos(ph) + shape['rotation'][2][1]*np.sin(th)*np.sin(ph) + \
+                            shape['rotation'][2][2]*np.cos(th)
+                    theta_frus = np.arccos(z_rot)
+                inside = (theta_frus >= shape['min_theta']) & (theta_frus <= shape['max_theta']) & \
+                         (r >= shape['inner_radius']) & (r <= shape['outer_radius'])
+            elif (shape['type']=='cylinder'):
+                if (shape['axis']=='disk minor axis'):
+                    norm_cand, rad_cand = cylinder_coords(shape, None, None, None, x_disk[cand], y_disk[cand], z_disk[cand])
+                else:
+                    norm_cand, rad_cand = cylinder_coords(shape, x[cand], y[cand], z[cand], None, None, None)
+                inside = (norm_cand >= shape['bottom_edge']) & (norm_cand <= shape['top_edge']) & (rad_cand <= shape['cyl_radius'])
+            elif (shape['type']=='ellipse'):
+                th = theta[cand]
+                ph = phi[cand]
+                betw_radii = (r > shape['inner_radius']) & (r < shape['outer_radius'])
+                if (shape['disjoint']):
+                    row = np.searchsorted(shape['r_inner'], r, side='left') - 1
+                    row[row < 0] = 0
+                    A, B, C, D, E, F = shape['coefficients'][:,row]
+                    inside = (A*th**2. + B*th*ph + C*ph**2. + D*th + E*ph + F < 0.) & \
+                             (r > shape['r_inner'][row]) & (r < shape['r_outer'][row]) & betw_radii
+                else:
+                    inside = np.zeros(len(cand), dtype=bool)
+                    for row in range(len(shape['r_inner'])):
+                        A, B, C, D, E, F = shape['coefficients'][:,row]
+                        inside = inside | ((A*th**2. + B*th*ph + C*ph**2. + D*th + E*ph + F < 0.) & \
+                          (r > shape['r_inner'][row]) & (r < shape['r_outer'][row]) & betw_radii)
+            bool_inshape[cand[inside]] = True
+
+        if (return_coord=='radius'):
+            return bool_inshape, rad_coord
+        elif (return_coord=='height'):
+            return bool_inshape, norm_coord
+        else:
+            return bool_inshape
+
+    _compiled_shapes[key] = in_shapes
+    return in_shapes
+
+def segment_region(x, y, z, theta, phi, radius, shapes, refine_width_kpc, x_disk=False, y_disk=False, z_disk=False, Rvir=100., units_kpc=False, units_rvir=False):
+    '''This function reads in arrays of x, y, z, theta_pos, phi_pos, and radius values and returns a
+    boolean list of the same size that is True if a cell is contained within a shape in the list of
+    shapes given by 'shapes' and is False otherwise. If disk-relative coordinates are needed for some
+    shapes, they can be passed in with the optional x_disk, y_disk, z_disk. The shapes are compiled
+    with compile_shapes the first time they are used and reused after that.'''
+
+    in_shapes = compile_shapes(shapes, refine_width_kpc, Rvir=Rvir, units_kpc=units_kpc, units_rvir=units_rvir)
+
+    return in_shapes(x, y, z, theta, phi, radius, x_disk=x_disk, y_disk=y_disk, z_disk=z_disk)
+
+def bin_index(values, edges):
+    '''This function returns an integer array of the same size as 'values' giving the index of the
+    bin defined by the sorted array 'edges' that each value falls strictly inside of, i.e.
+    edges[i] < value < edges[i+1]. Values that lie exactly on an edge, outside of the edges, or are
+    NaN are given an index of -1. This is equivalent to the masks (value > inner) & (value < outer)
+    for every pair of neighboring edges, but only requires one pass through the data.'''
+
+    edges = np.asarray(edges)
+    values = np.asarray(values)
+    index = np.searchsorted(edges, values, side='left') - 1
+    good = (index >= 0) & (index < len(edges)-1)
+    good[good] = values[good] < edges[index[good]+1]
+    index[~good] = -1
+
+    return index
+
+def crossing_index(start, end, edges):
+    '''This function finds every edge in the sorted array 'edges' (not including the last one) that
+    each cell crosses when it moves from 'start' to 'end', i.e. every edges[i] with
+    start < edges[i] < end. It returns two integer arrays of the same length, the first giving the
+    index of the cell and the second giving the index of the edge, with one entry for each
+    crossing. Since cells typically only cross one or two edges in one timestep, these arrays are
+    not much larger than the number of cells that cross any edge at all.'''
+
+    edges = np.asarray(edges)[:-1]
+    start = np.asarray(start)
+    end = np.asarray(end)
+    first = np.searchsorted(edges, start, side='right')
+    last = np.searchsorted(edges, end, side='left')
+    num_cross = last - first
+    num_cross[~(start < end) | (num_cross < 0)] = 0
+    cells = np.repeat(np.arange(len(start)), num_cross)
+    offsets = np.arange(len(cells)) - np.repeat(np.cumsum(num_cross) - num_cross, num_cross)
+    crossed = np.repeat(first, num_cross) + offsets
+
+    return cells, crossed
+
+def binned_sums(index, weights, num_bins, temp_index=None, num_temps=1):
+    '''This function sums 'weights' into 'num_bins' bins, where 'index' gives the bin of each weight
+    and entries with an index of -1 are ignored. If 'temp_index' is given, the weights are also split
+    into the num_temps-1 temperature bins given by 'temp_index' (again ignoring entries of -1).
+    Returns an array of shape (num_temps, num_bins) where the first row is the sum over all
+    temperatures and the following rows are the sums within each temperature bin.'''
+
+    sums = np.zeros((num_temps, num_bins))
+    good = (index >= 0)
+    sums[0] = np.bincount(index[good], weights=weights[good], minlength=num_bins)[:num_bins]
+    if (num_temps > 1):
+        good = good & (temp_index >= 0)
+        flat_index = temp_index[good]*num_bins + index[good]
+        sums[1:] = np.bincount(flat_index, weights=weights[good], \
+          minlength=(num_temps-1)*num_bins)[:(num_temps-1)*num_bins].reshape(num_temps-1, num_bins)
+
+    return sums
 
 def filter_ds(box, x_data, y_data, weight_data):
     '''This function filters the yt data object passed in as 'box' into inflow and outflow regions, based on temperature
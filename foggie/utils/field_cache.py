@@ -0,0 +1,128 @@
+"""
+Filename: field_cache.py
+This file contains functions for saving the halo-centric derived fields that foggie_load defines
+(radius_corrected, radial_velocity_corrected, theta_pos, phi_pos, the disk-relative fields, and
+vff/tff) to disk for the region that foggie_load returns, so that later scripts that load the same
+snapshot with the same halo center can read them back instead of re-deriving them through yt.
+It is used by:
+-utils/foggie_load.py (turn it on by passing field_cache='/path/to/cache/directory/' to foggie_load)
+
+Each cached field is stored as its own .npy file, which is memory-mapped when read back so only the
+parts of a field that are actually used are read from disk. The cache for a snapshot lives in a
+directory named with a hash of everything the fields depend on (the halo center and velocity, and
+the foggie_load arguments that decide the disk direction and the enclosed mass profile), so a cache
+made with a different center or disk is never used; it is deleted and remade instead.
+"""
+
+from __future__ import print_function
+
+import numpy as np
+import os
+import glob
+import json
+import shutil
+import hashlib
+
+# Fields that are cached for every snapshot
+halo_fields = ['radius_corrected', 'radial_velocity_corrected', 'theta_pos', 'phi_pos', \
+               'theta_velocity_corrected', 'phi_velocity_corrected', 'tangential_velocity_corrected']
+# Fields that are cached if foggie_load was called with disk_relative=True
+disk_fields = ['x_disk', 'y_disk', 'z_disk', 'vx_disk', 'vy_disk', 'vz_disk', 'phi_pos_disk', \
+               'theta_pos_disk', 'vphi_disk', 'vtheta_disk', 'vtan_disk']
+# Fields that are cached if foggie_load was called with gravity=True
+gravity_fields = ['vff', 'tff']
+
+def field_cache_key(ds, region_name, disk_relative=False, gravity=False, smooth_AM_name=False, \
+                    particle_type_for_angmom='young_stars', masses_dir=''):
+    '''Returns a string that identifies everything the cached fields of 'ds' depend on: the snapshot,
+    the name of the region, the halo center and velocity, and the foggie_load arguments that set the
+    disk direction and enclosed mass profile, if those fields are used. The key only depends on the
+    arguments, not on which foggie_load stages have run, so lazy and eager loads share a cache.'''
+
+    key = {'snapshot': os.path.basename(ds.parameter_filename),
+           'region': str(region_name),
+           'center': np.round(ds.halo_center_kpc.in_units('kpc').v, 8).tolist(),
+           'velocity': np.round(ds.halo_velocity_kms.in_units('km/s').v, 8).tolist(),
+           'disk_relative': bool(disk_relative),
+           'gravity': bool(gravity)}
+    if (disk_relative):
+        key['smooth_AM_name'] = str(smooth_AM_name)
+        key['particle_type_for_angmom'] = str(particle_type_for_angmom)
+    if (gravity):
+        key['masses_dir'] = str(masses_dir)
+    key_str = json.dumps(key, sort_keys=True)
+
+    return key_str, hashlib.sha1(key_str.encode('utf-8')).hexdigest()[:16]
+
+def cache_halo_fields(ds, region, cache_dir, region_name, disk_relative=False, gravity=False, \
+                      smooth_AM_name=False, particle_type_for_angmom='young_stars', masses_dir=''):
+    '''Fills the field data of the data object 'region' with the halo-centric derived fields of 'ds',
+    memory-mapped from the cache in the directory 'cache_dir'. If a field is not in the cache yet, or
+    its cached array is not the size of 'region', it is computed through yt and saved to the cache
+    first. 'region_name' is the name of the region that was passed to foggie_load, and the other
+    arguments are the ones that were passed to foggie_load, which are needed to tell which fields to
+    cache and if the cache is out of date.
+
+    Only 'region' itself uses the cached fields; other data objects made from 'ds' derive them as usual.'''
+
+    if (np.any(np.isnan(ds.halo_center_kpc.v))):
+        print('No halo center was found, not caching halo-centric fields')
+        return
+
+    fields = list(halo_fields)
+    if (disk_relative): fields += disk_fields
+    if (gravity): fields += gravity_fields
+
+    key_str, key_hash = field_cache_key(ds, region_name, disk_relative=disk_relative, gravity=gravity, \
+      smooth_AM_name=smooth_AM_name, particle_type_for_angmom=particle_type_for_angmom, masses_dir=masses_dir)
+    snap = os.path.basename(ds.parameter_filename)
+    snap_cache = os.path.join(cache_dir, snap + '_' + str(region_name) + '_' + key_hash)
+
+    # Remove caches of this snapshot and region that were made with a different center, velocity, or disk
+    for old_cache in glob.glob(os.path.join(cache_dir, snap + '_' + str(region_name) + '_*')):
+        if (old_cache!=snap_cache) and (os.path.isdir(old_cache)):
+            print('Removing out-of-date field cache ' + old_cache)
+            shutil.rmtree(old_cache, ignore_errors=True)
+    if not (os.path.exists(snap_cache)): os.makedirs(snap_cache, exist_ok=True)
+
+    units_file = os.path.join(snap_cache, 'units.json')
+    if (os.path.exists(units_file)):
+        with open(units_file, 'r') as f:
+            units = json.load(f)
+    else:
+        units = {}
+
+    # A field is (re)computed if it isn't cached, or if its cached array doesn't have one value per cell
+    n_cells = len(region['index', 'ones'])
+    new_fields = []
+    for field in fields:
+        field_file = os.path.join(snap_cache, field + '.npy')
+        if (field not in units) or (not os.path.exists(field_file)):
+            new_fields.append(field)
+        elif (np.load(field_file, mmap_mode='r').shape[0]!=n_cells):
+            print('Cached %s does not match the number of cells in the region, recomputing it' % (field))
+            new_fields.append(field)
+    if (len(new_fields)>0):
+        print('Saving %d fields to field cache %s' % (len(new_fields), snap_cache))
+    for field in new_fields:
+        values = region['gas', field]
+        units[field] = str(values.units)
+        # Write to a temporary file then rename, so another process reading the cache never sees
+        # a partly-written field
+        tmp_name = os.path.join(snap_cache, field + '.tmp%d.npy' % (os.getpid()))
+        np.save(tmp_name, np.asarray(values.v))
+        os.replace(tmp_name, os.path.join(snap_cache, field + '.npy'))
+    if (len(new_fields)>0):
+        tmp_name = units_file + '.tmp%d' % (os.getpid())
+        with open(tmp_name, 'w') as f:
+            json.dump(units, f)
+        os.replace(tmp_name, units_file)
+        with open(os.path.join(snap_cache, 'key.json'), 'w') as f:
+            f.write(key_str)
+
+    for field in fields:
+        values = np.load(os.path.join(snap_cache, field + '.npy'), mmap_mode='r')
+        if (units[field]=='dimensionless'):
+            region.field_data['gas', field] = ds.arr(values, '')
+        else:
+            region.field_data['gas', field] = ds.arr(values, units[field])
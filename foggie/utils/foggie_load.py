@@ -2,8 +2,10 @@ import numpy as np
 import yt
 from yt.units import *
 from yt import YTArray
+from yt.utilities.exceptions import YTFieldNotFound
 from astropy.table import Table
 import os
+import time
 from scipy.interpolate import InterpolatedUnivariateSpline as IUS
 
 from foggie.utils.consistency import *
@@ -12,6 +14,8 @@ from foggie.utils.get_proper_box_size import get_proper_box_size
 from foggie.utils.get_run_loc_etc import get_run_loc_etc
 from foggie.utils.yt_fields import *
 from foggie.utils.foggie_utils import filter_particles
+from foggie.utils.field_cache import cache_halo_fields
+from foggie.utils.halo_catalog import lookup_halo_c_v, lookup_masses
 import foggie.utils as futils
 import foggie.utils.get_refine_box as grb
 
@@ -28,6 +32,9 @@ def load_sim(args, **kwargs):
     particle_type_for_angmom -- what particles to use for angular momentum? Default is young_stars, only need this if disk_relative=True
     filter_partiles -- do you want to filter particles? Default is yes
     region -- what region do you want to return?
+    field_cache -- directory to save halo-centric fields of the region to, and read them back from on later loads? Default is not to cache
+    lazy -- do you want to register the corrected, particle, disk-relative, and gravity fields only when they are first used? Default is no
+    timings -- do you want to print how long each stage of loading took? Default is no
     '''
     use_halo_c_v = kwargs.get('use_halo_c_v', True)
     disk_relative = kwargs.get('disk_relative', False)
@@ -35,6 +42,9 @@ def load_sim(args, **kwargs):
     do_filter_particles = kwargs.get('do_filter_particles', True)
     find_halo_center = kwargs.get('find_halo_center', True)
     region = kwargs.get('region', 'refine_box')
+    field_cache = kwargs.get('field_cache', False)
+    lazy = kwargs.get('lazy', False)
+    timings = kwargs.get('timings', False)
 
     foggie_dir, output_dir, run_loc, code_path, trackname, haloname, spectra_dir, infofile = get_run_loc_etc(args)
     snap_name = foggie_dir + run_loc + args.output + '/' + args.output
@@ -44,13 +54,356 @@ def load_sim(args, **kwargs):
 
     ds, region = foggie_load(snap_name, trackname, find_halo_center=find_halo_center, halo_c_v_name=halo_c_v_name, disk_relative=disk_relative, \
                             particle_type_for_angmom=particle_type_for_angmom, do_filter_particles=do_filter_particles, \
-                            region=region)
+                            region=region, field_cache=field_cache, lazy=lazy, timings=timings)
 
     return ds, region
 
+def add_corrected_fields(ds):
+    '''Registers the halo-centric position, velocity, and energy fields (radius_corrected,
+    radial_velocity_corrected, theta_pos, etc.) on the dataset 'ds', which must already have
+    ds.halo_center_kpc and ds.halo_velocity_kms defined.'''
+
+    ds.add_field(('gas','vx_corrected'), function=vx_corrected, units='km/s', take_log=False, \
+                 sampling_type='cell')
+    ds.add_field(('gas', 'vy_corrected'), function=vy_corrected, units='km/s', take_log=False, \
+                 sampling_type='cell')
+    ds.add_field(('gas', 'vz_corrected'), function=vz_corrected, units='km/s', take_log=False, \
+                 sampling_type='cell')
+    ds.add_field(('gas', 'vel_mag_corrected'), function=vel_mag_corrected, units='km/s', take_log=False, \
+                 sampling_type='cell')
+    ds.add_field(('gas', 'radius_corrected'), function=radius_corrected, units='kpc', \
+                 take_log=False, force_override=True, sampling_type='cell')
+    ds.add_field(('gas', 'theta_pos'), function=theta_pos, units=None, take_log=False, \
+                 sampling_type='cell')
+    ds.add_field(('gas', 'phi_pos'), function=phi_pos, units=None, take_log=False, \
+                 sampling_type='cell')
+    ds.add_field(('gas', 'radial_velocity_corrected'), function=radial_velocity_corrected, \
+                 units='km/s', take_log=False, force_override=True, sampling_type='cell', display_name='Radial Velocity')
+    ds.add_field(('gas', 'theta_velocity_corrected'), function=theta_velocity_corrected, \
+                 units='km/s', take_log=False, force_override=True, sampling_type='cell')
+    ds.add_field(('gas', 'phi_velocity_corrected'), function=phi_velocity_corrected, \
+                 units='km/s', take_log=False, force_override=True, sampling_type='cell')
+    ds.add_field(('gas', 'tangential_velocity_corrected'), function=tangential_velocity_corrected, \
+                 units='km/s', take_log=False, force_override=True, sampling_type='cell', display_name='Tangential Velocity')
+    ds.add_field(('gas', 'kinetic_energy_corrected'), function=kinetic_energy_corrected, \
+                 units='erg', take_log=True, force_override=True, sampling_type='cell')
+    ds.add_field(('gas', 'radial_kinetic_energy'), function=radial_kinetic_energy, \
+                 units='erg', take_log=True, force_override=True, sampling_type='cell')
+    ds.add_field(('gas', 'tangential_kinetic_energy'), function=tangential_kinetic_energy, \
+                 units='erg', take_log=True, force_override=True, sampling_type='cell')
+    ds.add_field(('gas', 'cell_mass_msun'), function=cell_mass_msun, units='Msun', take_log=True, \
+                 force_override=True, sampling_type='cell')
+
+def add_particle_fields(ds, refine_box):
+    '''Filters the particles of 'ds' in 'refine_box' into young_stars, young_stars8, old_stars, stars, and dm,
+    and registers the halo-centric and angular momentum fields of those particle types.'''
+
+    filter_particles(refine_box, filter_particle_types = ['young_stars', 'young_stars8', 'old_stars', 'stars', 'dm'])
+
+    ds.add_field(('stars', 'radius_corrected'), function=radius_corrected_stars, units='kpc', \
+                 take_log=False, force_override=True, sampling_type='particle')
+    ds.add_field(('young_stars', 'radius_corrected'), function=radius_corrected_young_stars, units='kpc', \
+                 take_log=False, force_override=True, sampling_type='particle')
+    ds.add_field(('young_stars8', 'radius_corrected'), function=radius_corrected_young_stars8, units='kpc', \
+                 take_log=False, force_override=True, sampling_type='particle')
+    ds.add_field(('old_stars', 'radius_corrected'), function=radius_corrected_old_stars, units='kpc', \
+                 take_log=False, force_override=True, sampling_type='particle')
+    ds.add_field(('dm', 'radius_corrected'), function=radius_corrected_dm, units='kpc', \
+                 take_log=False, force_override=True, sampling_type='particle')
+    ds.add_field(('dm', 'radial_velocity_corrected'), function=radial_velocity_corrected_dm, units='km/s', \
+                 take_log=False, force_override=True, sampling_type='particle')
+
+
+    sam_un = ds.unit_system["specific_angular_momentum"]
+    am_un  = ds.unit_system["angular_momentum"]
+    for ptype in ['stars', 'young_stars', 'old_stars', 'dm']:
+        ds.add_field((ptype, "particle_relative_specific_angular_momentum"), sampling_type="particle",
+                     function=get_particle_relative_specific_angular_momentum(ptype), units=sam_un)
+
+        ds.add_field((ptype, "particle_relative_specific_angular_momentum_x"),sampling_type="particle",
+                    function= get_particle_relative_specific_angular_momentum_x(ptype), units=sam_un)
+        ds.add_field((ptype, "particle_relative_specific_angular_momentum_y"),sampling_type="particle",
+                    function= get_particle_relative_specific_angular_momentum_y(ptype), units=sam_un)
+        ds.add_field((ptype, "particle_relative_specific_angular_momentum_z"),sampling_type="particle",
+                    function= get_particle_relative_specific_angular_momentum_z(ptype), units=sam_un)
+
+        ds.add_field((ptype, "particle_relative_angular_momentum_x"),sampling_type="particle",
+                    function= get_particle_relative_angular_momentum_x(ptype), units=am_un)
+        ds.add_field((ptype, "particle_relative_angular_momentum_y"),sampling_type="particle",
+                    function= get_particle_relative_angular_momentum_y(ptype), units=am_un)
+        ds.add_field((ptype, "particle_relative_angular_momentum_z"),sampling_type="particle",
+                    function= get_particle_relative_angular_momentum_z(ptype), units=am_un)
+
+        '''
+        ds.add_field((ptype, "particle_relative_specific_angular_momentum"),
+          sampling_type="particle",
+          function=_particle_relative_specific_angular_momentum,
+          units=ds.unit_system["specific_angular_momentum"]
+          )
+
+
+        for axi, ax in enumerate("xyz"):
+            f, v = _get_spec_ang_mom_comp(axi, ax, ptype)
+
+        ds.add_field(
+            (ptype, f"particle_relative_angular_momentum_{ax}"),
+            sampling_type="particle",
+            function=v,
+            units=ds.unit_system["angular_momentum"]
+        )
+        '''
+
+
+        '''
+
+        def _particle_relative_specific_angular_momentum(field, data):
+            """Calculate the angular of a particle velocity.
+
+            Returns a vector for each particle.
+            """
+            pos = data.ds.arr([data[ptype, f"relative_particle_position_%s" % ax] for ax in "xyz"]).T
+            vel = data.ds.arr([data[ptype, f"relative_particle_velocity_%s" % ax] for ax in "xyz"]).T
+            return ucross(pos, vel, registry=data.ds.unit_registry)
+
+        def _get_spec_ang_mom_comp(axi, ax, _ptype):
+            def _particle_specific_angular_momentum_component(field, data):
+                return data[_ptype, "particle_relative_specific_angular_momentum"][:, axi]
+
+            def _particle_angular_momentum_component(field, data):
+                return (
+                    data[_ptype, "particle_mass"]
+                    * data[ptype, f"particle_relative_specific_angular_momentum_{ax}"]
+                )
+
+            return (
+                _particle_specific_angular_momentum_component,
+                _particle_angular_momentum_component,
+            )
+        '''
+
+    ds.particles_filtered = True
+    if (hasattr(ds, 'Menc_profile')):
+        ds.add_field(('dm', 'vff'), function=v_ff_dm, units='km/s', \
+                 take_log=False, force_override=True, sampling_type='particle')
+
+def add_disk_fields(ds, snap, smooth_AM_name=False, particle_type_for_angmom='young_stars'):
+    '''Finds the angular momentum direction of the disk, either from the smoothed catalog 'smooth_AM_name'
+    or from the particles of type 'particle_type_for_angmom' within 15 kpc of the halo center, and registers
+    positions and velocities relative to the disk on 'ds'.'''
+
+    if (smooth_AM_name):
+        smooth_am = Table.read(smooth_AM_name, format='ascii')
+        ind = np.where(smooth_am['col2']==snap[-6:])[0][0]
+        L = np.array([float(smooth_am['col5'][ind]), float(smooth_am['col6'][ind]), float(smooth_am['col7'][ind])])
+    else:
+        # Calculate angular momentum vector using sphere centered on halo center
+        sphere = ds.sphere(ds.halo_center_kpc, (15., 'kpc'))
+        print('using particle type ', particle_type_for_angmom, ' to derive angular momentum')
+        if (particle_type_for_angmom=='gas'):
+            sphere = sphere.include_below(('gas','temperature'), 1e4)
+            sphere.set_field_parameter('bulk_velocity', ds.halo_velocity_kms)
+            L = sphere.quantities.angular_momentum_vector(use_gas=True, use_particles=False)
+        else:
+            L = sphere.quantities.angular_momentum_vector(use_gas=False, use_particles=True, particle_type=particle_type_for_angmom)
+        print('found angular momentum vector')
+    norm_L = L / np.sqrt((L**2).sum())
+    # Define other unit vectors orthagonal to the angular momentum vector
+    np.random.seed(99)
+    x = np.random.randn(3)            # take a random vector
+    x -= x.dot(norm_L) * norm_L       # make it orthogonal to L
+    x /= np.linalg.norm(x)            # normalize it
+    y = np.cross(norm_L, x)           # cross product with L
+    x_vec = ds.arr(x)
+    y_vec = ds.arr(y)
+    L_vec = ds.arr(norm_L)
+    ds.x_unit_disk = x_vec
+    ds.y_unit_disk = y_vec
+    ds.z_unit_disk = L_vec
+    # Calculate the rotation matrix for converting from original coordinate system
+    # into this new basis
+    xhat = np.array([1,0,0])
+    yhat = np.array([0,1,0])
+    zhat = np.array([0,0,1])
+    transArr0 = np.array([[xhat.dot(ds.x_unit_disk), xhat.dot(ds.y_unit_disk), xhat.dot(ds.z_unit_disk)],
+                         [yhat.dot(ds.x_unit_disk), yhat.dot(ds.y_unit_disk), yhat.dot(ds.z_unit_disk)],
+                         [zhat.dot(ds.x_unit_disk), zhat.dot(ds.y_unit_disk), zhat.dot(ds.z_unit_disk)]])
+    rotationArr = np.linalg.inv(transArr0)
+    ds.disk_rot_arr = rotationArr
+
+    # Add the new fields
+    ds.add_field(('gas', 'x_disk'), function=x_diskrel, units='kpc', take_log=False, \
+                 force_override=True, sampling_type='cell')
+    ds.add_field(('gas', 'y_disk'), function=y_diskrel, units='kpc', take_log=False, \
+                 force_override=True, sampling_type='cell')
+    ds.add_field(('gas', 'z_disk'), function=z_diskrel, units='kpc', take_log=False, \
+                 force_override=True, sampling_type='cell')
+    ds.add_field(('dm', 'x_disk'), function=x_diskrel_dm, units='kpc', take_log=False, \
+                 force_override=True, sampling_type='particle')
+    ds.add_field(('dm', 'y_disk'), function=y_diskrel_dm, units='kpc', take_log=False, \
+                 force_override=True, sampling_type='particle')
+    ds.add_field(('dm', 'z_disk'), function=z_diskrel_dm, units='kpc', take_log=False, \
+                 force_override=True, sampling_type='particle')
+    ds.add_field(('stars', 'x_disk'), function=x_diskrel_stars, units='kpc', take_log=False, \
+                 force_override=True, sampling_type='particle')
+    ds.add_field(('stars', 'y_disk'), function=y_diskrel_stars, units='kpc', take_log=False, \
+                 force_override=True, sampling_type='particle')
+    ds.add_field(('stars', 'z_disk'), function=z_diskrel_stars, units='kpc', take_log=False, \
+                 force_override=True, sampling_type='particle')
+    ds.add_field(('young_stars8', 'x_disk'), function=x_diskrel_young_stars8, units='kpc', take_log=False, \
+                 force_override=True, sampling_type='particle')
+    ds.add_field(('young_stars8', 'y_disk'), function=y_diskrel_young_stars8, units='kpc', take_log=False, \
+                 force_override=True, sampling_type='particle')
+    ds.add_field(('young_stars8', 'z_disk'), function=z_diskrel_young_stars8, units='kpc', take_log=False, \
+                 force_override=True, sampling_type='particle')
+    ds.add_field(('gas', 'vx_disk'), function=vx_diskrel, units='km/s', take_log=False, \
+                 force_override=True, sampling_type='cell')
+    ds.add_field(('gas', 'vy_disk'), function=vy_diskrel, units='km/s', take_log=False, \
+                 force_override=True, sampling_type='cell')
+    ds.add_field(('gas', 'vz_disk'), function=vz_diskrel, units='km/s', take_log=False, \
+                 force_override=True, sampling_type='cell')
+    ds.add_field(('gas', 'phi_pos_disk'), function=phi_pos_diskrel, units=None, take_log=False, \
+                 force_override=True, sampling_type='cell')
+    ds.add_field(('gas', 'theta_pos_disk'), function=theta_pos_diskrel, units=None, take_log=False, \
+                 force_override=True, sampling_type='cell')
+    ds.add_field(('dm', 'phi_pos_disk'), function=phi_pos_diskrel_dm, units=None, take_log=False, \
+                 force_override=True, sampling_type='particle')
+    ds.add_field(('dm', 'theta_pos_disk'), function=theta_pos_diskrel_dm, units=None, take_log=False, \
+                 force_override=True, sampling_type='particle')
+    ds.add_field(('gas', 'vphi_disk'), function=phi_velocity_diskrel, units='km/s', take_log=False, \
+                 force_override=True, sampling_type='cell')
+    ds.add_field(('gas', 'vtheta_disk'), function=theta_velocity_diskrel, units='km/s', take_log=False, \
+                 force_override=True, sampling_type='cell')
+    ds.add_field(('gas', 'vtan_disk'), function=tangential_velocity_diskrel, units='km/s', take_log=False, \
+                 force_override=True, sampling_type='cell')
+    ds.add_field(('gas', 'tangential_kinetic_energy_disk'), function=tangential_kinetic_energy_diskrel, \
+                 units='erg', take_log=True, force_override=True, sampling_type='cell')
+
+def add_gravity_fields(ds, snap, zsnap, masses_dir):
+    '''Reads the enclosed mass profile of 'snap' from the mass tables in 'masses_dir' and registers the
+    free-fall time and velocity, escape velocity, gravitational potential, and HSE fields on 'ds'.'''
+
+    # Interpolate enclosed mass function to get tff
+    radius, total_mass = lookup_masses(masses_dir, snap, zsnap)
+    ds.Menc_profile = IUS(np.concatenate(([0],radius)), np.concatenate(([0],total_mass)))
+    ds.add_field(('gas', 'tff'), function=t_ff, units='yr', display_name='Free fall time', take_log=True, \
+                force_override=True, sampling_type='cell')
+    ds.add_field(('gas', 'vff'), function=v_ff, units='km/s', display_name='Free fall velocity', take_log=False, \
+                force_override=True, sampling_type='cell')
+    ds.add_field(('gas', 'vesc'), function=v_esc, units='km/s', display_name='Escape velocity', take_log=False, \
+                force_override=True, sampling_type='cell')
+    ds.add_field(('gas', 'tcool_tff'), function=tcool_tff_ratio, units=None, display_name='t_{cool}/t_{ff}', take_log=True, \
+                force_override=True, sampling_type='cell')
+    ds.add_field(('gas','grav_pot'), function=grav_pot, units='cm**2/s**2', force_override=True, sampling_type='cell', \
+                display_name = 'Gravitational Potential')
+    grad_fields_grav = ds.add_gradient_fields(('gas','grav_pot'))
+    ds.add_field(('gas','HSE'), function=hse_ratio, units='', \
+                 display_name='HSE Parameter', force_override=True, sampling_type='cell')
+    if (getattr(ds, 'particles_filtered', False)):
+        ds.add_field(('dm', 'vff'), function=v_ff_dm, units='km/s', \
+                 take_log=False, force_override=True, sampling_type='particle')
+
+# Names of the fields registered by each stage of foggie_load, used to find which stage to run when
+# a field that has not been registered yet is asked for from a lazily-loaded dataset
+corrected_field_names = ['vx_corrected', 'vy_corrected', 'vz_corrected', 'vel_mag_corrected', 'radius_corrected', \
+                         'theta_pos', 'phi_pos', 'radial_velocity_corrected', 'theta_velocity_corrected', \
+                         'phi_velocity_corrected', 'tangential_velocity_corrected', 'kinetic_energy_corrected', \
+                         'radial_kinetic_energy', 'tangential_kinetic_energy', 'cell_mass_msun']
+disk_field_names = ['x_disk', 'y_disk', 'z_disk', 'vx_disk', 'vy_disk', 'vz_disk', 'phi_pos_disk', 'theta_pos_disk', \
+                    'vphi_disk', 'vtheta_disk', 'vtan_disk', 'tangential_kinetic_energy_disk']
+gravity_field_names = ['tff', 'vff', 'vesc', 'tcool_tff', 'grav_pot', 'HSE']
+filtered_particle_types = ['young_stars', 'young_stars8', 'old_stars', 'stars', 'dm']
+
+def run_load_stage(ds, stage, function):
+    '''Runs the foggie_load stage named 'stage' by calling 'function', and records how long it took
+    in ds.load_timings.'''
+
+    start = time.time()
+    function()
+    ds.load_timings[stage] = time.time() - start
+    if (ds.report_load_timings):
+        print('foggie_load: %s took %.2f s' % (stage, ds.load_timings[stage]))
+
+def print_load_timings(ds):
+    '''Prints how long each stage of foggie_load took for the dataset 'ds'.'''
+
+    total = 0.
+    print('foggie_load timings for ' + str(ds) + ':')
+    for stage in ds.load_timings:
+        print('    %-12s %8.2f s' % (stage, ds.load_timings[stage]))
+        total += ds.load_timings[stage]
+    print('    %-12s %8.2f s' % ('total', total))
+
+def field_load_stage(ftype, fname):
+    '''Returns the name of the foggie_load stage that registers the field (ftype, fname), or None
+    if it is not registered by any stage.'''
+
+    if (fname in disk_field_names):
+        return 'disk'
+    if (fname in gravity_field_names) or (fname.startswith('grav_pot_gradient')):
+        return 'gravity'
+    if (ftype in filtered_particle_types):
+        return 'particles'
+    if (fname in corrected_field_names):
+        return 'corrected'
+    return None
+
+def load_stage(ds, stage):
+    '''Runs the pending foggie_load stage 'stage' of the lazily-loaded dataset 'ds', after first
+    running any pending stages it depends on.'''
+
+    function, requires = ds.pending_load_stages.pop(stage)
+    for required in requires:
+        if (required in ds.pending_load_stages):
+            load_stage(ds, required)
+    run_load_stage(ds, stage, function)
+
+def make_lazy(ds, stages):
+    '''Sets up the dataset 'ds' so that each of the foggie_load 'stages' (a dictionary of stage name:
+    (function, list of stages it depends on)) is only run the first time one of the fields it
+    registers is asked for. This works by wrapping ds._get_field_info, which yt uses to look up every
+    field, so that a field that isn't found triggers the stage that registers it. Attributes set by a
+    stage (like ds.disk_rot_arr or ds.Menc_profile) are not made lazy, so they only exist once the stage
+    has run; stages can be run by hand with load_stage(ds, stage).'''
+
+    ds.pending_load_stages = dict(stages)
+    get_field_info = ds._get_field_info
+
+    def _get_field_info(*args, **kwargs):
+        try:
+            return get_field_info(*args, **kwargs)
+        except YTFieldNotFound:
+            # The field may be given as (ftype, fname), a tuple, a name, or a DerivedField
+            if ('fname' in kwargs) and (kwargs['fname'] is not None):
+                ftype, fname = kwargs.get('ftype', 'unknown'), kwargs['fname']
+            elif (len(args) > 1) and (args[1] is not None):
+                ftype, fname = args[0], args[1]
+            else:
+                field = args[0] if (len(args) > 0) else kwargs.get('field')
+                field = getattr(field, 'name', field)
+                if (isinstance(field, tuple)):
+                    ftype, fname = field[0], field[-1]
+                else:
+                    ftype, fname = 'unknown', field
+            stage = field_load_stage(ftype, fname)
+            if (ftype in filtered_particle_types) and ('particles' in ds.pending_load_stages):
+                load_stage(ds, 'particles')
+            if (stage is not None) and (stage in ds.pending_load_stages):
+                load_stage(ds, stage)
+            return get_field_info(*args, **kwargs)
+
+    ds._get_field_info = _get_field_info
+
 def foggie_load(snap, trackfile, **kwargs):
     """This function loads a specified snapshot named by 'snap', the halo track "trackfile'
-    Based off of a helper function to flux_tracking written by Cassi, adapted for utils by JT."""
+    Based off of a helper function to flux_tracking written by Cassi, adapted for utils by JT.
+    If 'field_cache' is a directory name, the halo-centric fields of the returned region are saved
+    there the first time and memory-mapped from there on later loads with the same halo center.
+    If 'lazy' is True, the corrected, particle, disk-relative, and gravity fields are only registered
+    the first time one of them is used. The attributes those stages set (ds.particles_filtered,
+    ds.disk_rot_arr, ds.x_unit_disk, ds.y_unit_disk, ds.z_unit_disk, and ds.Menc_profile) don't exist
+    until then, so a script that needs them before using any of their fields must first run the stage
+    with load_stage(ds, 'particles'), load_stage(ds, 'disk'), or load_stage(ds, 'gravity'). The time taken by each stage is saved in ds.load_timings, and
+    printed if 'timings' is True."""
     find_halo_center = kwargs.get('find_halo_center', True)
     halo_c_v_name = kwargs.get('halo_c_v_name', 'halo_c_v')
     disk_relative = kwargs.get('disk_relative', False)
@@ -61,10 +414,17 @@ def foggie_load(snap, trackfile, **kwargs):
     masses_dir = kwargs.get('masses_dir', '')
     correct_bulk_velocity = kwargs.get('correct_bulk_velocity', False)
     smooth_AM_name = kwargs.get('smooth_AM_name', False)
+    field_cache = kwargs.get('field_cache', False)
+    lazy = kwargs.get('lazy', False)
+    timings = kwargs.get('timings', False)
 
+    start = time.time()
     print ('Opening snapshot ' + snap)
     ds = yt.load(snap)
+    ds.load_timings = {'open': time.time() - start}
+    ds.report_load_timings = timings
 
+    start = time.time()
     track = Table.read(trackfile, format='ascii')
     track.sort('col1')
 
@@ -74,18 +434,17 @@ def foggie_load(snap, trackfile, **kwargs):
     refine_box, refine_box_center, refine_width_code = grb.get_refine_box(ds, zsnap, track)
     refine_width = refine_width_code * proper_box_size
     refine_width_kpc = YTArray([refine_width], 'kpc')
+    ds.load_timings['refine_box'] = time.time() - start
 
     # Get halo center
+    start = time.time()
     if (find_halo_center):
         if (os.path.exists(halo_c_v_name)):
-            halo_c_v = Table.read(halo_c_v_name, format='ascii')
+            catalog_center, catalog_velocity = lookup_halo_c_v(halo_c_v_name, snap)
             if ('smoothed' in halo_c_v_name):
-                if (snap[-6:] in halo_c_v['col2']):
+                if (catalog_center is not None):
                     print('Pulling halo center from smoothed path catalog file')
-                    halo_ind = np.where(halo_c_v['col2']==snap[-6:])[0][0]
-                    halo_center_kpc = ds.arr([float(halo_c_v['col5'][halo_ind]), \
-                                              float(halo_c_v['col6'][halo_ind]), \
-                                              float(halo_c_v['col7'][halo_ind])], 'kpc')
+                    halo_center_kpc = ds.arr(catalog_center, 'kpc')
                     ds.halo_center_kpc = halo_center_kpc
                     ds.halo_center_code = halo_center_kpc.in_units('code_length')
                     sp = ds.sphere(ds.halo_center_kpc, (5., 'kpc'))
@@ -96,15 +455,10 @@ def foggie_load(snap, trackfile, **kwargs):
                     print('This snapshot is not in the halo_cen_smoothed file, calculating halo center (which will NOT be smoothed)...')
                     calc_hc = True
             else:
-                if (snap[-6:] in halo_c_v['col3']):
+                if (catalog_center is not None):
                     print("Pulling halo center from catalog file")
-                    halo_ind = np.where(halo_c_v['col3']==snap[-6:])[0][0]
-                    halo_center_kpc = ds.arr([float(halo_c_v['col4'][halo_ind]), \
-                                              float(halo_c_v['col5'][halo_ind]), \
-                                              float(halo_c_v['col6'][halo_ind])], 'kpc')
-                    halo_velocity_kms = ds.arr([float(halo_c_v['col7'][halo_ind]), \
-                                                float(halo_c_v['col8'][halo_ind]), \
-                                                float(halo_c_v['col9'][halo_ind])], 'km/s')
+                    halo_center_kpc = ds.arr(catalog_center, 'kpc')
+                    halo_velocity_kms = ds.arr(catalog_velocity, 'km/s')
                     ds.halo_center_kpc = halo_center_kpc
                     ds.halo_center_code = halo_center_kpc.in_units('code_length')
                     ds.halo_velocity_kms = halo_velocity_kms
@@ -133,244 +487,36 @@ def foggie_load(snap, trackfile, **kwargs):
         ds.halo_center_kpc = ds.arr([np.nan, np.nan, np.nan], 'kpc')
         ds.halo_center_code = ds.arr([np.nan, np.nan, np.nan], 'code_length')
         ds.halo_velocity_kms = ds.arr([np.nan, np.nan, np.nan], 'km/s')
+    ds.load_timings['halo_center'] = time.time() - start
 
     ds.track = track
     ds.refine_box_center = refine_box_center
+    # Set now even if the gravity stage is lazy, so caches of gravity fields can tell which profile they used
+    ds.masses_dir = masses_dir if (gravity) else None
     ds.refine_width = refine_width
 
-    ds.add_field(('gas','vx_corrected'), function=vx_corrected, units='km/s', take_log=False, \
-                 sampling_type='cell')
-    ds.add_field(('gas', 'vy_corrected'), function=vy_corrected, units='km/s', take_log=False, \
-                 sampling_type='cell')
-    ds.add_field(('gas', 'vz_corrected'), function=vz_corrected, units='km/s', take_log=False, \
-                 sampling_type='cell')
-    ds.add_field(('gas', 'vel_mag_corrected'), function=vel_mag_corrected, units='km/s', take_log=False, \
-                 sampling_type='cell')
-    ds.add_field(('gas', 'radius_corrected'), function=radius_corrected, units='kpc', \
-                 take_log=False, force_override=True, sampling_type='cell')
-    ds.add_field(('gas', 'theta_pos'), function=theta_pos, units=None, take_log=False, \
-                 sampling_type='cell')
-    ds.add_field(('gas', 'phi_pos'), function=phi_pos, units=None, take_log=False, \
-                 sampling_type='cell')
-    ds.add_field(('gas', 'radial_velocity_corrected'), function=radial_velocity_corrected, \
-                 units='km/s', take_log=False, force_override=True, sampling_type='cell', display_name='Radial Velocity')
-    ds.add_field(('gas', 'theta_velocity_corrected'), function=theta_velocity_corrected, \
-                 units='km/s', take_log=False, force_override=True, sampling_type='cell')
-    ds.add_field(('gas', 'phi_velocity_corrected'), function=phi_velocity_corrected, \
-                 units='km/s', take_log=False, force_override=True, sampling_type='cell')
-    ds.add_field(('gas', 'tangential_velocity_corrected'), function=tangential_velocity_corrected, \
-                 units='km/s', take_log=False, force_override=True, sampling_type='cell', display_name='Tangential Velocity')
-    ds.add_field(('gas', 'kinetic_energy_corrected'), function=kinetic_energy_corrected, \
-                 units='erg', take_log=True, force_override=True, sampling_type='cell')
-    ds.add_field(('gas', 'radial_kinetic_energy'), function=radial_kinetic_energy, \
-                 units='erg', take_log=True, force_override=True, sampling_type='cell')
-    ds.add_field(('gas', 'tangential_kinetic_energy'), function=tangential_kinetic_energy, \
-                 units='erg', take_log=True, force_override=True, sampling_type='cell')
-    ds.add_field(('gas', 'cell_mass_msun'), function=cell_mass_msun, units='Msun', take_log=True, \
-                 force_override=True, sampling_type='cell')
-
-    # filter particles into star and dm
-    # JT moved this to before "disk_relative" so that the if statement can use the filtered particle fields
-    if (do_filter_particles):
-        filter_particles(refine_box, filter_particle_types = ['young_stars', 'young_stars8', 'old_stars', 'stars', 'dm'])
-
-        ds.add_field(('stars', 'radius_corrected'), function=radius_corrected_stars, units='kpc', \
-                     take_log=False, force_override=True, sampling_type='particle')
-        ds.add_field(('young_stars', 'radius_corrected'), function=radius_corrected_young_stars, units='kpc', \
-                     take_log=False, force_override=True, sampling_type='particle')
-        ds.add_field(('young_stars8', 'radius_corrected'), function=radius_corrected_young_stars8, units='kpc', \
-                     take_log=False, force_override=True, sampling_type='particle')
-        ds.add_field(('old_stars', 'radius_corrected'), function=radius_corrected_old_stars, units='kpc', \
-                     take_log=False, force_override=True, sampling_type='particle')
-        ds.add_field(('dm', 'radius_corrected'), function=radius_corrected_dm, units='kpc', \
-                     take_log=False, force_override=True, sampling_type='particle')
-        ds.add_field(('dm', 'radial_velocity_corrected'), function=radial_velocity_corrected_dm, units='km/s', \
-                     take_log=False, force_override=True, sampling_type='particle')
-
-
-        sam_un = ds.unit_system["specific_angular_momentum"]
-        am_un  = ds.unit_system["angular_momentum"]
-        for ptype in ['stars', 'young_stars', 'old_stars', 'dm']:
-            ds.add_field((ptype, "particle_relative_specific_angular_momentum"), sampling_type="particle",
-                         function=get_particle_relative_specific_angular_momentum(ptype), units=sam_un)
-
-            ds.add_field((ptype, "particle_relative_specific_angular_momentum_x"),sampling_type="particle",
-                        function= get_particle_relative_specific_angular_momentum_x(ptype), units=sam_un)
-            ds.add_field((ptype, "particle_relative_specific_angular_momentum_y"),sampling_type="particle",
-                        function= get_particle_relative_specific_angular_momentum_y(ptype), units=sam_un)
-            ds.add_field((ptype, "particle_relative_specific_angular_momentum_z"),sampling_type="particle",
-                        function= get_particle_relative_specific_angular_momentum_z(ptype), units=sam_un)
-
-            ds.add_field((ptype, "particle_relative_angular_momentum_x"),sampling_type="particle",
-                        function= get_particle_relative_angular_momentum_x(ptype), units=am_un)
-            ds.add_field((ptype, "particle_relative_angular_momentum_y"),sampling_type="particle",
-                        function= get_particle_relative_angular_momentum_y(ptype), units=am_un)
-            ds.add_field((ptype, "particle_relative_angular_momentum_z"),sampling_type="particle",
-                        function= get_particle_relative_angular_momentum_z(ptype), units=am_un)
-
-            '''
-            ds.add_field((ptype, "particle_relative_specific_angular_momentum"),
-              sampling_type="particle",
-              function=_particle_relative_specific_angular_momentum,
-              units=ds.unit_system["specific_angular_momentum"]
-              )
-
-
-            for axi, ax in enumerate("xyz"):
-                f, v = _get_spec_ang_mom_comp(axi, ax, ptype)
-
-            ds.add_field(
-                (ptype, f"particle_relative_angular_momentum_{ax}"),
-                sampling_type="particle",
-                function=v,
-                units=ds.unit_system["angular_momentum"]
-            )
-            '''
-
-
-            '''
-
-            def _particle_relative_specific_angular_momentum(field, data):
-                """Calculate the angular of a particle velocity.
-
-                Returns a vector for each particle.
-                """
-                pos = data.ds.arr([data[ptype, f"relative_particle_position_%s" % ax] for ax in "xyz"]).T
-                vel = data.ds.arr([data[ptype, f"relative_particle_velocity_%s" % ax] for ax in "xyz"]).T
-                return ucross(pos, vel, registry=data.ds.unit_registry)
-
-            def _get_spec_ang_mom_comp(axi, ax, _ptype):
-                def _particle_specific_angular_momentum_component(field, data):
-                    return data[_ptype, "particle_relative_specific_angular_momentum"][:, axi]
-
-                def _particle_angular_momentum_component(field, data):
-                    return (
-                        data[_ptype, "particle_mass"]
-                        * data[ptype, f"particle_relative_specific_angular_momentum_{ax}"]
-                    )
-
-                return (
-                    _particle_specific_angular_momentum_component,
-                    _particle_angular_momentum_component,
-                )
-            '''
-
-
-
-    # Option to define velocities and coordinates relative to the angular momentum vector of the disk
-    if (disk_relative):
-        if (smooth_AM_name):
-            smooth_am = Table.read(smooth_AM_name, format='ascii')
-            ind = np.where(smooth_am['col2']==snap[-6:])[0][0]
-            L = np.array([float(smooth_am['col5'][ind]), float(smooth_am['col6'][ind]), float(smooth_am['col7'][ind])])
-        else:
-            # Calculate angular momentum vector using sphere centered on halo center
-            sphere = ds.sphere(ds.halo_center_kpc, (15., 'kpc'))
-            print('using particle type ', particle_type_for_angmom, ' to derive angular momentum')
-            if (particle_type_for_angmom=='gas'):
-                sphere = sphere.include_below(('gas','temperature'), 1e4)
-                sphere.set_field_parameter('bulk_velocity', ds.halo_velocity_kms)
-                L = sphere.quantities.angular_momentum_vector(use_gas=True, use_particles=False)
-            else:
-                L = sphere.quantities.angular_momentum_vector(use_gas=False, use_particles=True, particle_type=particle_type_for_angmom)
-            print('found angular momentum vector')
-        norm_L = L / np.sqrt((L**2).sum())
-        # Define other unit vectors orthagonal to the angular momentum vector
-        np.random.seed(99)
-        x = np.random.randn(3)            # take a random vector
-        x -= x.dot(norm_L) * norm_L       # make it orthogonal to L
-        x /= np.linalg.norm(x)            # normalize it
-        y = np.cross(norm_L, x)           # cross product with L
-        x_vec = ds.arr(x)
-        y_vec = ds.arr(y)
-        L_vec = ds.arr(norm_L)
-        ds.x_unit_disk = x_vec
-        ds.y_unit_disk = y_vec
-        ds.z_unit_disk = L_vec
-        # Calculate the rotation matrix for converting from original coordinate system
-        # into this new basis
-        xhat = np.array([1,0,0])
-        yhat = np.array([0,1,0])
-        zhat = np.array([0,0,1])
-        transArr0 = np.array([[xhat.dot(ds.x_unit_disk), xhat.dot(ds.y_unit_disk), xhat.dot(ds.z_unit_disk)],
-                             [yhat.dot(ds.x_unit_disk), yhat.dot(ds.y_unit_disk), yhat.dot(ds.z_unit_disk)],
-                             [zhat.dot(ds.x_unit_disk), zhat.dot(ds.y_unit_disk), zhat.dot(ds.z_unit_disk)]])
-        rotationArr = np.linalg.inv(transArr0)
-        ds.disk_rot_arr = rotationArr
-
-        # Add the new fields
-        ds.add_field(('gas', 'x_disk'), function=x_diskrel, units='kpc', take_log=False, \
-                     force_override=True, sampling_type='cell')
-        ds.add_field(('gas', 'y_disk'), function=y_diskrel, units='kpc', take_log=False, \
-                     force_override=True, sampling_type='cell')
-        ds.add_field(('gas', 'z_disk'), function=z_diskrel, units='kpc', take_log=False, \
-                     force_override=True, sampling_type='cell')
-        ds.add_field(('dm', 'x_disk'), function=x_diskrel_dm, units='kpc', take_log=False, \
-                     force_override=True, sampling_type='particle')
-        ds.add_field(('dm', 'y_disk'), function=y_diskrel_dm, units='kpc', take_log=False, \
-                     force_override=True, sampling_type='particle')
-        ds.add_field(('dm', 'z_disk'), function=z_diskrel_dm, units='kpc', take_log=False, \
-                     force_override=True, sampling_type='particle')
-        ds.add_field(('stars', 'x_disk'), function=x_diskrel_stars, units='kpc', take_log=False, \
-                     force_override=True, sampling_type='particle')
-        ds.add_field(('stars', 'y_disk'), function=y_diskrel_stars, units='kpc', take_log=False, \
-                     force_override=True, sampling_type='particle')
-        ds.add_field(('stars', 'z_disk'), function=z_diskrel_stars, units='kpc', take_log=False, \
-                     force_override=True, sampling_type='particle')
-        ds.add_field(('young_stars8', 'x_disk'), function=x_diskrel_young_stars8, units='kpc', take_log=False, \
-                     force_override=True, sampling_type='particle')
-        ds.add_field(('young_stars8', 'y_disk'), function=y_diskrel_young_stars8, units='kpc', take_log=False, \
-                     force_override=True, sampling_type='particle')
-        ds.add_field(('young_stars8', 'z_disk'), function=z_diskrel_young_stars8, units='kpc', take_log=False, \
-                     force_override=True, sampling_type='particle')
-        ds.add_field(('gas', 'vx_disk'), function=vx_diskrel, units='km/s', take_log=False, \
-                     force_override=True, sampling_type='cell')
-        ds.add_field(('gas', 'vy_disk'), function=vy_diskrel, units='km/s', take_log=False, \
-                     force_override=True, sampling_type='cell')
-        ds.add_field(('gas', 'vz_disk'), function=vz_diskrel, units='km/s', take_log=False, \
-                     force_override=True, sampling_type='cell')
-        ds.add_field(('gas', 'phi_pos_disk'), function=phi_pos_diskrel, units=None, take_log=False, \
-                     force_override=True, sampling_type='cell')
-        ds.add_field(('gas', 'theta_pos_disk'), function=theta_pos_diskrel, units=None, take_log=False, \
-                     force_override=True, sampling_type='cell')
-        ds.add_field(('dm', 'phi_pos_disk'), function=phi_pos_diskrel_dm, units=None, take_log=False, \
-                     force_override=True, sampling_type='particle')
-        ds.add_field(('dm', 'theta_pos_disk'), function=theta_pos_diskrel_dm, units=None, take_log=False, \
-                     force_override=True, sampling_type='particle')
-        ds.add_field(('gas', 'vphi_disk'), function=phi_velocity_diskrel, units='km/s', take_log=False, \
-                     force_override=True, sampling_type='cell')
-        ds.add_field(('gas', 'vtheta_disk'), function=theta_velocity_diskrel, units='km/s', take_log=False, \
-                     force_override=True, sampling_type='cell')
-        ds.add_field(('gas', 'vtan_disk'), function=tangential_velocity_diskrel, units='km/s', take_log=False, \
-                     force_override=True, sampling_type='cell')
-        ds.add_field(('gas', 'tangential_kinetic_energy_disk'), function=tangential_kinetic_energy_diskrel, \
-                     units='erg', take_log=True, force_override=True, sampling_type='cell')
-
-    if (gravity):
-        # Interpolate enclosed mass function to get tff
-        if (zsnap > 2.):
-            masses = Table.read(masses_dir + 'masses_z-gtr-2.hdf5', path='all_data')
-        else:
-            masses = Table.read(masses_dir + 'masses_z-less-2.hdf5', path='all_data')
-        snap_ind = masses['snapshot']==snap[-6:]
-        ds.Menc_profile = IUS(np.concatenate(([0],masses['radius'][snap_ind])), np.concatenate(([0],masses['total_mass'][snap_ind])))
-        ds.add_field(('gas', 'tff'), function=t_ff, units='yr', display_name='Free fall time', take_log=True, \
-                    force_override=True, sampling_type='cell')
-        ds.add_field(('gas', 'vff'), function=v_ff, units='km/s', display_name='Free fall velocity', take_log=False, \
-                    force_override=True, sampling_type='cell')
-        ds.add_field(('gas', 'vesc'), function=v_esc, units='km/s', display_name='Escape velocity', take_log=False, \
-                    force_override=True, sampling_type='cell')
-        ds.add_field(('gas', 'tcool_tff'), function=tcool_tff_ratio, units=None, display_name='t_{cool}/t_{ff}', take_log=True, \
-                    force_override=True, sampling_type='cell')
-        ds.add_field(('gas','grav_pot'), function=grav_pot, units='cm**2/s**2', force_override=True, sampling_type='cell', \
-                    display_name = 'Gravitational Potential')
-        grad_fields_grav = ds.add_gradient_fields(('gas','grav_pot'))
-        ds.add_field(('gas','HSE'), function=hse_ratio, units='', \
-                     display_name='HSE Parameter', force_override=True, sampling_type='cell')
-        if (do_filter_particles):
-            ds.add_field(('dm', 'vff'), function=v_ff_dm, units='km/s', \
-                     take_log=False, force_override=True, sampling_type='particle')
+    stages = {'corrected': (lambda: add_corrected_fields(ds), []),
+              'particles': (lambda: add_particle_fields(ds, refine_box), []),
+              'disk': (lambda: add_disk_fields(ds, snap, smooth_AM_name=smooth_AM_name, \
+                         particle_type_for_angmom=particle_type_for_angmom), ['corrected']),
+              'gravity': (lambda: add_gravity_fields(ds, snap, zsnap, masses_dir), ['corrected'])}
+    # The disk angular momentum is found from the filtered particles unless it is read from file
+    if (do_filter_particles) and (not smooth_AM_name) and (particle_type_for_angmom!='gas'):
+        stages['disk'][1].append('particles')
+    if (not do_filter_particles): del stages['particles']
+    if (not disk_relative): del stages['disk']
+    if (not gravity): del stages['gravity']
+
+    if (lazy):
+        # Register each group of fields only when one of its fields is first asked for
+        make_lazy(ds, stages)
+    else:
+        # Particles are filtered before "disk_relative" so that the disk can use the filtered particle fields
+        for stage in ['corrected', 'particles', 'disk', 'gravity']:
+            if (stage in stages):
+                run_load_stage(ds, stage, stages[stage][0])
 
+    region_name = region
     if (region=='refine_box'):
         region = refine_box
     elif (region=='cgm'):
@@ -380,4 +526,11 @@ def foggie_load(snap, trackfile, **kwargs):
         cgm_filtered = cgm.cut_region(cgm_field_filter)
         region = cgm_filtered
 
+    if (field_cache):
+        run_load_stage(ds, 'field_cache', lambda: cache_halo_fields(ds, region, field_cache, region_name, \
+                       disk_relative=disk_relative, gravity=gravity, smooth_AM_name=smooth_AM_name, \
+                       particle_type_for_angmom=particle_type_for_angmom, masses_dir=masses_dir))
+
+    if (timings): print_load_timings(ds)
+
     return ds, region
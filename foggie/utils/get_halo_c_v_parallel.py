@@ -21,9 +21,11 @@ import argparse
 import shutil
 
 from foggie.utils.get_refine_box import get_refine_box
-from foggie.utils.get_halo_center import get_halo_center
+from foggie.utils.get_halo_center import get_halo_center, get_particle_center
 from foggie.utils.get_proper_box_size import get_proper_box_size
 from foggie.utils.get_run_loc_etc import get_run_loc_etc
+from foggie.utils.snapshot_scheduler import run_snapshots
+from foggie.utils.track_builder import read_track_log, append_track_log
 import numpy as np
 import glob
 import os
@@ -70,16 +72,25 @@ def parse_args():
                         'code will run one output per processor')
     parser.set_defaults(nproc=4)
 
+    parser.add_argument('--center_method', metavar='center_method', type=str, action='store', \
+                        help='How do you want to find the halo centers? Options are dm_density (the peak of the\n' + \
+                        'dark matter density) and particles (a shrinking sphere on the dark matter and star particles,\n' + \
+                        'which is faster). Default is dm_density.')
+    parser.set_defaults(center_method='dm_density')
 
     args = parser.parse_args()
     return args
 
-def loop_over_halos(system, nproc, run_dir, trackname, output_dir, outs):
+def loop_over_halos(system, nproc, run_dir, trackname, output_dir, outs, center_method='dm_density'):
     '''
     This sets up the parallel processing for finding the halo centers of all datasets in 'outs'.
     It also takes the number of processors to use, 'nproc', the directory where the snapshots
     can be found, 'run_dir', the file name of the halo track file, 'trackname', and the directory where
-    the new halo_v_c file should be placed, 'output_dir'.
+    the new halo_v_c file should be placed, 'output_dir'. 'center_method' is passed to get_halo_info.
+
+    Each snapshot's row is appended to a log file in 'output_dir' as soon as it is done, and snapshots
+    already in the log are skipped, so a run that stops can be started again without redoing them. A
+    new snapshot is started as soon as any running one finishes.
     '''
     print("opening track: " + trackname)
     track = Table.read(trackname, format='ascii')
@@ -88,51 +99,32 @@ def loop_over_halos(system, nproc, run_dir, trackname, output_dir, outs):
     t = Table(dtype=('f8','S6', 'f8', 'f8', 'f8', 'f8', 'f8', 'f8'),
             names=('redshift', 'name', 'xc', 'yc', 'zc', 'xv', 'yv', 'zv'))
 
-    print('Computing centers and velocities for ' + str(len(outs)) + ' snaps ' + \
-          'from ' + outs[0] + ' to ' + outs[-1])
-    # Split into a number of groupings equal to the number of processors
-    # and run one process per processor
-    rows = []
-    for i in range(len(outs)//nproc):
-        threads = []
-        queue = mp.Queue()
-        for j in range(nproc):
-            snap = run_dir + outs[nproc*i+j] + '/' + outs[nproc*i+j]
-            thr = mp.Process(target=get_halo_info, \
-               args=(system, snap, track, queue))
-            threads.append(thr)
-            thr.start()
-        for thr in threads:
-            row = queue.get()
-            rows.append(row)
-        for thr in threads:
-            thr.join()
-    # For any leftover snapshots, run one per processor
-    threads = []
-    queue = mp.Queue()
-    for j in range(len(outs)%nproc):
-        snap = run_dir + outs[-(j+1)] + '/' + outs[-(j+1)]
-        thr = mp.Process(target=get_halo_info, \
-           args=(system, snap, track, queue))
-        threads.append(thr)
-        thr.start()
-    for thr in threads:
-        row = queue.get()
-        rows.append(row)
-    for thr in threads:
-        thr.join()
-
-    for row in rows:
-        t.add_row(row)
+    log_file = output_dir + 'halo_c_v_' + outs[0] + '_' + outs[-1] + '.log'
+    columns, done = read_track_log(log_file)
+    todo = [snap for snap in outs if snap not in done]
+    print('Computing centers and velocities for ' + str(len(todo)) + ' snaps ' + \
+          'from ' + outs[0] + ' to ' + outs[-1] + ' (' + str(len(outs)-len(todo)) + ' already in ' + log_file + ')')
+    run_snapshots(get_halo_info, todo, make_args=lambda snap: (system, run_dir + snap + '/' + snap, track, log_file, center_method), \
+                  nproc=nproc)
+
+    columns, done = read_track_log(log_file)
+    for snap in outs:
+        if (snap in done):
+            t.add_row([done[snap][0], snap] + done[snap][1:])
+        else:
+            print('No center found for ' + snap)
 
     t.sort('redshift')
     t.reverse()
     ascii.write(t, output_dir + 'halo_c_v_' + outs[0] + '_' + outs[-1], format='fixed_width', overwrite=True)
 
-def get_halo_info(system, snap, track, t):
+def get_halo_info(system, snap, track, log_file, center_method='dm_density'):
     '''
     This finds the halo center and halo velocity for a snapshot 'snap', using the halo track 'track',
-    and saves it to the multiprocessing queue 't'.
+    and appends it to the track log 'log_file'. The center is found with get_halo_center's
+    'center_method' ('dm_density' or 'particles'). With 'dm_density', the velocity is the bulk velocity within
+    10 kpc of the center, and with 'particles' it is the mass-weighted velocity of the dark matter and star
+    particles within 10 kpc of the center, found from the particles of the refine box along with the center.
     '''
 
     '''if (system=='pleiades_cassi'):
@@ -149,16 +141,21 @@ def get_halo_info(system, snap, track, t):
     zsnap = ds.get_parameter('CosmologyCurrentRedshift')
     proper_box_size = get_proper_box_size(ds)
     refine_box, refine_box_center, refine_width = get_refine_box(ds, zsnap, track)
-    center, velocity = get_halo_center(ds, refine_box_center)
-    halo_center_kpc = ds.arr(np.array(center)*proper_box_size, 'kpc')
-    sphere_region = ds.sphere(halo_center_kpc, (10., 'kpc') )
-    halo_velocity_kms = sphere_region.quantities['BulkVelocity']().in_units('km/s')
-
-    row = [zsnap, ds.parameter_filename[-6:],
-            halo_center_kpc[0], halo_center_kpc[1], halo_center_kpc[2],
+    if (center_method=='particles'):
+        center, velocity, diagnostics = get_particle_center(ds, refine_box_center, data_source=refine_box, vel_radius=10.)
+        if not (diagnostics['converged']): print('Warning: center of ' + snap[-6:] + ' moved by %.3f kpc in the last step' % (diagnostics['shift']))
+        halo_center_kpc = ds.arr(np.array(center)*proper_box_size, 'kpc')
+        halo_velocity_kms = ds.arr(velocity).in_units('km/s')
+    else:
+        center, velocity = get_halo_center(ds, refine_box_center, method=center_method)
+        halo_center_kpc = ds.arr(np.array(center)*proper_box_size, 'kpc')
+        sphere_region = ds.sphere(halo_center_kpc, (10., 'kpc') )
+        halo_velocity_kms = sphere_region.quantities['BulkVelocity']().in_units('km/s')
+
+    row = [zsnap, halo_center_kpc[0], halo_center_kpc[1], halo_center_kpc[2],
             halo_velocity_kms[0], halo_velocity_kms[1], halo_velocity_kms[2]]
+    append_track_log(log_file, ['redshift', 'xc', 'yc', 'zc', 'xv', 'yv', 'zv'], ds.parameter_filename[-6:], row)
     print(snap[-6:] + ' done')
-    t.put(row)
     '''if (system=='pleiades_cassi'):
         print('Deleting directory from /tmp')
         shutil.rmtree(snap_dir)'''
@@ -228,7 +225,7 @@ if __name__ == "__main__":
             outs.append(output_type + pad + str(i))
     else: outs = [args.output]
 
-    loop_over_halos(args.system, args.nproc, run_dir, trackname, output_dir, outs)
+    loop_over_halos(args.system, args.nproc, run_dir, trackname, output_dir, outs, center_method=args.center_method)
 
     warnings.filterwarnings('default', category=FutureWarning)
     warnings.filterwarnings('default', category=DeprecationWarning)
@@ -1,15 +1,145 @@
 """
 Obtains center position for a halo, and the x,y,z velocity components.
+
+By default, the center is the peak of the gridded dark matter density and the velocity is the mean
+gas velocity within 5 kpc of it. With method='particles', the center is instead found with a
+shrinking sphere on the dark matter and star particles, which are read once from the region around
+the center guess (or from a given data source like the refine box): the center of mass of the
+particles within a sphere is found, the sphere is shrunk around it, and this repeats until few
+particles are left. The velocity is then the mass-weighted velocity of the particles near that
+center. Everything after reading the particles is done on
+NumPy arrays, so no other yt selections or gridded fields are needed.
 """
 from __future__ import print_function
 import numpy as np
+from scipy.spatial import cKDTree
+
+def shrinking_sphere_center(positions, masses, center_guess, radius, shrink_factor=0.9, \
+                            min_particles=1000, min_radius=0., use_tree=False):
+    """
+    Inputs are arrays of particle positions (N x 3) and masses, the starting center
+    and radius (in the same units as the positions), the factor the radius is shrunk
+    by at each step, and the number of particles and radius to stop at. The particles
+    in each sphere are taken from those of the previous sphere when the new sphere lies
+    inside it, and from all the particles otherwise (or, if use_tree is True, always
+    from all the particles with a KD-tree).
+    Outputs the center and a dictionary of convergence diagnostics: the number of
+    iterations, the final radius and number of particles, the shift of the center in
+    the last iteration, and whether that shift is less than 10% of the final radius.
+    """
+
+    center = np.array(center_guess, dtype=float)
+    if use_tree: tree = cKDTree(positions)
+    # the particles of the last sphere, kept as their own arrays so each step only touches those
+    pos_in, mass_in = positions, masses
+    last_center, last_radius = center, np.inf
+    n_iter = 0
+    shift = np.inf
+    while True:
+        if use_tree:
+            inside = tree.query_ball_point(center, radius)
+            pos_in, mass_in = positions[inside], masses[inside]
+        else:
+            # if the center moved far enough that this sphere pokes out of the last one, the last
+            # sphere's particles are missing some of this one's, so start again from all of them
+            if (np.sqrt(np.sum((center - last_center)**2)) + radius > last_radius):
+                pos_in, mass_in = positions, masses
+            inside = np.einsum('ij,ij->i', pos_in - center, pos_in - center) < radius**2
+            pos_in, mass_in = pos_in[inside], mass_in[inside]
+            last_center, last_radius = center, radius
+        if (len(mass_in) == 0): break
+        new_center = np.dot(mass_in, pos_in) / np.sum(mass_in)
+        shift = np.sqrt(np.sum((new_center - center)**2))
+        center = new_center
+        n_iter += 1
+        if (len(mass_in) <= min_particles) or (radius * shrink_factor < min_radius): break
+        radius = radius * shrink_factor
+
+    diagnostics = {'n_iter': n_iter, 'radius': radius, 'n_particles': len(mass_in), \
+                   'shift': shift, 'converged': (shift < 0.1 * radius)}
+
+    return center, diagnostics
+
+def read_center_particles(data_source):
+    """
+    Input is a yt data source (a sphere, or a region like the refine box).
+    Outputs a dictionary of the positions and velocities (N x 3, in code units) and
+    masses (Msun) of its DM (type 1), star (2), and must-refine (4) particles, but not
+    tracers, so the center can be found without reading them again.
+    """
+
+    ptype = np.array(data_source['all', 'particle_type'])
+    use = (ptype == 1) | (ptype == 2) | (ptype == 4)
+    particles = {}
+    particles['position'] = np.transpose([np.array(data_source['all', 'particle_position_' + ax].in_units('code_length'))[use] for ax in 'xyz'])
+    particles['velocity'] = np.transpose([np.array(data_source['all', 'particle_velocity_' + ax].in_units('code_velocity'))[use] for ax in 'xyz'])
+    particles['mass'] = np.array(data_source['all', 'particle_mass'].in_units('Msun'))[use]
+    print("we have read", len(particles['mass']), "particles")
+
+    return particles
+
+def get_particle_center(ds, center_guess, **kwargs):
+    """
+    Inputs are a dataset, and the center_guess (in code units).
+    Keywords are radius (the starting search radius, in kpc), vel_radius (the radius
+    around the center within which the particle velocities are averaged, in kpc),
+    data_source (a yt region like the refine box to read the particles from, instead
+    of a sphere of the search radius), particles (the output of read_center_particles,
+    if the particles have already been read), units ('code' or 'physical'), min_radius
+    (in kpc, default 0.1, about the size of the smallest cells),
+    shrink_factor, min_particles, and use_tree (see shrinking_sphere_center).
+    Outputs center and velocity tuples composed of x,y,z coordinates, and the dictionary
+    of convergence diagnostics (with the final radius and shift in kpc).
+    """
+
+    radius = kwargs.get('radius', 50.)  # search radius in kpc
+    vel_radius = kwargs.get('vel_radius', 5.)
+    units = kwargs.get('units', 'code')
+    kpc_code = float(ds.quan(1., 'kpc').in_units('code_length'))
+
+    particles = kwargs.get('particles', None)
+    if (particles is None):
+        data_source = kwargs.get('data_source', None)
+        if (data_source is None): data_source = ds.sphere(center_guess, (radius, 'kpc'))
+        particles = read_center_particles(data_source)
+    positions, velocities, masses = particles['position'], particles['velocity'], particles['mass']
+
+    center, diagnostics = shrinking_sphere_center(positions, masses, np.array(center_guess, dtype=float), \
+      radius * kpc_code, shrink_factor=kwargs.get('shrink_factor', 0.9), \
+      min_particles=kwargs.get('min_particles', 1000), min_radius=kwargs.get('min_radius', 0.1) * kpc_code, \
+      use_tree=kwargs.get('use_tree', False))
+    diagnostics['radius'] = diagnostics['radius'] / kpc_code
+    diagnostics['shift'] = diagnostics['shift'] / kpc_code
+    print("we have obtained the center after", diagnostics['n_iter'], "iterations")
+
+    near = np.sum((positions - center)**2, axis=1) < (vel_radius * kpc_code)**2
+    if not (np.any(near)): near = np.ones(len(masses), dtype=bool)
+    velocity = np.sum(velocities[near] * masses[near, None], axis=0) / np.sum(masses[near])
+    halo_center = list(center)
+    velocity = list(ds.arr(velocity, 'code_velocity'))
+
+    if (units == 'physical'): # convert to physical units
+        halo_center = list(ds.arr(center, 'code_length').in_units('kpc').v)
+        velocity = list(ds.arr(velocity).in_units('km/s'))
+
+    print('Located the main halo at:', halo_center, velocity)
+
+    return halo_center, velocity, diagnostics
 
 def get_halo_center(ds, center_guess, **kwargs):
     """
     Inputs are a dataset, and the center_guess.
     Outputs center and velocity tuples composed of x,y,z coordinates.
+    Keyword method is 'dm_density' (the default) for the peak of the gridded dark matter
+    density and the mean gas velocity within 5 kpc of it, or 'particles' for the
+    shrinking-sphere particle center and mass-weighted particle velocity of
+    get_particle_center, which takes the same keywords.
     """
 
+    if (kwargs.get('method', 'dm_density') == 'particles'):
+        halo_center, velocity, diagnostics = get_particle_center(ds, center_guess, **kwargs)
+        return halo_center, velocity
+
     radius = kwargs.get('radius', 50.)  # search radius in kpc
     units = kwargs.get('units', 'code')
 
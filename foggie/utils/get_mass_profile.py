@@ -34,6 +34,7 @@ from foggie.utils.get_proper_box_size import get_proper_box_size
 from foggie.utils.get_run_loc_etc import get_run_loc_etc
 from foggie.utils.yt_fields import *
 from foggie.utils.foggie_load import *
+from foggie.utils.snapshot_scheduler import run_snapshots
 
 
 def parse_args():
@@ -90,6 +91,21 @@ def parse_args():
                         'also be calculated.')
     parser.set_defaults(smoothed=False)
 
+    parser.add_argument('--retries', metavar='retries', type=int, action='store', \
+                        help='If running in parallel, how many times do you want to retry a snapshot that fails? Default is 2.')
+    parser.set_defaults(retries=2)
+
+    parser.add_argument('--mem_per_snap', metavar='mem_per_snap', type=float, action='store', \
+                        help='If running in parallel, how much memory (in GB) does one snapshot need? If given, fewer\n' + \
+                        'than nproc snapshots will be run at once if the node does not have enough memory available.\n' + \
+                        'Default is not to limit by memory.')
+    parser.set_defaults(mem_per_snap=0.)
+
+    parser.add_argument('--resume', dest='resume', action='store_true', \
+                        help='Do you want to skip snapshots that were already finished by a previous run that was\n' + \
+                        'interrupted? Default is no, start over with all snapshots.')
+    parser.set_defaults(resume=False)
+
 
     args = parser.parse_args()
     return args
@@ -108,6 +124,22 @@ def set_table_units(table):
         table[key].unit = table_units[key]
     return table
 
+def mass_enclosed(radius, masses, radii):
+    """Returns a list with one array for each array in the list 'masses', giving the total of that mass
+    within each radius in 'radii', i.e. the sum of the mass of all cells or particles with
+    radius <= radii[i]. The cells or particles are sorted by 'radius' once and every enclosed mass is
+    found from the cumulative sum of the sorted masses.
+    """
+
+    order = np.argsort(radius)
+    num_enclosed = np.searchsorted(radius[order], radii, side='right')
+    masses_enc = []
+    for mass in masses:
+        cumulative_mass = np.concatenate(([0.], np.cumsum(mass[order])))
+        masses_enc.append(cumulative_mass[num_enclosed])
+
+    return masses_enc
+
 def calc_masses(ds, snap, zsnap, refine_width_kpc, tablename, ions=True):
     """Computes the mass enclosed in spheres centered on the halo center.
     Takes the dataset for the snapshot 'ds', the name of the snapshot 'snap', the redshfit of the
@@ -118,22 +150,6 @@ def calc_masses(ds, snap, zsnap, refine_width_kpc, tablename, ions=True):
 
     halo_center_kpc = ds.halo_center_kpc
 
-    # Set up table of everything we want
-    # NOTE: Make sure table units are updated when things are added to this table!
-    if (ions):
-        data = Table(names=('redshift', 'snapshot', 'radius', 'total_mass', 'dm_mass', \
-                            'stars_mass', 'young_stars_mass', 'old_stars_mass', 'sfr', 'gas_mass', \
-                            'gas_metal_mass', 'gas_H_mass', 'gas_HI_mass', 'gas_HII_mass', 'gas_CII_mass', \
-                            'gas_CIII_mass', 'gas_CIV_mass', 'gas_OVI_mass', 'gas_OVII_mass', 'gas_MgII_mass', \
-                            'gas_SiII_mass', 'gas_SiIII_mass', 'gas_SiIV_mass', 'gas_NeVIII_mass'), \
-                     dtype=('f8', 'S6', 'f8', 'f8', 'f8', 'f8', 'f8', 'f8', 'f8', 'f8', 'f8', 'f8', \
-                            'f8', 'f8', 'f8', 'f8', 'f8', 'f8', 'f8', 'f8', 'f8', 'f8', 'f8', 'f8'))
-    else:
-        data = Table(names=('redshift', 'snapshot', 'radius', 'total_mass', 'dm_mass', \
-                            'stars_mass', 'young_stars_mass', 'old_stars_mass', 'sfr', 'gas_mass', \
-                            'gas_metal_mass'), \
-                     dtype=('f8', 'S6', 'f8', 'f8', 'f8', 'f8', 'f8', 'f8', 'f8', 'f8', 'f8'))
-
     # Define the radii of the spheres where we want to calculate mass enclosed
     radii = refine_width_kpc * np.logspace(-2,.7,250)
 
@@ -141,74 +157,45 @@ def calc_masses(ds, snap, zsnap, refine_width_kpc, tablename, ions=True):
     print('Beginning calculation for snapshot', snap)
     print('Loading field arrays')
     sphere = ds.sphere(halo_center_kpc, radii[-1])
+    radii = np.asarray(radii)
 
-    gas_mass = sphere['gas','cell_mass'].in_units('Msun').v
-    gas_metal_mass = sphere['gas','metal_mass'].in_units('Msun').v
-    if (ions):
-        gas_H_mass = sphere['gas','H_mass'].in_units('Msun').v
-        gas_HI_mass = sphere['gas','H_p0_mass'].in_units('Msun').v
-        gas_HII_mass = sphere['gas','H_p1_mass'].in_units('Msun').v
-        gas_CII_mass = sphere['gas','C_p1_mass'].in_units('Msun').v
-        gas_CIII_mass = sphere['gas','C_p2_mass'].in_units('Msun').v
-        gas_CIV_mass = sphere['gas','C_p3_mass'].in_units('Msun').v
-        gas_OVI_mass = sphere['gas','O_p5_mass'].in_units('Msun').v
-        gas_OVII_mass = sphere['gas','O_p6_mass'].in_units('Msun').v
-        gas_MgII_mass = sphere['gas','Mg_p1_mass'].in_units('Msun').v
-        gas_SiII_mass = sphere['gas','Si_p1_mass'].in_units('Msun').v
-        gas_SiIII_mass = sphere['gas','Si_p2_mass'].in_units('Msun').v
-        gas_SiIV_mass = sphere['gas','Si_p3_mass'].in_units('Msun').v
-        gas_NeVIII_mass = sphere['gas','Ne_p7_mass'].in_units('Msun').v
-    dm_mass = sphere['dm','particle_mass'].in_units('Msun').v
-    stars_mass = sphere['stars','particle_mass'].in_units('Msun').v
-    young_stars_mass = sphere['young_stars','particle_mass'].in_units('Msun').v
-    old_stars_mass = sphere['old_stars','particle_mass'].in_units('Msun').v
     gas_radius = sphere['gas','radius_corrected'].in_units('kpc').v
     dm_radius = sphere['dm','radius_corrected'].in_units('kpc').v
     stars_radius = sphere['stars','radius_corrected'].in_units('kpc').v
     young_stars_radius = sphere['young_stars','radius_corrected'].in_units('kpc').v
     old_stars_radius = sphere['old_stars','radius_corrected'].in_units('kpc').v
-
-    # Loop over radii
-    for i in range(len(radii)):
-
-        if (i%10==0): print("Computing radius " + str(i) + "/" + str(len(radii)-1) + \
-                            " for snapshot " + snap)
-
-        # Cut the data interior to this radius
-        gas_mass_enc = np.sum(gas_mass[gas_radius <= radii[i]])
-        gas_metal_mass_enc = np.sum(gas_metal_mass[gas_radius <= radii[i]])
-        if (ions):
-            gas_H_mass_enc = np.sum(gas_H_mass[gas_radius <= radii[i]])
-            gas_HI_mass_enc = np.sum(gas_HI_mass[gas_radius <= radii[i]])
-            gas_HII_mass_enc = np.sum(gas_HII_mass[gas_radius <= radii[i]])
-            gas_CII_mass_enc = np.sum(gas_CII_mass[gas_radius <= radii[i]])
-            gas_CIII_mass_enc = np.sum(gas_CIII_mass[gas_radius <= radii[i]])
-            gas_CIV_mass_enc = np.sum(gas_CIV_mass[gas_radius <= radii[i]])
-            gas_OVI_mass_enc = np.sum(gas_OVI_mass[gas_radius <= radii[i]])
-            gas_OVII_mass_enc = np.sum(gas_OVII_mass[gas_radius <= radii[i]])
-            gas_MgII_mass_enc = np.sum(gas_MgII_mass[gas_radius <= radii[i]])
-            gas_SiII_mass_enc = np.sum(gas_SiII_mass[gas_radius <= radii[i]])
-            gas_SiIII_mass_enc = np.sum(gas_SiIII_mass[gas_radius <= radii[i]])
-            gas_SiIV_mass_enc = np.sum(gas_SiIV_mass[gas_radius <= radii[i]])
-            gas_NeVIII_mass_enc = np.sum(gas_NeVIII_mass[gas_radius <= radii[i]])
-        dm_mass_enc = np.sum(dm_mass[dm_radius <= radii[i]])
-        stars_mass_enc = np.sum(stars_mass[stars_radius <= radii[i]])
-        young_stars_mass_enc = np.sum(young_stars_mass[young_stars_radius <= radii[i]])
-        old_stars_mass_enc = np.sum(old_stars_mass[old_stars_radius <= radii[i]])
-        sfr_enc = young_stars_mass_enc/1.e7
-        total_mass_enc = gas_mass_enc + dm_mass_enc + stars_mass_enc
-
-        # Add everything to the table
-        if (ions):
-            data.add_row([zsnap, snap, radii[i], total_mass_enc, dm_mass_enc, stars_mass_enc, \
-                        young_stars_mass_enc, old_stars_mass_enc, sfr_enc, gas_mass_enc, gas_metal_mass_enc, \
-                        gas_H_mass_enc, gas_HI_mass_enc, gas_HII_mass_enc, gas_CII_mass_enc, \
-                        gas_CIII_mass_enc, gas_CIV_mass_enc, gas_OVI_mass_enc, gas_OVII_mass_enc, \
-                        gas_MgII_mass_enc, gas_SiII_mass_enc, gas_SiIII_mass_enc, gas_SiIV_mass_enc, \
-                        gas_NeVIII_mass_enc])
-        else:
-            data.add_row([zsnap, snap, radii[i], total_mass_enc, dm_mass_enc, stars_mass_enc, \
-                        young_stars_mass_enc, old_stars_mass_enc, sfr_enc, gas_mass_enc, gas_metal_mass_enc])
+    gas_fields = [('gas','cell_mass'), ('gas','metal_mass')]
+    if (ions):
+        gas_fields += [('gas','H_mass'), ('gas','H_p0_mass'), ('gas','H_p1_mass'), ('gas','C_p1_mass'), \
+                       ('gas','C_p2_mass'), ('gas','C_p3_mass'), ('gas','O_p5_mass'), ('gas','O_p6_mass'), \
+                       ('gas','Mg_p1_mass'), ('gas','Si_p1_mass'), ('gas','Si_p2_mass'), ('gas','Si_p3_mass'), \
+                       ('gas','Ne_p7_mass')]
+
+    # Sort each type of cell or particle by radius once and find the mass enclosed within every radius
+    # from the cumulative sum, rather than summing over the whole array separately for every radius
+    print('Computing enclosed masses for snapshot ' + snap)
+    gas_masses_enc = mass_enclosed(gas_radius, [sphere[field].in_units('Msun').v for field in gas_fields], radii)
+    dm_mass_enc = mass_enclosed(dm_radius, [sphere['dm','particle_mass'].in_units('Msun').v], radii)[0]
+    stars_mass_enc = mass_enclosed(stars_radius, [sphere['stars','particle_mass'].in_units('Msun').v], radii)[0]
+    young_stars_mass_enc = mass_enclosed(young_stars_radius, [sphere['young_stars','particle_mass'].in_units('Msun').v], radii)[0]
+    old_stars_mass_enc = mass_enclosed(old_stars_radius, [sphere['old_stars','particle_mass'].in_units('Msun').v], radii)[0]
+    gas_mass_enc = gas_masses_enc[0]
+    sfr_enc = young_stars_mass_enc/1.e7
+    total_mass_enc = gas_mass_enc + dm_mass_enc + stars_mass_enc
+
+    # Build the table of everything we want all at once
+    # NOTE: Make sure table units are updated when things are added to this table!
+    names = ['redshift', 'snapshot', 'radius', 'total_mass', 'dm_mass', 'stars_mass', 'young_stars_mass', \
+             'old_stars_mass', 'sfr', 'gas_mass', 'gas_metal_mass']
+    columns = [np.full(len(radii), zsnap), np.full(len(radii), snap, dtype='S6'), radii, total_mass_enc, \
+               dm_mass_enc, stars_mass_enc, young_stars_mass_enc, old_stars_mass_enc, sfr_enc] + gas_masses_enc[:2]
+    if (ions):
+        names += ['gas_H_mass', 'gas_HI_mass', 'gas_HII_mass', 'gas_CII_mass', 'gas_CIII_mass', 'gas_CIV_mass', \
+                  'gas_OVI_mass', 'gas_OVII_mass', 'gas_MgII_mass', 'gas_SiII_mass', 'gas_SiIII_mass', \
+                  'gas_SiIV_mass', 'gas_NeVIII_mass']
+        columns += gas_masses_enc[2:]
+    dtypes = ['f8', 'S6'] + ['f8']*(len(names)-2)
+    data = Table(columns, names=names, dtype=dtypes)
 
     # Save to file
     data = set_table_units(data)
@@ -238,6 +225,9 @@ def load_and_calculate(system, foggie_dir, run_dir, track, halo_c_v_name, snap,
         row = [ds.parameter_filename[-6:], zsnap, ds.current_time.in_units('Myr').v,
                 ds.halo_center_kpc.v[0], ds.halo_center_kpc.v[1], ds.halo_center_kpc.v[2],
                 ds.halo_velocity_kms.v[0], ds.halo_velocity_kms.v[1], ds.halo_velocity_kms.v[2]]
+        # Also saved with the snapshot's masses, so a resumed run can rebuild the smoothed table
+        with open(tablename + '_c_v.txt', 'w') as f:
+            f.write(row[0] + ' ' + ' '.join(['%.17g' % (float(v)) for v in row[1:]]) + '\n')
     else:
         row = []
     queue.put(row)
@@ -322,49 +312,36 @@ if __name__ == "__main__":
     if (args.simple): ions = False
     else: ions = True
 
+    if (args.smoothed):
+        mass_suffix = '_masses_smoothed'
+    else:
+        mass_suffix = '_masses'
+
     # Loop over outputs, for either single-processor or parallel processor computing
-    # Split into a number of groupings equal to the number of processors
-    # and run one process per processor
-    rows = []
-    for i in range(len(outs)//args.nproc):
-        threads = []
-        queue = multi.Queue()
-        for j in range(args.nproc):
-            snap = outs[args.nproc*i+j]
-            if (args.smoothed):
-                tablename = prefix + snap + '_masses_smoothed'
-            else:
-                tablename = prefix + snap + '_masses'
-            threads.append(multi.Process(target=load_and_calculate, \
-		       args=(args.system, foggie_dir, run_dir, trackname, halo_c_v_name, snap, tablename, queue, ions)))
-        for t in threads:
-            t.start()
-        for t in threads:
-            row = queue.get()
-            rows.append(row)
-        for t in threads:
-            t.join()
-    # For any leftover snapshots, run one per processor
-    threads = []
     queue = multi.Queue()
-    for j in range(len(outs)%args.nproc):
-        snap = outs[-(j+1)]
-        if (args.smoothed):
-            tablename = prefix + snap + '_masses_smoothed'
-        else:
-            tablename = prefix + snap + '_masses'
-        threads.append(multi.Process(target=load_and_calculate, \
-		   args=(args.system, foggie_dir, run_dir, trackname, halo_c_v_name, snap, tablename, queue, ions)))
-    for t in threads:
-        t.start()
-    for t in threads:
-        row = queue.get()
-        rows.append(row)
-    for t in threads:
-        t.join()
+    rows = []
+    run_snapshots(load_and_calculate, outs, make_args=lambda snap: (args.system, foggie_dir, run_dir, trackname, \
+      halo_c_v_name, snap, prefix + snap + mass_suffix, queue, ions), nproc=args.nproc, retries=args.retries, \
+      mem_per_snap=args.mem_per_snap, manifest=prefix + 'finished' + mass_suffix + '.txt', resume=args.resume, \
+      tmp_dir='/tmp/' if (args.system=='pleiades_cassi') else None, queue=queue, results=rows)
 
     if (args.smoothed):
+        # Snapshots skipped by --resume didn't send their rows, so read them from where they were saved
+        sent = [row[0] for row in rows]
+        for snap in outs:
+            if (snap in sent): continue
+            row_file = prefix + snap + mass_suffix + '_c_v.txt'
+            if (os.path.exists(row_file)):
+                with open(row_file, 'r') as f:
+                    words = f.read().split()
+                rows.append([words[0]] + [float(w) for w in words[1:]])
+            else:
+                print('No halo center and velocity saved for ' + snap + ', it will be missing from the smoothed table')
+        # A snapshot that was retried may have sent its row more than once
+        names = []
         for row in rows:
+            if (row[0] in names): continue
+            names.append(row[0])
             velocity_table.add_row(row)
         velocity_table.sort('time')
         ascii.write(velocity_table, output_dir + 'halo_centers/halo_00' + args.halo + '/' + args.run + '/smoothed_halo_c_v_' + outs[0] + '_' + outs[-1], format='fixed_width', overwrite=True)
@@ -0,0 +1,161 @@
+"""
+Filename: grid_cache.py
+This file contains the function cached_covering_grid, which is a drop-in replacement for
+ds.covering_grid that saves the fields pulled from the covering grid to disk, so that any later
+analysis of the same snapshot that asks for the same (or a smaller, contained) covering grid reads
+them back instead of building the grid again. It is used by:
+-flux_tracking/accretion.py
+-pressure_support/pressure_support.py
+-turbulence/turbulence.py
+-edges/edge_functions.py
+-utils/tiled_grid.py
+
+Cached grids are saved in
+cache_dir/<snapshot>/level<level>_ng<ghost zones>_<frame>/grid_<start index>_<dims>/<field>.npy
+where <frame> is a hash of the halo center, halo velocity, disk orientation, and enclosed mass
+profile (which the halo-centric and gravity fields depend on) and the start index is the index of the grid's first cell on the grid
+of all cells at that level, so two grids of the same snapshot and level line up cell for cell. A
+field that is not saved for the requested grid is cut out of any saved grid at the same level that
+contains it, unless it is a field that yt computes from neighboring cells.
+"""
+
+from __future__ import print_function
+
+import numpy as np
+import os
+import glob
+import json
+import hashlib
+from yt.fields.derived_field import ValidateSpatial
+
+class CachedCoveringGrid(object):
+    '''Acts like the covering grid ds.covering_grid(level, left_edge, dims, num_ghost_zones), but
+    reads fields from the cache in 'cache_dir' when possible and saves any field it has to compute.
+    The real covering grid is only made if a field is not in the cache, or if any attribute other
+    than a field is asked for. If 'cached_only' is True, asking for a field that is not in the cache
+    raises a KeyError instead of reading it from the covering grid.'''
+
+    def __init__(self, ds, level, left_edge, dims, cache_dir, num_ghost_zones=0, cached_only=False):
+        self.ds = ds
+        self.cached_only = cached_only
+        self.level = level
+        self.num_ghost_zones = num_ghost_zones
+        self._left_edge = left_edge
+        self.ActiveDimensions = np.array(dims, dtype='int64')
+        self._grid = None
+
+        # Index of the first cell on the grid of all cells at this level, found the same way yt does
+        left_edge_code = np.array(ds.arr(left_edge).in_units('code_length'))
+        rdx = np.array(ds.domain_dimensions) * ds.relative_refinement(0, level)
+        dds = np.array(ds.domain_width.in_units('code_length'))/rdx
+        self.start_index = np.rint((left_edge_code - np.array(ds.domain_left_edge.in_units('code_length')))/dds).astype('int64')
+
+        frame = [np.round(np.array(ds.halo_center_kpc.in_units('kpc')), 8).tolist(), \
+                 np.round(np.array(ds.halo_velocity_kms.in_units('km/s')), 8).tolist()]
+        if (hasattr(ds, 'disk_rot_arr')): frame.append(np.round(ds.disk_rot_arr, 10).tolist())
+        # vff, tff, and the gravity fields depend on the enclosed mass profile
+        if (getattr(ds, 'masses_dir', None) is not None): frame.append(str(ds.masses_dir))
+        if (hasattr(ds, 'Menc_profile')):
+            knots = np.concatenate((ds.Menc_profile.get_knots(), ds.Menc_profile.get_coeffs()))
+            frame.append(hashlib.sha1(np.ascontiguousarray(knots, dtype='float64').tobytes()).hexdigest())
+        frame_hash = hashlib.sha1(json.dumps(frame).encode('utf-8')).hexdigest()[:12]
+        self.level_dir = os.path.join(cache_dir, os.path.basename(ds.parameter_filename), \
+          'level%d_ng%d_%s' % (level, num_ghost_zones, frame_hash))
+        self.grid_dir = os.path.join(self.level_dir, grid_dir_name(self.start_index, self.ActiveDimensions))
+
+    def _get_grid(self):
+        if (self._grid is None):
+            self._grid = self.ds.covering_grid(level=self.level, left_edge=self._left_edge, \
+              dims=self.ActiveDimensions, num_ghost_zones=self.num_ghost_zones)
+        return self._grid
+
+    def __getattr__(self, name):
+        # Anything that isn't a field comes from the real covering grid
+        if (name.startswith('__')) or (name=='_grid'):
+            raise AttributeError(name)
+        return getattr(self._get_grid(), name)
+
+    def __getitem__(self, field):
+        finfo = self.ds._get_field_info(field)
+        ftype, fname = finfo.name
+        spatial = any([isinstance(v, ValidateSpatial) for v in finfo.validators])
+
+        values, units = read_cached_field(self.grid_dir, ftype, fname)
+        if (values is None) and (not spatial):
+            # Look for a saved grid at the same level that contains this one
+            for other_dir in glob.glob(os.path.join(self.level_dir, 'grid_*')):
+                if (other_dir==self.grid_dir): continue
+                other_start, other_dims = parse_grid_dir_name(other_dir)
+                offset = self.start_index - other_start
+                if (np.any(offset < 0)) or (np.any(offset + self.ActiveDimensions > other_dims)): continue
+                values, units = read_cached_field(other_dir, ftype, fname)
+                if (values is not None):
+                    values = values[offset[0]:offset[0]+self.ActiveDimensions[0], \
+                                    offset[1]:offset[1]+self.ActiveDimensions[1], \
+                                    offset[2]:offset[2]+self.ActiveDimensions[2]]
+                    break
+        if (values is None) and (self.cached_only):
+            raise KeyError('%s is not in the covering grid cache %s, and this grid was set to only read '
+                           'cached fields' % (str((ftype, fname)), self.grid_dir))
+        if (values is None):
+            data = self._get_grid()[field]
+            save_cached_field(self.grid_dir, ftype, fname, data)
+            return data
+
+        return self.ds.arr(values, units)
+
+def grid_dir_name(start_index, dims):
+    '''Returns the name of the cache directory of the grid with first cell 'start_index' and shape 'dims'.'''
+
+    return 'grid_%d_%d_%d_%d_%d_%d' % (tuple(start_index) + tuple(dims))
+
+def parse_grid_dir_name(grid_dir):
+    '''Returns the start index and dimensions of the grid saved in the cache directory 'grid_dir'.'''
+
+    numbers = np.array(os.path.basename(grid_dir).split('_')[1:], dtype='int64')
+    return numbers[:3], numbers[3:]
+
+def read_cached_field(grid_dir, ftype, fname):
+    '''Returns the memory-mapped values and the units of the field (ftype, fname) saved in 'grid_dir',
+    or None, None if it isn't saved there.'''
+
+    filename = os.path.join(grid_dir, ftype + '-' + fname + '.npy')
+    units_file = os.path.join(grid_dir, ftype + '-' + fname + '.units')
+    if not (os.path.exists(filename)) or not (os.path.exists(units_file)):
+        return None, None
+    with open(units_file, 'r') as f:
+        units = f.read().strip()
+    if (units=='dimensionless'): units = ''
+
+    return np.load(filename, mmap_mode='r'), units
+
+def save_cached_field(grid_dir, ftype, fname, data):
+    '''Saves the values of the field (ftype, fname) from the covering grid, 'data', to 'grid_dir'.'''
+
+    try:
+        if not (os.path.exists(grid_dir)): os.makedirs(grid_dir, exist_ok=True)
+        # Write to a temporary name then rename, so another process never reads a partial field
+        base = os.path.join(grid_dir, ftype + '-' + fname)
+        pid = str(os.getpid())
+        np.save(base + '.tmp' + pid + '.npy', np.asarray(data.v))
+        os.replace(base + '.tmp' + pid + '.npy', base + '.npy')
+        with open(base + '.units.tmp' + pid, 'w') as f:
+            f.write(str(data.units))
+        os.replace(base + '.units.tmp' + pid, base + '.units')
+    except OSError:
+        print('Could not save %s to covering grid cache %s' % (str((ftype, fname)), grid_dir))
+
+def cached_covering_grid(ds, level, left_edge, dims, cache_dir=None, num_ghost_zones=0, cached_only=False):
+    '''Returns the covering grid of 'ds' at refinement level 'level' with left edge 'left_edge' and
+    number of cells 'dims', like ds.covering_grid. If 'cache_dir' is a directory name, fields taken
+    from the covering grid are saved there and read back by any later call on the same snapshot and
+    halo center with a grid that is the same or contained in it. If 'cache_dir' is None or 'none',
+    this just returns ds.covering_grid. If 'cached_only' is True, fields that are not already in the
+    cache raise a KeyError instead of being read from the whole covering grid (for grids that were
+    made in tiles because they don't fit in memory).'''
+
+    if (cache_dir is None) or (cache_dir=='none'):
+        return ds.covering_grid(level=level, left_edge=left_edge, dims=dims, num_ghost_zones=num_ghost_zones)
+
+    return CachedCoveringGrid(ds, level, left_edge, dims, cache_dir, num_ghost_zones=num_ghost_zones, \
+                              cached_only=cached_only)
@@ -0,0 +1,221 @@
+"""
+Filename: halo_catalog.py
+This file contains functions for looking up per-snapshot values from the halo_infos catalogs
+(halo_c_v, halo_cen_smoothed, masses_z-gtr-2.hdf5, masses_z-less-2.hdf5, and rvir_masses.hdf5)
+without re-reading and searching the whole catalog for every snapshot. It is used by:
+-utils/foggie_load.py
+-flux_tracking/flux_tracking.py
+-flux_tracking/accretion.py
+-radial_quantities/stats_in_shells.py
+-radial_quantities/totals_in_shells.py
+-pressure_support/pressure_support.py
+
+The first time a catalog is used, it is parsed once and saved as a set of .npy files in a
+catalog_index directory in the user's cache directory (~/.cache/foggie/catalog_index, or the directory
+given by the FOGGIE_CATALOG_INDEX environment variable), not in the source tree, sorted so that the rows belonging to each snapshot are
+contiguous. Later lookups (in this or any other process) memory-map these files and find a snapshot's
+rows from a dictionary of snapshot name to row range, so processes running different snapshots share
+one read-only copy of the catalog. The index is rebuilt automatically if the catalog file is newer
+or the index was saved by an older version of this file.
+"""
+
+from __future__ import print_function
+
+import numpy as np
+import os
+import json
+import hashlib
+from astropy.table import Table
+
+# Catalogs already opened by this process, keyed by catalog file name
+_opened = {}
+# Version of the saved index format, increased whenever the way catalogs are parsed changes so that
+# indexes saved by older versions are rebuilt
+_index_version = 2
+
+def _index_dir():
+    '''Returns the directory where catalog indexes are saved: $FOGGIE_CATALOG_INDEX if it is set,
+    otherwise foggie/catalog_index in the user's cache directory ($XDG_CACHE_HOME or ~/.cache).'''
+
+    if ('FOGGIE_CATALOG_INDEX' in os.environ):
+        return os.environ['FOGGIE_CATALOG_INDEX']
+    cache_home = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(cache_home, 'foggie', 'catalog_index')
+
+def _index_base(catalog_file):
+    '''Returns the start of the names of the index files of 'catalog_file', which include a hash of its
+    full path so catalogs with the same name in different directories don't share an index.'''
+
+    path = os.path.abspath(catalog_file)
+    path_hash = hashlib.sha1(path.encode('utf-8')).hexdigest()[:12]
+    return os.path.join(_index_dir(), os.path.basename(catalog_file) + '_' + path_hash)
+
+def _index_is_current(catalog_file):
+    '''Returns True if the saved index of 'catalog_file' exists, is newer than the catalog, and was
+    saved with the current index version.'''
+
+    info_file = _index_base(catalog_file) + '_info.json'
+    if not (os.path.exists(info_file)) or (os.path.getmtime(info_file) < os.path.getmtime(catalog_file)):
+        return False
+    try:
+        with open(info_file, 'r') as f:
+            return json.load(f).get('version', 1)==_index_version
+    except (OSError, ValueError):
+        return False
+
+def _save_index(catalog_file, names, columns, data):
+    '''Saves the index of 'catalog_file', made of the snapshot name of each row 'names', the list of
+    column names 'columns', and the 2D array 'data' with one column for each of 'columns', sorted
+    so that the rows of each snapshot are contiguous. Returns the sorted names and data.'''
+
+    order = np.argsort(names, kind='stable')
+    names = names[order]
+    data = data[order]
+    index_dir = _index_dir()
+    base = _index_base(catalog_file)
+    try:
+        if not (os.path.exists(index_dir)): os.makedirs(index_dir, exist_ok=True)
+        # Write to temporary files then rename, so another process never reads a partial index
+        pid = str(os.getpid())
+        np.save(base + '_data.tmp' + pid + '.npy', data)
+        os.replace(base + '_data.tmp' + pid + '.npy', base + '_data.npy')
+        np.save(base + '_names.tmp' + pid + '.npy', names.astype('U'))
+        os.replace(base + '_names.tmp' + pid + '.npy', base + '_names.npy')
+        with open(base + '_info.json.tmp' + pid, 'w') as f:
+            json.dump({'columns': columns, 'version': _index_version}, f)
+        os.replace(base + '_info.json.tmp' + pid, base + '_info.json')
+    except OSError:
+        print('Could not save catalog index for ' + catalog_file + ', using it from memory only')
+
+    return names, data
+
+def _to_float(value):
+    '''Returns 'value' as a float, or NaN if it isn't a number (like a column name or an empty entry).'''
+
+    if (np.ma.is_masked(value)): return np.nan
+    try:
+        return float(value)
+    except (ValueError, TypeError):
+        return np.nan
+
+def _parse_catalog(catalog_file):
+    '''Reads 'catalog_file' and returns the snapshot name of each row, the list of numeric column
+    names, and a 2D array of the numeric columns.'''
+
+    if (catalog_file.endswith('.hdf5')):
+        table = Table.read(catalog_file, path='all_data')
+        names = np.array(table['snapshot']).astype('U')
+        columns = [col for col in table.colnames if (col!='snapshot') and (table[col].dtype.kind in 'fiu')]
+        data = np.column_stack([np.array(table[col], dtype=float) for col in columns])
+    else:
+        # halo_c_v-style ascii tables are read the same way foggie_load always read them, which
+        # names the columns col1, col2, ...
+        table = Table.read(catalog_file, format='ascii')
+        if ('smoothed' in catalog_file):
+            name_col = 'col2'
+        else:
+            name_col = 'col3'
+        # The header line of the catalog is read as a row too, so only the rows with numbers in them
+        # are kept, and of those columns only the ones that are numbers in every kept row
+        other_cols = [col for col in table.colnames if (col!=name_col)]
+        values = np.array([[_to_float(value) for value in table[col]] for col in other_cols], dtype=float)
+        is_data = np.any(np.isfinite(values), axis=0)
+        values = values[:, is_data]
+        names = np.array(table[name_col])[is_data].astype('U')
+        is_numeric = np.all(np.isfinite(values), axis=1)
+        columns = [col for col, numeric in zip(other_cols, is_numeric) if (numeric)]
+        data = values[is_numeric].T
+
+    return names, columns, data
+
+def open_catalog(catalog_file):
+    '''Returns the catalog in 'catalog_file' as a dictionary with entries:
+    'columns': a dictionary of column name to column number in 'data'
+    'data': a read-only 2D array of the numeric columns of the catalog, memory-mapped if possible
+    'rows': a dictionary of snapshot name to the (start, end) range of its rows in 'data'
+    The catalog is indexed the first time it is used, and is only opened once per process.'''
+
+    mtime = os.path.getmtime(catalog_file)
+    if (catalog_file in _opened) and (_opened[catalog_file]['mtime']==mtime):
+        return _opened[catalog_file]
+
+    base = _index_base(catalog_file)
+    if (_index_is_current(catalog_file)):
+        with open(base + '_info.json', 'r') as f:
+            columns = json.load(f)['columns']
+        names = np.load(base + '_names.npy')
+        data = np.load(base + '_data.npy', mmap_mode='r')
+    else:
+        print('Indexing catalog ' + catalog_file)
+        names, columns, data = _parse_catalog(catalog_file)
+        names, data = _save_index(catalog_file, names, columns, data)
+
+    unique_names, starts, counts = np.unique(names, return_index=True, return_counts=True)
+    catalog = {'columns': dict(zip(columns, range(len(columns)))),
+               'data': data,
+               'rows': dict(zip(unique_names, zip(starts, starts + counts))),
+               'mtime': mtime}
+    _opened[catalog_file] = catalog
+
+    return catalog
+
+def lookup(catalog_file, snap, column):
+    '''Returns the values of the column named 'column' in the rows of the catalog 'catalog_file' that
+    belong to the snapshot 'snap', or None if the snapshot is not in the catalog.'''
+
+    catalog = open_catalog(catalog_file)
+    snap = snap[-6:]
+    if (snap not in catalog['rows']):
+        return None
+    start, end = catalog['rows'][snap]
+    return catalog['data'][start:end, catalog['columns'][column]]
+
+def lookup_halo_c_v(halo_c_v_name, snap):
+    '''Returns the halo center in kpc and the halo velocity in km/s of the snapshot 'snap' from the
+    halo_c_v file 'halo_c_v_name', or None, None if the snapshot is not in the file. Smoothed halo
+    center files (with 'smoothed' in their name) do not have velocities, so the velocity returned is None.'''
+
+    if ('smoothed' in halo_c_v_name):
+        center_cols, velocity_cols = ['col5', 'col6', 'col7'], None
+    else:
+        center_cols, velocity_cols = ['col4', 'col5', 'col6'], ['col7', 'col8', 'col9']
+    center = [lookup(halo_c_v_name, snap, col) for col in center_cols]
+    if (center[0] is None):
+        return None, None
+    center = np.array([c[0] for c in center])
+    if (velocity_cols is None):
+        return center, None
+    velocity = np.array([lookup(halo_c_v_name, snap, col)[0] for col in velocity_cols])
+
+    return center, velocity
+
+def masses_file(masses_dir, zsnap):
+    '''Returns the name of the enclosed mass table in 'masses_dir' that covers redshift 'zsnap'.'''
+
+    if (zsnap > 2.):
+        return masses_dir + 'masses_z-gtr-2.hdf5'
+    else:
+        return masses_dir + 'masses_z-less-2.hdf5'
+
+def lookup_masses(masses_dir, snap, zsnap, column='total_mass'):
+    '''Returns the radii (in kpc) and the enclosed mass in the column 'column' of the enclosed mass
+    profile of the snapshot 'snap' at redshift 'zsnap', from the mass tables in 'masses_dir'.
+    These are the knots for building an enclosed mass interpolation.'''
+
+    filename = masses_file(masses_dir, zsnap)
+    radius = lookup(filename, snap, 'radius')
+    if (radius is None):
+        return np.array([]), np.array([])
+    return np.array(radius), np.array(lookup(filename, snap, column))
+
+def lookup_rvir(masses_dir, snap):
+    '''Returns the virial radius (in kpc) and virial mass (in Msun) of the snapshot 'snap' from the
+    rvir_masses.hdf5 table in 'masses_dir'. Raises a KeyError if the snapshot is not in the table.'''
+
+    filename = masses_dir + 'rvir_masses.hdf5'
+    Rvir = lookup(filename, snap, 'radius')
+    Mvir = lookup(filename, snap, 'total_mass')
+    if (Rvir is None) or (len(Rvir)==0):
+        raise KeyError('Snapshot ' + snap + ' is not in ' + filename)
+
+    return Rvir[0], Mvir[0]
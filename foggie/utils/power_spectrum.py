@@ -0,0 +1,146 @@
+"""
+Filename: power_spectrum.py
+This file contains functions for finding the spherically-binned power spectrum of real fields on a
+uniform grid, like the turbulent kinetic energy spectrum of a covering grid. It is used by:
+-turbulence/turbulence.py
+-pressure_support/pressure_support.py
+
+The fields are transformed with real-input FFTs from scipy.fft (rfftn), which only compute the half
+of Fourier space with non-negative frequencies along the last axis; the other half is the complex
+conjugate of this half for a real field, so each mode that stands in for its conjugate is counted
+twice (the Hermitian weights). The FFTs can use several threads with 'workers'. The power in all
+modes is binned by the magnitude of the wavenumber with a single np.bincount.
+
+The power is normalized so that the sum over all modes is the mean of the square of the field, so
+the power in a wavenumber bin does not depend on the size of the grid it was found from. That lets
+the spectrum of a grid that is too big for one FFT, or that is not periodic (like a box cut out of
+the simulation around a halo), be found by averaging the spectra of overlapping tiles of the grid,
+each multiplied by a window that goes to zero at the tile's edges (Welch's method).
+"""
+
+from __future__ import print_function
+
+import numpy as np
+import scipy.fft
+
+def hermitian_weights(n_last):
+    '''Returns the weight of each mode along the last axis of an rfftn of a field with 'n_last' cells
+    along that axis: 1 for the zero frequency (and the Nyquist frequency if 'n_last' is even), which
+    are their own conjugates, and 2 for the rest, which stand in for their conjugates too.'''
+
+    weights = np.full(n_last//2 + 1, 2.)
+    weights[0] = 1.
+    if (n_last % 2 == 0): weights[-1] = 1.
+
+    return weights
+
+def rfft_wavenumbers(shape, box_size):
+    '''Returns the magnitude of the wavenumber (in inverse units of 'box_size', without a factor of 2pi)
+    of each mode of an rfftn of a field of shape 'shape' that spans a physical size 'box_size', which
+    is a list of the size along each axis.'''
+
+    kx = np.fft.fftfreq(shape[0]) * shape[0]/box_size[0]
+    ky = np.fft.fftfreq(shape[1]) * shape[1]/box_size[1]
+    kz = np.fft.rfftfreq(shape[2]) * shape[2]/box_size[2]
+
+    return np.sqrt(kx[:,None,None]**2. + ky[None,:,None]**2. + kz[None,None,:]**2.)
+
+def window_3d(shape, window='hann'):
+    '''Returns a 3D window of shape 'shape' that is the product of a 1D window along each axis.
+    'window' can be 'hann' or 'tukey' (flat in the middle half and cosine-tapered at the edges).'''
+
+    windows = []
+    for n in shape:
+        x = (np.arange(n) + 0.5)/n
+        if (window=='hann'):
+            w = np.sin(np.pi*x)**2.
+        elif (window=='tukey'):
+            w = np.ones(n)
+            edge = np.abs(x - 0.5) > 0.25
+            w[edge] = 0.5*(1. + np.cos(np.pi*(np.abs(x[edge] - 0.5) - 0.25)/0.25))
+        else:
+            raise ValueError('Unknown window ' + str(window))
+        windows.append(w)
+
+    return windows[0][:,None,None] * windows[1][None,:,None] * windows[2][None,None,:]
+
+def rfft_power(field, window=None, workers=-1):
+    '''Returns the power in each mode of the real 3D array 'field', already multiplied by the Hermitian
+    weights, normalized so the sum over all modes is the mean of the square of 'field' (times the
+    window, divided by the mean square of the window, if 'window' is an array the shape of 'field').
+    'workers' is the number of threads the FFT can use (-1 for all available).'''
+
+    n_cells = field.size
+    if (window is not None):
+        field = field*window
+        norm = n_cells**2. * np.mean(window**2.)
+    else:
+        norm = n_cells**2.
+    ft = scipy.fft.rfftn(field, workers=workers)
+    power = (ft.real**2. + ft.imag**2.)/norm
+    power *= hermitian_weights(field.shape[2])[None,None,:]
+
+    return power
+
+def tile_starts(n, tile_size):
+    '''Returns the first index of each tile of 'tile_size' cells along an axis of 'n' cells, where
+    neighboring tiles overlap by half and the last tile ends at the end of the axis.'''
+
+    if (tile_size >= n): return np.array([0])
+    starts = np.arange(0, n - tile_size + 1, max(tile_size//2, 1))
+    if (starts[-1] != n - tile_size): starts = np.append(starts, n - tile_size)
+
+    return starts
+
+def radial_power_spectrum(get_fields, dims, box_size, kbins, tile_size=0, window='hann', workers=-1):
+    '''Returns the total power of the fields returned by 'get_fields' in each wavenumber bin between
+    the edges 'kbins', and the number of modes in each bin. 'get_fields' is a function that takes a
+    tuple of three slices and returns a list of real arrays (for example, the three components of
+    velocity) for that part of the grid; their power is summed. 'dims' is the number of cells of the
+    whole grid along each axis and 'box_size' its physical size along each axis.
+
+    If 'tile_size' is 0, the whole grid is transformed at once, treating it as periodic with no window.
+    Otherwise, the spectrum is the average of the spectra of cubic tiles of 'tile_size' cells that
+    overlap by half, each multiplied by 'window' ('hann' or 'tukey', or None for no window). This needs
+    memory for only one tile at a time (as long as 'get_fields' only makes that part of the grid), and with a window it does not assume the grid is periodic, but
+    it cannot measure wavelengths longer than a tile, so bins below the tile's smallest wavenumber are
+    returned as NaN.'''
+
+    dims = np.array(dims, dtype=int)
+    box_size = np.array(box_size, dtype=float)
+    n_bins = len(kbins) - 1
+    if (tile_size <= 0) or (tile_size >= np.min(dims)):
+        tile_shape = dims
+        window = None
+        starts = [np.array([0])]*3
+    else:
+        tile_shape = np.array([tile_size]*3)
+        starts = [tile_starts(dims[i], tile_size) for i in range(3)]
+    tile_box_size = box_size*tile_shape/dims
+
+    # The wavenumbers and bin of each mode are the same for every tile
+    k = rfft_wavenumbers(tile_shape, tile_box_size)
+    which_bin = np.searchsorted(kbins, k.ravel(), side='right') - 1
+    in_bins = (which_bin >= 0) & (which_bin < n_bins)
+    which_bin = which_bin[in_bins]
+    n_modes = np.bincount(which_bin, minlength=n_bins)
+    if (window is not None):
+        window = window_3d(tile_shape, window=window)
+
+    spectrum = np.zeros(n_bins)
+    n_tiles = 0
+    for i in starts[0]:
+        for j in starts[1]:
+            for l in starts[2]:
+                slices = (slice(i, i+tile_shape[0]), slice(j, j+tile_shape[1]), slice(l, l+tile_shape[2]))
+                power = np.zeros(k.shape)
+                for field in get_fields(slices):
+                    power += rfft_power(np.asarray(field, dtype=float), window=window, workers=workers)
+                spectrum += np.bincount(which_bin, weights=power.ravel()[in_bins], minlength=n_bins)
+                n_tiles += 1
+    spectrum /= n_tiles
+
+    # Bins too long-wavelength for the tiles have no modes
+    spectrum[n_modes==0] = np.nan
+
+    return spectrum, n_modes
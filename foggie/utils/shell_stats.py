@@ -0,0 +1,191 @@
+"""
+Filename: shell_stats.py
+This file contains functions that compute weighted statistics (sums, means, standard deviations,
+quantiles, and PDFs) of many fields within many radial shells at once. It is used by:
+-radial_quantities/stats_in_shells.py
+-radial_quantities/totals_in_shells.py
+-pressure_support/pressure_support.py
+
+Rather than building a boolean mask for every shell and sorting every field separately within every
+shell, each cell is assigned to its shell once, each field is sorted once by (shell, value), and all
+per-shell quantities are then found with segmented sums over the sorted arrays.
+"""
+
+from __future__ import print_function
+
+import numpy as np
+
+from foggie.utils.analysis_utils import bin_index
+
+def shell_index(radius, edges, include_inner=False):
+    '''Returns an integer array of the same size as 'radius' giving the index of the shell defined by
+    the sorted array 'edges' that each cell is in, or -1 if it is not in any shell. If 'include_inner'
+    is False, shells are open intervals, i.e. edges[i] < radius < edges[i+1], and if it is True, shells
+    include their inner edge, i.e. edges[i] <= radius < edges[i+1].'''
+
+    radius = np.asarray(radius).ravel()
+    if (not include_inner):
+        return bin_index(radius, edges)
+
+    edges = np.asarray(edges)
+    index = np.searchsorted(edges, radius, side='right') - 1
+    index[(index < 0) | (index >= len(edges)-1)] = -1
+
+    return index
+
+def shell_sums(index, values, num_shells):
+    '''Returns an array of length 'num_shells' giving the sum of 'values' in each shell, where 'index'
+    is the shell index of each value as returned by shell_index. Values with an index of -1 are ignored.'''
+
+    good = (index >= 0)
+    return np.bincount(index[good], weights=values[good], minlength=num_shells)[:num_shells]
+
+def shell_avg_and_std(index, values, weights, num_shells):
+    '''Returns the weighted average and standard deviation of 'values' in each of the 'num_shells'
+    shells given by 'index'. Shells that contain no cells are given an average and standard deviation
+    of zero.'''
+
+    good = (index >= 0)
+    index = index[good]
+    values = values[good]
+    weights = weights[good]
+    weight_sums = np.bincount(index, weights=weights, minlength=num_shells)[:num_shells]
+    filled = (np.bincount(index, minlength=num_shells)[:num_shells] > 0)
+    avg = np.zeros(num_shells)
+    std = np.zeros(num_shells)
+    avg[filled] = np.bincount(index, weights=values*weights, minlength=num_shells)[:num_shells][filled]/weight_sums[filled]
+    variance = np.bincount(index, weights=(values-avg[index])**2.*weights, minlength=num_shells)[:num_shells]
+    std[filled] = np.sqrt(variance[filled]/weight_sums[filled])
+
+    return avg, std
+
+def sort_by_shell(index, values):
+    '''Returns the array of indices that sorts the cells first by the shell index 'index' and then by
+    'values' within each shell. Cells with an index of -1 are left out. The result can be passed as the
+    'order' argument of shell_quantiles, and remains sorted if it is cut down to any subset of cells,
+    so one sort of a field can be shared by many different selections of cells.'''
+
+    good = np.where(index >= 0)[0]
+    return good[np.lexsort((values[good], index[good]))]
+
+def shell_quantiles(index, values, weights, num_shells, quantiles, order=None):
+    '''Returns an array of shape (num_shells, len(quantiles)) giving the weighted 'quantiles' (in [0,1])
+    of 'values' within each of the 'num_shells' shells given by 'index'. This gives the same result as
+    calling weighted_quantile separately on the cells in each shell. If 'order' is given, it must be
+    an array of cell indices sorted by (shell, value), as returned by sort_by_shell (or a subset of it),
+    and only those cells are used. Shells that contain no cells are given quantiles of zero, and shells
+    whose weights are all zero are given quantiles of NaN, as weighted_quantile gives.'''
+
+    quantiles = np.atleast_1d(quantiles)
+    if (order is None):
+        order = sort_by_shell(index, values)
+    index = index[order]
+    values = values[order]
+    weights = weights[order]
+
+    # Cumulative weight within each shell, found from one cumulative sum over all shells
+    counts = np.bincount(index, minlength=num_shells)[:num_shells]
+    ends = np.cumsum(counts)
+    starts = ends - counts
+    cum_weights = np.concatenate(([0.], np.cumsum(weights)))
+    offsets = cum_weights[starts]
+    totals = cum_weights[ends] - offsets
+    filled = np.where(counts > 0)[0]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weighted_quantiles = (cum_weights[1:] - offsets[index] - 0.5*weights)/totals[index]
+    # Shells with no weight would get NaN keys, which break the sorted search for every later shell,
+    # so they're given keys of zero here and quantiles of NaN below
+    weighted_quantiles[totals[index] == 0.] = 0.
+
+    # Shell index + weighted quantile increases monotonically through the sorted cells, so the
+    # position of every requested quantile in every shell can be found with one search
+    key = index + weighted_quantiles
+    target = filled[:,np.newaxis] + quantiles[np.newaxis,:]
+    upper = np.searchsorted(key, target, side='right')
+    lower = upper - 1
+    first = starts[filled][:,np.newaxis]
+    last = ends[filled][:,np.newaxis] - 1
+    below = (lower < first)
+    above = (upper > last)
+    lower = np.clip(lower, first, last)
+    upper = np.clip(upper, first, last)
+    x_lower = weighted_quantiles[lower]
+    x_upper = weighted_quantiles[upper]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        frac = np.where(x_upper > x_lower, (quantiles[np.newaxis,:] - x_lower)/(x_upper - x_lower), 0.)
+    result_filled = values[lower] + frac*(values[upper] - values[lower])
+    result_filled = np.where(below, values[first], result_filled)
+    result_filled = np.where(above, values[last], result_filled)
+
+    # With no weight in a shell, its weighted quantiles are undefined
+    result_filled[totals[filled] == 0.] = np.nan
+
+    result = np.zeros((num_shells, len(quantiles)))
+    result[filled] = result_filled
+
+    return result
+
+def shell_pdfs(index, values, weights, num_shells, bins, range, density=True):
+    '''Returns an array of shape (num_shells, bins) giving the weighted histogram of 'values' within
+    each of the 'num_shells' shells given by 'index', with 'bins' equal-size bins spanning 'range',
+    and the array of bin edges. If 'density' is True, each shell's histogram is normalized the same way
+    as np.histogram(..., density=True). Shells that contain no cells are given histograms of zero.'''
+
+    bin_edges = np.linspace(range[0], range[1], bins+1)
+    good = (index >= 0) & (values >= range[0]) & (values <= range[1])
+    good_values = values[good]
+    value_bin = ((good_values - range[0])*(bins/(range[1] - range[0]))).astype(int)
+    value_bin[value_bin==bins] = bins-1
+    # Correct for round-off in the bin position, the same way np.histogram does
+    value_bin[good_values < bin_edges[value_bin]] -= 1
+    value_bin[(good_values >= bin_edges[value_bin+1]) & (value_bin != bins-1)] += 1
+    hist = np.bincount(index[good]*bins + value_bin, weights=weights[good], \
+      minlength=num_shells*bins)[:num_shells*bins].reshape(num_shells, bins)
+
+    if (density):
+        filled = (np.bincount(index[index >= 0], minlength=num_shells)[:num_shells] > 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            hist[filled] = hist[filled]/np.diff(bin_edges)[np.newaxis,:]/np.sum(hist[filled], axis=1)[:,np.newaxis]
+
+    return hist, bin_edges
+
+def shell_statistics(index, num_shells, weights, fields, quantiles=[0.25,0.5,0.75], pdf_ranges=None, pdf_bins=200):
+    '''Computes weighted statistics of every field in the list 'fields' within each of the 'num_shells'
+    shells given by 'index' (as returned by shell_index), weighted by 'weights'. Returns a dictionary
+    with the following entries:
+    'count': number of cells in each shell, shape (num_shells)
+    'weight': sum of the weights in each shell, shape (num_shells)
+    'sum': weighted sum of each field in each shell, shape (len(fields), num_shells)
+    'avg', 'std': weighted average and standard deviation, shape (len(fields), num_shells)
+    'quantiles': weighted quantiles, shape (len(fields), num_shells, len(quantiles))
+    and, if 'pdf_ranges' is given as a list of [min, max] for each field,
+    'pdf': density-normalized weighted histograms with 'pdf_bins' bins, shape (len(fields), num_shells, pdf_bins)
+    'pdf_edges': the bin edges of the histograms of each field, shape (len(fields), pdf_bins+1)
+    Shells that contain no cells are given values of zero for everything.'''
+
+    index = np.asarray(index).ravel()
+    weights = np.asarray(weights).ravel()
+    stats = {}
+    stats['count'] = np.bincount(index[index >= 0], minlength=num_shells)[:num_shells]
+    stats['weight'] = shell_sums(index, weights, num_shells)
+    sums, avgs, stds, quants, pdfs, pdf_edges = [], [], [], [], [], []
+    for i in range(len(fields)):
+        field = np.asarray(fields[i]).ravel()
+        sums.append(shell_sums(index, field*weights, num_shells))
+        avg, std = shell_avg_and_std(index, field, weights, num_shells)
+        avgs.append(avg)
+        stds.append(std)
+        quants.append(shell_quantiles(index, field, weights, num_shells, quantiles))
+        if (pdf_ranges is not None):
+            hist, bin_edges = shell_pdfs(index, field, weights, num_shells, pdf_bins, pdf_ranges[i])
+            pdfs.append(hist)
+            pdf_edges.append(bin_edges)
+    stats['sum'] = np.array(sums)
+    stats['avg'] = np.array(avgs)
+    stats['std'] = np.array(stds)
+    stats['quantiles'] = np.array(quants)
+    if (pdf_ranges is not None):
+        stats['pdf'] = np.array(pdfs)
+        stats['pdf_edges'] = np.array(pdf_edges)
+
+    return stats
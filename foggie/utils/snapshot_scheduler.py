@@ -0,0 +1,189 @@
+"""
+Filename: snapshot_scheduler.py
+This file contains the function run_snapshots, which runs an analysis function over a list of
+snapshots in parallel. It is used by:
+-flux_tracking/flux_tracking.py
+-flux_tracking/accretion.py
+-radial_quantities/stats_in_shells.py
+-radial_quantities/totals_in_shells.py
+-radial_quantities/radial_profiles.py
+-utils/get_mass_profile.py
+-utils/get_halo_c_v_parallel.py
+
+Snapshots are taken from a queue and a new process is started as soon as any running one finishes,
+so one slow snapshot does not hold up the others. Snapshots whose process fails (exits with an error
+or is killed) are put back on the queue and retried, and every snapshot that finishes is recorded
+in an on-disk manifest so an interrupted run can be resumed where it stopped.
+"""
+
+from __future__ import print_function
+
+import os
+import time
+import shutil
+import datetime
+import multiprocessing as multi
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+
+def read_manifest(manifest):
+    '''Returns the list of snapshots recorded as finished in the manifest file 'manifest', or an
+    empty list if the file does not exist.'''
+
+    if (manifest is None) or (not os.path.exists(manifest)):
+        return []
+    with open(manifest, 'r') as f:
+        return [line.strip() for line in f if line.strip()!='']
+
+def add_to_manifest(manifest, snap):
+    '''Records the snapshot 'snap' as finished in the manifest file 'manifest'.'''
+
+    if (manifest is None): return
+    with open(manifest, 'a') as f:
+        f.write(snap + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+def drain_queue(queue, results, timeout=0.1):
+    '''Moves everything currently waiting on the multiprocessing Queue 'queue' into the list 'results'.'''
+
+    if (queue is None): return
+    while True:
+        try:
+            results.append(queue.get(timeout=timeout))
+        except Empty:
+            break
+
+def available_memory():
+    '''Returns the memory (in GB) currently available for new processes on this node, or None if it
+    cannot be determined.'''
+
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if (line.startswith('MemAvailable:')):
+                    return float(line.split()[1])/1024.**2.
+    except (IOError, OSError):
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES')*os.sysconf('SC_PAGE_SIZE')/1024.**3.
+    except (ValueError, OSError, AttributeError):
+        return None
+
+def run_snapshots(target, outs, make_args=None, nproc=1, retries=2, mem_per_snap=0., manifest=None, \
+                  resume=False, tmp_dir=None, queue=None, results=None, poll_time=1.):
+    '''Runs the function 'target' once for each snapshot in the list 'outs'. 'make_args' is a function
+    that takes a snapshot name and returns the tuple of arguments to pass to 'target' for that
+    snapshot; if it is not given, 'target' is called with just the snapshot name.
+
+    If 'nproc' is 1, the snapshots are run one after another in this process, and a snapshot whose
+    'target' raises an exception is retried up to 'retries' more times. Otherwise, up to 'nproc'
+    snapshots are run at once, each in its own process, and the next snapshot in the queue is started
+    as soon as any running one finishes. If 'mem_per_snap' (in GB) is given, the memory available on
+    the node is checked before starting each snapshot, and a snapshot is only started if there is room
+    for 'mem_per_snap' more (after what the snapshots started in the same pass will use), or if no
+    other snapshot is running; otherwise it waits until a running one finishes or memory frees up. A snapshot whose process fails is retried up to 'retries' more
+    times. If 'tmp_dir' is given, a leftover directory 'tmp_dir' + snap from a failed process is
+    deleted before the snapshot is retried.
+
+    If 'manifest' is given, it is the name of a file where each snapshot is recorded once it has
+    finished. If 'resume' is True, snapshots already recorded in the manifest are skipped, otherwise
+    the manifest is started over.
+
+    If 'target' returns results by putting them on a multiprocessing Queue, pass the queue as 'queue'
+    and a list as 'results'. The queue is emptied into 'results' while snapshots are running, so no
+    process blocks on a full queue. A snapshot that is retried may put its results on the queue more
+    than once. Returns the list of snapshots that failed every attempt.'''
+
+    if (resume):
+        finished = read_manifest(manifest)
+        skipped = [snap for snap in outs if snap in finished]
+        if (len(skipped)>0):
+            print('Skipping %d snapshots already finished according to %s' % (len(skipped), manifest))
+        outs = [snap for snap in outs if snap not in finished]
+    elif (manifest is not None) and (os.path.exists(manifest)):
+        os.remove(manifest)
+    if (make_args is None):
+        make_args = lambda snap: (snap,)
+
+    if (nproc==1):
+        failed = []
+        for snap in outs:
+            for attempt in range(1, retries+2):
+                try:
+                    target(*make_args(snap))
+                except Exception as error:
+                    drain_queue(queue, results)
+                    print('Snapshot %s failed with %s on attempt %d' % (snap, repr(error), attempt))
+                    if (tmp_dir is not None) and (os.path.exists(tmp_dir + snap)):
+                        print('Deleting failed %s from %s' % (snap, tmp_dir))
+                        shutil.rmtree(tmp_dir + snap)
+                    continue
+                drain_queue(queue, results)
+                add_to_manifest(manifest, snap)
+                break
+            else:
+                failed.append(snap)
+        if (len(failed)>0):
+            print(str(datetime.datetime.now()))
+            print('These snapshots failed after %d attempts: %s' % (retries+1, ', '.join(failed)))
+        return failed
+
+    waiting = list(outs)
+    attempts = {}
+    running = {}
+    failed = []
+    held = False
+    while (len(waiting)>0) or (len(running)>0):
+        # Start new snapshots while there are free slots and, if 'mem_per_snap' is given, while the
+        # memory available now fits another snapshot besides the ones just started, which may not have
+        # used their memory yet
+        mem_avail = None
+        if (mem_per_snap > 0.) and (len(waiting)>0) and (len(running)<nproc):
+            mem_avail = available_memory()
+        started = 0
+        while (len(waiting)>0) and (len(running)<nproc):
+            if (mem_avail is not None) and (len(running)>0) and (mem_avail - started*mem_per_snap < mem_per_snap):
+                if not (held):
+                    print('Only %.1f GB of memory available, waiting to start more snapshots with %d running' % \
+                          (mem_avail - started*mem_per_snap, len(running)))
+                    held = True
+                break
+            held = False
+            started += 1
+            snap = waiting.pop(0)
+            attempts[snap] = attempts.get(snap, 0) + 1
+            process = multi.Process(target=target, args=make_args(snap))
+            process.start()
+            running[snap] = process
+
+        # Check for finished snapshots
+        if (queue is None):
+            time.sleep(poll_time)
+        else:
+            drain_queue(queue, results, timeout=poll_time)
+        for snap in list(running.keys()):
+            process = running[snap]
+            if (process.is_alive()): continue
+            process.join()
+            drain_queue(queue, results)
+            del running[snap]
+            if (process.exitcode==0):
+                add_to_manifest(manifest, snap)
+                continue
+            print('Snapshot %s failed with exit code %s on attempt %d' % (snap, str(process.exitcode), attempts[snap]))
+            if (tmp_dir is not None) and (os.path.exists(tmp_dir + snap)):
+                print('Deleting failed %s from %s' % (snap, tmp_dir))
+                shutil.rmtree(tmp_dir + snap)
+            if (attempts[snap] <= retries):
+                waiting.append(snap)
+            else:
+                failed.append(snap)
+
+    if (len(failed)>0):
+        print(str(datetime.datetime.now()))
+        print('These snapshots failed after %d attempts: %s' % (retries+1, ', '.join(failed)))
+
+    return failed
@@ -0,0 +1,173 @@
+"""
+Filename: structure_function.py
+This file contains functions for finding velocity structure functions (VSFs), the average velocity
+difference between pairs of points as a function of their separation, either on a uniform grid or
+for a list of AMR cells. It is used by:
+-turbulence/turbulence.py
+
+On a uniform grid, grid_structure_function finds the second-order structure function
+S2(l) = < |v(x+l) - v(x)|^2 > from FFT autocorrelations, which gives the sum over every pair of cells
+at every lag vector at once, instead of shifting the grid once per lag. The grid is zero-padded by the
+largest lag so it is not treated as periodic.
+
+For a list of cells, cell_structure_function finds the pairs of cells in each octave of separation
+with a cKDTree. For each octave, the tree is made from a random subsample of the cells that is as
+large as possible while keeping the number of pairs within the octave's largest separation under
+'max_pairs', so small separations use every cell and large separations use a random subset of them.
+
+Both take a dictionary of masks or weights, so the VSF of several phases or regions (for example,
+cold, cool, and hot gas) can be found in one call.
+"""
+
+from __future__ import print_function
+
+import numpy as np
+import scipy.fft
+from scipy.spatial import cKDTree
+
+def grid_structure_function(velocities, dx, sep_bins, masks=None, workers=-1):
+    '''Returns the second-order velocity structure function on a uniform grid in bins of separation.
+    'velocities' is a list of the arrays of each velocity component on the grid, 'dx' is the cell size,
+    and 'sep_bins' is the edges of the separation bins, in the same units as 'dx'. 'masks' is a
+    dictionary of name to a boolean mask or a non-negative weight for every cell of the grid; pairs of
+    cells are weighted by the product of their weights, so only pairs where both cells are in a mask are
+    counted. If 'masks' is None, every cell is used. Cells where any velocity is NaN are never used.
+    'workers' is the number of threads the FFTs can use.
+
+    Returns a dictionary of mask name to a tuple of (S2, npairs), where S2 is the mean of
+    |v(x+l) - v(x)|^2 over the pairs of cells in each separation bin (NaN if there are none) and
+    npairs is the summed weight of those pairs. Each pair is counted in both orders.'''
+
+    shape = np.array(velocities[0].shape)
+    finite = np.all([np.isfinite(v) for v in velocities], axis=0)
+    if (masks is None): masks = {'all': np.ones(tuple(shape))}
+
+    # Zero-pad by the largest lag so no pair wraps around the grid
+    max_lag = min(int(np.ceil(sep_bins[-1]/dx)), int(np.max(shape)))
+    fshape = [scipy.fft.next_fast_len(int(n) + max_lag, real=True) for n in shape]
+
+    # Separation of each lag vector and the bin it goes in
+    lags = []
+    for i in range(3):
+        lag = np.arange(fshape[i])
+        lag[lag > fshape[i]//2] -= fshape[i]
+        lags.append(lag)
+    sep = dx*np.sqrt(lags[0][:,None,None]**2. + lags[1][None,:,None]**2. + lags[2][None,None,:]**2.)
+    in_range = (np.abs(lags[0])[:,None,None] <= max_lag) & (np.abs(lags[1])[None,:,None] <= max_lag) & \
+               (np.abs(lags[2])[None,None,:] <= max_lag)
+    which_bin = np.searchsorted(sep_bins, sep, side='right') - 1
+    # The zero lag pairs each cell with itself, so it is never used
+    use = in_range & (sep > 0.) & (which_bin >= 0) & (which_bin < len(sep_bins)-1)
+    which_bin = which_bin[use]
+    n_bins = len(sep_bins) - 1
+
+    results = {}
+    for name in masks:
+        weight = np.where(finite, np.asarray(masks[name], dtype=float), 0.)
+        if not (np.any(weight > 0.)):
+            results[name] = (np.full(n_bins, np.nan), np.zeros(n_bins))
+            continue
+        w_ft = scipy.fft.rfftn(weight, s=fshape, workers=workers)
+        npairs = scipy.fft.irfftn(w_ft*np.conj(w_ft), s=fshape, workers=workers)
+        # sum over pairs of w w' |v' - v|^2 = sum w v^2 w' + sum w w' v'^2 - 2 sum (w v)(w' v'),
+        # all of which are correlations, summed over components before the inverse transform
+        dv2_ft = np.zeros(w_ft.shape, dtype=complex)
+        for v in velocities:
+            # S2 doesn't depend on the mean velocity; subtracting it keeps the difference precise
+            v = np.where(weight > 0., v - np.sum(weight*np.nan_to_num(v))/np.sum(weight), 0.)
+            v_ft = scipy.fft.rfftn(weight*v, s=fshape, workers=workers)
+            v2_ft = scipy.fft.rfftn(weight*v**2., s=fshape, workers=workers)
+            dv2_ft += 2.*(v2_ft*np.conj(w_ft)).real - 2.*(v_ft*np.conj(v_ft)).real
+        dv2 = scipy.fft.irfftn(dv2_ft, s=fshape, workers=workers)
+
+        npairs_bins = np.bincount(which_bin, weights=npairs[use], minlength=n_bins)
+        dv2_bins = np.bincount(which_bin, weights=dv2[use], minlength=n_bins)
+        # Round-off can leave tiny nonzero pair counts where there are no pairs
+        npairs_bins[npairs_bins < 0.5*np.min(weight[weight > 0.])**2.] = 0.
+        with np.errstate(invalid='ignore', divide='ignore'):
+            S2 = dv2_bins/npairs_bins
+        S2[npairs_bins==0.] = np.nan
+        results[name] = (S2, npairs_bins)
+
+    return results
+
+def cell_structure_function(positions, velocities, sep_bins, masks=None, weights=None, \
+                            max_pairs=10000000, seed=None):
+    '''Returns the first- and second-order velocity structure functions of a list of cells in bins of
+    separation. 'positions' and 'velocities' are (N, 3) arrays of the position and velocity of each
+    cell, and 'sep_bins' is the edges of the separation bins, in the same units as 'positions'.
+    'masks' is a dictionary of name to a boolean array picking out the cells to use (for example,
+    cells in a temperature range), or None to use every cell. 'weights' is an optional weight for each
+    cell (for example, mass); pairs are weighted by the product of the weights of the two cells.
+
+    The pairs in each octave of separation are found with a cKDTree of a random subsample of the cells
+    small enough that there are about 'max_pairs' pairs within the octave's largest separation, or of
+    all cells if there are fewer than that. 'seed' seeds the random subsamples.
+
+    Returns a dictionary of mask name to a tuple of (S1, S2, npairs), where S1 is the weighted mean of
+    |v' - v| and S2 the weighted mean of |v' - v|^2 over the pairs in each bin (NaN if there are none),
+    and npairs is the number of pairs used in each bin.'''
+
+    positions = np.asarray(positions, dtype=float)
+    velocities = np.asarray(velocities, dtype=float)
+    sep_bins = np.asarray(sep_bins, dtype=float)
+    if (masks is None): masks = {'all': np.ones(len(positions), dtype=bool)}
+    if (weights is None): weights = np.ones(len(positions))
+    rng = np.random.default_rng(seed)
+    n_bins = len(sep_bins) - 1
+
+    # Group the separation bins into octaves
+    sep_max = sep_bins[1:]
+    octave = np.floor(np.log2(sep_max/sep_max[0])).astype(int)
+    octave_edges = [np.flatnonzero(octave==o) for o in np.unique(octave)]
+
+    results = {}
+    for name in masks:
+        cells = np.flatnonzero(np.asarray(masks[name], dtype=bool) & np.all(np.isfinite(velocities), axis=1))
+        sum_w = np.zeros(n_bins)
+        sum_dv = np.zeros(n_bins)
+        sum_dv2 = np.zeros(n_bins)
+        npairs = np.zeros(n_bins, dtype=int)
+        if (len(cells) < 2):
+            results[name] = (np.full(n_bins, np.nan), np.full(n_bins, np.nan), npairs)
+            continue
+
+        # Fraction of all pairs of cells closer than each separation, from a random set of pairs
+        test_A = rng.integers(0, len(cells), 100000)
+        test_B = rng.integers(0, len(cells), 100000)
+        test_sep = np.sqrt(np.sum((positions[cells[test_A]] - positions[cells[test_B]])**2., axis=1))
+        test_sep = np.sort(test_sep[test_A != test_B])
+
+        for bins in octave_edges:
+            r_lo, r_hi = sep_bins[bins[0]], sep_bins[bins[-1]+1]
+            frac = max(np.searchsorted(test_sep, r_hi, side='right'), 1)/float(max(len(test_sep), 1))
+            n_sample = int(min(len(cells), np.sqrt(2.*max_pairs/frac)))
+            if (n_sample < len(cells)):
+                sample = cells[rng.choice(len(cells), n_sample, replace=False)]
+            else:
+                sample = cells
+            tree = cKDTree(positions[sample])
+            pairs = tree.query_pairs(r_hi, output_type='ndarray')
+            if (len(pairs)==0): continue
+            A, B = sample[pairs[:,0]], sample[pairs[:,1]]
+            sep = np.sqrt(np.sum((positions[A] - positions[B])**2., axis=1))
+            keep = sep >= r_lo
+            A, B, sep = A[keep], B[keep], sep[keep]
+            which_bin = np.searchsorted(sep_bins, sep, side='right') - 1
+            keep = (which_bin >= bins[0]) & (which_bin <= bins[-1])
+            A, B, which_bin = A[keep], B[keep], which_bin[keep]
+            w = weights[A]*weights[B]
+            dv2 = np.sum((velocities[A] - velocities[B])**2., axis=1)
+            sum_w += np.bincount(which_bin, weights=w, minlength=n_bins)
+            sum_dv += np.bincount(which_bin, weights=w*np.sqrt(dv2), minlength=n_bins)
+            sum_dv2 += np.bincount(which_bin, weights=w*dv2, minlength=n_bins)
+            npairs += np.bincount(which_bin, minlength=n_bins)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            S1 = sum_dv/sum_w
+            S2 = sum_dv2/sum_w
+        S1[npairs==0] = np.nan
+        S2[npairs==0] = np.nan
+        results[name] = (S1, S2, npairs)
+
+    return results
@@ -0,0 +1,236 @@
+"""
+Filename: tiled_grid.py
+This file contains functions for building a covering grid too large to fit in memory (for example, a
+3 Rvir box at level 10 or 11) one block at a time, and running kernels (smoothing, gradients, mask
+dilation, and binning) over it block by block. It is used by:
+-flux_tracking/accretion.py
+-turbulence/turbulence.py
+-pressure_support/pressure_support.py
+
+The grid is split into cubic tiles of 'tile_size' cells on a side. Each tile is made as its own
+covering grid, padded on every side by as many ghost cells as the kernels need (for example, 4 sigma
+for a Gaussian smoothing or 'iterations' cells for a binary dilation), so the kernels give the same
+result in each tile's interior as they would on the whole grid. Only one padded tile is in memory at
+a time; full-size results are written into memory-mapped .npy files and binned results (reductions)
+are summed tile by tile and saved after every tile, so peak memory depends on the tile size and not on
+the size of the whole grid.
+
+If the fields of the grid are saved with 'cache_dir', they are written in the same format and
+location as utils/grid_cache.py uses, so cached_covering_grid can read them back afterwards as if the
+whole grid had been made at once.
+
+Kernels are functions that take 'data', a dictionary of field name to the numpy array of that field in
+the padded tile, and 'inner', the tuple of slices that picks out the tile's interior from the padded
+arrays, and return a dictionary of result name to array. A result the same shape as the tile's
+interior is written into the full-size output of that name; any other result is added to the running
+total of that name. Each kernel has an attribute 'ghost_zones' giving the padding it needs.
+"""
+
+from __future__ import print_function
+
+import numpy as np
+import os
+from scipy import ndimage
+from scipy.ndimage import gaussian_filter
+from foggie.utils.grid_cache import CachedCoveringGrid
+
+def tile_slices(dims, tile_size, ghost_zones=0):
+    '''Returns a list of the tiles that cover a grid of shape 'dims' with cubes of side 'tile_size'.
+    Each tile is a tuple of (outer, inner, local), where 'outer' is the slices of the padded tile
+    in the full grid (ghost cells outside the grid are dropped), 'inner' is the slices of the tile's
+    interior in the full grid, and 'local' is the slices of the interior within the padded tile.'''
+
+    starts = [range(0, dims[i], tile_size) for i in range(3)]
+    tiles = []
+    for i0 in starts[0]:
+        for j0 in starts[1]:
+            for k0 in starts[2]:
+                outer, inner, local = [], [], []
+                for axis, start in enumerate([i0, j0, k0]):
+                    end = min(start + tile_size, dims[axis])
+                    outer_start = max(start - ghost_zones, 0)
+                    outer_end = min(end + ghost_zones, dims[axis])
+                    outer.append(slice(outer_start, outer_end))
+                    inner.append(slice(start, end))
+                    local.append(slice(start - outer_start, end - outer_start))
+                tiles.append((tuple(outer), tuple(inner), tuple(local)))
+
+    return tiles
+
+def gaussian_smoothing_kernel(name, field, sigma):
+    '''Returns a kernel that saves the field 'field' smoothed by a Gaussian of width 'sigma' cells
+    as the result 'name'.'''
+
+    def kernel(data, inner):
+        return {name: gaussian_filter(data[field], sigma)[inner]}
+    kernel.ghost_zones = int(4.*sigma + 0.5)
+
+    return kernel
+
+def gradient_kernel(names, field, dx):
+    '''Returns a kernel that saves the x, y, and z components of the gradient of the field 'field' on
+    a grid with cell size 'dx' as the results named in the list 'names'.'''
+
+    def kernel(data, inner):
+        gradients = np.gradient(data[field], dx)
+        return {names[i]: gradients[i][inner] for i in range(3)}
+    kernel.ghost_zones = 1
+
+    return kernel
+
+def dilation_kernel(name, mask_function, iterations=1, structure=None):
+    '''Returns a kernel that saves the boolean mask returned by 'mask_function' (a function of the
+    dictionary of field arrays), dilated 'iterations' times by 'structure' (default all 26 neighbors),
+    as the result 'name'.'''
+
+    if (structure is None): structure = ndimage.generate_binary_structure(3,3)
+    def kernel(data, inner):
+        return {name: ndimage.binary_dilation(mask_function(data), structure=structure, iterations=iterations)[inner]}
+    kernel.ghost_zones = iterations * (np.max(structure.shape)//2)
+
+    return kernel
+
+def grid_left_edge(ds, level, left_edge, dims, num_ghost_zones=0):
+    '''Returns the left edge (in code_length) of the covering grid of 'ds' at refinement level 'level'
+    with left edge 'left_edge' and number of cells 'dims', lined up with the cells at this level the
+    same way ds.covering_grid lines it up, and the size of those cells (in code_length).'''
+
+    cache = CachedCoveringGrid(ds, level, left_edge, dims, 'none', num_ghost_zones=num_ghost_zones)
+    rdx = np.array(ds.domain_dimensions) * ds.relative_refinement(0, level)
+    dds = np.array(ds.domain_width.in_units('code_length'))/rdx
+
+    return np.array(ds.domain_left_edge.in_units('code_length')) + cache.start_index*dds, dds
+
+def covering_grid_tile(ds, level, left_edge, dims, slices, num_ghost_zones=0):
+    '''Returns the part 'slices' (a tuple of three slices with a start and stop) of the covering grid of
+    'ds' at refinement level 'level' with left edge 'left_edge' and number of cells 'dims' as its own
+    covering grid, so that only that part of the grid is made.'''
+
+    grid_left, dds = grid_left_edge(ds, level, left_edge, dims, num_ghost_zones=num_ghost_zones)
+    start = np.array([s.start for s in slices])
+    tile_dims = np.array([s.stop - s.start for s in slices])
+
+    return ds.covering_grid(level=level, left_edge=ds.arr(grid_left + start*dds, 'code_length'), \
+                            dims=tile_dims, num_ghost_zones=num_ghost_zones)
+
+def binning_kernel(name, bin_function, num_bins, weight_function):
+    '''Returns a kernel that sums the weights returned by 'weight_function' over the cells in each of
+    'num_bins' bins. 'bin_function' returns the integer bin of each cell, or -1 to leave it out, either
+    in the shape of the tile or with extra leading axes to put each cell in several bins at once (for
+    example, one bin for each of several shapes). 'weight_function' returns a dictionary of weight name
+    to an array of the shape of the tile. The sums are saved as the results name + '_' + weight name,
+    and the number of cells in each bin as name + '_count'. Both functions take the dictionary of field
+    arrays, already cut to the tile's interior.'''
+
+    def kernel(data, inner):
+        data = {field: data[field][inner] for field in data}
+        index = np.asarray(bin_function(data))
+        use = (index >= 0)
+        results = {name + '_count': np.bincount(index[use], minlength=num_bins).astype(float)}
+        weights = weight_function(data)
+        for weight_name in weights:
+            results[name + '_' + weight_name] = np.bincount(index[use], \
+              weights=np.broadcast_to(weights[weight_name], index.shape)[use], minlength=num_bins)
+        return results
+    kernel.ghost_zones = 0
+
+    return kernel
+
+def tiled_covering_grid(ds, level, left_edge, dims, fields, kernels=[], tile_size=128, cache_dir=None, \
+                        out_dir=None, num_ghost_zones=0, grid=None):
+    '''Builds the covering grid of 'ds' at refinement level 'level' with left edge 'left_edge' and
+    number of cells 'dims' in tiles of 'tile_size' cells on a side, and runs each of the 'kernels' on
+    every tile. 'fields' is a dictionary of the fields to take from each tile to the units to put them
+    in; the kernels see them as numpy arrays in those units, keyed by the same field names.
+
+    If 'cache_dir' is given, the fields are also saved there as the full grid, in the same way
+    cached_covering_grid saves them, so cached_covering_grid(ds, level, left_edge, dims, cache_dir)
+    reads them back afterwards without making the whole grid.
+
+    Returns a dictionary of result name to the full-size output arrays of the kernels and the summed
+    binned results. If 'out_dir' is given, the full-size outputs are memory-mapped .npy files named
+    after each result in 'out_dir', and the binned results are saved in 'out_dir' + 'reductions.npz'
+    after every tile; otherwise they are kept in memory.
+
+    If 'grid' is given, it is a covering grid (or cached_covering_grid) of this size that already has the
+    fields, for example one made in tiles by an earlier call and read back from the cache, and each
+    tile is cut out of it rather than made from 'ds' again. 'left_edge' is then only used if
+    'cache_dir' is given.'''
+
+    dims = np.array(dims, dtype='int64')
+    ghost_zones = max([0] + [kernel.ghost_zones for kernel in kernels])
+    tiles = tile_slices(dims, tile_size, ghost_zones=ghost_zones)
+
+    if (cache_dir is not None):
+        cache = CachedCoveringGrid(ds, level, left_edge, dims, cache_dir, num_ghost_zones=num_ghost_zones)
+    if (grid is None):
+        # Line up the tiles with the cells at this level, the same way the whole covering grid would be
+        grid_left, dds = grid_left_edge(ds, level, left_edge, dims, num_ghost_zones=num_ghost_zones)
+
+    if (out_dir is not None) and not (os.path.exists(out_dir)): os.makedirs(out_dir, exist_ok=True)
+    if (cache_dir is not None) and not (os.path.exists(cache.grid_dir)): os.makedirs(cache.grid_dir, exist_ok=True)
+    pid = str(os.getpid())
+    saved_fields = {}
+    field_units = {}
+    outputs = {}
+    reductions = {}
+    for t in range(len(tiles)):
+        outer, inner, local = tiles[t]
+        outer_start = np.array([s.start for s in outer])
+        outer_dims = np.array([s.stop - s.start for s in outer])
+        if (grid is None):
+            tile = ds.covering_grid(level=level, left_edge=ds.arr(grid_left + outer_start*dds, 'code_length'), \
+                                    dims=outer_dims, num_ghost_zones=num_ghost_zones)
+        else:
+            # Fields memory-mapped from the cache are only read where they are cut
+            tile = {field: grid[field][outer] for field in fields}
+        data = {}
+        for field in fields:
+            values = tile[field].in_units(fields[field])
+            data[field] = values.v
+            if (cache_dir is not None):
+                if (field not in saved_fields):
+                    ftype, fname = ds._get_field_info(field).name
+                    base = os.path.join(cache.grid_dir, ftype + '-' + fname)
+                    saved_fields[field] = (base, np.lib.format.open_memmap(base + '.tmp' + pid + '.npy', \
+                      mode='w+', dtype=values.dtype, shape=tuple(dims)))
+                    field_units[field] = str(values.units)
+                saved_fields[field][1][inner] = values.v[local]
+        del tile
+
+        for kernel in kernels:
+            results = kernel(data, local)
+            for name in results:
+                result = np.asarray(results[name])
+                tile_shape = tuple([s.stop - s.start for s in inner])
+                if (result.shape==tile_shape):
+                    if (name not in outputs):
+                        if (out_dir is not None):
+                            outputs[name] = np.lib.format.open_memmap(os.path.join(out_dir, name + '.npy'), \
+                              mode='w+', dtype=result.dtype, shape=tuple(dims))
+                        else:
+                            outputs[name] = np.zeros(tuple(dims), dtype=result.dtype)
+                    outputs[name][inner] = result
+                elif (name in reductions):
+                    reductions[name] += result
+                else:
+                    reductions[name] = np.array(result, dtype=float)
+        if (out_dir is not None):
+            for name in outputs: outputs[name].flush()
+            if (len(reductions)>0):
+                np.savez(os.path.join(out_dir, 'reductions.tmp' + pid + '.npz'), tiles_done=t+1, **reductions)
+                os.replace(os.path.join(out_dir, 'reductions.tmp' + pid + '.npz'), os.path.join(out_dir, 'reductions.npz'))
+        print('Finished tile %d of %d' % (t+1, len(tiles)))
+
+    # Move the saved fields into place only once they are complete, units file last, so
+    # cached_covering_grid never reads a partly-written field
+    for field in saved_fields:
+        base, values = saved_fields[field]
+        values.flush()
+        os.replace(base + '.tmp' + pid + '.npy', base + '.npy')
+        with open(base + '.units.tmp' + pid, 'w') as f:
+            f.write(field_units[field])
+        os.replace(base + '.units.tmp' + pid, base + '.units')
+
+    outputs.update(reductions)
+    return outputs
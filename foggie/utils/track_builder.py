@@ -0,0 +1,104 @@
+"""
+Filename: track_builder.py
+This file contains functions for building halo tracks (the center of a halo in each of a list of
+snapshots) that can be stopped and resumed at any point. It is used by:
+-halo_analysis/get_center_track.py
+-utils/get_halo_c_v_parallel.py
+
+The result for each snapshot is appended to a plain-text log file as soon as it is found, one line
+per snapshot, so a run that crashes or is killed loses at most the snapshot it was working on and
+picks up from the log when it is run again. The final tables are written from the log at the end.
+
+build_track runs through the snapshots in order when each snapshot's center guess comes from the
+previous snapshot's center. While one snapshot is being centered, the next one is opened and its
+particles are read in a background thread, so reading from disk overlaps with the centering.
+"""
+
+from __future__ import print_function
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+def read_track_log(log_file):
+    '''Returns the list of column names and a dictionary of snapshot name to the list of values
+    recorded in the track log 'log_file', or an empty list and dictionary if it does not exist. If a
+    snapshot is in the log more than once, its last line is used.'''
+
+    columns = []
+    rows = {}
+    if (log_file is None) or (not os.path.exists(log_file)):
+        return columns, rows
+    with open(log_file, 'r') as f:
+        for line in f:
+            if (line.startswith('#')):
+                columns = line[1:].split()[1:]
+                continue
+            words = line.split()
+            # A line cut off by a crash is skipped
+            if (len(words)!=len(columns)+1): continue
+            try:
+                rows[words[0]] = [float(w) for w in words[1:]]
+            except ValueError:
+                continue
+
+    return columns, rows
+
+def append_track_log(log_file, columns, snap, values):
+    '''Appends the line for snapshot 'snap' with the list of 'values' (one for each name in 'columns')
+    to the track log 'log_file', starting it with a header of the column names if it is new.'''
+
+    line = snap + ' ' + ' '.join(['%.17g' % (float(v)) for v in values]) + '\n'
+    new = (not os.path.exists(log_file)) or (os.path.getsize(log_file)==0)
+    with open(log_file, 'a') as f:
+        if (new): f.write('# name ' + ' '.join(columns) + '\n')
+        f.write(line)
+        f.flush()
+        os.fsync(f.fileno())
+
+def build_track(snaps, load_snapshot, find_center, center_guess, log_file, columns, center_columns):
+    '''Finds the center of the halo in each snapshot in the list 'snaps', in order, starting from
+    'center_guess' and using each snapshot's center as the guess for the next.
+
+    'load_snapshot' is a function that takes a snapshot name and a center guess and returns whatever
+    'find_center' needs from that snapshot (for example, the dataset and its particles near the guess).
+    It is run in a background thread for the next snapshot while the current one is centered, with the
+    center guess known at that time (the center of the snapshot before the current one), so it should
+    read a region large enough to hold the halo's center in the next snapshot.
+
+    'find_center' is a function that takes a snapshot name, what 'load_snapshot' returned for it, and
+    the center guess, and returns the list of values to record in the log (one for each name in
+    'columns'). The names in 'center_columns' are the columns that hold the center.
+
+    Each snapshot's values are appended to the log 'log_file' as soon as they are found, and snapshots
+    already in the log are skipped, with the center guess taken from the log. Returns the dictionary of
+    snapshot name to values for every snapshot in the log.'''
+
+    logged_columns, done = read_track_log(log_file)
+    if (len(logged_columns)>0) and (logged_columns!=list(columns)):
+        raise ValueError('Track log %s has columns %s, not %s' % (log_file, str(logged_columns), str(list(columns))))
+    center_index = [list(columns).index(c) for c in center_columns]
+
+    # Snapshots already done only update the guess, from the last one done before the first left to do
+    todo = []
+    for snap in snaps:
+        if (snap in done):
+            if (len(todo)==0): center_guess = [done[snap][i] for i in center_index]
+        else:
+            todo.append(snap)
+    if (len(todo)<len(snaps)):
+        print('Skipping %d snapshots already in %s' % (len(snaps)-len(todo), log_file))
+    if (len(todo)==0): return done
+
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        loading = pool.submit(load_snapshot, todo[0], center_guess)
+        for i in range(len(todo)):
+            data = loading.result()
+            if (i+1 < len(todo)):
+                loading = pool.submit(load_snapshot, todo[i+1], center_guess)
+            values = find_center(todo[i], data, center_guess)
+            append_track_log(log_file, columns, todo[i], values)
+            done[todo[i]] = values
+            center_guess = [values[j] for j in center_index]
+            del data
+
+    return done